@@ -0,0 +1,105 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Compare the cost of looking up the boot device of a large domain
+
+Usage: python tools/benchmark_boot_device.py [--devices N] [--number N]
+
+Builds a domain XML description with many disks, NICs and PCI host
+devices and times, per lookup:
+
+* a full parse of the XML (what `get_boot_device` used to do)
+* the incremental parse stopping at the `<os>` element
+* a cache hit, as served while libvirt domain events are flowing
+"""
+
+import argparse
+import timeit
+import xml.etree.ElementTree as ET
+
+from virtualbmc import vbmc
+
+DOMAIN_HEAD = """\
+<domain type='kvm'>
+  <name>benchmark</name>
+  <uuid>c7a5fdbd-cdaf-9455-926a-d65c16db1809</uuid>
+  <memory unit='KiB'>4194304</memory>
+  <vcpu placement='static'>4</vcpu>
+  <os>
+    <type arch='x86_64' machine='pc-q35-6.2'>hvm</type>
+    <boot dev='network'/>
+    <bootmenu enable='no'/>
+    <bios useserial='yes'/>
+  </os>
+  <devices>
+"""
+
+DEVICES = """\
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='qcow2' cache='none' io='native'/>
+      <source file='/var/lib/libvirt/images/disk%(i)d.qcow2'/>
+      <target dev='vd%(i)d' bus='virtio'/>
+      <address type='pci' domain='0x0000' bus='0x%(i)02x' slot='0x00'/>
+    </disk>
+    <interface type='network'>
+      <mac address='52:54:00:00:00:%(i)02x'/>
+      <source network='net%(i)d'/>
+      <model type='virtio'/>
+      <address type='pci' domain='0x0000' bus='0x%(i)02x' slot='0x01'/>
+    </interface>
+    <hostdev mode='subsystem' type='pci' managed='yes'>
+      <source>
+        <address domain='0x0000' bus='0x%(i)02x' slot='0x00' function='0'/>
+      </source>
+    </hostdev>
+"""
+
+DOMAIN_TAIL = """\
+  </devices>
+</domain>
+"""
+
+
+def full_parse(domain_xml):
+    boot_element = ET.fromstring(domain_xml).find('.//os/boot')
+    return boot_element is not None and boot_element.attrib.get('dev')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--devices', type=int, default=64,
+                        help='Number of disk/NIC/host device triplets')
+    parser.add_argument('--number', type=int, default=2000,
+                        help='Number of lookups to time')
+    args = parser.parse_args()
+
+    domain_xml = (DOMAIN_HEAD
+                  + ''.join(DEVICES % {'i': i} for i in range(args.devices))
+                  + DOMAIN_TAIL)
+    cache = {'boot_settings': vbmc.parse_boot_settings(domain_xml)}
+
+    cases = [
+        ('full parse', lambda: full_parse(domain_xml)),
+        ('incremental parse',
+         lambda: vbmc.parse_boot_settings(domain_xml)['boot_dev']),
+        ('cached', lambda: cache['boot_settings']['boot_dev']),
+    ]
+
+    print('domain XML: %d bytes' % len(domain_xml))
+    for name, func in cases:
+        elapsed = min(timeit.repeat(func, number=args.number, repeat=3))
+        print('%-20s %10.2f us/lookup' % (name,
+                                          elapsed / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
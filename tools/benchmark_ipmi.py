@@ -0,0 +1,386 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Measure the IPMI request throughput and latency vBMCs sustain
+
+Usage: python tools/benchmark_ipmi.py [--bmcs N,N,...] [--clients N]
+                                      [--duration SECONDS] [--output FILE]
+
+For each BMC count, starts that many vBMCs in a single process, the
+way a vbmcd worker hosts them, each backed by its own copy of a domain
+of libvirt's test driver. Client processes then each open one RMCP+
+session per BMC and keep every session busy with the command mix for
+the given duration. With `--target`, BMCs already served by a running
+vbmcd get measured instead.
+
+Throughput and the p50/p99/p999 latencies are reported per command and
+per BMC count as JSON, along with the vBMC version, so that the reports
+of two versions can be compared. A summary goes to stderr.
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import math
+import multiprocessing
+import platform
+import signal
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from pyghmi.ipmi import command as ipmicommand
+from pyghmi.ipmi.private import session as ipmisession
+
+import virtualbmc
+from virtualbmc import config as vbmc_config
+
+# IPMI request (netfn, command, data) of each command. pyghmi queries
+# the power state through the chassis status too.
+COMMANDS = {
+    'chassis_status': (0x00, 0x01, ()),
+    'get_boot_device': (0x00, 0x09, (0x05, 0x00, 0x00)),
+    # Persistent boot from PXE, then from disk
+    'set_boot_device': [(0x00, 0x08, (0x05, 0xc0, 0x04, 0x00, 0x00, 0x00)),
+                        (0x00, 0x08, (0x05, 0xc0, 0x08, 0x00, 0x00, 0x00))],
+    'power_on': (0x00, 0x02, (0x01,)),
+    'power_off': (0x00, 0x02, (0x00,)),
+    'power_reset': (0x00, 0x02, (0x03,)),
+}
+
+DEFAULT_COMMANDS = ('chassis_status', 'get_boot_device', 'set_boot_device',
+                    'power_on', 'power_off')
+
+DOMAIN_PREFIX = 'vbmc-benchmark-'
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def define_domains(uri, template, count):
+    """Define and start copies of a test driver domain"""
+    import libvirt
+
+    conn = libvirt.open(uri)
+    domain_xml = conn.lookupByName(template).XMLDesc()
+    names = []
+    for i in range(count):
+        root = ET.fromstring(domain_xml)
+        root.find('name').text = name = '%s%d' % (DOMAIN_PREFIX, i)
+        uuid = root.find('uuid')
+        if uuid is not None:
+            root.remove(uuid)
+        domain = conn.defineXML(ET.tostring(root, encoding='unicode'))
+        domain.create()
+        names.append(name)
+
+    # The test driver state lives as long as a connection to it does
+    return conn, names
+
+
+def serve(args, count, conn):
+    """Host the BMCs until the parent goes away"""
+    from virtualbmc.vbmc import VirtualBMC
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if args.backend == 'fake':
+        vbmc_config.get_config()['default']['backend'] = 'fake'
+        names = ['%s%d' % (DOMAIN_PREFIX, i) for i in range(count)]
+    else:
+        libvirt_conn, names = define_domains(args.libvirt_uri, args.domain,
+                                             count)
+
+    # pyghmi wakes up its I/O thread through the first socket it has
+    # ever opened, see virtualbmc.engine
+    ipmisession.Session._assignsocket()
+
+    bmcs = [VirtualBMC(username=args.username, password=args.password,
+                       port=args.port + i, address=args.address,
+                       domain_name=name, libvirt_uri=args.libvirt_uri)
+            for i, name in enumerate(names)]
+    conn.send(len(bmcs))
+
+    while not conn.poll(0):
+        ipmisession.Session.wait_for_rsp(timeout=0.5)
+
+    for bmc in bmcs:
+        bmc.close()
+
+
+def use_cipher_suite_3():
+    """Have pyghmi clients open sessions with cipher suite 3
+
+    pyghmi BMCs, vBMCs included, only implement cipher suite 3 (SHA-1)
+    yet do not reject the SHA-256 one pyghmi clients first ask for.
+    """
+    open_request = ipmisession.Session._open_rmcpplus_request
+
+    def _open_rmcpplus_request(self):
+        self.attemptedhash = 1
+        open_request(self)
+
+    ipmisession.Session._open_rmcpplus_request = _open_rmcpplus_request
+
+
+def drive(args, targets, barrier, results):
+    """Keep one RMCP+ session per target busy until the time is up
+
+    Requests go out asynchronously and responses are handled off a
+    single pyghmi event loop, like a vbmcd worker does on the BMC side.
+    Blocking pyghmi calls may stall until their retry timer fires even
+    though the response is in, which would be measured as BMC latency.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    use_cipher_suite_3()
+    # See virtualbmc.engine
+    ipmisession.Session._assignsocket()
+
+    try:
+        sessions = [ipmicommand.Command(bmc=address, userid=args.username,
+                                        password=args.password,
+                                        port=port).ipmi_session
+                    for address, port in targets]
+
+    except Exception as e:
+        results.put(e)
+        barrier.abort()
+        return
+
+    latencies = {name: [] for name in args.commands}
+    errors = {name: 0 for name in args.commands}
+    # Sessions ready for their next request, along with its turn
+    ready = collections.deque()
+
+    def send(session, turn):
+        name = args.commands[turn % len(args.commands)]
+        request = COMMANDS[name]
+        if isinstance(request, list):
+            request = request[turn // len(args.commands) % len(request)]
+        netfn, command, data = request
+
+        def got_response(rsp):
+            # Left to asynchronous callers by pyghmi
+            session.incommand = False
+            while session.evq:
+                session.evq.popleft().set()
+
+            if 'error' in rsp or rsp.get('code'):
+                errors[name] += 1
+            else:
+                latencies[name].append(time.perf_counter() - start)
+            ready.append((session, turn + 1))
+
+        start = time.perf_counter()
+        try:
+            session.raw_command(netfn=netfn, command=command, data=data,
+                                callback=got_response)
+        except Exception:
+            # The session is gone, so is its share of the load
+            errors[name] += 1
+
+    barrier.wait()
+    deadline = time.monotonic() + args.duration
+    ready.extend((session, 0) for session in sessions)
+
+    while time.monotonic() < deadline:
+        # Not from the callbacks, pyghmi is not done with the previous
+        # request of the session by then
+        while ready:
+            send(*ready.popleft())
+
+        ipmisession.Session.wait_for_rsp(timeout=0.1)
+
+    results.put((latencies, errors))
+
+
+def to_ms(seconds):
+    return None if seconds is None else round(seconds * 1e3, 3)
+
+
+def summarize(latencies, errors, duration):
+    values = sorted(latencies)
+    return {
+        'requests': len(values),
+        'errors': errors,
+        'throughput': round(len(values) / duration, 1),
+        'mean_ms': to_ms(sum(values) / len(values) if values else None),
+        'p50_ms': to_ms(percentile(values, 0.5)),
+        'p99_ms': to_ms(percentile(values, 0.99)),
+        'p999_ms': to_ms(percentile(values, 0.999)),
+    }
+
+
+def run_step(args, targets):
+    barrier = multiprocessing.Barrier(args.clients + 1)
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=drive,
+                                       args=(args, targets, barrier, results))
+               for _ in range(args.clients)]
+    for client in clients:
+        client.start()
+
+    try:
+        # Everybody is logged in
+        barrier.wait(timeout=args.login_timeout)
+
+    except threading.BrokenBarrierError:
+        for client in clients:
+            client.terminate()
+        error = 'timed out' if results.empty() else results.get()
+        sys.exit('Failed to log into the BMCs: %s' % error)
+
+    latencies = {name: [] for name in args.commands}
+    errors = {name: 0 for name in args.commands}
+    for _ in clients:
+        client_latencies, client_errors = results.get()
+        for name in args.commands:
+            latencies[name].extend(client_latencies[name])
+            errors[name] += client_errors[name]
+
+    for client in clients:
+        client.join()
+
+    commands = {name: summarize(latencies[name], errors[name],
+                                args.duration)
+                for name in args.commands}
+    total = summarize(itertools.chain(*latencies.values()),
+                      sum(errors.values()), args.duration)
+
+    return dict(total, bmcs=len(targets), clients=args.clients,
+                sessions=len(targets) * args.clients, commands=commands)
+
+
+def start_server(args, count):
+    conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve,
+                                     args=(args, count, child_conn))
+    server.start()
+
+    while not conn.poll(0.1):
+        if not server.is_alive():
+            sys.exit('vBMCs failed to start')
+    conn.recv()
+
+    return server, conn
+
+
+def print_step(step):
+    sys.stderr.write('%d BMC(s), %d session(s): %.1f requests/s, '
+                     '%d error(s)\n' % (step['bmcs'], step['sessions'],
+                                        step['throughput'], step['errors']))
+    for name, result in step['commands'].items():
+        sys.stderr.write('  %-16s %9.1f/s  p50 %s ms  p99 %s ms  '
+                         'p999 %s ms\n' % (name, result['throughput'],
+                                           result['p50_ms'],
+                                           result['p99_ms'],
+                                           result['p999_ms']))
+
+
+def parse_target(value):
+    address, _, port = value.rpartition(':')
+    return address or '127.0.0.1', int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--bmcs', default='1,10,50',
+                        help='Comma-separated BMC counts to measure')
+    parser.add_argument('--clients', type=int, default=4,
+                        help='Client processes, each opening one session '
+                             'per BMC')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds to measure each BMC count for')
+    parser.add_argument('--commands', default=','.join(DEFAULT_COMMANDS),
+                        help='Comma-separated commands to send in turn, '
+                             'out of %s' % ', '.join(sorted(COMMANDS)))
+    parser.add_argument('--backend', choices=('libvirt', 'fake'),
+                        default='libvirt',
+                        help='Backend of the vBMCs, the fake one leaves '
+                             'libvirt out of the measurement')
+    parser.add_argument('--libvirt-uri', default='test:///default',
+                        help='libvirt test driver URI')
+    parser.add_argument('--domain', default='test',
+                        help='Test driver domain the BMC domains are '
+                             'copies of')
+    parser.add_argument('--address', default='127.0.0.1',
+                        help='Address the vBMCs listen on')
+    parser.add_argument('--port', type=int, default=16230,
+                        help='Port of the first vBMC, the next ones '
+                             'listen on the following ports')
+    parser.add_argument('--target', action='append', type=parse_target,
+                        metavar='[ADDRESS:]PORT',
+                        help='Measure an already running BMC rather than '
+                             'starting any, may be repeated')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--login-timeout', type=float, default=120,
+                        help='Seconds to wait for the BMCs to start and '
+                             'the clients to log in')
+    parser.add_argument('--output', help='Write the JSON report to this '
+                                         'file rather than to stdout')
+    args = parser.parse_args()
+
+    args.commands = args.commands.split(',')
+    unknown = set(args.commands) - set(COMMANDS)
+    if unknown:
+        parser.error('unknown commands: %s' % ', '.join(sorted(unknown)))
+
+    if (args.backend == 'libvirt' and not args.target
+            and not args.libvirt_uri.startswith('test:')):
+        parser.error('domains are only defined on the libvirt test driver')
+
+    report = {
+        'version': virtualbmc.__version__,
+        'python': platform.python_version(),
+        'backend': None if args.target else args.backend,
+        'clients': args.clients,
+        'duration': args.duration,
+        'commands': args.commands,
+        'steps': [],
+    }
+
+    if args.target:
+        step = run_step(args, args.target)
+        print_step(step)
+        report['steps'].append(step)
+
+    else:
+        for count in [int(count) for count in args.bmcs.split(',')]:
+            server, conn = start_server(args, count)
+            try:
+                targets = [(args.address, args.port + i)
+                           for i in range(count)]
+                step = run_step(args, targets)
+            finally:
+                conn.send(None)
+                server.join()
+
+            print_step(step)
+            report['steps'].append(step)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Measure how the resource usage of vbmcd grows with its BMCs
+
+Usage: python tools/benchmark_scale.py [--steps N,N,...] [--settle SECONDS]
+                                       [--option SECTION.KEY=VALUE]
+                                       [--output FILE]
+
+Stands in for vbmcd: a vBMC manager runs in this process, configured
+from a scratch directory, and acts upon domains of the libvirt test
+driver defined here beforehand. At each step, BMCs are added and started
+through the manager until there are that many, then left idle for a
+while. All along, the RSS, PSS and CPU time of this process and all of
+its children are sampled off /proc.
+
+For each step, the JSON report gives the memory overhead per BMC, the
+rate BMCs got added and spawned at, the CPU time spent while idle and
+how long a full reconciliation pass over all BMCs takes. The samples
+follow. A summary goes to stderr.
+
+Test driver domains are only known to the process defining them and to
+the processes it forks, BMCs must be started with the "fork" method.
+"""
+
+import argparse
+import configparser
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import virtualbmc
+
+DOMAIN_PREFIX = 'vbmc-scale-'
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+MIB = 1024 * 1024
+
+
+def read_stat(pid):
+    """Fields of /proc/<pid>/stat following the command name"""
+    with open('/proc/%s/stat' % pid) as f:
+        stat = f.read()
+    # The command name may contain spaces and parentheses
+    return stat[stat.rindex(')') + 2:].split()
+
+
+def process_tree(root_pid):
+    """PIDs of a process and all of its descendants"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            ppid = int(read_stat(entry)[1])
+        except OSError:
+            # Gone meanwhile
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = [root_pid]
+    for pid in pids:
+        pids.extend(children.get(pid, ()))
+    return pids
+
+
+def read_usage(pid):
+    """RSS and PSS bytes and CPU seconds of a process
+
+    CPU time includes that of the children it has reaped, so that the
+    CPU time of exited processes is not lost.
+    """
+    fields = read_stat(pid)
+    cpu = sum(int(value) for value in fields[11:15]) / CLOCK_TICKS
+
+    with open('/proc/%d/statm' % pid) as f:
+        rss = int(f.read().split()[1]) * PAGE_SIZE
+
+    pss = None
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    pss = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        # Linux < 4.14
+        pass
+
+    return rss, pss, cpu
+
+
+class Sampler(threading.Thread):
+    """Sample the resource usage of this process and its descendants
+
+    The CPU time spent sampling is left out of the samples.
+
+    :param interval: seconds between samples
+    """
+
+    def __init__(self, interval):
+        super(Sampler, self).__init__(daemon=True)
+        self.interval = interval
+        self.samples = []
+        # Reported along with the samples
+        self.bmcs = 0
+        self._lock = threading.Lock()
+        self._own_cpu = 0
+        self._started_at = time.monotonic()
+        self._stopped = threading.Event()
+
+    def sample(self):
+        started = time.thread_time()
+        processes = rss = cpu = 0
+        pss = []
+
+        for pid in process_tree(os.getpid()):
+            try:
+                usage = read_usage(pid)
+            except OSError:
+                continue
+            processes += 1
+            rss += usage[0]
+            pss.append(usage[1])
+            cpu += usage[2]
+
+        with self._lock:
+            sample = {
+                'time': round(time.monotonic() - self._started_at, 3),
+                'bmcs': self.bmcs,
+                'processes': processes,
+                'rss_bytes': rss,
+                'pss_bytes': None if None in pss else sum(pss),
+                'cpu_seconds': round(cpu - self._own_cpu, 3),
+            }
+            self._own_cpu += time.thread_time() - started
+            self.samples.append(sample)
+
+        return sample
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def write_config(work_dir, options):
+    config_dir = os.path.join(work_dir, 'bmcs')
+    os.mkdir(config_dir)
+
+    config = configparser.ConfigParser()
+    config['default'] = {
+        'config_dir': config_dir,
+        'pid_file': os.path.join(work_dir, 'master.pid'),
+    }
+    config['log'] = {'logfile': os.path.join(work_dir, 'vbmcd.log')}
+
+    for section, key, value in options:
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, key, value)
+
+    path = os.path.join(work_dir, 'virtualbmc.conf')
+    with open(path, 'w') as f:
+        config.write(f)
+    return path
+
+
+def define_domains(uri, template, count):
+    """Define copies of a test driver domain"""
+    import libvirt
+
+    conn = libvirt.open(uri)
+    domain_xml = conn.lookupByName(template).XMLDesc()
+    for i in range(count):
+        root = ET.fromstring(domain_xml)
+        root.find('name').text = '%s%d' % (DOMAIN_PREFIX, i)
+        uuid = root.find('uuid')
+        if uuid is not None:
+            root.remove(uuid)
+        conn.defineXML(ET.tostring(root, encoding='unicode'))
+
+    # The test driver state lives as long as a connection to it does
+    return conn
+
+
+def per_bmc(value, baseline, bmcs):
+    if value is None or baseline is None:
+        return None
+    return round((value - baseline) / bmcs)
+
+
+def run_step(args, bmc_manager, sampler, baseline, count, target):
+    from virtualbmc import manager
+
+    domain_names = ['%s%d' % (DOMAIN_PREFIX, i) for i in range(count, target)]
+
+    started = time.monotonic()
+    for i, domain_name in enumerate(domain_names, count):
+        rc, msg = bmc_manager.add(
+            username='admin', password='password', port=args.port + i,
+            address=args.address, domain_name=domain_name,
+            libvirt_uri=args.libvirt_uri, libvirt_sasl_username=None,
+            libvirt_sasl_password=None)
+        if rc:
+            sys.exit('Failed to add a BMC for domain %s: %s'
+                     % (domain_name, msg))
+    add_seconds = time.monotonic() - started
+
+    sampler.bmcs = target
+    before = sampler.sample()
+    started = time.monotonic()
+    results = bmc_manager.start_many(domain_names)
+    start_seconds = time.monotonic() - started
+    after = sampler.sample()
+
+    time.sleep(args.settle)
+    idle = sampler.sample()
+
+    _, tables = bmc_manager.list()
+    running = sum(1 for table in tables
+                  if table['status'] == manager.RUNNING)
+
+    # What vbmcd goes through whenever the config store changes
+    started = time.monotonic()
+    bmc_manager._sync_vbmc_states()
+    reconcile_seconds = time.monotonic() - started
+
+    idle_seconds = max(idle['time'] - after['time'], 0.001)
+    # CPU times come in clock ticks and the sampling cost is estimated,
+    # do not let the noise go negative
+    idle_cpu = max(idle['cpu_seconds'] - after['cpu_seconds'],
+                   0) / idle_seconds
+
+    return {
+        'bmcs': target,
+        'running': running,
+        'start_errors': sum(1 for rc, _ in results.values() if rc),
+        'processes': idle['processes'],
+        'rss_bytes': idle['rss_bytes'],
+        'pss_bytes': idle['pss_bytes'],
+        'rss_per_bmc_bytes': per_bmc(idle['rss_bytes'],
+                                     baseline['rss_bytes'], target),
+        'pss_per_bmc_bytes': per_bmc(idle['pss_bytes'],
+                                     baseline['pss_bytes'], target),
+        'add_seconds': round(add_seconds, 3),
+        'add_rate': round(len(domain_names) / add_seconds, 1),
+        'start_seconds': round(start_seconds, 3),
+        'spawn_rate': round(len(domain_names) / start_seconds, 1),
+        'start_cpu_seconds': round(after['cpu_seconds']
+                                   - before['cpu_seconds'], 3),
+        'idle_cpu_percent': round(idle_cpu * 100, 2),
+        'idle_cpu_per_bmc_percent': round(idle_cpu * 100 / target, 4),
+        'reconcile_seconds': round(reconcile_seconds, 4),
+    }
+
+
+def print_step(step):
+    def mib(value):
+        return '?' if value is None else '%.2f' % (value / MIB)
+
+    sys.stderr.write(
+        '%d BMC(s), %d running, %d process(es): RSS %s MiB (%s/BMC), '
+        'PSS %s MiB (%s/BMC)\n' % (
+            step['bmcs'], step['running'], step['processes'],
+            mib(step['rss_bytes']), mib(step['rss_per_bmc_bytes']),
+            mib(step['pss_bytes']), mib(step['pss_per_bmc_bytes'])))
+    sys.stderr.write(
+        '  added %.1f/s, spawned %.1f/s, idle CPU %.2f%% (%.4f%%/BMC), '
+        'reconciliation %.4f s\n' % (
+            step['add_rate'], step['spawn_rate'], step['idle_cpu_percent'],
+            step['idle_cpu_per_bmc_percent'], step['reconcile_seconds']))
+
+
+def parse_option(value):
+    name, sep, option_value = value.partition('=')
+    section, _, key = name.partition('.')
+    if not sep or not key:
+        raise argparse.ArgumentTypeError('expected SECTION.KEY=VALUE')
+    return section, key, option_value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--steps', default='100,1000',
+                        help='Comma-separated BMC counts to reach in turn')
+    parser.add_argument('--settle', type=float, default=30,
+                        help='Seconds to leave the BMCs idle at each step')
+    parser.add_argument('--interval', type=float, default=1,
+                        help='Seconds between samples')
+    parser.add_argument('--option', action='append', type=parse_option,
+                        default=[], metavar='SECTION.KEY=VALUE',
+                        help='vbmcd configuration option, e.g. '
+                             'default.bmc_engine=shared, may be repeated')
+    parser.add_argument('--libvirt-uri', default='test:///default',
+                        help='libvirt test driver URI')
+    parser.add_argument('--domain', default='test',
+                        help='Test driver domain the BMC domains are '
+                             'copies of')
+    parser.add_argument('--address', default='127.0.0.1',
+                        help='Address the BMCs listen on')
+    parser.add_argument('--port', type=int, default=16230,
+                        help='Port of the first BMC, the next ones listen '
+                             'on the following ports')
+    parser.add_argument('--output', help='Write the JSON report to this '
+                                         'file rather than to stdout')
+    args = parser.parse_args()
+
+    steps = sorted(set(int(step) for step in args.steps.split(',')))
+    if steps[0] <= 0:
+        parser.error('BMC counts must be positive')
+
+    work_dir = tempfile.mkdtemp(prefix='vbmc-scale-')
+    try:
+        # Read once the config module gets imported
+        os.environ['VIRTUALBMC_CONFIG'] = write_config(work_dir,
+                                                       args.option)
+
+        from virtualbmc import config as vbmc_config
+        from virtualbmc import manager
+
+        conf = vbmc_config.get_config()
+        libvirt_conn = None
+        if conf['default']['backend'] == 'libvirt':
+            if not args.libvirt_uri.startswith('test:'):
+                parser.error('domains are only defined on the libvirt test '
+                             'driver')
+            if conf['default']['bmc_start_method'] != 'fork':
+                parser.error('BMCs must be started with the "fork" method')
+            libvirt_conn = define_domains(args.libvirt_uri, args.domain,
+                                          steps[-1])
+
+        sampler = Sampler(args.interval)
+        sampler.start()
+
+        bmc_manager = manager.VirtualBMCManager()
+        try:
+            # Get the services the BMCs rely on going
+            bmc_manager._sync_vbmc_states()
+            time.sleep(args.settle)
+            baseline = sampler.sample()
+
+            report = {
+                'version': virtualbmc.__version__,
+                'python': platform.python_version(),
+                'cpus': os.cpu_count(),
+                'options': ['%s.%s=%s' % option for option in args.option],
+                'baseline': baseline,
+                'steps': [],
+            }
+
+            for count, target in zip([0] + steps, steps):
+                step = run_step(args, bmc_manager, sampler, baseline,
+                                count, target)
+                print_step(step)
+                report['steps'].append(step)
+
+        finally:
+            bmc_manager.periodic(shutdown=True)
+            sampler.stop()
+            if libvirt_conn is not None:
+                libvirt_conn.close()
+
+        report['samples'] = sampler.samples
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,587 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""What vBMCs act upon the domains they manage through
+
+A backend powers a domain on and off, changes the device it boots from
+and tells its definition. vBMCs deal with the IPMI side of things and
+leave the rest to their backend, libvirt unless set up otherwise.
+"""
+
+import contextlib
+import random
+import threading
+import time
+import uuid
+from xml.parsers import expat
+
+import libvirt
+
+from virtualbmc import broker
+from virtualbmc import config as vbmc_config
+from virtualbmc import exception
+from virtualbmc import log
+from virtualbmc import qmp
+from virtualbmc import utils
+
+LOG = log.get_logger()
+
+CONF = vbmc_config.get_config()
+
+FAKE_DOMAIN_XML = """\
+<domain type='fake'>
+  <name>%(name)s</name>
+  <uuid>%(uuid)s</uuid>
+  <memory unit='MiB'>1024</memory>
+  <vcpu>1</vcpu>
+  <os>
+    <type arch='x86_64'>hvm</type>
+    <boot dev='%(boot_dev)s'/>
+  </os>
+  <devices>
+    <interface type='network'>
+      <mac address='%(mac)s'/>
+    </interface>
+  </devices>
+</domain>
+"""
+
+# What is known of the definition of QEMU processes run without libvirt
+QMP_DOMAIN_XML = """\
+<domain type='kvm'>
+  <name>%(name)s</name>
+  <uuid>%(uuid)s</uuid>
+</domain>
+"""
+
+
+class Backend(object):
+    """Interface of the backends of vBMCs
+
+    Operations raise `exception.BackendError` when they fail in a way
+    the client may retry, and `exception.DomainNotFound` when there is
+    no such domain.
+
+    :param domain_name: the name of the domain
+    """
+
+    # Whether the domain is a libvirt domain, whose events, statistics
+    # and serial console vBMCs may use
+    libvirt_domain = False
+
+    def __init__(self, domain_name):
+        self.domain_name = domain_name
+
+    def is_active(self):
+        """Tell whether the domain is running"""
+        raise NotImplementedError()
+
+    def power_on(self, boot_device=None):
+        """Start the domain, unless it is running
+
+        :param boot_device: the libvirt boot device to boot from this
+            time only, the persistent one if None
+        :returns: whether the domain got started
+        """
+        raise NotImplementedError()
+
+    def power_off(self):
+        """Stop the domain at once, if it is running"""
+        raise NotImplementedError()
+
+    def shutdown(self):
+        """Ask the guest OS to shut down, if the domain is running"""
+        raise NotImplementedError()
+
+    def reset(self, boot_device=None):
+        """Reset the domain, if it is running
+
+        :param boot_device: the libvirt boot device to boot from this
+            time only, the persistent one if None
+        :returns: whether the domain got reset
+        """
+        raise NotImplementedError()
+
+    def inject_nmi(self):
+        """Inject an NMI into the domain, if it is running"""
+        raise NotImplementedError()
+
+    def get_definition(self):
+        """Return the XML description of the persistent definition"""
+        raise NotImplementedError()
+
+    def set_boot_device(self, device):
+        """Set the persistent boot device
+
+        :param device: the libvirt boot device
+        :returns: whether the definition got changed
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class _BootElementScanner(object):
+    """Locate the boot elements of a domain XML description.
+
+    Records the byte offsets of the `<boot>` elements under `<os>` and
+    under each device, and of the `</os>` end tag, without building a
+    tree of the document.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.os_boots = []
+        self.device_boots = []
+        self.os_end = None
+        self._path = []
+        self._boot = None
+        self._empty = False
+        self._parser = expat.ParserCreate()
+        self._parser.StartElementHandler = self._start_element
+        self._parser.EndElementHandler = self._end_element
+        self._parser.CharacterDataHandler = self._character_data
+
+    def scan(self):
+        self._parser.Parse(self.data, True)
+        return self
+
+    def _start_element(self, name, attrs):
+        self._path.append(name)
+        self._empty = name == 'boot'
+        if self._empty:
+            self._boot = (self._parser.CurrentByteIndex, attrs.get('dev'))
+
+    def _end_element(self, name):
+        index = self._parser.CurrentByteIndex
+        path = self._path[1:]
+
+        if name == 'boot' and self._boot is not None:
+            start, dev = self._boot
+            # expat points past empty elements and at the end tag of
+            # the others
+            if self._empty and self.data[index - 2:index] == b'/>':
+                end = index
+            else:
+                end = self.data.index(b'>', index) + 1
+
+            if path == ['os', 'boot']:
+                self.os_boots.append((start, end, dev))
+            elif len(path) == 3 and path[0] == 'devices':
+                self.device_boots.append((start, end))
+            self._boot = None
+
+        elif path == ['os']:
+            self.os_end = index
+
+        self._path.pop()
+        self._empty = False
+
+    def _character_data(self, data):
+        self._empty = False
+
+
+def _line_span(data, start, end):
+    # Widen the span of an element to its whole line if it is alone on it
+    line_start = data.rfind(b'\n', 0, start) + 1
+    if not data[line_start:start].strip() and data[end:end + 1] == b'\n':
+        return line_start, end + 1
+    return start, end
+
+
+def rewrite_boot_device(domain_xml, device):
+    """Set the boot device in a domain XML description.
+
+    Only the `<boot>` elements are touched, the rest of the document is
+    copied over as is. The per-device boot elements are removed as they
+    are mutually exclusive with the `<os>` ones.
+
+    :param domain_xml: The domain XML description
+    :param device: The libvirt boot device to set
+    :returns: The new domain XML description or None if the domain
+        already boots from `device` only
+    """
+    data = domain_xml.encode('utf-8')
+    scanner = _BootElementScanner(data).scan()
+
+    if ([dev for start, end, dev in scanner.os_boots] == [device]
+            and not scanner.device_boots):
+        return None
+
+    boot_element = ("<boot dev='%s'/>" % device).encode('utf-8')
+
+    edits = [_line_span(data, start, end) + (b'',)
+             for start, end in scanner.device_boots]
+    for start, end, dev in scanner.os_boots[1:]:
+        edits.append(_line_span(data, start, end) + (b'',))
+
+    if scanner.os_boots:
+        start, end, dev = scanner.os_boots[0]
+        edits.append((start, end, boot_element))
+    elif scanner.os_end is not None:
+        edits.append((scanner.os_end, scanner.os_end, boot_element))
+
+    chunks = []
+    offset = 0
+    for start, end, replacement in sorted(edits):
+        chunks.append(data[offset:start])
+        chunks.append(replacement)
+        offset = end
+    chunks.append(data[offset:])
+
+    return b''.join(chunks).decode('utf-8')
+
+
+# Copied from nova/virt/libvirt/guest.py
+def get_xml_desc(domain, dump_sensitive=False, inactive=False):
+    """Returns xml description of guest.
+
+    :param domain: The libvirt domain to call
+    :param dump_sensitive: Dump security sensitive information
+    :param inactive: Dump the persistent rather than the live
+        definition of the guest
+    :returns string: XML description of the guest
+    """
+    flags = dump_sensitive and libvirt.VIR_DOMAIN_XML_SECURE or 0
+    if inactive:
+        flags |= libvirt.VIR_DOMAIN_XML_INACTIVE
+    return domain.XMLDesc(flags=flags)
+
+
+class LibvirtBackend(Backend):
+    """Domains managed by libvirt
+
+    :param domain_name: the name of the domain
+    :param conn_args: the libvirt URI and SASL credentials
+    """
+
+    libvirt_domain = True
+
+    def __init__(self, domain_name, conn_args):
+        super(LibvirtBackend, self).__init__(domain_name)
+        self._conn_args = conn_args
+        # Whether the domain runs off a one-time boot definition
+        self._boot_override_live = False
+
+    @contextlib.contextmanager
+    def _domain(self, operation, readonly=False):
+        """Yield a libvirt connection and the domain"""
+        try:
+            with broker.libvirt_connection(readonly=readonly,
+                                           **self._conn_args) as conn:
+                yield conn, utils.get_libvirt_domain(conn, self.domain_name)
+
+        except libvirt.libvirtError as e:
+            raise exception.BackendError(operation=operation,
+                                         domain=self.domain_name, error=e)
+
+    def is_active(self):
+        with self._domain('is_active', readonly=True) as (conn, domain):
+            return bool(domain.isActive())
+
+    def _start(self, conn, domain, boot_device):
+        if boot_device is None:
+            domain.create()
+            self._boot_override_live = False
+            return
+
+        # Start the domain off a transient definition booting from the
+        # one-time boot device, its persistent definition is left as is
+        domain_xml = get_xml_desc(domain, dump_sensitive=True, inactive=True)
+        conn.createXML(rewrite_boot_device(domain_xml, boot_device)
+                       or domain_xml)
+        LOG.debug('Domain %(domain)s started with one-time boot device '
+                  '%(bootdev)s', {'domain': self.domain_name,
+                                  'bootdev': boot_device})
+        self._boot_override_live = True
+
+    def power_on(self, boot_device=None):
+        with self._domain('power_on') as (conn, domain):
+            if domain.isActive():
+                return False
+
+            self._start(conn, domain, boot_device)
+            return True
+
+    def power_off(self):
+        with self._domain('power_off') as (conn, domain):
+            if domain.isActive():
+                domain.destroy()
+
+    def shutdown(self):
+        with self._domain('shutdown') as (conn, domain):
+            if domain.isActive():
+                domain.shutdown()
+
+    def reset(self, boot_device=None):
+        with self._domain('reset') as (conn, domain):
+            if not domain.isActive():
+                return False
+
+            if boot_device is None and not self._boot_override_live:
+                domain.reset()
+            else:
+                # The boot definition of a running domain can not be
+                # changed, start it over
+                domain.destroy()
+                self._start(conn, domain, boot_device)
+            return True
+
+    def inject_nmi(self):
+        with self._domain('inject_nmi') as (conn, domain):
+            if domain.isActive():
+                domain.injectNMI()
+
+    def get_definition(self):
+        with self._domain('get_definition', readonly=True) as (conn, domain):
+            return get_xml_desc(domain, inactive=True)
+
+    def set_boot_device(self, device):
+        with self._domain('set_boot_device') as (conn, domain):
+            domain_xml = rewrite_boot_device(
+                get_xml_desc(domain, dump_sensitive=True, inactive=True),
+                device)
+
+            if domain_xml is None:
+                return False
+
+            started_at = time.monotonic()
+            conn.defineXML(domain_xml)
+            LOG.debug('Redefined domain %(domain)s in %(time).1f ms',
+                      {'domain': self.domain_name,
+                       'time': (time.monotonic() - started_at) * 1000})
+            return True
+
+
+class FakeBackend(Backend):
+    """Domains simulated in memory, for testing vBMCs at scale
+
+    Domains start powered off and booting from disk. Each operation
+    takes its configured latency, then fails at its configured rate.
+
+    :param domain_name: the name of the domain
+    :param latency: seconds each operation takes, by operation name,
+        None standing for the operations not named
+    :param failure_rate: fraction of the calls of each operation that
+        fail, by operation name, None standing for the others
+    """
+
+    def __init__(self, domain_name, latency=None, failure_rate=None):
+        super(FakeBackend, self).__init__(domain_name)
+        self.latency = latency or {}
+        self.failure_rate = failure_rate or {}
+        self.active = False
+        self.boot_device = 'hd'
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def _call(self, operation):
+        latency = self.latency.get(operation, self.latency.get(None, 0))
+        if latency > 0:
+            time.sleep(latency)
+
+        failure_rate = self.failure_rate.get(
+            operation, self.failure_rate.get(None, 0))
+        if failure_rate > 0 and self._random.random() < failure_rate:
+            raise exception.BackendError(operation=operation,
+                                         domain=self.domain_name,
+                                         error='injected failure')
+
+    def is_active(self):
+        self._call('is_active')
+        return self.active
+
+    def power_on(self, boot_device=None):
+        self._call('power_on')
+        with self._lock:
+            started = not self.active
+            self.active = True
+            return started
+
+    def power_off(self):
+        self._call('power_off')
+        self.active = False
+
+    def shutdown(self):
+        # The guest OS complies at once
+        self._call('shutdown')
+        self.active = False
+
+    def reset(self, boot_device=None):
+        self._call('reset')
+        return self.active
+
+    def inject_nmi(self):
+        self._call('inject_nmi')
+
+    def get_definition(self):
+        self._call('get_definition')
+        boot_device = self.boot_device
+
+        domain_uuid = uuid.uuid5(uuid.NAMESPACE_URL, self.domain_name)
+        return FAKE_DOMAIN_XML % {
+            'name': self.domain_name, 'uuid': domain_uuid,
+            'boot_dev': boot_device,
+            'mac': '52:54:00:%02x:%02x:%02x' % tuple(domain_uuid.bytes[:3])}
+
+    def set_boot_device(self, device):
+        self._call('set_boot_device')
+        with self._lock:
+            changed = device != self.boot_device
+            self.boot_device = device
+            return changed
+
+
+class QMPBackend(Backend):
+    """QEMU processes run without libvirt, driven over their QMP monitor
+
+    QEMU is expected to run with `-no-shutdown`, so that it stays around
+    once the guest powers off, and is best started with `-S` by a
+    supervisor restarting it once it quits. Powering off quits QEMU,
+    powering on starts the CPUs of a fresh or shut down QEMU. Booting
+    from another device is not supported: QEMU has no notion of a
+    persistent boot device.
+
+    :param domain_name: the name of the domain
+    :param socket_path: the path of the QMP monitor socket
+    :param timeout: seconds to wait for the monitor to answer
+    """
+
+    # Run states of QEMU with the guest powered off: not started yet,
+    # or shut down
+    POWER_OFF_STATES = ('prelaunch', 'shutdown')
+
+    # Seconds between checks of whether a reset is over
+    RESET_POLL_INTERVAL = 0.05
+
+    def __init__(self, domain_name, socket_path, timeout=5):
+        super(QMPBackend, self).__init__(domain_name)
+        self._client = qmp.QMPClient(socket_path, timeout=timeout)
+
+    def _execute(self, operation, command, arguments=None):
+        try:
+            return self._client.execute(command, arguments)
+
+        except (OSError, exception.QMPError,
+                exception.QMPCommandError) as e:
+            raise exception.BackendError(
+                operation=operation, domain=self.domain_name, error=e) from e
+
+    def _status(self, operation):
+        """Return the run state of QEMU, None if it is not running"""
+        try:
+            return self._execute(operation, 'query-status')['status']
+
+        except exception.BackendError as e:
+            # Nothing listens on the socket
+            if isinstance(e.__cause__, (FileNotFoundError,
+                                        ConnectionRefusedError)):
+                return None
+            raise
+
+    def _ignore_boot_device(self, boot_device):
+        if boot_device is not None:
+            LOG.warning('Ignoring one-time boot device %(bootdev)s of '
+                        'domain %(domain)s, QEMU can not change it',
+                        {'bootdev': boot_device, 'domain': self.domain_name})
+
+    def is_active(self):
+        status = self._status('is_active')
+        return status is not None and status not in self.POWER_OFF_STATES
+
+    def power_on(self, boot_device=None):
+        status = self._status('power_on')
+        if status is None:
+            raise exception.BackendError(
+                operation='power_on', domain=self.domain_name,
+                error='QEMU is not running')
+
+        if status not in self.POWER_OFF_STATES:
+            return False
+
+        self._ignore_boot_device(boot_device)
+        if status == 'shutdown':
+            # Back to the state of a machine just powered on, which QEMU
+            # gets to asynchronously
+            self._execute('power_on', 'system_reset')
+            deadline = time.monotonic() + self._client.timeout
+            while (self._status('power_on') == 'shutdown'
+                   and time.monotonic() < deadline):
+                time.sleep(self.RESET_POLL_INTERVAL)
+        self._execute('power_on', 'cont')
+        return True
+
+    def power_off(self):
+        if self._status('power_off') is None:
+            return
+
+        try:
+            self._execute('power_off', 'quit')
+
+        except exception.BackendError as e:
+            # QEMU may well be gone before answering
+            if not isinstance(e.__cause__, ConnectionError):
+                raise
+
+        finally:
+            # The connection goes away along with QEMU, do not let the
+            # next command race with that
+            self._client.close()
+
+    def shutdown(self):
+        if self.is_active():
+            self._execute('shutdown', 'system_powerdown')
+
+    def reset(self, boot_device=None):
+        if not self.is_active():
+            return False
+
+        self._ignore_boot_device(boot_device)
+        self._execute('reset', 'system_reset')
+        return True
+
+    def inject_nmi(self):
+        if self.is_active():
+            self._execute('inject_nmi', 'inject-nmi')
+
+    def get_definition(self):
+        domain_uuid = self._execute('get_definition', 'query-uuid')['UUID']
+        return QMP_DOMAIN_XML % {'name': self.domain_name,
+                                 'uuid': domain_uuid}
+
+    def set_boot_device(self, device):
+        raise exception.OperationNotSupported(operation='set_boot_device',
+                                              domain=self.domain_name)
+
+    def close(self):
+        self._client.close()
+
+
+def get_backend(domain_name, conn_args, qmp_socket=None):
+    """Create the backend of a domain
+
+    :param domain_name: the name of the domain
+    :param conn_args: the libvirt URI and SASL credentials
+    :param qmp_socket: the QMP monitor socket of a QEMU process run
+        without libvirt, if any
+    """
+    if qmp_socket:
+        return QMPBackend(domain_name, qmp_socket,
+                          timeout=CONF['qmp']['timeout'])
+
+    if CONF['default']['backend'] == 'fake':
+        return FakeBackend(domain_name,
+                           latency=CONF['fake_backend']['latency'],
+                           failure_rate=CONF['fake_backend']['failure_rate'])
+
+    return LibvirtBackend(domain_name, conn_args)
@@ -0,0 +1,423 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Libvirt broker
+
+The broker is a process of `vbmcd` holding one libvirt connection per
+URI on behalf of all the vBMC instances, which send it the libvirt calls
+they would otherwise make themselves over a Unix socket. Calls from
+different vBMCs are run concurrently and share the broker's connections,
+which matters most for remote URIs (e.g. `qemu+ssh://`).
+
+Requests and responses are length-prefixed JSON documents. A request
+names a libvirt URI (and credentials), a domain and one of the libvirt
+methods the vBMCs use, the response carries the method's result or the
+error it raised.
+"""
+
+from concurrent import futures
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import struct
+import threading
+import time
+
+import libvirt
+
+from virtualbmc import config as vbmc_config
+from virtualbmc import exception
+from virtualbmc import log
+from virtualbmc import utils
+
+LOG = log.get_logger()
+
+CONF = vbmc_config.get_config()
+
+SOCKET_NAME = 'libvirt-broker.sock'
+
+# Libvirt methods the vBMCs may call through the broker
+CONNECTION_METHODS = frozenset(['createXML', 'defineXML', 'lookupByName'])
+DOMAIN_METHODS = frozenset(['XMLDesc', 'create', 'destroy', 'injectNMI',
+                            'isActive', 'reset', 'shutdown'])
+
+# Seconds to wait for a new broker to listen
+START_TIMEOUT = 5
+
+# Seconds to wait before trying to reach a broker found unreachable
+RECONNECT_INTERVAL = 5
+
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+_HEADER = struct.Struct('>I')
+
+CLIENT = None
+
+
+def get_socket_path():
+    return os.path.join(os.path.dirname(CONF['default']['pid_file']),
+                        SOCKET_NAME)
+
+
+def _encode(message):
+    data = json.dumps(message).encode('utf-8')
+    return _HEADER.pack(len(data)) + data
+
+
+def _decode(buffer):
+    """Split the complete messages off a buffer
+
+    :returns: a list of messages and what is left of the buffer
+    """
+    messages = []
+    while len(buffer) >= _HEADER.size:
+        size, = _HEADER.unpack_from(buffer)
+        if size > MAX_MESSAGE_SIZE:
+            raise ValueError('Message of %d bytes is too large' % size)
+
+        end = _HEADER.size + size
+        if len(buffer) < end:
+            break
+
+        messages.append(json.loads(buffer[_HEADER.size:end]))
+        buffer = buffer[end:]
+
+    return messages, buffer
+
+
+class _Peer(object):
+    """A vBMC process connected to the broker"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            self.sock.sendall(_encode(message))
+
+
+class BrokerServer(object):
+
+    def __init__(self, socket_path, threads=16):
+        self.socket_path = socket_path
+        self._executor = futures.ThreadPoolExecutor(
+            threads, thread_name_prefix='libvirt-broker')
+        self._selector = selectors.DefaultSelector()
+
+    def _call(self, request):
+        method = request['method']
+        args = request.get('args', [])
+        kwargs = request.get('kwargs', {})
+
+        with utils.libvirt_connection(
+                request['uri'], sasl_username=request.get('sasl_username'),
+                sasl_password=request.get('sasl_password'),
+                readonly=request.get('readonly', False)) as conn:
+
+            if method in CONNECTION_METHODS:
+                getattr(conn, method)(*args, **kwargs)
+                # Domain objects stay here, the caller knows the name
+                return None
+
+            if method not in DOMAIN_METHODS:
+                raise ValueError('Method %s is not allowed' % method)
+
+            domain = conn.lookupByName(request['domain'])
+            return getattr(domain, method)(*args, **kwargs)
+
+    def _handle(self, peer, request):
+        response = {'id': request.get('id')}
+        try:
+            response['result'] = self._call(request)
+
+        except libvirt.libvirtError as e:
+            response['error'] = {'type': 'libvirt', 'message': str(e)}
+
+        except Exception as e:
+            response['error'] = {'type': 'vbmc', 'message': str(e)}
+
+        try:
+            peer.send(response)
+
+        except OSError:
+            # The vBMC is gone, the selector will notice
+            pass
+
+    def _accept(self, sock):
+        conn, _ = sock.accept()
+        self._selector.register(conn, selectors.EVENT_READ, _Peer(conn))
+
+    def _read(self, peer):
+        try:
+            data = peer.sock.recv(65536)
+            if data:
+                requests, peer.buffer = _decode(peer.buffer + data)
+
+        except (OSError, ValueError) as e:
+            LOG.warning('Dropping libvirt broker client: %(error)s',
+                        {'error': e})
+            data = None
+
+        if not data:
+            self._selector.unregister(peer.sock)
+            peer.sock.close()
+            return
+
+        for request in requests:
+            self._executor.submit(self._handle, peer, request)
+
+    def serve(self, ready=None):
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            sock.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        sock.listen(128)
+
+        self._selector.register(sock, selectors.EVENT_READ)
+
+        LOG.info('Libvirt broker listening at %(path)s',
+                 {'path': self.socket_path})
+
+        if ready is not None:
+            ready.set()
+
+        while True:
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    self._accept(key.fileobj)
+                else:
+                    self._read(key.data)
+
+
+def broker_main(socket_path, threads, ready):
+    # The manager process installs a signal handler for SIGTERM to
+    # propagate it to children. Return to the default handler.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    try:
+        BrokerServer(socket_path, threads=threads).serve(ready)
+
+    except Exception as ex:
+        LOG.exception('Libvirt broker failed: %(error)s', {'error': ex})
+
+
+class BrokerProcess(object):
+    """The broker process, as run by the manager"""
+
+    def __init__(self, socket_path, threads=16):
+        self.socket_path = socket_path
+        self.threads = threads
+        self._context = multiprocessing.get_context('fork')
+        self._process = None
+
+    def ensure_running(self):
+        """Start the broker unless it is running already"""
+        if self._process is not None:
+            if self._process.is_alive():
+                return
+
+            LOG.warning('Libvirt broker died (rc %(rc)s), restarting it',
+                        {'rc': self._process.exitcode})
+
+        ready = self._context.Event()
+        self._process = self._context.Process(
+            name='vbmcd-libvirt-broker', target=broker_main,
+            args=(self.socket_path, self.threads, ready))
+        self._process.daemon = True
+        self._process.start()
+
+        if not ready.wait(START_TIMEOUT):
+            LOG.warning('Libvirt broker is not listening at %(path)s yet, '
+                        'vBMCs will reach libvirt directly meanwhile',
+                        {'path': self.socket_path})
+
+    def shutdown(self):
+        if self._process is not None and self._process.is_alive():
+            self._process.terminate()
+
+        self._process = None
+
+
+class BrokerClient(object):
+    """Send libvirt calls to the broker
+
+    Each thread talks to the broker over a socket of its own, so that
+    the calls of different threads do not wait for each other.
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._local = threading.local()
+        self._ids = itertools.count()
+        self._next_connect = 0
+
+    def _close(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            sock.close()
+        self._local.sock = None
+
+    def available(self):
+        """Whether the broker can be reached
+
+        After a failure, the broker is not tried again for a while.
+        """
+        if getattr(self._local, 'sock', None) is not None:
+            return True
+
+        now = time.monotonic()
+        if now < self._next_connect:
+            return False
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+
+        except OSError as e:
+            sock.close()
+            self._next_connect = now + RECONNECT_INTERVAL
+            LOG.debug('Libvirt broker at %(path)s unreachable, reaching '
+                      'libvirt directly. Error: %(error)s',
+                      {'path': self.socket_path, 'error': e})
+            return False
+
+        self._local.sock = sock
+        self._local.buffer = b''
+        self._local.messages = []
+        return True
+
+    def _receive(self):
+        while True:
+            messages, self._local.buffer = _decode(self._local.buffer)
+            self._local.messages.extend(messages)
+            if self._local.messages:
+                return self._local.messages.pop(0)
+
+            data = self._local.sock.recv(65536)
+            if not data:
+                raise ConnectionResetError('Libvirt broker went away')
+
+            self._local.buffer += data
+
+    def call(self, **request):
+        if not self.available():
+            raise libvirt.libvirtError('Libvirt broker is unreachable')
+
+        request['id'] = next(self._ids)
+        try:
+            self._local.sock.sendall(_encode(request))
+
+            while True:
+                response = self._receive()
+                if response.get('id') == request['id']:
+                    break
+
+                # A response to a call that got interrupted
+                LOG.debug('Dropping a stale libvirt broker response to '
+                          'request %(id)s', {'id': response.get('id')})
+
+        except (OSError, ValueError) as e:
+            self._close()
+            raise libvirt.libvirtError(
+                'Lost the libvirt broker connection: %s' % e)
+
+        error = response.get('error')
+        if error is None:
+            return response.get('result')
+
+        if error['type'] == 'libvirt':
+            raise libvirt.libvirtError(error['message'])
+
+        raise exception.VirtualBMCError(message=error['message'])
+
+
+class BrokerDomain(object):
+    """Stand-in for a libvirt domain living in the broker"""
+
+    def __init__(self, conn, name):
+        self._conn = conn
+        self._name = name
+
+    def name(self):
+        return self._name
+
+    def __getattr__(self, method):
+        if method not in DOMAIN_METHODS:
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            return self._conn.call(method, domain=self._name, args=args,
+                                   kwargs=kwargs)
+
+        return call
+
+
+class BrokerConnection(object):
+    """Stand-in for a libvirt connection held by the broker"""
+
+    def __init__(self, client, uri, sasl_username=None, sasl_password=None,
+                 readonly=False):
+        self._client = client
+        self._target = {'uri': uri, 'sasl_username': sasl_username,
+                        'sasl_password': sasl_password, 'readonly': readonly}
+
+    def call(self, method, domain=None, args=(), kwargs=None):
+        return self._client.call(method=method, domain=domain,
+                                 args=list(args), kwargs=kwargs or {},
+                                 **self._target)
+
+    def lookupByName(self, name):
+        self.call('lookupByName', args=[name])
+        return BrokerDomain(self, name)
+
+    def defineXML(self, xml):
+        self.call('defineXML', args=[xml])
+
+    def createXML(self, xml, flags=0):
+        self.call('createXML', args=[xml, flags])
+
+
+def get_client():
+    """Return the broker client of this process or None if disabled"""
+    global CLIENT
+    if CLIENT is None and CONF['libvirt']['broker']:
+        CLIENT = BrokerClient(get_socket_path())
+
+    return CLIENT
+
+
+def libvirt_connection(uri, **kwargs):
+    """Get a libvirt connection, through the broker if it is up
+
+    Same interface as `utils.libvirt_connection`, which is used when
+    the broker is disabled or can not be reached.
+    """
+    client = get_client()
+    if client is not None and client.available():
+        return contextlib.nullcontext(BrokerConnection(client, uri,
+                                                       **kwargs))
+
+    return utils.libvirt_connection(uri=uri, **kwargs)
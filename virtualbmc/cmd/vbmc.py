@@ -158,6 +158,12 @@ class AddCommand(Command):
                             default=None,
                             help=('The libvirt SASL password; defaults to '
                                   'None'))
+        parser.add_argument('--qmp-socket',
+                            dest='qmp_socket',
+                            default=None,
+                            help=('The QMP monitor socket of a QEMU process '
+                                  'run without libvirt, to drive it through '
+                                  'rather than libvirt; defaults to None'))
         return parser
 
     def take_action(self, args):
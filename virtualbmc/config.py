@@ -41,6 +41,26 @@ class VirtualBMCConfig(object):
             'server_port': 50891,
             'server_response_timeout': 5000,  # milliseconds
             'server_spawn_wait': 3000,  # milliseconds
+            # Number of threads running control commands concurrently
+            'server_threads': 4,
+            # How vBMC instances are run: "process" runs each instance
+            # in a process of its own, "shared" spreads them over a pool
+            # of worker processes
+            'bmc_engine': 'process',
+            # Number of "shared" engine workers, 0 means one per CPU
+            'workers': 0,
+            # Where vBMC configurations live: "directory" or "sqlite"
+            'config_store': 'directory',
+            # Maximum number of vBMC processes started concurrently
+            'spawn_concurrency': 8,
+            # How vBMC processes are started: "fork" forks the server,
+            # "forkserver" forks a server with preloaded modules
+            'bmc_start_method': 'fork',
+            # Number of idle vBMC processes kept ready, 0 disables them
+            'warm_pool_size': 0,
+            # What vBMCs act upon domains through: "libvirt", or "fake"
+            # for domains simulated in memory
+            'backend': 'libvirt',
         },
         'log': {
             'logfile': None,
@@ -48,7 +68,65 @@ class VirtualBMCConfig(object):
         },
         'ipmi': {
             # Maximum time (in seconds) to wait for the data to come across
-            'session_timeout': 1
+            'session_timeout': 1,
+            # Number of responses kept for replaying to retransmitted
+            # requests, 0 disables replaying
+            'replay_cache_size': 256,
+            # Seconds during which a response may be replayed, clients
+            # retransmit within a second or so
+            'replay_cache_ttl': 2,
+            # Number of entries of the System Event Log of a vBMC, the
+            # oldest ones get overwritten once it is full
+            'sel_capacity': 1024,
+            # Seconds an entry may wait before the SEL gets saved to the
+            # domain's config directory
+            'sel_save_interval': 30,
+            # Bytes of console output, and of console input, an SOL
+            # session buffers before holding back the other end
+            'sol_buffer_size': 16384,
+        },
+        'libvirt': {
+            # Maximum number of libvirt connections kept open per process
+            'connection_pool_size': 16,
+            # Seconds between libvirt keepalive probes, 0 disables them
+            'keepalive_interval': 5,
+            'keepalive_count': 3,
+            # Maximum number of concurrent calls to a libvirt URI from
+            # all vBMCs of the host, 0 means no limit
+            'max_concurrent_calls': 0,
+            # Number of those kept for calls changing domains (power
+            # actions, boot device changes)
+            'reserved_calls': 4,
+            # Make the libvirt calls of all vBMCs through a broker
+            # process of vbmcd holding one connection per libvirt URI
+            'broker': 'false',
+            # Number of libvirt calls the broker runs concurrently
+            'broker_threads': 16,
+            # Serve state from caches kept fresh by libvirt domain events
+            'domain_events': 'false',
+        },
+        'fake_backend': {
+            # Milliseconds each operation of the fake backend takes,
+            # and the fraction of them failing. Either a value for all
+            # operations, or comma-separated <operation>:<value> pairs
+            # possibly following it, e.g. "5, power_on:2000"
+            'latency': '0',
+            'failure_rate': '0',
+        },
+        'qmp': {
+            # Seconds to wait for the QMP monitor of a QEMU process
+            'timeout': 5,
+        },
+        'sensors': {
+            # Seconds between collections of the domain statistics the
+            # virtual sensors report, 0 disables the sensors
+            'interval': 0,
+            # Maximum number of domains per libvirt URI having sensors
+            'table_size': 4096,
+            # Power consumption estimate of a domain: idle watts plus
+            # watts per fully busy vCPU
+            'idle_watts': 40,
+            'vcpu_watts': 12,
         },
     }
 
@@ -84,13 +162,68 @@ class VirtualBMCConfig(object):
         self._conf_dict['default']['server_response_timeout'] = int(
             self._conf_dict['default']['server_response_timeout'])
 
-        self._conf_dict['ipmi']['session_timeout'] = int(
-            self._conf_dict['ipmi']['session_timeout'])
+        self._conf_dict['default']['server_threads'] = int(
+            self._conf_dict['default']['server_threads'])
+
+        self._conf_dict['default']['workers'] = int(
+            self._conf_dict['default']['workers'])
+
+        self._conf_dict['default']['spawn_concurrency'] = int(
+            self._conf_dict['default']['spawn_concurrency'])
+
+        self._conf_dict['default']['warm_pool_size'] = int(
+            self._conf_dict['default']['warm_pool_size'])
+
+        for key in ('session_timeout', 'replay_cache_size',
+                    'replay_cache_ttl', 'sel_capacity', 'sel_save_interval',
+                    'sol_buffer_size'):
+            self._conf_dict['ipmi'][key] = int(self._conf_dict['ipmi'][key])
+
+        for key in ('connection_pool_size', 'keepalive_interval',
+                    'keepalive_count', 'max_concurrent_calls',
+                    'reserved_calls', 'broker_threads'):
+            self._conf_dict['libvirt'][key] = int(
+                self._conf_dict['libvirt'][key])
+
+        self._conf_dict['qmp']['timeout'] = int(
+            self._conf_dict['qmp']['timeout'])
+
+        for key in ('interval', 'table_size', 'idle_watts', 'vcpu_watts'):
+            self._conf_dict['sensors'][key] = int(
+                self._conf_dict['sensors'][key])
+
+        for key in ('broker', 'domain_events'):
+            self._conf_dict['libvirt'][key] = utils.str2bool(
+                self._conf_dict['libvirt'][key])
+
+        self._conf_dict['fake_backend']['latency'] = {
+            operation: value / 1000 for operation, value in
+            _parse_per_operation(
+                self._conf_dict['fake_backend']['latency']).items()}
+
+        self._conf_dict['fake_backend']['failure_rate'] = (
+            _parse_per_operation(
+                self._conf_dict['fake_backend']['failure_rate']))
 
     def __getitem__(self, key):
         return self._conf_dict[key]
 
 
+def _parse_per_operation(string):
+    """Parse a value for all operations and values of some of them
+
+    :returns: the values by operation name, the one for all operations
+        under None
+    """
+    values = {}
+    for item in string.split(','):
+        operation, _, value = item.rpartition(':')
+        if value.strip():
+            values[operation.strip() or None] = float(value)
+
+    return values
+
+
 def get_config():
     global CONFIG
     if CONFIG is None:
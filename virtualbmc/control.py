@@ -13,25 +13,30 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import asyncio
+from concurrent import futures
 import json
 import signal
-import sys
 
 import zmq
+import zmq.asyncio
 
 from virtualbmc import config as vbmc_config
 from virtualbmc import exception
 from virtualbmc import log
 from virtualbmc.manager import VirtualBMCManager
+from virtualbmc import utils
 
 CONF = vbmc_config.get_config()
 
 LOG = log.get_logger()
 
-TIMER_PERIOD = 3000  # milliseconds
 
+# Commands which do not change anything, thus may run concurrently
+READ_ONLY_COMMANDS = ('list', 'show')
 
-def main_loop(vbmc_manager, handle_command):
+
+class ControlServer(object):
     """Server part of the CLI control interface
 
     Receives JSON messages from ZMQ socket, calls the command handler and
@@ -45,74 +50,236 @@ def main_loop(vbmc_manager, handle_command):
     contains at least the `rc` and `msg` attributes, used to indicate the
     outcome of the command, and optionally 2-D table conveyed through the
     `header` and `rows` attributes pointing to lists of cell values.
+
+    Commands from many clients are served concurrently through a ROUTER
+    socket, each in a thread of an executor as they block on libvirt or
+    the file system. Read-only commands share the vBMC manager, others
+    get it exclusively. The vBMC manager reconciles its instances in a
+    task of its own, whenever reconciliation is due or vBMC processes
+    exit. Once serving stops, be it on SIGTERM or on error, the vBMC
+    instances get shut down after the commands being run complete.
     """
-    server_port = CONF['default']['server_port']
 
-    context = socket = None
+    def __init__(self, vbmc_manager, handle_command):
+        self.vbmc_manager = vbmc_manager
+        self.handle_command = handle_command
+        self._lock = utils.ReadWriteLock()
+        self._executor = futures.ThreadPoolExecutor(
+            CONF['default']['server_threads'])
+        self._wakeup = None
+        self._stopping = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _run_command(self, data_in):
+        command = data_in.get('command')
+
+        if command in READ_ONLY_COMMANDS:
+            lock = self._lock.read()
+        else:
+            lock = self._lock.write()
+
+        try:
+            if command == 'add':
+                # Talking to libvirt may take a while, check the domain
+                # before getting the manager exclusively
+                self.vbmc_manager.check_domain(**data_in)
+                data_in = dict(data_in, checked=True)
+
+            with lock:
+                return self.handle_command(self.vbmc_manager, data_in)
+
+        except exception.VirtualBMCError as ex:
+            msg = 'Command failed: %(error)s' % {'error': ex}
+            LOG.error(msg)
+            return {
+                'rc': 1,
+                'msg': [msg]
+            }
+
+    async def _handle(self, socket, identity, message):
+        try:
+            data_in = json.loads(message.decode('utf-8'))
+
+        except ValueError as ex:
+            LOG.warning(
+                'Control server request deserialization error: '
+                '%(error)s', {'error': ex}
+            )
+            return
+
+        LOG.debug('Command request data: %(request)s',
+                  {'request': data_in})
+
+        command = data_in.get('command')
+
+        try:
+            data_out = await self._run(self._run_command, data_in)
+
+        except Exception as ex:
+            msg = 'Command failed: %(error)s' % {'error': ex}
+            LOG.exception(msg)
+            data_out = {
+                'rc': 1,
+                'msg': [msg]
+            }
+
+        if command not in READ_ONLY_COMMANDS:
+            # vBMC instances may have come or gone
+            self._wakeup.set()
+
+        LOG.debug('Command response data: %(response)s',
+                  {'response': data_out})
+
+        try:
+            message = json.dumps(data_out)
+
+        except ValueError as ex:
+            LOG.warning(
+                'Control server response serialization error: '
+                '%(error)s', {'error': ex}
+            )
+            return
+
+        await socket.send_multipart([identity, b'', message.encode('utf-8')])
+
+    async def _receive(self, socket):
+        handlers = set()
 
-    try:
-        context = zmq.Context()
-        socket = context.socket(zmq.REP)
-        socket.setsockopt(zmq.LINGER, 5)
-        socket.bind("tcp://127.0.0.1:%s" % server_port)
+        while True:
+            frames = await socket.recv_multipart()
+            if len(frames) != 3:
+                LOG.warning('Control server dropped a malformed message '
+                            'of %(count)d frame(s)', {'count': len(frames)})
+                continue
+
+            identity, _, message = frames
+
+            handler = asyncio.ensure_future(
+                self._handle(socket, identity, message))
+            handlers.add(handler)
+            handler.add_done_callback(handlers.discard)
+
+    def _reconcile_once(self, fds):
+        with self._lock.write():
+            self.vbmc_manager.handle_events(fds)
+            self.vbmc_manager.periodic()
+
+            return set(self.vbmc_manager.watched_fds())
 
-        poller = zmq.Poller()
-        poller.register(socket, zmq.POLLIN)
+    async def _reconcile(self):
+        loop = asyncio.get_running_loop()
+        watched = set()
+        ready = set()
 
-        LOG.info('Started vBMC server on port %s', server_port)
+        def on_readable(fd):
+            # Sentinels of dead processes stay readable, stop watching
+            # them until the vBMC manager tells otherwise
+            loop.remove_reader(fd)
+            watched.discard(fd)
+            ready.add(fd)
+            self._wakeup.set()
 
         while True:
-            socks = dict(poller.poll(timeout=TIMER_PERIOD))
-            if socket in socks and socks[socket] == zmq.POLLIN:
-                message = socket.recv()
-            else:
-                vbmc_manager.periodic()
-                continue
+            fds = list(ready)
+            ready.clear()
+
+            # Wake up on vBMC instance changes too
+            wanted = await self._run(self._reconcile_once, fds)
+            for fd in watched - wanted:
+                loop.remove_reader(fd)
+            for fd in wanted - watched:
+                loop.add_reader(fd, on_readable, fd)
+            watched.clear()
+            watched.update(wanted)
+
+            timeout = self.vbmc_manager.poll_timeout() / 1000
 
             try:
-                data_in = json.loads(message.decode('utf-8'))
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
 
-            except ValueError as ex:
-                LOG.warning(
-                    'Control server request deserialization error: '
-                    '%(error)s', {'error': ex}
-                )
-                continue
+            except asyncio.TimeoutError:
+                pass
 
-            LOG.debug('Command request data: %(request)s',
-                      {'request': data_in})
+            self._wakeup.clear()
 
-            try:
-                data_out = handle_command(vbmc_manager, data_in)
+    def _shutdown(self):
+        with self._lock.write():
+            self.vbmc_manager.periodic(shutdown=True)
+
+    def _stop(self):
+        LOG.info('Got SIGTERM, stopping the vBMC server')
+        self._stopping.set()
+
+    async def serve(self):
+        server_port = CONF['default']['server_port']
+
+        loop = asyncio.get_running_loop()
+
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+
+        # SIGTERM does not seem to propagate to multiprocessing
+        loop.add_signal_handler(signal.SIGTERM, self._stop)
 
-            except exception.VirtualBMCError as ex:
-                msg = 'Command failed: %(error)s' % {'error': ex}
-                LOG.error(msg)
-                data_out = {
-                    'rc': 1,
-                    'msg': [msg]
-                }
+        context = socket = None
 
-            LOG.debug('Command response data: %(response)s',
-                      {'response': data_out})
+        try:
+            context = zmq.asyncio.Context()
+            socket = context.socket(zmq.ROUTER)
+            socket.setsockopt(zmq.LINGER, 5)
+            socket.bind("tcp://127.0.0.1:%s" % server_port)
+
+            LOG.info('Started vBMC server on port %s', server_port)
+
+            tasks = [asyncio.ensure_future(self._receive(socket)),
+                     asyncio.ensure_future(self._reconcile()),
+                     asyncio.ensure_future(self._stopping.wait())]
 
             try:
-                message = json.dumps(data_out)
+                done, _ = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED)
 
-            except ValueError as ex:
-                LOG.warning(
-                    'Control server response serialization error: '
-                    '%(error)s', {'error': ex}
-                )
-                continue
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+            for task in done:
+                task.result()
+
+        finally:
+            loop.remove_signal_handler(signal.SIGTERM)
+            if socket:
+                socket.close()
+            if context:
+                context.destroy()
 
-            socket.send(message.encode('utf-8'))
+            # Commands still running hold on to the vBMC manager
+            self._executor.shutdown(wait=True)
+            self._shutdown()
 
-    finally:
-        if socket:
-            socket.close()
-        if context:
-            context.destroy()
+
+def main_loop(vbmc_manager, handle_command):
+    """Serve the CLI control interface until SIGTERM or an error"""
+    server = ControlServer(vbmc_manager, handle_command)
+    asyncio.run(server.serve())
+
+
+def _batch_response(results):
+    """Build the response to a command run over many domains
+
+    Besides the overall `rc` and the error messages, the response
+    reports the outcome for each domain as a table.
+    """
+    return {
+        'rc': max((rc for rc, msg in results.values()), default=0),
+        'msg': [msg for rc, msg in results.values() if msg],
+        'header': ('Domain name', 'Result'),
+        'rows': [[domain_name, msg or 'OK']
+                 for domain_name, (rc, msg) in results.items()],
+    }
 
 
 def command_dispatcher(vbmc_manager, data_in):
@@ -143,29 +310,13 @@ def command_dispatcher(vbmc_manager, data_in):
             'msg': [msg] if msg else []
         }
 
-    elif command == 'delete':
-        data_out = [vbmc_manager.delete(domain_name)
-                    for domain_name in set(data_in['domain_names'])]
-        return {
-            'rc': max(rc for rc, msg in data_out),
-            'msg': [msg for rc, msg in data_out if msg],
-        }
+    elif command in ('delete', 'start', 'stop'):
+        handler = getattr(vbmc_manager, '%s_many' % command)
 
-    elif command == 'start':
-        data_out = [vbmc_manager.start(domain_name)
-                    for domain_name in set(data_in['domain_names'])]
-        return {
-            'rc': max(rc for rc, msg in data_out),
-            'msg': [msg for rc, msg in data_out if msg],
-        }
+        # Drop duplicates, keep the order
+        domain_names = list(dict.fromkeys(data_in['domain_names']))
 
-    elif command == 'stop':
-        data_out = [vbmc_manager.stop(domain_name)
-                    for domain_name in set(data_in['domain_names'])]
-        return {
-            'rc': max(rc for rc, msg in data_out),
-            'msg': [msg for rc, msg in data_out if msg],
-        }
+        return _batch_response(handler(domain_names))
 
     elif command == 'list':
         rc, tables = vbmc_manager.list()
@@ -205,20 +356,12 @@ def application():
 
     vbmc_manager.periodic()
 
-    def kill_children(*args):
-        vbmc_manager.periodic(shutdown=True)
-        sys.exit(0)
-
-    # SIGTERM does not seem to propagate to multiprocessing
-    signal.signal(signal.SIGTERM, kill_children)
-
+    # The vBMC instances get shut down as the control server stops
     try:
         main_loop(vbmc_manager, command_dispatcher)
     except KeyboardInterrupt:
         LOG.info('Got keyboard interrupt, exiting')
-        vbmc_manager.periodic(shutdown=True)
     except Exception as ex:
         LOG.error(
             'Control server error: %(error)s', {'error': ex}
         )
-        vbmc_manager.periodic(shutdown=True)
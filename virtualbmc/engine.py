@@ -0,0 +1,386 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import bisect
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+
+import pyghmi.ipmi.private.session as ipmisession
+
+from virtualbmc import config as vbmc_config
+from virtualbmc import log
+from virtualbmc import utils
+from virtualbmc.vbmc import VirtualBMC
+
+LOG = log.get_logger()
+
+CONF = vbmc_config.get_config()
+
+# Worker commands
+START = 'start'
+STOP = 'stop'
+
+# Worker reports
+RUNNING = 'running'
+ERROR = 'error'
+
+
+def worker_main(conn):
+    """Serve many vBMC instances from a single process
+
+    All BMCs hosted by the worker share pyghmi's I/O loop which
+    multiplexes their UDP sockets, so starting a BMC only costs a
+    socket bind. Commands from the manager are handled between loop
+    iterations, thus never concurrently with IPMI requests.
+    """
+    utils.exit_on_sigterm()
+
+    show_passwords = CONF['default']['show_passwords']
+    session_timeout = CONF['ipmi']['session_timeout']
+
+    # pyghmi wakes up its I/O thread through the first socket it has
+    # ever opened, make sure that one is not a BMC socket we may close
+    ipmisession.Session._assignsocket()
+
+    bmcs = {}
+
+    def start_bmc(bmc_config):
+        domain_name = bmc_config['domain_name']
+
+        if show_passwords:
+            show_options = bmc_config
+        else:
+            show_options = utils.mask_dict_password(bmc_config)
+
+        stop_bmc(domain_name)
+
+        try:
+            bmcs[domain_name] = VirtualBMC(**bmc_config)
+
+        except Exception as ex:
+            LOG.exception(
+                'Error running vBMC with configuration '
+                '%(opts)s: %(error)s', {'opts': show_options,
+                                        'error': ex}
+            )
+            conn.send((ERROR, domain_name, str(ex)))
+            return
+
+        conn.send((RUNNING, domain_name, None))
+
+    def stop_bmc(domain_name):
+        vbmc = bmcs.pop(domain_name, None)
+        if vbmc is not None:
+            vbmc.close()
+
+    try:
+        while True:
+            while conn.poll(0):
+                try:
+                    command, arg = conn.recv()
+
+                except EOFError:
+                    # The manager is gone, so are we
+                    return
+
+                if command == START:
+                    start_bmc(arg)
+
+                elif command == STOP:
+                    stop_bmc(arg)
+
+            try:
+                ipmisession.Session.wait_for_rsp(timeout=session_timeout)
+
+            except Exception as ex:
+                LOG.exception('Error serving IPMI requests: %(error)s',
+                              {'error': ex})
+
+    finally:
+        for domain_name in list(bmcs):
+            stop_bmc(domain_name)
+
+
+class Worker(object):
+    """Manager side of a worker process hosting vBMC instances"""
+
+    def __init__(self, index):
+        self.index = index
+        self.errors = {}
+        self.started_at = None
+        self._lock = threading.Lock()
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            name='vbmcd-worker-%d' % index,
+            target=worker_main,
+            args=(child_conn,)
+        )
+        self._process.daemon = True
+
+    def start(self):
+        self._process.start()
+        self.started_at = time.monotonic()
+
+        LOG.info('Started vBMC worker %(index)d (pid %(pid)s)',
+                 {'index': self.index, 'pid': self._process.pid})
+
+    def is_alive(self):
+        return self._process.is_alive()
+
+    def terminate(self):
+        if self._process.is_alive():
+            self._process.terminate()
+
+    @property
+    def sentinel(self):
+        return self._process.sentinel
+
+    def fileno(self):
+        return self._conn.fileno()
+
+    def _send(self, message):
+        try:
+            self._conn.send(message)
+        except (OSError, ValueError) as ex:
+            LOG.warning('Failed to talk to vBMC worker %(index)d: '
+                        '%(error)s', {'index': self.index, 'error': ex})
+
+    def start_bmc(self, bmc_config):
+        self.errors.pop(bmc_config['domain_name'], None)
+        self._send((START, bmc_config))
+
+    def stop_bmc(self, domain_name):
+        self.errors.pop(domain_name, None)
+        self._send((STOP, domain_name))
+
+    def poll(self):
+        """Collect BMC status reports sent by the worker"""
+        with self._lock:
+            try:
+                while self._conn.poll(0):
+                    status, domain_name, error = self._conn.recv()
+                    if status == ERROR:
+                        self.errors[domain_name] = error
+                    else:
+                        self.errors.pop(domain_name, None)
+
+            except (EOFError, OSError):
+                pass
+
+
+class SharedBMCInstance(object):
+    """A vBMC instance hosted by a worker process
+
+    Quacks like the `multiprocessing.Process` used to run a vBMC
+    instance in a dedicated process, so that the manager can handle
+    both the same way. Which worker hosts the instance is up to the
+    engine and may change over time.
+    """
+
+    def __init__(self, engine, bmc_config):
+        self.engine = engine
+        self.worker = None
+        self.bmc_config = bmc_config
+        self.domain_name = bmc_config['domain_name']
+
+    def start(self):
+        self.engine.place(self)
+
+    def is_alive(self):
+        if self.worker is None:
+            return False
+
+        self.worker.poll()
+        return (self.worker.is_alive()
+                and self.domain_name not in self.worker.errors)
+
+    @property
+    def exitcode(self):
+        return None if self.is_alive() else 1
+
+    @property
+    def sentinels(self):
+        """File descriptors signalling changes of this instance
+
+        The worker's process sentinel and its report pipe, shared by
+        all instances hosted by the worker.
+        """
+        if self.worker is None:
+            return []
+
+        return [self.worker.sentinel, self.worker.fileno()]
+
+    def terminate(self):
+        self.engine.remove(self)
+
+
+class HashRing(object):
+    """Consistent hash ring mapping domain names to worker indexes
+
+    Adding or removing a worker only remaps the domains hashed next to
+    that worker's points on the ring, all others stay where they are.
+    """
+
+    REPLICAS = 64
+
+    def __init__(self, nodes):
+        self._ring = sorted(
+            (self._hash('%s-%s' % (node, replica)), node)
+            for node in nodes for replica in range(self.REPLICAS))
+        self._hashes = [point for point, node in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    def get(self, key):
+        if not self._ring:
+            return None
+
+        position = bisect.bisect(self._hashes, self._hash(key))
+        return self._ring[position % len(self._ring)][1]
+
+
+class SharedEngine(object):
+    """Run vBMC instances in a pool of shared worker processes
+
+    vBMC instances are spread over the workers (shards) by consistent
+    hashing of their domain names. Dead workers are restarted, unless
+    they keep crashing right after start, in which case they are left
+    out of the ring for a while and their instances are rebalanced over
+    the surviving workers.
+    """
+
+    # Workers dying sooner than that (in seconds) after start are
+    # considered crashing and not restarted for that long
+    RESTART_BACKOFF = 30
+
+    def __init__(self, workers=None):
+        workers = workers or os.cpu_count() or 1
+        self.size = workers
+        self._workers = {}
+        self._instances = {}
+        self._backoff = {}
+        self._ring = HashRing(range(workers))
+
+    def _update_ring(self):
+        now = time.monotonic()
+        for index, deadline in list(self._backoff.items()):
+            if deadline <= now:
+                del self._backoff[index]
+
+        shards = [index for index in range(self.size)
+                  if index not in self._backoff]
+
+        # Never leave the ring empty, a crashing worker beats no worker
+        self._ring = HashRing(shards or range(self.size))
+
+    def _check_workers(self):
+        now = time.monotonic()
+        ring_changed = any(deadline <= now
+                           for deadline in self._backoff.values())
+
+        for index, worker in list(self._workers.items()):
+            if worker.is_alive():
+                continue
+
+            del self._workers[index]
+
+            if now - worker.started_at < self.RESTART_BACKOFF:
+                LOG.warning('vBMC worker %(index)d keeps dying, moving its '
+                            'instances to other workers', {'index': index})
+                self._backoff[index] = now + self.RESTART_BACKOFF
+                ring_changed = True
+            else:
+                LOG.warning('vBMC worker %(index)d died, restarting it',
+                            {'index': index})
+
+        if ring_changed:
+            self._update_ring()
+
+    def _get_worker(self, domain_name):
+        index = self._ring.get(domain_name)
+
+        worker = self._workers.get(index)
+        if worker is None:
+            worker = self._workers[index] = Worker(index)
+            worker.start()
+
+        return worker
+
+    def spawn(self, bmc_config):
+        """Create a (not yet started) vBMC instance"""
+        return SharedBMCInstance(self, bmc_config)
+
+    def place(self, instance):
+        """Start an instance on the worker its domain is hashed to"""
+        self._check_workers()
+
+        self._instances[instance.domain_name] = instance
+        self._move(instance, self._get_worker(instance.domain_name))
+
+    def _move(self, instance, worker):
+        if instance.worker is not None and instance.worker is not worker:
+            if instance.worker.is_alive():
+                instance.worker.stop_bmc(instance.domain_name)
+
+        instance.worker = worker
+        worker.start_bmc(instance.bmc_config)
+
+    def remove(self, instance):
+        if self._instances.get(instance.domain_name) is instance:
+            del self._instances[instance.domain_name]
+
+        if instance.worker is not None:
+            instance.worker.stop_bmc(instance.domain_name)
+
+    def rebalance(self):
+        """Restart dead workers and move misplaced instances
+
+        Instances end up misplaced when their worker dies or the number
+        of workers changes.
+        """
+        self._check_workers()
+
+        for instance in list(self._instances.values()):
+            worker = self._get_worker(instance.domain_name)
+
+            if instance.worker is not worker:
+                LOG.debug('Moving vBMC instance for domain %(domain)s to '
+                          'worker %(index)d', {'domain': instance.domain_name,
+                                               'index': worker.index})
+                self._move(instance, worker)
+
+    def resize(self, workers):
+        """Change the number of workers, rebalancing instances"""
+        for index in list(self._workers):
+            if index >= workers:
+                self._workers.pop(index).terminate()
+
+        self.size = workers
+        self._backoff = {index: deadline
+                         for index, deadline in self._backoff.items()
+                         if index < workers}
+        self._update_ring()
+
+        self.rebalance()
+
+    def shutdown(self):
+        for worker in self._workers.values():
+            worker.terminate()
+
+        self._workers = {}
+        self._instances = {}
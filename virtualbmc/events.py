@@ -0,0 +1,201 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import os
+import threading
+import time
+
+import libvirt
+
+from virtualbmc import config as vbmc_config
+from virtualbmc import exception
+from virtualbmc import log
+from virtualbmc import utils
+
+LOG = log.get_logger()
+
+CONF = vbmc_config.get_config()
+
+# Minimum time (in seconds) between attempts to re-establish a
+# broken event channel
+RECONNECT_INTERVAL = 5
+
+EVENT_LOOP_PID = None
+
+MONITORS = {}
+
+# Reboot and watchdog events, dispatched along with the lifecycle ones
+REBOOT_EVENT = 'reboot'
+WATCHDOG_EVENT = 'watchdog'
+
+
+def start_event_loop():
+    """Run libvirt's default event loop in a background thread.
+
+    libvirt only delivers domain events (and keepalive probes) on
+    connections opened after an event loop implementation has been
+    registered, so this has to be called early. Threads do not survive
+    `fork()`, hence the loop is (re)started once per process.
+    """
+    global EVENT_LOOP_PID
+    if EVENT_LOOP_PID == os.getpid():
+        return
+
+    libvirt.virEventRegisterDefaultImpl()
+
+    def run_event_loop():
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    thread = threading.Thread(target=run_event_loop,
+                              name='libvirt-event-loop', daemon=True)
+    thread.start()
+
+    EVENT_LOOP_PID = os.getpid()
+
+
+class DomainEventMonitor(object):
+    """Dispatch libvirt domain lifecycle events to subscribers.
+
+    A monitor holds one dedicated connection per libvirt URI and listens
+    to the lifecycle events of all its domains, handing each one over to
+    the callbacks subscribed to that domain name as `callback(event,
+    detail)`. Reboot and watchdog events come as `REBOOT_EVENT` and
+    `WATCHDOG_EVENT`, the latter with the watchdog action as `detail`.
+    When the event channel goes down every subscriber is called with
+    `event` set to `None`, as events may have been lost.
+    """
+
+    def __init__(self, uri, sasl_username=None, sasl_password=None):
+        self.uri = uri
+        self.sasl_username = sasl_username
+        self.sasl_password = sasl_password
+        self.alive = False
+        self._conn = None
+        self._next_connect = 0
+        self._lock = threading.Lock()
+        self._subscribers = collections.defaultdict(list)
+
+    def subscribe(self, domain_name, callback):
+        with self._lock:
+            self._subscribers[domain_name].append(callback)
+
+        self.connect()
+
+    def unsubscribe(self, domain_name, callback):
+        with self._lock:
+            callbacks = self._subscribers.get(domain_name, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._subscribers.pop(domain_name, None)
+
+    def connect(self):
+        """Make sure the event channel is up.
+
+        Reconnection attempts are rate limited, so this is cheap enough
+        to be called on every request.
+
+        :returns: whether events are being received
+        """
+        if self.alive:
+            return True
+
+        with self._lock:
+            now = time.monotonic()
+            if self.alive or now < self._next_connect:
+                return self.alive
+
+            self._next_connect = now + RECONNECT_INTERVAL
+
+            start_event_loop()
+
+            try:
+                conn = utils.open_connection(
+                    self.uri, sasl_username=self.sasl_username,
+                    sasl_password=self.sasl_password, readonly=True)
+                conn.registerCloseCallback(self._on_close, None)
+                conn.domainEventRegisterAny(
+                    None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                    self._on_lifecycle, None)
+                conn.domainEventRegisterAny(
+                    None, libvirt.VIR_DOMAIN_EVENT_ID_REBOOT,
+                    self._on_reboot, None)
+                conn.domainEventRegisterAny(
+                    None, libvirt.VIR_DOMAIN_EVENT_ID_WATCHDOG,
+                    self._on_watchdog, None)
+
+            except (libvirt.libvirtError,
+                    exception.LibvirtConnectionOpenError) as e:
+                LOG.warning('Failed to subscribe to libvirt domain events '
+                            'at %(uri)s. Error: %(error)s',
+                            {'uri': self.uri, 'error': e})
+                return False
+
+            try:
+                conn.setKeepAlive(CONF['libvirt']['keepalive_interval'],
+                                  CONF['libvirt']['keepalive_count'])
+            except libvirt.libvirtError:
+                pass
+
+            self._conn = conn
+            self.alive = True
+
+        LOG.debug('Subscribed to libvirt domain events at %(uri)s',
+                  {'uri': self.uri})
+        return True
+
+    def _notify(self, domain_name, event, detail):
+        with self._lock:
+            callbacks = list(self._subscribers.get(domain_name, ()))
+
+        for callback in callbacks:
+            try:
+                callback(event, detail)
+            except Exception as e:
+                LOG.error('Error handling libvirt event %(event)s for '
+                          'domain %(domain)s: %(error)s',
+                          {'event': event, 'domain': domain_name,
+                           'error': e})
+
+    def _on_lifecycle(self, conn, domain, event, detail, opaque):
+        self._notify(domain.name(), event, detail)
+
+    def _on_reboot(self, conn, domain, opaque):
+        self._notify(domain.name(), REBOOT_EVENT, 0)
+
+    def _on_watchdog(self, conn, domain, action, opaque):
+        self._notify(domain.name(), WATCHDOG_EVENT, action)
+
+    def _on_close(self, conn, reason, opaque):
+        LOG.warning('Lost libvirt event channel to %(uri)s (reason '
+                    '%(reason)s)', {'uri': self.uri, 'reason': reason})
+        self.alive = False
+        self._conn = None
+
+        with self._lock:
+            domain_names = list(self._subscribers)
+
+        for domain_name in domain_names:
+            self._notify(domain_name, None, reason)
+
+
+def get_event_monitor(uri, sasl_username=None, sasl_password=None):
+    """Return this process' event monitor for a libvirt URI."""
+    key = (os.getpid(), uri, sasl_username)
+    monitor = MONITORS.get(key)
+    if monitor is None:
+        monitor = MONITORS[key] = DomainEventMonitor(
+            uri, sasl_username=sasl_username, sasl_password=sasl_password)
+
+    return monitor
@@ -39,3 +39,22 @@ class LibvirtConnectionOpenError(VirtualBMCError):
 class DetachProcessError(VirtualBMCError):
     message = ('Error when forking (detaching) the VirtualBMC process '
                'from its parent and session. Error: %(error)s')
+
+
+class BackendError(VirtualBMCError):
+    message = ('Backend operation %(operation)s failed for domain '
+               '%(domain)s. Error: %(error)s')
+
+
+class QMPError(VirtualBMCError):
+    message = 'QMP protocol error on monitor %(path)s. Error: %(error)s'
+
+
+class QMPCommandError(VirtualBMCError):
+    message = ('QMP command %(command)s failed on monitor %(path)s. '
+               'Error: %(error)s')
+
+
+class OperationNotSupported(BackendError):
+    message = ('Backend operation %(operation)s is not supported for '
+               'domain %(domain)s')
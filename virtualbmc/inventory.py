@@ -0,0 +1,276 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""FRU inventory and SDR repository of a domain
+
+Both are derived from the domain definition and encoded once, as
+described by the IPMI Platform Management FRU Information Storage
+Definition v1.0 and section 43 of the IPMI specification. Reads of the
+FRU data and of the SDRs are then served off the encoded bytes.
+"""
+
+import xml.etree.ElementTree as ET
+
+from virtualbmc import sensors
+
+# FRU device ID of the domain
+FRU_DEVICE_ID = 0
+
+FRU_FORMAT_VERSION = 0x01
+
+# 8-bit ASCII + Latin 1 fields of at most 63 bytes, end of fields
+FRU_FIELD_TYPE = 0xC0
+MAX_FRU_FIELD_LENGTH = 63
+END_OF_FIELDS = 0xC1
+
+# Areas are at most 255 blocks of 8 bytes
+FRU_BLOCK_SIZE = 8
+MAX_FRU_AREA_SIZE = 255 * FRU_BLOCK_SIZE
+
+CHASSIS_TYPE_OTHER = 0x01
+LANGUAGE_ENGLISH = 0x00
+
+DEFAULT_MANUFACTURER = 'libvirt'
+
+# SDR record types
+FRU_DEVICE_LOCATOR = 0x11
+MC_DEVICE_LOCATOR = 0x12
+
+# Management controller capabilities: FRU inventory, SEL, SDR repository
+# and sensor device
+MC_CAPABILITIES = 0b00001111
+
+# FRU device locator: logical FRU device behind the management
+# controller, an IPMI FRU inventory
+FRU_LOGICAL = 0x80
+DEVICE_TYPE_FRU_INVENTORY = 0x10
+
+ENTITY_SYSTEM_MANAGEMENT_MODULE = 0x06
+
+MC_NAME = 'VirtualBMC'
+
+# Analog characteristic flags of full sensor records
+NORMAL_MAXIMUM_SPECIFIED = 0x02
+
+MEMORY_UNITS = {
+    'b': 1, 'bytes': 1,
+    'KB': 10 ** 3, 'k': 2 ** 10, 'KiB': 2 ** 10,
+    'MB': 10 ** 6, 'M': 2 ** 20, 'MiB': 2 ** 20,
+    'GB': 10 ** 9, 'G': 2 ** 30, 'GiB': 2 ** 30,
+    'TB': 10 ** 12, 'T': 2 ** 40, 'TiB': 2 ** 40,
+}
+
+
+def parse_domain(domain_xml):
+    """Extract what the inventory describes off a domain XML description
+
+    :returns: a dict of domain properties
+    """
+    tree = ET.fromstring(domain_xml)
+
+    memory = tree.find('memory')
+    if memory is not None:
+        memory = int(memory.text) * MEMORY_UNITS.get(
+            memory.get('unit', 'KiB'), 2 ** 10)
+
+    os_type = tree.find('os/type')
+    sysinfo = {entry.get('name'): (entry.text or '').strip()
+               for entry in tree.findall("sysinfo/system/entry")}
+
+    disks = []
+    for disk in tree.findall('devices/disk'):
+        target = disk.find('target')
+        source = disk.find('source')
+        disks.append({
+            'device': disk.get('device', 'disk'),
+            'target': target is not None and target.get('dev') or '',
+            'bus': target is not None and target.get('bus') or '',
+            'source': source is not None and (
+                source.get('file') or source.get('dev')
+                or source.get('name')) or ''})
+
+    nics = []
+    for interface in tree.findall('devices/interface'):
+        mac = interface.find('mac')
+        model = interface.find('model')
+        nics.append({
+            'mac': mac is not None and mac.get('address') or '',
+            'model': model is not None and model.get('type') or ''})
+
+    return {
+        'name': tree.findtext('name', ''),
+        'uuid': tree.findtext('uuid', ''),
+        'vcpus': int(tree.findtext('vcpu', '1')),
+        'memory': memory or 0,
+        'machine': os_type is not None and os_type.get('machine') or '',
+        'manufacturer': sysinfo.get('manufacturer', DEFAULT_MANUFACTURER),
+        'product': sysinfo.get('product'),
+        'version': sysinfo.get('version', ''),
+        'serial': sysinfo.get('serial'),
+        'disks': disks,
+        'nics': nics,
+    }
+
+
+def _encode_field(value):
+    data = value.encode('latin-1', 'replace')[:MAX_FRU_FIELD_LENGTH]
+    return bytes([FRU_FIELD_TYPE | len(data)]) + data
+
+
+def _checksum(data):
+    return -sum(data) & 0xFF
+
+
+def _encode_area(header, fields, custom_fields):
+    """Encode a FRU info area
+
+    Custom fields not fitting in the area are left out.
+    """
+    data = bytearray([FRU_FORMAT_VERSION, 0]) + bytes(header)
+    for field in fields:
+        data += _encode_field(field)
+
+    # The end marker and the checksum take 2 bytes at most
+    for field in custom_fields:
+        field = _encode_field(field)
+        if len(data) + len(field) + 2 > MAX_FRU_AREA_SIZE:
+            break
+        data += field
+
+    data.append(END_OF_FIELDS)
+    data += bytes(-(len(data) + 1) % FRU_BLOCK_SIZE)
+    data[1] = (len(data) + 1) // FRU_BLOCK_SIZE
+    data.append(_checksum(data))
+    return bytes(data)
+
+
+def encode_fru(domain):
+    """Encode the FRU data of a domain
+
+    :param domain: the domain properties, as returned by `parse_domain`
+    :returns: the FRU data, as read by the Read FRU Data command
+    """
+    serial = domain['serial'] or domain['uuid']
+    product = domain['product'] or domain['machine']
+
+    custom_fields = ['vCPUs: %d' % domain['vcpus'],
+                     'Memory: %d MiB' % (domain['memory'] // 2 ** 20)]
+    custom_fields += ['NIC: %(mac)s %(model)s' % nic
+                      for nic in domain['nics']]
+    custom_fields += ['Disk: %(target)s %(device)s %(bus)s %(source)s' % disk
+                      for disk in domain['disks']]
+
+    chassis = _encode_area([CHASSIS_TYPE_OTHER], ['', serial], [])
+    board = _encode_area(
+        # Manufacturing date unspecified
+        [LANGUAGE_ENGLISH, 0, 0, 0],
+        [domain['manufacturer'], product, serial, '', ''], [])
+    product_area = _encode_area(
+        [LANGUAGE_ENGLISH],
+        [domain['manufacturer'], product, '', domain['version'], serial,
+         domain['name'], ''], custom_fields)
+
+    offset = FRU_BLOCK_SIZE
+    offsets = []
+    for area in (chassis, board, product_area):
+        offsets.append(offset // FRU_BLOCK_SIZE)
+        offset += len(area)
+
+    header = bytearray([FRU_FORMAT_VERSION, 0] + offsets + [0, 0])
+    header.append(_checksum(header))
+    return bytes(header) + chassis + board + product_area
+
+
+def _encode_id_string(name):
+    name = name.encode('latin-1', 'replace')[:sensors.MAX_ID_STRING_LENGTH]
+    return bytes([sensors.ID_STRING_TYPE | len(name)]) + name
+
+
+def encode_mc_device_locator(record_id):
+    body = bytes([
+        sensors.SENSOR_OWNER_ID,
+        0,  # channel
+        0,  # no event or power state notification
+        MC_CAPABILITIES,
+        0, 0, 0,  # reserved
+        ENTITY_SYSTEM_MANAGEMENT_MODULE,
+        1,  # entity instance
+        0,  # OEM
+    ]) + _encode_id_string(MC_NAME)
+    return sensors.encode_record(record_id, MC_DEVICE_LOCATOR, body)
+
+
+def encode_fru_device_locator(record_id, name):
+    body = bytes([
+        sensors.SENSOR_OWNER_ID,
+        FRU_DEVICE_ID,
+        FRU_LOGICAL,
+        0,  # channel
+        0,  # reserved
+        DEVICE_TYPE_FRU_INVENTORY,
+        0,  # device type modifier
+        sensors.ENTITY_SYSTEM_BOARD,
+        1,  # entity instance
+        0,  # OEM
+    ]) + _encode_id_string(name)
+    return sensors.encode_record(record_id, FRU_DEVICE_LOCATOR, body)
+
+
+def encode_sensor_records(first_record_id, domain=None):
+    """Encode the full sensor records
+
+    The memory sensor of a domain is normally at most the memory of
+    the domain.
+    """
+    records = []
+    for record_id, sensor in enumerate(sensors.SENSORS, first_record_id):
+        record = bytearray(sensors.encode_full_sensor_record(record_id,
+                                                             sensor))
+        if domain is not None and sensor.field == 'memory':
+            record[30] |= NORMAL_MAXIMUM_SPECIFIED
+            record[32] = sensors.raw_reading(sensor,
+                                             {'memory': domain['memory']})
+        records.append(bytes(record))
+
+    return records
+
+
+class Inventory(object):
+    """The FRU data and SDRs of a domain, encoded and ready to serve
+
+    :param domain_xml: the domain XML description, None when it can not
+        be had, in which case there is no FRU and only sensors
+    """
+
+    def __init__(self, domain_xml=None):
+        domain = None
+        self.fru = None
+        records = [encode_mc_device_locator(1)]
+
+        if domain_xml is not None:
+            domain = parse_domain(domain_xml)
+            self.fru = encode_fru(domain)
+            records.append(encode_fru_device_locator(len(records) + 1,
+                                                     domain['name']))
+
+        records += encode_sensor_records(len(records) + 1, domain)
+        self.sdr = sensors.SdrRepository(records)
+
+    def read_fru(self, offset, count):
+        """Read part of the FRU data
+
+        :raises: IndexError if the offset is out of the FRU data
+        """
+        if offset > len(self.fru):
+            raise IndexError(offset)
+
+        return memoryview(self.fru)[offset:offset + count]
@@ -0,0 +1,239 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import gc
+import multiprocessing
+import signal
+import threading
+import time
+
+from virtualbmc import config as vbmc_config
+from virtualbmc import log
+from virtualbmc import utils
+from virtualbmc.vbmc import VirtualBMC
+
+LOG = log.get_logger()
+
+CONF = vbmc_config.get_config()
+
+# Modules the fork server imports once for all vBMC processes
+PRELOAD_MODULES = ['libvirt', 'pyghmi.ipmi.bmc', 'virtualbmc.vbmc']
+
+
+def _process_name(domain_name):
+    return 'vbmcd-managing-domain-%s' % domain_name
+
+
+def vbmc_runner(bmc_config, started_at=None):
+    utils.exit_on_sigterm()
+
+    # Keep the garbage collector off the objects inherited from the
+    # parent (or the fork server), so that their memory pages stay
+    # shared
+    gc.freeze()
+
+    show_passwords = CONF['default']['show_passwords']
+
+    if show_passwords:
+        show_options = bmc_config
+    else:
+        show_options = utils.mask_dict_password(bmc_config)
+
+    try:
+        vbmc = VirtualBMC(**bmc_config)
+
+    except Exception as ex:
+        LOG.exception(
+            'Error running vBMC with configuration '
+            '%(opts)s: %(error)s', {'opts': show_options,
+                                    'error': ex}
+        )
+        return
+
+    if started_at is not None:
+        LOG.info('vBMC instance for domain %(domain)s listening after '
+                 '%(time).1f ms', {'domain': show_options['domain_name'],
+                                   'time': (time.monotonic() - started_at)
+                                   * 1000})
+
+    try:
+        vbmc.listen(timeout=CONF['ipmi']['session_timeout'])
+
+    except Exception as ex:
+        LOG.exception(
+            'Shutdown vBMC for domain %(domain)s, cause '
+            '%(error)s', {'domain': show_options['domain_name'],
+                          'error': ex}
+        )
+        return
+
+    finally:
+        vbmc.close()
+
+
+def idle_worker_main(conn):
+    """Wait for a vBMC configuration to run
+
+    Idle workers are forked ahead of time, so that starting a vBMC
+    instance does not have to wait for a process to come up.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    try:
+        bmc_config, started_at = conn.recv()
+
+    except EOFError:
+        # The manager is gone, so are we
+        return
+
+    finally:
+        conn.close()
+
+    multiprocessing.current_process().name = _process_name(
+        bmc_config['domain_name'])
+
+    vbmc_runner(bmc_config, started_at=started_at)
+
+
+class BMCProcess(object):
+    """A vBMC instance running in a process of its own
+
+    Quacks like `multiprocessing.Process`, except that the process may
+    be taken from the launcher's pool of idle workers on start.
+    """
+
+    def __init__(self, launcher, bmc_config):
+        self.launcher = launcher
+        self.bmc_config = bmc_config
+        self.process = None
+
+    def start(self):
+        self.process = self.launcher.launch(self.bmc_config)
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    @property
+    def exitcode(self):
+        return self.process and self.process.exitcode
+
+    @property
+    def pid(self):
+        return self.process and self.process.pid
+
+    @property
+    def sentinel(self):
+        return self.process.sentinel
+
+    def terminate(self):
+        if self.process is not None:
+            self.process.terminate()
+
+
+class Launcher(object):
+    """Start vBMC processes
+
+    Processes are forked either from the manager itself or, with the
+    "forkserver" start method, from a small server process which has
+    preloaded libvirt, pyghmi and the vBMC code once. Optionally, a
+    pool of idle workers is kept ready to adopt a vBMC configuration.
+    """
+
+    def __init__(self, start_method='fork', warm_pool=0):
+        self.warm_pool = warm_pool
+        self.start_method = start_method
+        self._context = multiprocessing.get_context(start_method)
+        if start_method == 'forkserver':
+            self._context.set_forkserver_preload(PRELOAD_MODULES)
+        self._idle = collections.deque()
+        self._freeze_lock = threading.Lock()
+        self._forking = 0
+
+    def _fork(self, name, target, args):
+        process = self._context.Process(name=name, target=target,
+                                        args=args)
+        process.daemon = True
+
+        if self.start_method != 'fork':
+            # Not forked from us, the child freezes what it inherits
+            process.start()
+            return process
+
+        # Move the objects alive so far out of the garbage collector's
+        # reach while forking, so that it does not write to (and thus
+        # copy) the memory pages the child shares with us. Processes
+        # get started from several threads at once, the first of them
+        # freezes and the last one unfreezes.
+        with self._freeze_lock:
+            if not self._forking:
+                gc.freeze()
+            self._forking += 1
+
+        try:
+            process.start()
+
+        finally:
+            with self._freeze_lock:
+                self._forking -= 1
+                if not self._forking:
+                    gc.unfreeze()
+
+        return process
+
+    def spawn(self, bmc_config):
+        """Create a (not yet started) vBMC process"""
+        return BMCProcess(self, bmc_config)
+
+    def launch(self, bmc_config):
+        """Run a vBMC instance, in an idle worker if there is one"""
+        started_at = time.monotonic()
+
+        while self._idle:
+            try:
+                process, conn = self._idle.popleft()
+
+            except IndexError:
+                break
+
+            try:
+                if process.is_alive():
+                    conn.send((bmc_config, started_at))
+                    process.name = _process_name(bmc_config['domain_name'])
+                    return process
+
+            except (OSError, ValueError):
+                pass
+
+            finally:
+                conn.close()
+
+        return self._fork(
+            name=_process_name(bmc_config['domain_name']),
+            target=vbmc_runner,
+            args=(bmc_config, started_at))
+
+    def refill(self):
+        """Fork idle workers until the pool is full again"""
+        while len(self._idle) < self.warm_pool:
+            conn, child_conn = self._context.Pipe()
+            process = self._fork(name='vbmcd-idle-worker',
+                                 target=idle_worker_main,
+                                 args=(child_conn,))
+            child_conn.close()
+            self._idle.append((process, conn))
+
+    def shutdown(self):
+        while self._idle:
+            process, conn = self._idle.popleft()
+            conn.close()
+            process.terminate()
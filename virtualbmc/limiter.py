@@ -0,0 +1,195 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import contextlib
+import fcntl
+import hashlib
+import os
+import random
+import threading
+
+from virtualbmc import config as vbmc_config
+from virtualbmc import log
+
+# NOTE: the configuration and the logger are looked up lazily, this
+# module being imported by the utils module the configuration depends on
+
+# Where the kernel lists the file locks held and waited for
+PROC_LOCKS = '/proc/locks'
+
+LIMITERS = {}
+
+_LIMITERS_LOCK = threading.Lock()
+
+# Lock files open in this process, closed in children right after fork
+_OPEN_FDS = set()
+
+_OPEN_FDS_LOCK = threading.Lock()
+
+
+def _close_inherited_fds():
+    # A child sharing the open file of a held slot would keep the slot
+    # for as long as it lives, whatever the parent does
+    for fd in _OPEN_FDS:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+    _OPEN_FDS.clear()
+    _OPEN_FDS_LOCK.release()
+
+
+def _open(path):
+    with _OPEN_FDS_LOCK:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        _OPEN_FDS.add(fd)
+
+    return fd
+
+
+def _close(fd):
+    with _OPEN_FDS_LOCK:
+        _OPEN_FDS.discard(fd)
+        os.close(fd)
+
+
+os.register_at_fork(before=lambda: _OPEN_FDS_LOCK.acquire(),
+                    after_in_parent=lambda: _OPEN_FDS_LOCK.release(),
+                    after_in_child=_close_inherited_fds)
+
+
+class ConcurrencyLimiter(object):
+    """Host-wide limit on the concurrent calls to a libvirt URI.
+
+    Every call holds one of `slots` slots, a slot being an exclusive
+    `flock()` on a lock file of its own, so that all the vBMC processes
+    of the host share the limit whatever their parent. The kernel drops
+    the locks of dead processes, so a killed vBMC never leaks a slot.
+    Processes forked while a slot is held close their copy of its lock
+    file right away, so that the slot is freed along with the parent's.
+
+    The last `reserved` slots are kept for priority calls (the ones
+    changing domains, like power actions), so that a burst of status
+    reads can not hold them up.
+    """
+
+    def __init__(self, lock_dir, uri, slots, reserved=0):
+        self.uri = uri
+        self.slots = slots
+        self.reserved = min(reserved, slots - 1)
+        name = hashlib.sha1(uri.encode('utf-8')).hexdigest()[:16]
+        self._prefix = os.path.join(lock_dir, '.libvirt-%s' % name)
+        self.stats = collections.Counter()
+        os.makedirs(lock_dir, exist_ok=True)
+
+    def _slot_path(self, slot):
+        return '%s.%d.lock' % (self._prefix, slot)
+
+    def _lock(self, slot, blocking=False):
+        # Each call opens the lock file anew: flock() locks belong to
+        # the open file, sharing it would let threads share the slot
+        fd = _open(self._slot_path(slot))
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking
+                                             else fcntl.LOCK_NB))
+
+        except BlockingIOError:
+            _close(fd)
+            return None
+
+        except BaseException:
+            _close(fd)
+            raise
+
+        return fd
+
+    def queue_depth(self):
+        """Count the calls waiting for a slot, host-wide"""
+        inodes = set()
+        for slot in range(self.slots):
+            try:
+                inodes.add(os.stat(self._slot_path(slot)).st_ino)
+            except FileNotFoundError:
+                pass
+
+        depth = 0
+        try:
+            with open(PROC_LOCKS) as f:
+                for line in f:
+                    fields = line.split()
+                    # Lock requests being waited for are marked "->"
+                    if len(fields) > 6 and fields[1] == '->':
+                        inode = fields[6].rsplit(':', 1)[-1]
+                        if inode.isdigit() and int(inode) in inodes:
+                            depth += 1
+
+        except OSError:
+            pass
+
+        return depth
+
+    @contextlib.contextmanager
+    def acquire(self, priority=False):
+        """Hold a slot for the time of a libvirt call
+
+        :param priority: Whether the reserved slots may be used
+        """
+        slots = self.slots if priority else self.slots - self.reserved
+
+        first = random.randrange(slots)
+        for slot in range(first, first + slots):
+            fd = self._lock(slot % slots)
+            if fd is not None:
+                break
+
+        else:
+            self.stats['waits'] += 1
+            log.get_logger().debug(
+                'Waiting for a call slot for libvirt at %(uri)s, '
+                '%(depth)d call(s) queued',
+                {'uri': self.uri, 'depth': self.queue_depth()})
+            if priority and self.reserved:
+                # Priority calls only compete with each other for the
+                # reserved slots
+                slot = random.randrange(self.slots - self.reserved,
+                                        self.slots)
+            else:
+                slot = random.randrange(slots)
+
+            fd = self._lock(slot, blocking=True)
+
+        self.stats['calls'] += 1
+        try:
+            yield
+
+        finally:
+            _close(fd)
+
+
+def get_limiter(uri):
+    """Return the limiter of a libvirt URI or None if calls are unlimited"""
+    conf = vbmc_config.get_config()
+    libvirt_conf = conf['libvirt']
+    if not libvirt_conf['max_concurrent_calls']:
+        return None
+
+    with _LIMITERS_LOCK:
+        limiter = LIMITERS.get(uri)
+        if limiter is None:
+            limiter = LIMITERS[uri] = ConcurrencyLimiter(
+                os.path.dirname(conf['default']['pid_file']), uri,
+                slots=libvirt_conf['max_concurrent_calls'],
+                reserved=libvirt_conf['reserved_calls'])
+
+    return limiter
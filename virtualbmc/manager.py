@@ -10,18 +10,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import configparser
+from concurrent import futures
 import errno
-import multiprocessing
-import os
-import shutil
-import signal
+import time
 
+from virtualbmc import broker
 from virtualbmc import config as vbmc_config
+from virtualbmc import engine
 from virtualbmc import exception
+from virtualbmc import launcher
 from virtualbmc import log
+from virtualbmc import stats
+from virtualbmc import store
 from virtualbmc import utils
-from virtualbmc.vbmc import VirtualBMC
 
 LOG = log.get_logger()
 
@@ -30,62 +31,58 @@ RUNNING = 'running'
 DOWN = 'down'
 ERROR = 'error'
 
-DEFAULT_SECTION = 'VirtualBMC'
-
 CONF = vbmc_config.get_config()
 
+# Seconds between checks of the config store for changes made behind
+# the manager's back
+CHANGES_CHECK_INTERVAL = 3
 
-class VirtualBMCManager(object):
+# Seconds to wait before respawning a vBMC instance found dead, so that
+# crashing instances do not keep the manager busy
+RESPAWN_DELAY = 3
 
-    VBMC_OPTIONS = ['username', 'password', 'address', 'port',
-                    'domain_name', 'libvirt_uri', 'libvirt_sasl_username',
-                    'libvirt_sasl_password', 'active']
+
+class VirtualBMCManager(object):
 
     def __init__(self):
         super(VirtualBMCManager, self).__init__()
         self.config_dir = CONF['default']['config_dir']
+        self._store = store.get_store(self.config_dir)
         self._running_domains = {}
+        self._spawn_concurrency = CONF['default']['spawn_concurrency']
+        self._dirty = {}
+        self._watched = None
+        self._next_changes_check = 0
+        self._launcher = launcher.Launcher(
+            start_method=CONF['default']['bmc_start_method'],
+            warm_pool=CONF['default']['warm_pool_size'])
+        self._broker = None
+        if CONF['libvirt']['broker']:
+            self._broker = broker.BrokerProcess(
+                broker.get_socket_path(),
+                threads=CONF['libvirt']['broker_threads'])
+        self._collector = None
+        # Fake domains have no statistics to collect
+        if (CONF['sensors']['interval']
+                and CONF['default']['backend'] == 'libvirt'):
+            self._collector = stats.StatsCollector(
+                interval=CONF['sensors']['interval'],
+                table_size=CONF['sensors']['table_size'],
+                idle_watts=CONF['sensors']['idle_watts'],
+                vcpu_watts=CONF['sensors']['vcpu_watts'])
+        self._engine = None
+        if CONF['default']['bmc_engine'] == 'shared':
+            self._engine = engine.SharedEngine(
+                workers=CONF['default']['workers'])
+
+    def _domain_names(self):
+        return self._store.domain_names()
 
     def _parse_config(self, domain_name):
-        config_path = os.path.join(self.config_dir, domain_name, 'config')
-        if not os.path.exists(config_path):
-            raise exception.DomainNotFound(domain=domain_name)
-
-        try:
-            config = configparser.ConfigParser()
-            config.read(config_path)
-
-            bmc = {}
-            for item in self.VBMC_OPTIONS:
-                try:
-                    value = config.get(DEFAULT_SECTION, item)
-                except configparser.NoOptionError:
-                    value = None
-
-                bmc[item] = value
-
-            # Port needs to be int
-            bmc['port'] = config.getint(DEFAULT_SECTION, 'port')
-
-            return bmc
-
-        except OSError:
-            raise exception.DomainNotFound(domain=domain_name)
+        return self._store.get(domain_name)
 
     def _store_config(self, **options):
-        config = configparser.ConfigParser()
-        config.add_section(DEFAULT_SECTION)
-
-        for option, value in options.items():
-            if value is not None:
-                config.set(DEFAULT_SECTION, option, str(value))
-
-        config_path = os.path.join(
-            self.config_dir, options['domain_name'], 'config'
-        )
-
-        with open(config_path, 'w') as f:
-            config.write(f)
+        self._store.update(**options)
 
     def _vbmc_enabled(self, domain_name, lets_enable=None, config=None):
         if not config:
@@ -105,58 +102,119 @@ class VirtualBMCManager(object):
 
         return currently_enabled
 
-    def _sync_vbmc_states(self, shutdown=False):
-        """Starts/stops vBMC instances
+    def _spawn(self, bmc_config):
+        if self._engine:
+            return self._engine.spawn(bmc_config)
 
-        Walks over vBMC instances configuration, starts
-        enabled but dead instances, kills non-configured
-        but alive ones.
-        """
+        return self._launcher.spawn(bmc_config)
 
-        def vbmc_runner(bmc_config):
-            # The manager process installs a signal handler for SIGTERM to
-            # propagate it to children. Return to the default handler.
-            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    def _start_instances(self, spawned):
+        """Start freshly spawned vBMC instances
 
-            show_passwords = CONF['default']['show_passwords']
+        Processes are started concurrently, at most `spawn_concurrency`
+        at a time. Instances of the shared engine are only handed over
+        to a worker, which is cheap enough to be done in a row.
 
-            if show_passwords:
-                show_options = bmc_config
-            else:
-                show_options = utils.mask_dict_password(bmc_config)
+        :returns: a dict of start errors by domain name
+        """
+        errors = {}
 
+        def start(domain_name, instance):
             try:
-                vbmc = VirtualBMC(**bmc_config)
+                instance.start()
 
             except Exception as ex:
-                LOG.exception(
-                    'Error running vBMC with configuration '
-                    '%(opts)s: %(error)s', {'opts': show_options,
-                                            'error': ex}
-                )
+                LOG.error('Failed to start vBMC instance for domain '
+                          '%(domain)s: %(error)s',
+                          {'domain': domain_name, 'error': ex})
+                self._running_domains.pop(domain_name, None)
+                errors[domain_name] = str(ex)
                 return
 
-            try:
-                vbmc.listen(timeout=CONF['ipmi']['session_timeout'])
+            LOG.info('Started vBMC instance for domain %(domain)s',
+                     {'domain': domain_name})
 
-            except Exception as ex:
-                LOG.exception(
-                    'Shutdown vBMC for domain %(domain)s, cause '
-                    '%(error)s', {'domain': show_options['domain_name'],
-                                  'error': ex}
-                )
-                return
+            if not instance.is_alive():
+                LOG.debug('Found dead vBMC instance for domain %(domain)s '
+                          '(rc %(rc)s)', {'domain': domain_name,
+                                          'rc': instance.exitcode})
 
-        for domain_name in os.listdir(self.config_dir):
-            if not os.path.isdir(
-                    os.path.join(self.config_dir, domain_name)
-            ):
-                continue
+        concurrency = min(self._spawn_concurrency, len(spawned))
+
+        if self._engine or concurrency <= 1:
+            for domain_name, instance in spawned:
+                start(domain_name, instance)
+
+        else:
+            with futures.ThreadPoolExecutor(concurrency) as executor:
+                for domain_name, instance in spawned:
+                    executor.submit(start, domain_name, instance)
+
+        if not self._engine and spawned:
+            # Get ready for the next ones
+            self._launcher.refill()
 
+        return errors
+
+    def _ensure_services(self):
+        """Start the services the vBMCs rely on, restart dead ones"""
+        if self._broker:
+            # Started ahead of the vBMCs
+            self._broker.ensure_running()
+
+        if self._collector:
+            self._collector.ensure_running()
+
+        if self._engine:
+            self._engine.rebalance()
+        else:
+            # Have idle workers ready by the time vBMCs get started,
+            # the first ones included
+            self._launcher.refill()
+
+    def _watch_stats(self, domain_name, bmc_config=None):
+        """Have the statistics of a domain collected, or no longer"""
+        if not self._collector:
+            return
+
+        # QEMU processes run without libvirt have no statistics
+        if bmc_config is None or bmc_config.get('qmp_socket'):
+            self._collector.unwatch(domain_name)
+            return
+
+        self._collector.watch(
+            domain_name, bmc_config['libvirt_uri'],
+            sasl_username=bmc_config.get('libvirt_sasl_username'),
+            sasl_password=bmc_config.get('libvirt_sasl_password'))
+
+    def _sync_vbmc_states(self, shutdown=False, domain_names=None):
+        """Starts/stops vBMC instances
+
+        Walks over vBMC instances configuration, starts
+        enabled but dead instances, kills non-configured
+        but alive ones.
+
+        :param domain_names: only reconcile these domains rather
+            than all configured ones
+        :returns: a dict of start errors by domain name
+        """
+        if not shutdown:
+            self._ensure_services()
+
+        if domain_names is None:
+            domain_names = self._domain_names()
+
+        spawned = []
+
+        for domain_name in domain_names:
             try:
                 bmc_config = self._parse_config(domain_name)
 
             except exception.DomainNotFound:
+                self._watch_stats(domain_name)
+                instance = self._running_domains.pop(domain_name, None)
+                if instance and instance.is_alive():
+                    instance.terminate()
                 continue
 
             if shutdown:
@@ -172,30 +230,17 @@ class VirtualBMCManager(object):
 
                 if not instance or not instance.is_alive():
 
-                    instance = multiprocessing.Process(
-                        name='vbmcd-managing-domain-%s' % domain_name,
-                        target=vbmc_runner,
-                        args=(bmc_config,)
-                    )
-
-                    instance.daemon = True
-                    instance.start()
+                    instance = self._spawn(bmc_config)
 
                     self._running_domains[domain_name] = instance
 
-                    LOG.info(
-                        'Started vBMC instance for domain '
-                        '%(domain)s', {'domain': domain_name}
-                    )
+                    spawned.append((domain_name, instance))
 
-                if not instance.is_alive():
-                    LOG.debug(
-                        'Found dead vBMC instance for domain %(domain)s '
-                        '(rc %(rc)s)', {'domain': domain_name,
-                                        'rc': instance.exitcode}
-                    )
+                self._watch_stats(domain_name, bmc_config)
 
             else:
+                self._watch_stats(domain_name)
+
                 if instance:
                     if instance.is_alive():
                         instance.terminate()
@@ -206,8 +251,28 @@ class VirtualBMCManager(object):
 
                     self._running_domains.pop(domain_name, None)
 
-    def _show(self, domain_name):
-        bmc_config = self._parse_config(domain_name)
+        errors = self._start_instances(spawned)
+
+        # Instances have come and gone, watch the new ones
+        self._watched = None
+
+        if shutdown:
+            self._launcher.shutdown()
+
+            if self._engine:
+                self._engine.shutdown()
+
+            if self._broker:
+                self._broker.shutdown()
+
+            if self._collector:
+                self._collector.stop()
+
+        return errors
+
+    def _show(self, domain_name, bmc_config=None):
+        if bmc_config is None:
+            bmc_config = self._parse_config(domain_name)
 
         show_passwords = CONF['default']['show_passwords']
 
@@ -227,34 +292,129 @@ class VirtualBMCManager(object):
 
         return show_options
 
+    def _mark_dirty(self, domain_names, delay=0):
+        """Schedule domains for reconciliation
+
+        :param delay: seconds from now the domains are due for
+            reconciliation at the latest
+        """
+        due = time.monotonic() + delay
+        for domain_name in domain_names:
+            self._dirty[domain_name] = min(
+                due, self._dirty.get(domain_name, due))
+
+    def _instance_fds(self, instance):
+        if self._engine:
+            return instance.sentinels
+
+        return [instance.sentinel]
+
+    def watched_fds(self):
+        """File descriptors signalling changes of vBMC instances
+
+        These become readable once a vBMC process exits or a shared
+        engine worker reports on its instances. Instances already
+        scheduled for reconciliation are not watched, as the sentinel
+        of a dead process stays readable.
+
+        :returns: a dict of domain name lists by file descriptor
+        """
+        if self._watched is None:
+            self._watched = {}
+
+            for domain_name, instance in self._running_domains.items():
+                if domain_name in self._dirty:
+                    continue
+
+                if not instance.is_alive():
+                    # Died before we could watch it
+                    self._mark_dirty([domain_name], delay=RESPAWN_DELAY)
+                    continue
+
+                for fd in self._instance_fds(instance):
+                    self._watched.setdefault(fd, []).append(domain_name)
+
+        return self._watched
+
+    def handle_events(self, fds):
+        """Schedule the instances behind readable watched fds"""
+        if not fds:
+            return
+
+        watched = self.watched_fds()
+
+        for fd in fds:
+            for domain_name in watched.get(fd, ()):
+                instance = self._running_domains.get(domain_name)
+                if instance is None or not instance.is_alive():
+                    LOG.debug('vBMC instance for domain %(domain)s is gone',
+                              {'domain': domain_name})
+                    self._mark_dirty([domain_name], delay=RESPAWN_DELAY)
+                    self._watched = None
+
+    def poll_timeout(self):
+        """Milliseconds until some reconciliation work is due"""
+        due = min([self._next_changes_check] + list(self._dirty.values()))
+        return max(0, int((due - time.monotonic()) * 1000))
+
     def periodic(self, shutdown=False):
-        self._sync_vbmc_states(shutdown)
+        """Run the reconciliation work that is due, if any
 
-    def add(self, username, password, port, address, domain_name,
-            libvirt_uri, libvirt_sasl_username, libvirt_sasl_password,
-            **kwargs):
+        Domains get reconciled once they are due, which happens when
+        their config changes, their instance dies or on shutdown. When
+        nothing has changed, this only checks the config store for
+        changes every now and then.
+        """
+        if shutdown:
+            self._dirty.clear()
+            self._sync_vbmc_states(shutdown)
+            return
 
-        # check libvirt's connection and if domain exist prior to adding it
-        utils.check_libvirt_connection_and_domain(
-            libvirt_uri, domain_name,
-            sasl_username=libvirt_sasl_username,
-            sasl_password=libvirt_sasl_password)
+        now = time.monotonic()
 
-        domain_path = os.path.join(self.config_dir, domain_name)
+        if now >= self._next_changes_check:
+            self._next_changes_check = now + CHANGES_CHECK_INTERVAL
 
-        try:
-            os.makedirs(domain_path)
-        except OSError as ex:
-            if ex.errno == errno.EEXIST:
-                return 1, str(ex)
+            if self._store.changed():
+                self._mark_dirty(
+                    set(self._domain_names()) | set(self._running_domains))
 
-            msg = ('Failed to create domain %(domain)s. '
-                   'Error: %(error)s' % {'domain': domain_name, 'error': ex})
-            LOG.error(msg)
-            return 1, msg
+        due = [domain_name for domain_name, deadline in self._dirty.items()
+               if deadline <= now]
+
+        if due:
+            for domain_name in due:
+                del self._dirty[domain_name]
+
+            self._sync_vbmc_states(domain_names=due)
+
+    def check_domain(self, domain_name, libvirt_uri,
+                     libvirt_sasl_username=None, libvirt_sasl_password=None,
+                     qmp_socket=None, **kwargs):
+        """Check libvirt's connection and that the domain of a vBMC exists
+
+        This only talks to libvirt, so it can be done ahead of `add`
+        without holding up the commands the manager serves meanwhile.
+        """
+        if CONF['default']['backend'] == 'libvirt' and not qmp_socket:
+            utils.check_libvirt_connection_and_domain(
+                libvirt_uri, domain_name,
+                sasl_username=libvirt_sasl_username,
+                sasl_password=libvirt_sasl_password)
+
+    def add(self, username, password, port, address, domain_name,
+            libvirt_uri, libvirt_sasl_username, libvirt_sasl_password,
+            qmp_socket=None, checked=False, **kwargs):
+
+        # check libvirt's connection and if domain exist prior to adding it
+        if not checked:
+            self.check_domain(domain_name, libvirt_uri,
+                              libvirt_sasl_username=libvirt_sasl_username,
+                              libvirt_sasl_password=libvirt_sasl_password,
+                              qmp_socket=qmp_socket)
 
         try:
-            self._store_config(domain_name=domain_name,
+            self._store.create(domain_name=domain_name,
                                username=username,
                                password=password,
                                port=str(port),
@@ -262,17 +422,20 @@ class VirtualBMCManager(object):
                                libvirt_uri=libvirt_uri,
                                libvirt_sasl_username=libvirt_sasl_username,
                                libvirt_sasl_password=libvirt_sasl_password,
+                               qmp_socket=qmp_socket,
                                active=False)
 
-        except Exception as ex:
-            self.delete(domain_name)
+        except exception.DomainAlreadyExists as ex:
+            return 1, str(ex)
+
+        except exception.VirtualBMCError as ex:
+            LOG.error(str(ex))
             return 1, str(ex)
 
         return 0, ''
 
     def delete(self, domain_name):
-        domain_path = os.path.join(self.config_dir, domain_name)
-        if not os.path.exists(domain_path):
+        if not self._store.exists(domain_name):
             raise exception.DomainNotFound(domain=domain_name)
 
         try:
@@ -280,60 +443,125 @@ class VirtualBMCManager(object):
         except exception.VirtualBMCError:
             pass
 
-        shutil.rmtree(domain_path)
+        self._store.delete(domain_name)
 
         return 0, ''
 
-    def start(self, domain_name):
-        try:
-            bmc_config = self._parse_config(domain_name)
+    def delete_many(self, domain_names):
+        """Delete vBMCs, stopping them all at once first
 
-        except Exception as ex:
-            return 1, str(ex)
+        :returns: a dict of `(rc, msg)` tuples by domain name
+        """
+        results = {}
+        existing = []
+
+        for domain_name in domain_names:
+            if self._store.exists(domain_name):
+                existing.append(domain_name)
+            else:
+                results[domain_name] = (
+                    1, str(exception.DomainNotFound(domain=domain_name)))
+
+        self.stop_many(existing)
+
+        for domain_name in existing:
+            self._store.delete(domain_name)
+            results[domain_name] = 0, ''
+
+        return results
+
+    def _set_active(self, domain_names, active):
+        """Flag vBMCs (in)active with a single store update
+
+        :returns: a tuple of the names of the vBMCs found and a dict of
+            `(rc, msg)` tuples by the names of the others
+        """
+        results = {}
+        found = []
+        changed = []
+
+        for domain_name in domain_names:
+            try:
+                bmc_config = self._parse_config(domain_name)
+
+            except Exception as ex:
+                results[domain_name] = 1, str(ex)
+                continue
+
+            found.append(domain_name)
+
+            if self._vbmc_enabled(domain_name,
+                                  config=bmc_config) != active:
+                changed.append(domain_name)
+
+        if changed:
+            self._store.set_active(changed, active)
 
-        if domain_name in self._running_domains:
+        return found, results
 
-            self._sync_vbmc_states()
+    def start(self, domain_name):
+        return self.start_many([domain_name])[domain_name]
+
+    def start_many(self, domain_names):
+        """Start vBMCs with a single reconciliation pass
 
-            if domain_name in self._running_domains:
-                LOG.warning(
-                    'BMC instance %(domain)s already running, ignoring '
-                    '"start" command' % {'domain': domain_name})
-                return 0, ''
+        All domains are enabled at once first, then only those are
+        reconciled, so starting N domains parses N configs rather than
+        N * N.
 
+        :returns: a dict of `(rc, msg)` tuples by domain name
+        """
         try:
-            self._vbmc_enabled(domain_name,
-                               config=bmc_config,
-                               lets_enable=True)
+            dirty, results = self._set_active(domain_names, True)
 
         except Exception as e:
-            LOG.exception('Failed to start domain %s', domain_name)
-            return 1, ('Failed to start domain %(domain)s. Error: '
-                       '%(error)s' % {'domain': domain_name, 'error': e})
+            LOG.exception('Failed to start domains %s', domain_names)
+            errors = {domain_name: e for domain_name in domain_names}
+            dirty, results = domain_names, {}
 
-        self._sync_vbmc_states()
+        else:
+            errors = self._sync_vbmc_states(domain_names=dirty)
+
+        for domain_name in dirty:
+            if domain_name in errors:
+                results[domain_name] = 1, (
+                    'Failed to start domain %(domain)s. Error: '
+                    '%(error)s' % {'domain': domain_name,
+                                   'error': errors[domain_name]})
+            else:
+                results[domain_name] = 0, ''
 
-        return 0, ''
+        return results
 
     def stop(self, domain_name):
+        return self.stop_many([domain_name])[domain_name]
+
+    def stop_many(self, domain_names):
+        """Stop vBMCs with a single reconciliation pass
+
+        :returns: a dict of `(rc, msg)` tuples by domain name
+        """
         try:
-            self._vbmc_enabled(domain_name, lets_enable=False)
+            dirty, results = self._set_active(domain_names, False)
 
         except Exception as ex:
-            LOG.exception('Failed to stop domain %s', domain_name)
-            return 1, str(ex)
+            LOG.exception('Failed to stop domains %s', domain_names)
+            return {domain_name: (1, str(ex)) for domain_name in domain_names}
 
-        self._sync_vbmc_states()
+        self._sync_vbmc_states(domain_names=dirty)
 
-        return 0, ''
+        for domain_name in dirty:
+            results[domain_name] = 0, ''
+
+        return results
 
     def list(self):
         rc = 0
         tables = []
         try:
-            for domain in os.listdir(self.config_dir):
-                if os.path.isdir(os.path.join(self.config_dir, domain)):
-                    tables.append(self._show(domain))
+            for bmc_config in self._store.get_all():
+                tables.append(self._show(bmc_config['domain_name'],
+                                         bmc_config=bmc_config))
 
         except OSError as e:
             if e.errno == errno.EEXIST:
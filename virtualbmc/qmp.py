@@ -0,0 +1,168 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Client of the QEMU Machine Protocol
+
+QMP messages are JSON objects, one per line. The connection to the
+monitor socket of a QEMU process is kept open across commands, so that
+a command costs a round trip to QEMU and nothing more. Asynchronous
+events QEMU sends in between responses are skipped.
+"""
+
+import json
+import select
+import socket
+import threading
+
+from virtualbmc import exception
+from virtualbmc import log
+
+LOG = log.get_logger()
+
+
+class QMPClient(object):
+    """A connection to the QMP monitor socket of a QEMU process
+
+    Commands may be executed from several threads, they are sent one
+    at a time. The connection is opened on the first command and opened
+    again on the next one once lost.
+
+    :param path: the path of the UNIX socket of the monitor
+    :param timeout: seconds to wait for the monitor to answer
+    """
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sock = None
+        self._file = None
+        self._next_id = 0
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+            self._sock = sock
+            self._file = sock.makefile('rb')
+
+            greeting = self._receive()
+            if 'QMP' not in greeting:
+                raise exception.QMPError(path=self.path,
+                                         error='no QMP greeting')
+
+            # Leave the capabilities negotiation mode
+            self._command('qmp_capabilities')
+
+        except BaseException:
+            self._close()
+            raise
+
+        LOG.debug('Connected to the QMP monitor %(path)s',
+                  {'path': self.path})
+
+    def _receive(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionResetError('QMP monitor %s closed the '
+                                       'connection' % self.path)
+
+        try:
+            return json.loads(line)
+
+        except ValueError as e:
+            raise exception.QMPError(path=self.path, error=e)
+
+    def _command(self, command, arguments=None):
+        self._next_id += 1
+        message = {'execute': command, 'id': self._next_id}
+        if arguments:
+            message['arguments'] = arguments
+
+        self._sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+        while True:
+            response = self._receive()
+            if 'event' in response:
+                LOG.debug('QMP monitor %(path)s sent event %(event)s',
+                          {'path': self.path, 'event': response['event']})
+                continue
+
+            if response.get('id') != self._next_id:
+                # A response to a command that timed out
+                continue
+
+            if 'error' in response:
+                raise exception.QMPCommandError(
+                    path=self.path, command=command,
+                    error=response['error'].get('desc'))
+
+            return response.get('return')
+
+    def _alive(self):
+        """Tell whether the connection is still up, without blocking"""
+        try:
+            poller = select.poll()
+            poller.register(self._sock, select.POLLIN)
+            readable = poller.poll(0)
+            # Pending events count, a closed connection reads as empty
+            return not readable or bool(self._sock.recv(1, socket.MSG_PEEK))
+
+        except OSError:
+            return False
+
+    def execute(self, command, arguments=None):
+        """Execute a QMP command
+
+        A connection found closed, say as QEMU got restarted, is opened
+        again before sending the command. A command is never sent twice.
+
+        :param command: the name of the command
+        :param arguments: a dict of the command arguments, if any
+        :returns: what the command returns
+        :raises: OSError when QEMU can not be reached or the connection
+            gets lost, QMPCommandError when the command fails and
+            QMPError on protocol errors
+        """
+        with self._lock:
+            if self._sock is not None and not self._alive():
+                LOG.debug('Lost the connection to the QMP monitor '
+                          '%(path)s, reconnecting', {'path': self.path})
+                self._close()
+
+            if self._sock is None:
+                self._connect()
+
+            try:
+                return self._command(command, arguments)
+
+            except exception.QMPCommandError:
+                raise
+
+            except BaseException:
+                self._close()
+                raise
+
+    def close(self):
+        """Close the connection, once the command being executed is over"""
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        sock, self._sock = self._sock, None
+        if sock is None:
+            return
+
+        self._file.close()
+        self._file = None
+        sock.close()
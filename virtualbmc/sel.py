@@ -0,0 +1,308 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""System Event Log of a vBMC
+
+The log is a ring of a fixed number of 16-byte System Event Records
+(section 32.1 of the IPMI specification), the newest entry overwriting
+the oldest one once the ring is full. Entries are encoded once, when
+added, and served as they are.
+"""
+
+import collections
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from virtualbmc import log
+
+LOG = log.get_logger()
+
+ENTRY_SIZE = 16
+
+SEL_VERSION = 0x51
+
+SYSTEM_EVENT_RECORD = 0x02
+
+# Events are generated by the BMC (slave address 0x20, LUN 0)
+GENERATOR_ID = 0x0020
+
+EVENT_MESSAGE_REVISION = 0x04
+
+# Event/reading type code of sensor-specific events, direction bit
+SENSOR_SPECIFIC = 0x6F
+DEASSERTION = 0x80
+
+# Event data 2 and 3 unspecified
+UNSPECIFIED = 0xFF
+
+# Record IDs cycle through 1 - 0xFFFE, 0xFFFF stands for the last entry
+LAST_RECORD_ID = 0xFFFF
+MAX_RECORD_ID = 0xFFFE
+
+# Sensor types (table 42-3) and the numbers of the sensors of the events
+SENSOR_TYPE_POWER_UNIT = 0x09
+SENSOR_TYPE_SYSTEM_RESTART = 0x1D
+SENSOR_TYPE_OS_STOP = 0x20
+SENSOR_TYPE_WATCHDOG = 0x23
+
+POWER_UNIT_SENSOR = 0x10
+SYSTEM_RESTART_SENSOR = 0x11
+OS_STOP_SENSOR = 0x12
+WATCHDOG_SENSOR = 0x13
+
+Event = collections.namedtuple(
+    'Event', ['sensor_type', 'sensor_number', 'offset', 'deassertion'])
+
+POWER_ON = Event(SENSOR_TYPE_POWER_UNIT, POWER_UNIT_SENSOR, 0x00, True)
+POWER_OFF = Event(SENSOR_TYPE_POWER_UNIT, POWER_UNIT_SENSOR, 0x00, False)
+HARD_RESET = Event(SENSOR_TYPE_SYSTEM_RESTART, SYSTEM_RESTART_SENSOR, 0x01,
+                   False)
+SYSTEM_RESTART = Event(SENSOR_TYPE_SYSTEM_RESTART, SYSTEM_RESTART_SENSOR,
+                       0x07, False)
+CRITICAL_STOP = Event(SENSOR_TYPE_OS_STOP, OS_STOP_SENSOR, 0x01, False)
+WATCHDOG_EXPIRED = Event(SENSOR_TYPE_WATCHDOG, WATCHDOG_SENSOR, 0x00, False)
+WATCHDOG_RESET = Event(SENSOR_TYPE_WATCHDOG, WATCHDOG_SENSOR, 0x01, False)
+WATCHDOG_POWER_DOWN = Event(SENSOR_TYPE_WATCHDOG, WATCHDOG_SENSOR, 0x02,
+                            False)
+
+_ENTRY = struct.Struct('<HBIHBBBBBBB')
+
+MAGIC = b'VSEL'
+
+# Number of entries, entries added since the last clear, times of the
+# last addition and erase
+_FILE_HEADER = struct.Struct('<4sIIII')
+
+
+class SystemEventLog(object):
+    """A ring of SEL entries, saved to a file now and then
+
+    :param capacity: number of entries kept
+    :param path: file the log is loaded from and saved to, if any
+    :param save_interval: seconds an added entry may wait to be saved
+    """
+
+    def __init__(self, capacity, path=None, save_interval=30):
+        self.capacity = max(1, min(capacity, MAX_RECORD_ID))
+        self.path = path
+        self.save_interval = save_interval
+        # Held while reading entries, to keep them from being overwritten
+        self.lock = threading.Lock()
+        self.last_addition = 0
+        self.last_erase = 0
+        self.overflow = False
+        self._entries = bytearray(self.capacity * ENTRY_SIZE)
+        self._view = memoryview(self._entries)
+        # Slot of the oldest entry
+        self._head = 0
+        self._count = 0
+        # Entries added since the last clear, record IDs derive from it
+        self._added = 0
+        self._dirty = False
+        self._save_timer = None
+
+        if path is not None:
+            self._load()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def free_space(self):
+        return (self.capacity - self._count) * ENTRY_SIZE
+
+    def add(self, event, timestamp=None):
+        """Append an entry, overwriting the oldest one if the log is full
+
+        :returns: the record ID of the entry
+        """
+        if timestamp is None:
+            timestamp = int(time.time())
+
+        with self.lock:
+            if self._count == self.capacity:
+                slot = self._head
+                self._head = (self._head + 1) % self.capacity
+                self.overflow = True
+            else:
+                slot = (self._head + self._count) % self.capacity
+                self._count += 1
+
+            record_id = self._added % MAX_RECORD_ID + 1
+            self._added += 1
+
+            _ENTRY.pack_into(
+                self._entries, slot * ENTRY_SIZE, record_id,
+                SYSTEM_EVENT_RECORD, timestamp, GENERATOR_ID,
+                EVENT_MESSAGE_REVISION, event.sensor_type,
+                event.sensor_number,
+                (DEASSERTION if event.deassertion else 0) | SENSOR_SPECIFIC,
+                event.offset, UNSPECIFIED, UNSPECIFIED)
+
+            self.last_addition = timestamp
+            self._dirty = True
+            self._schedule_save()
+
+        return record_id
+
+    def _index(self, record_id):
+        """Return the position of an entry, from the oldest one"""
+        if record_id == 0:
+            index = 0
+        elif record_id == LAST_RECORD_ID:
+            index = self._count - 1
+        else:
+            oldest = self._added - self._count
+            index = (record_id - 1 - oldest) % MAX_RECORD_ID
+
+        if not 0 <= index < self._count or record_id > LAST_RECORD_ID:
+            raise KeyError(record_id)
+
+        return index
+
+    def get(self, record_id, offset, count):
+        """Read (part of) an entry
+
+        To be called with `lock` held, until done with the data read.
+
+        :param record_id: the record ID, 0 for the first entry and
+            0xFFFF for the last one
+        :returns: the ID of the next entry and the data read
+        :raises: KeyError if there is no such entry, IndexError if the
+            offset is out of the entry
+        """
+        index = self._index(record_id)
+        if offset > ENTRY_SIZE:
+            raise IndexError(offset)
+
+        if index == self._count - 1:
+            next_id = LAST_RECORD_ID
+        else:
+            next_id = (self._added - self._count + index + 1) % (
+                MAX_RECORD_ID) + 1
+
+        start = ((self._head + index) % self.capacity) * ENTRY_SIZE
+        return next_id, self._view[start + offset:
+                                   start + min(ENTRY_SIZE, offset + count)]
+
+    def clear(self):
+        with self.lock:
+            self._head = self._count = self._added = 0
+            self.overflow = False
+            self.last_erase = int(time.time())
+            self._dirty = True
+            self._schedule_save()
+
+    def _schedule_save(self):
+        # Called with the lock held
+        if self.path is None or self._save_timer is not None:
+            return
+
+        self._save_timer = threading.Timer(self.save_interval,
+                                           self._save_due)
+        self._save_timer.daemon = True
+        self._save_timer.start()
+
+    def _save_due(self):
+        with self.lock:
+            self._save_timer = None
+
+        self.save()
+
+    def _dump(self):
+        """Return the file contents, entries from the oldest"""
+        end = self._head + self._count
+        data = [_FILE_HEADER.pack(MAGIC, self._count, self._added,
+                                  self.last_addition, self.last_erase),
+                self._view[self._head * ENTRY_SIZE:
+                           min(end, self.capacity) * ENTRY_SIZE]]
+        if end > self.capacity:
+            data.append(self._view[:(end - self.capacity) * ENTRY_SIZE])
+
+        return b''.join(data)
+
+    def save(self):
+        """Save the log to its file, unless it is unchanged"""
+        with self.lock:
+            if self.path is None or not self._dirty:
+                return
+
+            data = self._dump()
+            self._dirty = False
+
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            # Not ours to create: the vBMC got deleted along with it
+            LOG.info('Not saving the SEL to %(path)s, its directory is '
+                     'gone', {'path': self.path})
+            return
+
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.sel-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, self.path)
+
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+        except OSError as e:
+            LOG.warning('Failed to save the SEL to %(path)s: %(error)s',
+                        {'path': self.path, 'error': e})
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+
+        except FileNotFoundError:
+            return
+
+        except OSError as e:
+            LOG.warning('Failed to load the SEL from %(path)s: %(error)s',
+                        {'path': self.path, 'error': e})
+            return
+
+        try:
+            magic, count, added, last_addition, last_erase = (
+                _FILE_HEADER.unpack_from(data))
+        except struct.error:
+            magic = None
+
+        if (magic != MAGIC or count > added
+                or len(data) != _FILE_HEADER.size + count * ENTRY_SIZE):
+            LOG.warning('Ignoring the invalid SEL file %(path)s',
+                        {'path': self.path})
+            return
+
+        # The newest entries, should the log have shrunk
+        count = min(count, self.capacity)
+        self._entries[:count * ENTRY_SIZE] = data[
+            len(data) - count * ENTRY_SIZE:]
+        self._count = count
+        self._added = added
+        self.last_addition = last_addition
+        self.last_erase = last_erase
+        self.overflow = added > count
+
+    def close(self):
+        with self.lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+
+        self.save()
@@ -0,0 +1,193 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Virtual IPMI sensors and their Sensor Data Records
+
+The sensors report the domain statistics gathered by the `stats`
+collector. Each one is an analog threshold-based sensor without
+thresholds, described by a Full Sensor Record (section 43.1 of the IPMI
+specification).
+"""
+
+import collections
+import struct
+
+SDR_VERSION = 0x51
+
+FULL_SENSOR_RECORD = 0x01
+
+# Record ID of the last record's next record
+LAST_RECORD_ID = 0xFFFF
+
+# The BMC owns the sensors
+SENSOR_OWNER_ID = 0x20
+
+# Sensor types (table 42-3)
+SENSOR_TYPE_PROCESSOR = 0x07
+SENSOR_TYPE_MEMORY = 0x0C
+SENSOR_TYPE_OTHER_UNITS = 0x0B
+
+# Entity IDs (table 43-13)
+ENTITY_PROCESSOR = 0x03
+ENTITY_DISK = 0x04
+ENTITY_SYSTEM_BOARD = 0x07
+ENTITY_MEMORY_MODULE = 0x08
+ENTITY_POWER_UNIT = 0x15
+
+# Sensor units 1 byte: rate unit (bits 5:3) and percentage (bit 0)
+UNITS_PER_SECOND = 3 << 3
+UNITS_PERCENTAGE = 0x01
+
+# Base units (table 43-15)
+UNIT_UNSPECIFIED = 0
+UNIT_WATTS = 6
+UNIT_MEGABIT = 68
+UNIT_MEGABYTE = 72
+UNIT_GIGABYTE = 73
+
+# Event/reading type code of threshold-based sensors
+READING_TYPE_THRESHOLD = 0x01
+
+# Scanning and events enabled on initialization, auto re-arm
+SENSOR_INITIALIZATION = 0x7F
+SENSOR_CAPABILITIES = 0x40
+
+# 8-bit ASCII + Latin 1 ID string
+ID_STRING_TYPE = 0xC0
+MAX_ID_STRING_LENGTH = 16
+
+Sensor = collections.namedtuple(
+    'Sensor', ['number', 'name', 'sensor_type', 'entity_id', 'units',
+               'base_unit', 'm', 'r_exp', 'field', 'scale'])
+Sensor.__doc__ = """A virtual sensor
+
+The sensor reads `field` of the domain statistics times `scale`, in
+`base_unit`, and reports it as a raw reading `x` such that the value is
+`m * x * 10 ** r_exp`.
+"""
+
+SENSORS = (
+    Sensor(1, 'CPU Usage', SENSOR_TYPE_PROCESSOR, ENTITY_PROCESSOR,
+           UNITS_PERCENTAGE, UNIT_UNSPECIFIED, 1, 0, 'cpu_usage', 1),
+    Sensor(2, 'Memory', SENSOR_TYPE_MEMORY, ENTITY_MEMORY_MODULE, 0,
+           UNIT_GIGABYTE, 2, -1, 'memory', 1.0 / 2 ** 30),
+    Sensor(3, 'Disk Read', SENSOR_TYPE_OTHER_UNITS, ENTITY_DISK,
+           UNITS_PER_SECOND, UNIT_MEGABYTE, 2, 0, 'disk_read',
+           1.0 / 2 ** 20),
+    Sensor(4, 'Disk Write', SENSOR_TYPE_OTHER_UNITS, ENTITY_DISK,
+           UNITS_PER_SECOND, UNIT_MEGABYTE, 2, 0, 'disk_write',
+           1.0 / 2 ** 20),
+    Sensor(5, 'Net RX', SENSOR_TYPE_OTHER_UNITS, ENTITY_SYSTEM_BOARD,
+           UNITS_PER_SECOND, UNIT_MEGABIT, 4, 0, 'net_rx', 8 / 1e6),
+    Sensor(6, 'Net TX', SENSOR_TYPE_OTHER_UNITS, ENTITY_SYSTEM_BOARD,
+           UNITS_PER_SECOND, UNIT_MEGABIT, 4, 0, 'net_tx', 8 / 1e6),
+    Sensor(7, 'Power', SENSOR_TYPE_OTHER_UNITS, ENTITY_POWER_UNIT, 0,
+           UNIT_WATTS, 2, 0, 'power', 1),
+)
+
+SENSORS_BY_NUMBER = {sensor.number: sensor for sensor in SENSORS}
+
+_SDR_HEADER = struct.Struct('<HBBB')
+
+
+def encode_record(record_id, record_type, body):
+    """Prepend an SDR header to a record body"""
+    return _SDR_HEADER.pack(record_id, SDR_VERSION, record_type,
+                            len(body)) + body
+
+
+def encode_full_sensor_record(record_id, sensor):
+    m = sensor.m & 0x3FF
+    name = sensor.name.encode('latin-1')[:MAX_ID_STRING_LENGTH]
+    body = bytes([
+        SENSOR_OWNER_ID,
+        0,  # owner LUN
+        sensor.number,
+        sensor.entity_id,
+        1,  # entity instance
+        SENSOR_INITIALIZATION,
+        SENSOR_CAPABILITIES,
+        sensor.sensor_type,
+        READING_TYPE_THRESHOLD,
+        0, 0,  # assertion event mask
+        0, 0,  # deassertion event mask
+        0, 0,  # reading mask
+        sensor.units,
+        sensor.base_unit,
+        0,  # modifier unit
+        0,  # linear
+        m & 0xFF,
+        (m >> 8) << 6,  # tolerance
+        0,  # B
+        0,  # accuracy
+        0,  # accuracy, sensor direction
+        (sensor.r_exp & 0x0F) << 4,  # B exponent is 0
+        0,  # analog characteristics
+        0, 0, 0,  # nominal, normal maximum and minimum readings
+        0xFF, 0x00,  # sensor maximum and minimum readings
+        0, 0, 0, 0, 0, 0,  # thresholds
+        0, 0,  # hysteresis
+        0, 0,  # reserved
+        0,  # OEM
+        ID_STRING_TYPE | len(name),
+    ]) + name
+    return encode_record(record_id, FULL_SENSOR_RECORD, body)
+
+
+def raw_reading(sensor, stats):
+    """Convert a statistic into the raw reading of a sensor"""
+    value = stats[sensor.field] * sensor.scale
+    raw = int(round(value / (sensor.m * 10.0 ** sensor.r_exp)))
+    return max(0, min(0xFF, raw))
+
+
+class SdrRepository(object):
+    """Sensor Data Records, as served by the Get SDR commands
+
+    The records are packed in a single buffer, reads are slices of it.
+    """
+
+    def __init__(self, records):
+        self._data = b''.join(records)
+        # Start, end and next record ID by record ID
+        self._index = {}
+        self._first = LAST_RECORD_ID
+
+        offset = len(self._data)
+        next_id = LAST_RECORD_ID
+        for record in reversed(records):
+            record_id, = struct.unpack_from('<H', record)
+            self._index[record_id] = (offset - len(record), offset, next_id)
+            offset -= len(record)
+            next_id = self._first = record_id
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, record_id, offset, count):
+        """Read (part of) a record
+
+        :param record_id: the record ID, 0 for the first record
+        :returns: the ID of the next record and the data read
+        :raises: KeyError if there is no such record, IndexError if the
+            offset is out of the record
+        """
+        if record_id == 0:
+            record_id = self._first
+
+        start, end, next_id = self._index[record_id]
+        if offset > end - start:
+            raise IndexError(offset)
+
+        start += offset
+        return next_id, memoryview(self._data)[start:min(end,
+                                                         start + count)]
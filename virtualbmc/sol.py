@@ -0,0 +1,348 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Serial-over-LAN backed by the serial console of a domain
+
+The console is a non-blocking libvirt stream watched by the libvirt
+event loop, which also drives retransmissions through a timeout: no
+thread is spent per SOL session, and nothing blocks on the IPMI client.
+Console output and client input go through buffers of bounded size.
+Reading the console stops while its output buffer is full, client input
+is NACKed while the input buffer is, both resuming as the buffers drain.
+"""
+
+import libvirt
+import pyghmi.ipmi.console as console
+
+from virtualbmc import events
+from virtualbmc import exception
+from virtualbmc import log
+from virtualbmc import utils
+
+LOG = log.get_logger()
+
+SOL_PAYLOAD_TYPE = 1
+
+# Largest SOL payload sent or accepted, console data taking all but
+# the 4-byte header
+SOL_PAYLOAD_SIZE = 256
+SOL_HEADER_SIZE = 4
+MAX_CHUNK_SIZE = SOL_PAYLOAD_SIZE - SOL_HEADER_SIZE
+
+# Operation/status byte: packet NACKed, character transfer unavailable,
+# SOL deactivating
+SOL_NACK = 0b01000000
+SOL_TRANSFER_UNAVAILABLE = 0b00100000
+SOL_DEACTIVATING = 0b00010000
+
+# Milliseconds between retransmissions of unacknowledged console output,
+# resumptions after a NACK and attempts at reopening the console
+RETRY_INTERVAL = 1000
+MAX_RETRIES = 5
+
+STREAM_ERROR_EVENTS = (libvirt.VIR_STREAM_EVENT_ERROR
+                       | libvirt.VIR_STREAM_EVENT_HANGUP)
+
+# libvirt stream recv() and send() result when they would block
+STREAM_AGAIN = -2
+
+
+class SolConsole(console.ServerConsole):
+    """An SOL session attached to the serial console of a domain
+
+    Callbacks run on the libvirt event loop thread, SOL payloads are
+    handled on the thread serving IPMI requests, `outputlock` guards the
+    state they share.
+
+    :param session: the IPMI session the SOL payload got activated on
+    :param domain_name: the domain name
+    :param conn_args: the libvirt URI and SASL credentials
+    :param buffer_size: size of each of the output and input buffers
+    :param on_close: called once the session is over
+    """
+
+    def __init__(self, session, domain_name, conn_args, buffer_size,
+                 on_close=None):
+        events.start_event_loop()
+        self._conn_args = conn_args
+        self._conn = utils.open_connection(**conn_args)
+        super(SolConsole, self).__init__(session, None)
+        self.domain_name = domain_name
+        self.buffer_size = buffer_size
+        self._on_close = on_close
+        self._output = bytearray()
+        self._input = bytearray()
+        self._stream = None
+        self._stream_events = 0
+        self._timer = None
+        self._timer_interval = -1
+        # Console output bytes in the payload awaiting acknowledgement
+        self._sent = 0
+        self._retries = 0
+        # Output is held back until the next retry after a NACK
+        self._nacked = False
+        # Input bytes accepted off the last payload of the client
+        self._accepted = 0
+        self._closed = False
+
+    def start(self):
+        """Attach to the console, once the activation got answered"""
+        with self.outputlock:
+            self._timer = libvirt.virEventAddTimeout(-1, self._on_timeout,
+                                                     None)
+            self._open_console()
+            self._update()
+
+    def _open_console(self):
+        try:
+            if not self._conn.isAlive():
+                self._conn.close()
+                self._conn = utils.open_connection(**self._conn_args)
+
+            domain = utils.get_libvirt_domain(self._conn, self.domain_name)
+            stream = self._conn.newStream(libvirt.VIR_STREAM_NONBLOCK)
+            domain.openConsole(None, stream, 0)
+            stream.eventAddCallback(
+                libvirt.VIR_STREAM_EVENT_READABLE | STREAM_ERROR_EVENTS,
+                self._on_stream_event, None)
+
+        except (libvirt.libvirtError, exception.VirtualBMCError) as e:
+            LOG.debug('Console of domain %(domain)s unavailable: %(error)s',
+                      {'domain': self.domain_name, 'error': e})
+            return
+
+        self._stream = stream
+        self._stream_events = (libvirt.VIR_STREAM_EVENT_READABLE
+                               | STREAM_ERROR_EVENTS)
+        LOG.debug('SOL attached to the console of domain %(domain)s',
+                  {'domain': self.domain_name})
+
+    def _close_stream(self):
+        stream, self._stream = self._stream, None
+        if stream is None:
+            return
+
+        LOG.debug('SOL detached from the console of domain %(domain)s',
+                  {'domain': self.domain_name})
+        # Client input is of no use to the next console
+        self._input = bytearray()
+        try:
+            stream.eventRemoveCallback()
+            stream.abort()
+        except libvirt.libvirtError:
+            pass
+
+    def _status(self):
+        return 0 if self._stream is not None else SOL_TRANSFER_UNAVAILABLE
+
+    def _send(self, payload):
+        try:
+            self.ipmi_session.send_payload(
+                payload, payload_type=SOL_PAYLOAD_TYPE, retry=False)
+        except Exception as e:
+            LOG.warning('Failed to send an SOL payload for domain '
+                        '%(domain)s: %(error)s',
+                        {'domain': self.domain_name, 'error': e})
+
+    def _read_console(self):
+        """Read the console output while there is room for it"""
+        while len(self._output) < self.buffer_size:
+            data = self._stream.recv(self.buffer_size - len(self._output))
+            if data == STREAM_AGAIN:
+                return
+
+            if not data:
+                # The domain went away along with its console
+                self._close_stream()
+                return
+
+            self._output += data
+
+    def _write_console(self):
+        if self._stream is None or not self._input:
+            return
+
+        try:
+            sent = self._stream.send(bytes(self._input))
+        except libvirt.libvirtError as e:
+            LOG.debug('Lost the console of domain %(domain)s: %(error)s',
+                      {'domain': self.domain_name, 'error': e})
+            self._close_stream()
+            return
+
+        if sent != STREAM_AGAIN:
+            del self._input[:sent]
+
+    def _send_output(self):
+        if (self.awaitingack or self._nacked or not self._output
+                or self.ipmi_session is None):
+            return
+
+        self.myseq = self.myseq % 0x0f + 1
+        self._sent = min(len(self._output), MAX_CHUNK_SIZE)
+        self._retries = 0
+        self.lastpayload = bytearray(
+            (self.myseq, 0, 0, self._status())) + self._output[:self._sent]
+        self.awaitingack = True
+        self._send(self.lastpayload)
+
+    def _update(self):
+        """Watch what the buffers leave room for, send pending output"""
+        self._send_output()
+
+        if self._stream is not None:
+            wanted = STREAM_ERROR_EVENTS
+            # Resume reading once the output buffer is half drained
+            limit = self.buffer_size
+            if not self._stream_events & libvirt.VIR_STREAM_EVENT_READABLE:
+                limit //= 2
+            if len(self._output) < limit:
+                wanted |= libvirt.VIR_STREAM_EVENT_READABLE
+            if self._input:
+                wanted |= libvirt.VIR_STREAM_EVENT_WRITABLE
+
+            if wanted != self._stream_events:
+                try:
+                    self._stream.eventUpdateCallback(wanted)
+                    self._stream_events = wanted
+                except libvirt.libvirtError:
+                    self._close_stream()
+
+        interval = -1
+        if self.awaitingack or self._nacked or self._stream is None:
+            interval = RETRY_INTERVAL
+        if self._timer is not None and interval != self._timer_interval:
+            libvirt.virEventUpdateTimeout(self._timer, interval)
+            self._timer_interval = interval
+
+    def _on_stream_event(self, stream, stream_events, opaque):
+        with self.outputlock:
+            if self._closed or stream is not self._stream:
+                return
+
+            if stream_events & libvirt.VIR_STREAM_EVENT_WRITABLE:
+                self._write_console()
+
+            try:
+                if (self._stream is not None and stream_events
+                        & libvirt.VIR_STREAM_EVENT_READABLE):
+                    self._read_console()
+
+            except libvirt.libvirtError as e:
+                LOG.debug('Lost the console of domain %(domain)s: '
+                          '%(error)s',
+                          {'domain': self.domain_name, 'error': e})
+                self._close_stream()
+
+            if stream_events & STREAM_ERROR_EVENTS:
+                self._close_stream()
+
+            self._update()
+
+    def _on_timeout(self, timer, opaque):
+        with self.outputlock:
+            if self._closed:
+                return
+
+            if self._stream is None:
+                self._open_console()
+
+            if self.awaitingack:
+                self._retries += 1
+                if self._retries > MAX_RETRIES:
+                    LOG.info('SOL client of domain %(domain)s gone, '
+                             'deactivating SOL',
+                             {'domain': self.domain_name})
+                    self.close()
+                    return
+
+                self._send(self.lastpayload)
+
+            self._nacked = False
+            self._update()
+
+    def _got_sol_payload(self, payload):
+        if isinstance(payload, dict):
+            # The IPMI session is over
+            self.close()
+            return
+
+        seq = payload[0] & 0x0f
+        ack_seq = payload[1] & 0x0f
+        with self.outputlock:
+            if self._closed:
+                return
+
+            if seq:
+                self._got_input(seq, payload[SOL_HEADER_SIZE:])
+
+            if ack_seq and self.awaitingack and ack_seq == self.myseq:
+                self.awaitingack = False
+                accepted = self._sent
+                if payload[3] & SOL_NACK:
+                    # Partially accepted at most, the rest is held back
+                    # until the client is ready for more
+                    accepted = min(payload[2], self._sent)
+                    self._nacked = True
+                del self._output[:accepted]
+
+            self._update()
+
+    def _got_input(self, seq, data):
+        if seq != self.remseq:
+            # Not a retransmission, take what fits in the input buffer
+            self.remseq = seq
+            self._accepted = min(len(data),
+                                 self.buffer_size - len(self._input))
+            if self._stream is not None:
+                self._input += data[:self._accepted]
+                self._write_console()
+
+        status = self._status()
+        if self._accepted < len(data):
+            status |= SOL_NACK
+        self._send(bytearray((0, seq, self._accepted, status)))
+
+    def send_data(self, data):
+        """Queue console output, should there be room for it"""
+        with self.outputlock:
+            data = data[:self.buffer_size - len(self._output)]
+            self._output += data
+            self._update()
+
+    def close(self):
+        """Detach from the console and end the SOL session"""
+        with self.outputlock:
+            if self._closed:
+                return
+
+            self._closed = True
+            self.activated = False
+            self._close_stream()
+            if self._timer is not None:
+                libvirt.virEventRemoveTimeout(self._timer)
+                self._timer = None
+
+            if self.ipmi_session is not None:
+                self._send(bytearray((0, 0, 0, SOL_DEACTIVATING)))
+                if getattr(self.ipmi_session.sol_handler, '__self__',
+                           None) is self:
+                    self.ipmi_session.sol_handler = None
+                self.ipmi_session = None
+
+        try:
+            self._conn.close()
+        except libvirt.libvirtError:
+            pass
+
+        if self._on_close is not None:
+            self._on_close(self)
@@ -0,0 +1,468 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Domain statistics shared with the vBMCs
+
+A collector thread of `vbmcd` fetches the statistics of all the domains
+of a libvirt URI with a single `getAllDomainStats` call every now and
+then, turns them into the values the virtual sensors report and writes
+them to a table of fixed-size records in a file mapped to memory. Each
+vBMC maps the table of its URI and reads the record of its domain, so
+that sensor readings never cost a libvirt call.
+
+Records are written by a single writer and read without locks. Each
+record carries a sequence number, odd while the record is being
+written, so that readers can tell a torn read and retry it.
+"""
+
+import collections
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import libvirt
+
+from virtualbmc import config as vbmc_config
+from virtualbmc import log
+from virtualbmc import utils
+
+LOG = log.get_logger()
+
+CONF = vbmc_config.get_config()
+
+# Values of a record, in the units the sensors scale them from
+FIELDS = (
+    'cpu_usage',  # percent of the vCPUs capacity
+    'memory',  # bytes
+    'disk_read',  # bytes per second
+    'disk_write',
+    'net_rx',
+    'net_tx',
+    'power',  # watts, estimated
+    'power_min',
+    'power_max',
+    'power_avg',
+)
+
+MAGIC = b'VBST'
+
+HEADER_SIZE = 64
+
+_HEADER = struct.Struct('<4sII')
+
+# Key, sequence number, flags, timestamp and values
+_RECORD = struct.Struct('<QIId%df' % len(FIELDS))
+
+_KEY = struct.Struct('<Q')
+
+_SEQUENCE = struct.Struct('<I')
+
+_SEQUENCE_OFFSET = _KEY.size
+
+# The record holds readings, the domain is running
+FLAG_VALID = 0x01
+
+READ_RETRIES = 8
+
+STATS_TYPES = (libvirt.VIR_DOMAIN_STATS_STATE
+               | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL
+               | libvirt.VIR_DOMAIN_STATS_BALLOON
+               | libvirt.VIR_DOMAIN_STATS_VCPU
+               | libvirt.VIR_DOMAIN_STATS_INTERFACE
+               | libvirt.VIR_DOMAIN_STATS_BLOCK)
+
+# Number of samples the minimum, maximum and average power cover
+POWER_SAMPLES = 30
+
+
+def get_table_path(uri):
+    name = hashlib.sha1(uri.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(os.path.dirname(CONF['default']['pid_file']),
+                        '.stats-%s' % name)
+
+
+def domain_key(domain_name):
+    digest = hashlib.sha1(domain_name.encode('utf-8')).digest()
+    # 0 marks free records
+    return _KEY.unpack_from(digest)[0] or 1
+
+
+class StatsTable(object):
+    """The statistics table of a libvirt URI, as written by the collector
+
+    The table is created anew, readers still mapping a former table
+    find out and map the new one once their records go stale.
+    """
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self._slots = {}
+        self._free = list(range(capacity - 1, -1, -1))
+
+        size = HEADER_SIZE + capacity * _RECORD.size
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        prefix='.stats-')
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+            _HEADER.pack_into(self._map, 0, MAGIC, _RECORD.size, capacity)
+            os.replace(tmp_path, path)
+
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        finally:
+            os.close(fd)
+
+    def _offset(self, slot):
+        return HEADER_SIZE + slot * _RECORD.size
+
+    def names(self):
+        return set(self._slots)
+
+    def update(self, domain_name, values=None):
+        """Write the record of a domain
+
+        :param values: a dict of `FIELDS` values, None if the domain
+            has no readings
+        """
+        slot = self._slots.get(domain_name)
+        if slot is None:
+            if not self._free:
+                LOG.warning('Statistics table %(path)s is full, no '
+                            'readings for domain %(domain)s',
+                            {'path': self.path, 'domain': domain_name})
+                return
+
+            slot = self._slots[domain_name] = self._free.pop()
+
+        offset = self._offset(slot)
+        sequence = _SEQUENCE.unpack_from(self._map,
+                                         offset + _SEQUENCE_OFFSET)[0]
+        # Odd while writing
+        _SEQUENCE.pack_into(self._map, offset + _SEQUENCE_OFFSET,
+                            (sequence + 1) & 0xffffffff)
+
+        flags = FLAG_VALID if values is not None else 0
+        values = values or {}
+        _RECORD.pack_into(self._map, offset, domain_key(domain_name),
+                          (sequence + 1) & 0xffffffff, flags, time.time(),
+                          *[values.get(field, 0) for field in FIELDS])
+
+        _SEQUENCE.pack_into(self._map, offset + _SEQUENCE_OFFSET,
+                            (sequence + 2) & 0xffffffff)
+
+    def remove(self, domain_name):
+        slot = self._slots.pop(domain_name, None)
+        if slot is None:
+            return
+
+        _RECORD.pack_into(self._map, self._offset(slot), 0, 0, 0, 0,
+                          *[0] * len(FIELDS))
+        self._free.append(slot)
+
+    def close(self):
+        self._map.close()
+
+
+class StatsReader(object):
+    """Read the statistics of a domain off the table of its URI"""
+
+    def __init__(self, path, domain_name, max_age):
+        self.path = path
+        self.key = domain_key(domain_name)
+        self.max_age = max_age
+        self._map = None
+        self._inode = None
+        self._capacity = 0
+        self._slot = None
+
+    def _reopen(self):
+        """Map the table unless it is mapped already
+
+        :returns: whether a new table got mapped
+        """
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+
+        except FileNotFoundError:
+            return False
+
+        try:
+            stat = os.fstat(fd)
+            if stat.st_ino == self._inode or stat.st_size < HEADER_SIZE:
+                return False
+
+            table = mmap.mmap(fd, stat.st_size, access=mmap.ACCESS_READ)
+
+        finally:
+            os.close(fd)
+
+        magic, record_size, capacity = _HEADER.unpack_from(table)
+        if (magic != MAGIC or record_size != _RECORD.size
+                or stat.st_size < HEADER_SIZE + capacity * record_size):
+            table.close()
+            return False
+
+        if self._map is not None:
+            self._map.close()
+
+        self._map = table
+        self._inode = stat.st_ino
+        self._capacity = capacity
+        self._slot = None
+        return True
+
+    def _find(self):
+        for slot in range(self._capacity):
+            offset = HEADER_SIZE + slot * _RECORD.size
+            if _KEY.unpack_from(self._map, offset)[0] == self.key:
+                return slot
+
+    def _read_record(self):
+        if self._map is None:
+            return None
+
+        if self._slot is None:
+            self._slot = self._find()
+            if self._slot is None:
+                return None
+
+        offset = HEADER_SIZE + self._slot * _RECORD.size
+        for _ in range(READ_RETRIES):
+            sequence = _SEQUENCE.unpack_from(self._map,
+                                             offset + _SEQUENCE_OFFSET)[0]
+            if sequence & 1:
+                continue
+
+            record = _RECORD.unpack_from(self._map, offset)
+            if record[1] == sequence:
+                break
+
+        else:
+            return None
+
+        if record[0] != self.key:
+            # The record got reused for another domain
+            self._slot = None
+            return None
+
+        if time.time() - record[3] > self.max_age:
+            return None
+
+        return record
+
+    def read(self):
+        """Return the statistics of the domain
+
+        :returns: a dict of `FIELDS` values and their `timestamp`, None
+            if the domain has no readings
+        """
+        record = self._read_record()
+        if record is None and self._reopen():
+            record = self._read_record()
+
+        if record is None or not record[2] & FLAG_VALID:
+            return None
+
+        values = dict(zip(FIELDS, record[4:]))
+        values['timestamp'] = record[3]
+        return values
+
+
+def _sum_counters(record, prefix, names):
+    totals = [0] * len(names)
+    for index in range(record.get('%s.count' % prefix, 0)):
+        for position, name in enumerate(names):
+            totals[position] += record.get(
+                '%s.%d.%s' % (prefix, index, name), 0)
+
+    return totals
+
+
+def get_counters(record):
+    """Pick the counters rates are computed from off domain stats"""
+    counters = [record['cpu.time']]
+    counters += _sum_counters(record, 'block', ('rd.bytes', 'wr.bytes'))
+    counters += _sum_counters(record, 'net', ('rx.bytes', 'tx.bytes'))
+    return counters
+
+
+class _DomainSampler(object):
+    """Turn the successive stats of a domain into sensor values"""
+
+    def __init__(self, idle_watts, vcpu_watts):
+        self.idle_watts = idle_watts
+        self.vcpu_watts = vcpu_watts
+        self._previous = None
+        self._power = collections.deque(maxlen=POWER_SAMPLES)
+
+    def sample(self, record, now):
+        """Return the sensor values or None if there are none yet"""
+        # Only running domains report CPU time
+        if 'cpu.time' not in record:
+            self._previous = None
+            self._power.clear()
+            return None
+
+        counters = get_counters(record)
+        previous, self._previous = self._previous, (now, counters)
+        if previous is None:
+            return None
+
+        elapsed = now - previous[0]
+        deltas = [current - last
+                  for current, last in zip(counters, previous[1])]
+        if elapsed <= 0 or min(deltas) < 0:
+            # Restarted domain, start over
+            return None
+
+        rates = [delta / elapsed for delta in deltas]
+        vcpus = record.get('vcpu.current') or 1
+        cpu_usage = min(100.0, rates[0] / 1e9 / vcpus * 100)
+        power = self.idle_watts + self.vcpu_watts * vcpus * cpu_usage / 100
+        self._power.append(power)
+
+        memory = record.get('balloon.current',
+                            record.get('balloon.maximum', 0))
+
+        return {
+            'cpu_usage': cpu_usage,
+            'memory': memory * 1024,
+            'disk_read': rates[1],
+            'disk_write': rates[2],
+            'net_rx': rates[3],
+            'net_tx': rates[4],
+            'power': power,
+            'power_min': min(self._power),
+            'power_max': max(self._power),
+            'power_avg': sum(self._power) / len(self._power),
+        }
+
+
+class StatsCollector(object):
+    """Periodically fill the statistics tables of the watched domains"""
+
+    def __init__(self, interval, table_size, idle_watts, vcpu_watts):
+        self.interval = interval
+        self.table_size = table_size
+        self.idle_watts = idle_watts
+        self.vcpu_watts = vcpu_watts
+        self._watched = {}
+        self._tables = {}
+        self._samplers = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def watch(self, domain_name, uri, sasl_username=None,
+              sasl_password=None):
+        with self._lock:
+            self._watched[domain_name] = (uri, sasl_username, sasl_password)
+
+    def unwatch(self, domain_name):
+        with self._lock:
+            self._watched.pop(domain_name, None)
+
+    def _targets(self):
+        """Group the watched domains by libvirt URI
+
+        :returns: a dict of `(conn_args, domain_names)` tuples by URI
+        """
+        targets = {}
+        with self._lock:
+            for domain_name, conn_args in self._watched.items():
+                # Domains of a URI share a table, one connection does
+                targets.setdefault(conn_args[0], (conn_args, set()))[
+                    1].add(domain_name)
+
+        return targets
+
+    def _get_table(self, uri):
+        table = self._tables.get(uri)
+        if table is None:
+            table = self._tables[uri] = StatsTable(get_table_path(uri),
+                                                   self.table_size)
+        return table
+
+    def _collect_uri(self, conn_args, domain_names):
+        uri, sasl_username, sasl_password = conn_args
+
+        start = time.monotonic()
+        with utils.libvirt_connection(
+                uri, sasl_username=sasl_username,
+                sasl_password=sasl_password, readonly=True) as conn:
+            results = conn.getAllDomainStats(STATS_TYPES)
+
+        now = time.monotonic()
+        LOG.debug('Got the stats of %(count)d domain(s) at %(uri)s in '
+                  '%(elapsed).3fs', {'count': len(results), 'uri': uri,
+                                     'elapsed': now - start})
+
+        table = self._get_table(uri)
+        for domain, record in results:
+            domain_name = domain.name()
+            if domain_name not in domain_names:
+                continue
+
+            sampler = self._samplers.get((uri, domain_name))
+            if sampler is None:
+                sampler = self._samplers[(uri, domain_name)] = (
+                    _DomainSampler(self.idle_watts, self.vcpu_watts))
+
+            table.update(domain_name, sampler.sample(record, now))
+
+        for domain_name in table.names() - domain_names:
+            table.remove(domain_name)
+            self._samplers.pop((uri, domain_name), None)
+
+    def collect(self):
+        """Update the statistics of all the watched domains once"""
+        targets = self._targets()
+        for uri, (conn_args, domain_names) in targets.items():
+            try:
+                self._collect_uri(conn_args, domain_names)
+
+            except Exception as ex:
+                LOG.warning('Failed to collect domain statistics at '
+                            '%(uri)s: %(error)s', {'uri': uri, 'error': ex})
+
+        for uri in set(self._tables) - set(targets):
+            self._tables.pop(uri).close()
+            for key in [key for key in self._samplers if key[0] == uri]:
+                del self._samplers[key]
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.collect()
+            self._stop.wait(self.interval)
+
+    def ensure_running(self):
+        """Start the collector thread unless it is running already"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='vbmc-stats-collector', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
@@ -0,0 +1,420 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import configparser
+import errno
+import os
+import shutil
+import sqlite3
+import threading
+
+from virtualbmc import config as vbmc_config
+from virtualbmc import exception
+from virtualbmc import log
+from virtualbmc import utils
+
+LOG = log.get_logger()
+
+CONF = vbmc_config.get_config()
+
+DEFAULT_SECTION = 'VirtualBMC'
+
+VBMC_OPTIONS = ['username', 'password', 'address', 'port',
+                'domain_name', 'libvirt_uri', 'libvirt_sasl_username',
+                'libvirt_sasl_password', 'qmp_socket', 'active']
+
+SQLITE_DB_FILE = 'virtualbmc.db'
+
+
+class DirectoryStore(object):
+    """Store each vBMC configuration in a directory of its own
+
+    The configuration of a domain lives in `<config_dir>/<domain>/config`
+    as an INI file. Parsed configs are indexed by domain name along with
+    the inode, modification time and size of their file, so that a config
+    is only parsed again once its file has changed. Read-only commands
+    run concurrently, so the index has a lock of its own.
+    """
+
+    def __init__(self, config_dir):
+        self.config_dir = config_dir
+        self._lock = threading.Lock()
+        self._config_index = {}
+        self._domains = []
+        self._domains_signature = None
+        self._changes_signature = None
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.config_dir)
+            return stat.st_ino, stat.st_mtime_ns
+
+        except OSError:
+            return None
+
+    def _config_signature(self, domain_name):
+        config_path = os.path.join(self.config_dir, domain_name, 'config')
+
+        try:
+            stat = os.stat(config_path)
+            return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+        except OSError:
+            return None
+
+    def changed(self):
+        """Tell whether domains may have changed since the last call
+
+        Adding or removing a domain changes the modification time of the
+        config directory, while editing or replacing a config changes the
+        inode, modification time or size of its file, so this takes one
+        `stat()` per domain but parses nothing.
+        """
+        signature = self._signature()
+
+        if signature is not None:
+            signature = signature, tuple(
+                (domain_name, self._config_signature(domain_name))
+                for domain_name in self.domain_names())
+
+        changed = signature is None or signature != self._changes_signature
+        self._changes_signature = signature
+        return changed
+
+    def domain_names(self):
+        """List the configured domains, rescanning only on changes
+
+        Adding or removing a domain directory changes the modification
+        time of the config directory, which is cheap to check.
+        """
+        signature = self._signature()
+
+        with self._lock:
+            if signature is None or signature != self._domains_signature:
+                self._domains = [
+                    domain_name
+                    for domain_name in os.listdir(self.config_dir)
+                    if os.path.isdir(os.path.join(self.config_dir,
+                                                  domain_name))
+                ]
+                self._domains_signature = signature
+
+                for domain_name in (set(self._config_index)
+                                    - set(self._domains)):
+                    del self._config_index[domain_name]
+
+            return list(self._domains)
+
+    def exists(self, domain_name):
+        return os.path.exists(os.path.join(self.config_dir, domain_name))
+
+    def get(self, domain_name):
+        config_path = os.path.join(self.config_dir, domain_name, 'config')
+
+        signature = self._config_signature(domain_name)
+
+        with self._lock:
+            if signature is None:
+                self._config_index.pop(domain_name, None)
+                raise exception.DomainNotFound(domain=domain_name)
+
+            cached = self._config_index.get(domain_name)
+            if cached and cached[0] == signature:
+                return dict(cached[1])
+
+        try:
+            config = configparser.ConfigParser()
+            config.read(config_path)
+
+            bmc = {}
+            for item in VBMC_OPTIONS:
+                try:
+                    value = config.get(DEFAULT_SECTION, item)
+                except configparser.NoOptionError:
+                    value = None
+
+                bmc[item] = value
+
+            # Port needs to be int
+            bmc['port'] = config.getint(DEFAULT_SECTION, 'port')
+
+            with self._lock:
+                self._config_index[domain_name] = signature, dict(bmc)
+
+            return bmc
+
+        except OSError:
+            raise exception.DomainNotFound(domain=domain_name)
+
+    def get_all(self):
+        bmcs = []
+        for domain_name in self.domain_names():
+            try:
+                bmcs.append(self.get(domain_name))
+
+            except exception.DomainNotFound:
+                continue
+
+        return bmcs
+
+    def create(self, **options):
+        domain_name = options['domain_name']
+        domain_path = os.path.join(self.config_dir, domain_name)
+
+        try:
+            os.makedirs(domain_path)
+        except OSError as ex:
+            if ex.errno == errno.EEXIST:
+                raise exception.DomainAlreadyExists(domain=domain_name)
+
+            raise exception.VirtualBMCError(
+                'Failed to create domain %(domain)s. Error: %(error)s'
+                % {'domain': domain_name, 'error': ex})
+
+        try:
+            self.update(**options)
+
+        except Exception as ex:
+            shutil.rmtree(domain_path, ignore_errors=True)
+            raise exception.VirtualBMCError(str(ex))
+
+    def update(self, **options):
+        config = configparser.ConfigParser()
+        config.add_section(DEFAULT_SECTION)
+
+        for option, value in options.items():
+            if value is not None:
+                config.set(DEFAULT_SECTION, option, str(value))
+
+        config_path = os.path.join(
+            self.config_dir, options['domain_name'], 'config'
+        )
+
+        with open(config_path, 'w') as f:
+            config.write(f)
+
+        with self._lock:
+            self._config_index.pop(options['domain_name'], None)
+
+    def set_active(self, domain_names, active):
+        for domain_name in domain_names:
+            bmc = self.get(domain_name)
+            bmc.update(active=active)
+            self.update(**bmc)
+
+    def delete(self, domain_name):
+        shutil.rmtree(os.path.join(self.config_dir, domain_name))
+
+        with self._lock:
+            self._config_index.pop(domain_name, None)
+
+
+class SQLiteStore(object):
+    """Store all vBMC configurations in a single SQLite database
+
+    The database runs in WAL mode and indexes BMCs by domain name, port
+    and active flag, so that listing all BMCs or (de)activating many of
+    them at once is a single query or transaction. On first use, the
+    configurations found in the per-domain directory layout are imported.
+    """
+
+    COLUMNS = VBMC_OPTIONS
+
+    # Columns added to the schema since its first version
+    ADDED_COLUMNS = ('qmp_socket',)
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS bmcs ('
+        ' domain_name TEXT PRIMARY KEY,'
+        ' username TEXT,'
+        ' password TEXT,'
+        ' address TEXT,'
+        ' port INTEGER NOT NULL,'
+        ' libvirt_uri TEXT,'
+        ' libvirt_sasl_username TEXT,'
+        ' libvirt_sasl_password TEXT,'
+        ' qmp_socket TEXT,'
+        ' active INTEGER NOT NULL DEFAULT 0)',
+        'CREATE INDEX IF NOT EXISTS bmcs_port ON bmcs (port)',
+        'CREATE INDEX IF NOT EXISTS bmcs_active ON bmcs (active)',
+        'CREATE TABLE IF NOT EXISTS meta ('
+        ' key TEXT PRIMARY KEY,'
+        ' value TEXT)',
+    )
+
+    def __init__(self, db_path, import_dir=None):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+
+        with self._transaction() as db:
+            for statement in self.SCHEMA:
+                db.execute(statement)
+
+            # Databases created before columns got added lack them
+            columns = [row[1] for row in
+                       db.execute('PRAGMA table_info(bmcs)')]
+            for column in self.ADDED_COLUMNS:
+                if column not in columns:
+                    db.execute('ALTER TABLE bmcs ADD COLUMN %s TEXT'
+                               % column)
+
+        if import_dir is not None:
+            self._import(DirectoryStore(import_dir))
+
+        self._data_version = None
+
+    def changed(self):
+        """Tell whether other processes have changed the database
+
+        SQLite bumps the data version on commits made through other
+        connections, changes made through this store do not count.
+        """
+        with self._lock:
+            data_version = self._db.execute(
+                'PRAGMA data_version').fetchone()[0]
+
+        changed = data_version != self._data_version
+        self._data_version = data_version
+        return changed
+
+    def _transaction(self):
+        return _sqlite_transaction(self._db, self._lock)
+
+    def _import(self, directory_store):
+        with self._transaction() as db:
+            imported = db.execute(
+                "SELECT value FROM meta WHERE key = 'imported'").fetchone()
+            if imported:
+                return
+
+            bmcs = directory_store.get_all()
+            db.executemany(self._insert_sql('INSERT OR IGNORE'),
+                           [self._to_row(bmc) for bmc in bmcs])
+            db.execute("INSERT INTO meta (key, value) "
+                       "VALUES ('imported', ?)", (str(len(bmcs)),))
+
+        LOG.info('Imported %(count)d vBMC configurations from %(dir)s',
+                 {'count': len(bmcs), 'dir': directory_store.config_dir})
+
+    def _insert_sql(self, verb='INSERT'):
+        return '%s INTO bmcs (%s) VALUES (%s)' % (
+            verb, ', '.join(self.COLUMNS),
+            ', '.join('?' * len(self.COLUMNS)))
+
+    def _to_row(self, options):
+        row = []
+        for column in self.COLUMNS:
+            value = options.get(column)
+            if column == 'port':
+                value = int(value)
+            elif column == 'active':
+                value = int(utils.str2bool(str(value or False)))
+            row.append(value)
+
+        return row
+
+    def _from_row(self, row):
+        bmc = dict(zip(self.COLUMNS, row))
+        # Same representation as in INI files
+        bmc['active'] = str(bool(bmc['active']))
+        return bmc
+
+    def _select(self, where='', args=()):
+        with self._lock:
+            return self._db.execute(
+                'SELECT %s FROM bmcs %s ORDER BY domain_name'
+                % (', '.join(self.COLUMNS), where), args).fetchall()
+
+    def domain_names(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                'SELECT domain_name FROM bmcs ORDER BY domain_name')]
+
+    def exists(self, domain_name):
+        with self._lock:
+            return self._db.execute(
+                'SELECT 1 FROM bmcs WHERE domain_name = ?',
+                (domain_name,)).fetchone() is not None
+
+    def get(self, domain_name):
+        rows = self._select('WHERE domain_name = ?', (domain_name,))
+        if not rows:
+            raise exception.DomainNotFound(domain=domain_name)
+
+        return self._from_row(rows[0])
+
+    def get_all(self):
+        return [self._from_row(row) for row in self._select()]
+
+    def create(self, **options):
+        try:
+            with self._transaction() as db:
+                db.execute(self._insert_sql(), self._to_row(options))
+
+        except sqlite3.IntegrityError:
+            raise exception.DomainAlreadyExists(
+                domain=options['domain_name'])
+
+    def update(self, **options):
+        row = self._to_row(options)
+        assignments = ', '.join('%s = ?' % column
+                                for column in self.COLUMNS)
+
+        with self._transaction() as db:
+            cursor = db.execute(
+                'UPDATE bmcs SET %s WHERE domain_name = ?' % assignments,
+                row + [options['domain_name']])
+
+        if not cursor.rowcount:
+            raise exception.DomainNotFound(domain=options['domain_name'])
+
+    def set_active(self, domain_names, active):
+        with self._transaction() as db:
+            db.executemany('UPDATE bmcs SET active = ? WHERE domain_name = ?',
+                           [(int(active), domain_name)
+                            for domain_name in domain_names])
+
+    def delete(self, domain_name):
+        with self._transaction() as db:
+            db.execute('DELETE FROM bmcs WHERE domain_name = ?',
+                       (domain_name,))
+
+
+class _sqlite_transaction(object):
+
+    def __init__(self, db, lock):
+        self.db = db
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, type, value, traceback):
+        try:
+            self.db.execute('ROLLBACK' if type else 'COMMIT')
+        finally:
+            self.lock.release()
+
+
+def get_store(config_dir):
+    """Create the vBMC configuration store set up in the config file"""
+    if CONF['default']['config_store'] == 'sqlite':
+        return SQLiteStore(os.path.join(config_dir, SQLITE_DB_FILE),
+                           import_dir=config_dir)
+
+    return DirectoryStore(config_dir)
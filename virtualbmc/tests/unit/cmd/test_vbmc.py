@@ -81,6 +81,7 @@ class VBMCTestCase(base.TestCase):
                 'libvirt_uri': 'qemu:///system',
                 'libvirt_sasl_username': None,
                 'libvirt_sasl_password': None,
+                'qmp_socket': None,
                 'username': 'ironic',
                 'password': 'password',
                 'domain_name': 'bar',
@@ -0,0 +1,281 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+import libvirt
+
+from virtualbmc import backends
+from virtualbmc import exception
+from virtualbmc import inventory
+from virtualbmc.tests.unit import base
+from virtualbmc.tests.unit import utils as test_utils
+from virtualbmc import utils
+from virtualbmc import vbmc
+
+DOMAIN_XML_TEMPLATE = """\
+<domain type='qemu'>
+  <os>
+    <type arch='x86_64' machine='pc-1.0'>hvm</type>
+    <boot dev='%s'/>
+    <bootmenu enable='no'/>
+  </os>
+  <devices>
+    <disk type='block' device='disk'>
+      <boot order='2'/>
+    </disk>
+    <interface type='network'>
+      <boot order='1'/>
+    </interface>
+  </devices>
+</domain>
+"""
+
+
+class RewriteBootDeviceTestCase(base.TestCase):
+
+    def test_rewrite_boot_device(self):
+        domain_xml = DOMAIN_XML_TEMPLATE.replace(
+            "    <boot dev='%s'/>\n",
+            "    <boot dev='hd'/>\n    <boot dev='network'/>\n")
+
+        ret = backends.rewrite_boot_device(domain_xml, 'cdrom')
+
+        # Everything but the boot elements is left untouched
+        expected = (DOMAIN_XML_TEMPLATE % 'cdrom').replace(
+            "      <boot order='2'/>\n", '').replace(
+            "      <boot order='1'/>\n", '')
+        self.assertEqual(expected, ret)
+
+    def test_rewrite_boot_device_no_os_boot(self):
+        domain_xml = DOMAIN_XML_TEMPLATE.replace("<boot dev='%s'/>", '')
+
+        ret = backends.rewrite_boot_device(domain_xml, 'network')
+
+        self.assertEqual(
+            "<boot dev='network'/></os>",
+            ret[ret.index('<boot '):ret.index('</os>') + 5])
+        self.assertEqual(1, ret.count('<boot '))
+
+
+@mock.patch.object(utils, 'libvirt_connection')
+@mock.patch.object(utils, 'get_libvirt_domain')
+class LibvirtBackendTestCase(base.TestCase):
+
+    def setUp(self):
+        super(LibvirtBackendTestCase, self).setUp()
+        self.backend = backends.LibvirtBackend(
+            'SpongeBob', {'uri': 'foo://bar', 'sasl_username': None,
+                          'sasl_password': None})
+
+    def test_error(self, mock_libvirt_domain, mock_libvirt_conn):
+        mock_libvirt_domain.side_effect = libvirt.libvirtError('boom')
+
+        for operation in ('is_active', 'power_off', 'get_definition'):
+            self.assertRaises(exception.BackendError,
+                              getattr(self.backend, operation))
+
+    def test_domain_not_found(self, mock_libvirt_domain, mock_libvirt_conn):
+        mock_libvirt_domain.side_effect = exception.DomainNotFound(
+            domain='SpongeBob')
+
+        self.assertRaises(exception.DomainNotFound, self.backend.power_on)
+
+    def test_power_on_is_on(self, mock_libvirt_domain, mock_libvirt_conn):
+        domain = mock_libvirt_domain.return_value
+        domain.isActive.return_value = True
+
+        self.assertFalse(self.backend.power_on(boot_device='network'))
+        self.assertFalse(domain.create.called)
+
+    def test_reset_is_off(self, mock_libvirt_domain, mock_libvirt_conn):
+        domain = mock_libvirt_domain.return_value
+        domain.isActive.return_value = False
+
+        self.assertFalse(self.backend.reset())
+        self.assertFalse(domain.reset.called)
+
+    def test_set_boot_device_unchanged(self, mock_libvirt_domain,
+                                       mock_libvirt_conn):
+        domain_xml = DOMAIN_XML_TEMPLATE.replace(
+            "<boot order='2'/>", '').replace("<boot order='1'/>", '')
+        mock_libvirt_domain.return_value.XMLDesc.return_value = (
+            domain_xml % 'hd')
+
+        self.assertFalse(self.backend.set_boot_device('hd'))
+        self.assertTrue(self.backend.set_boot_device('network'))
+
+
+class FakeBackendTestCase(base.TestCase):
+
+    def setUp(self):
+        super(FakeBackendTestCase, self).setUp()
+        self.backend = backends.FakeBackend('SpongeBob')
+
+    def test_power(self):
+        self.assertFalse(self.backend.is_active())
+        self.assertFalse(self.backend.reset())
+
+        self.assertTrue(self.backend.power_on())
+        self.assertFalse(self.backend.power_on())
+        self.assertTrue(self.backend.is_active())
+        self.assertTrue(self.backend.reset())
+
+        self.backend.shutdown()
+
+        self.assertFalse(self.backend.is_active())
+
+    def test_definition(self):
+        self.assertTrue(self.backend.set_boot_device('network'))
+        self.assertFalse(self.backend.set_boot_device('network'))
+
+        domain_xml = self.backend.get_definition()
+
+        self.assertEqual({'boot_dev': 'network'},
+                         vbmc.parse_boot_settings(domain_xml))
+        domain = inventory.parse_domain(domain_xml)
+        self.assertEqual('SpongeBob', domain['name'])
+        # Stable across restarts
+        self.assertEqual(domain_xml,
+                         backends.FakeBackend('SpongeBob').get_definition()
+                         .replace("'hd'", "'network'"))
+
+    @mock.patch.object(time, 'sleep', autospec=True)
+    def test_latency(self, mock_sleep):
+        self.backend.latency = {None: 0.005, 'power_on': 2.0,
+                                'is_active': 0}
+
+        self.backend.power_on()
+        self.backend.power_off()
+        self.backend.is_active()
+
+        self.assertEqual([mock.call(2.0), mock.call(0.005)],
+                         mock_sleep.call_args_list)
+
+    def test_failure_rate(self):
+        self.backend.failure_rate = {None: 1.0, 'is_active': 0}
+
+        self.assertRaises(exception.BackendError, self.backend.power_on)
+        self.assertRaises(exception.BackendError,
+                          self.backend.set_boot_device, 'network')
+        self.assertFalse(self.backend.is_active())
+        self.assertEqual('hd', self.backend.boot_device)
+
+
+class QMPBackendTestCase(base.TestCase):
+
+    def setUp(self):
+        super(QMPBackendTestCase, self).setUp()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, 'qmp.sock')
+        self.server = test_utils.FakeQMPServer(self.path)
+        self.addCleanup(self.server.stop)
+        self.backend = backends.QMPBackend('SpongeBob', self.path)
+        self.addCleanup(self.backend.close)
+
+    def _commands(self):
+        commands = [command for command in self.server.commands
+                    if command not in ('qmp_capabilities', 'query-status')]
+        self.server.commands = []
+        return commands
+
+    def test_power_on(self):
+        self.assertFalse(self.backend.is_active())
+
+        self.assertTrue(self.backend.power_on())
+        self.assertFalse(self.backend.power_on())
+
+        self.assertTrue(self.backend.is_active())
+        self.assertEqual(['cont'], self._commands())
+
+    def test_power_on_shut_down(self):
+        self.server.status = 'shutdown'
+
+        self.assertTrue(self.backend.power_on(boot_device='network'))
+
+        self.assertEqual(['system_reset', 'cont'], self._commands())
+        self.assertEqual('running', self.server.status)
+
+    def test_power_on_not_running(self):
+        self.server.stop()
+
+        self.assertFalse(self.backend.is_active())
+        self.assertRaises(exception.BackendError, self.backend.power_on)
+
+    def test_power_off(self):
+        self.server.status = 'running'
+
+        self.backend.power_off()
+
+        self.assertEqual(['quit'], self._commands())
+        self.assertFalse(self.backend.is_active())
+        # Nothing left to power off
+        self.backend.power_off()
+
+    def test_shutdown_reset_nmi(self):
+        self.backend.shutdown()
+        self.assertFalse(self.backend.reset())
+        self.backend.inject_nmi()
+        self.assertEqual([], self._commands())
+
+        self.server.status = 'running'
+        self.backend.inject_nmi()
+        self.assertTrue(self.backend.reset())
+        self.backend.shutdown()
+
+        self.assertEqual(['inject-nmi', 'system_reset', 'system_powerdown'],
+                         self._commands())
+        self.assertFalse(self.backend.is_active())
+
+    def test_definition(self):
+        domain = inventory.parse_domain(self.backend.get_definition())
+
+        self.assertEqual('SpongeBob', domain['name'])
+        self.assertEqual(self.server.uuid, domain['uuid'])
+        self.assertRaises(exception.OperationNotSupported,
+                          self.backend.set_boot_device, 'network')
+
+    def test_persistent_connection(self):
+        for _ in range(3):
+            self.backend.is_active()
+
+        self.assertEqual(1, self.server.connections)
+
+
+class GetBackendTestCase(base.TestCase):
+
+    def test_get_backend(self):
+        ret = backends.get_backend('SpongeBob', {'uri': 'foo://bar'})
+
+        self.assertIsInstance(ret, backends.LibvirtBackend)
+        self.assertTrue(ret.libvirt_domain)
+
+    def test_get_backend_fake(self):
+        with mock.patch.dict(backends.CONF['default'], {'backend': 'fake'}):
+            ret = backends.get_backend('SpongeBob', {'uri': 'foo://bar'})
+
+        self.assertIsInstance(ret, backends.FakeBackend)
+        self.assertFalse(ret.libvirt_domain)
+        self.assertIs(backends.CONF['fake_backend']['latency'], ret.latency)
+
+    def test_get_backend_qmp(self):
+        ret = backends.get_backend('SpongeBob', {'uri': 'foo://bar'},
+                                   qmp_socket='/run/qemu/spongebob.qmp')
+
+        self.assertIsInstance(ret, backends.QMPBackend)
+        self.assertFalse(ret.libvirt_domain)
+        self.assertEqual('/run/qemu/spongebob.qmp', ret._client.path)
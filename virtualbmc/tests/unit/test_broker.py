@@ -0,0 +1,245 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
+
+import libvirt
+
+from virtualbmc import broker
+from virtualbmc import exception
+from virtualbmc.tests.unit import base
+from virtualbmc import utils
+
+
+class MessageTestCase(base.TestCase):
+
+    def test_decode(self):
+        data = broker._encode({'id': 1}) + broker._encode({'id': 2})
+
+        messages, rest = broker._decode(data + data[:3])
+
+        self.assertEqual([{'id': 1}, {'id': 2}], messages)
+        self.assertEqual(data[:3], rest)
+
+    def test_decode_too_large(self):
+        data = broker._HEADER.pack(broker.MAX_MESSAGE_SIZE + 1)
+
+        self.assertRaises(ValueError, broker._decode, data)
+
+
+@mock.patch.object(utils, 'libvirt_connection')
+class BrokerServerCallTestCase(base.TestCase):
+
+    def setUp(self):
+        super(BrokerServerCallTestCase, self).setUp()
+        self.server = broker.BrokerServer('/nonexistent', threads=1)
+        self.addCleanup(self.server._executor.shutdown)
+        self.request = {'uri': 'qemu:///system', 'sasl_username': None,
+                        'sasl_password': None, 'readonly': True,
+                        'domain': 'SpongeBob'}
+
+    def test_domain_method(self, mock_libvirt_conn):
+        conn = mock_libvirt_conn.return_value.__enter__.return_value
+        domain = conn.lookupByName.return_value
+        domain.isActive.return_value = 1
+
+        ret = self.server._call(dict(self.request, method='isActive'))
+
+        self.assertEqual(1, ret)
+        mock_libvirt_conn.assert_called_once_with(
+            'qemu:///system', sasl_username=None, sasl_password=None,
+            readonly=True)
+        conn.lookupByName.assert_called_once_with('SpongeBob')
+
+    def test_connection_method(self, mock_libvirt_conn):
+        conn = mock_libvirt_conn.return_value.__enter__.return_value
+
+        ret = self.server._call(dict(self.request, method='defineXML',
+                                     args=['<domain/>']))
+
+        self.assertIsNone(ret)
+        conn.defineXML.assert_called_once_with('<domain/>')
+
+    def test_method_not_allowed(self, mock_libvirt_conn):
+        self.assertRaises(ValueError, self.server._call,
+                          dict(self.request, method='undefine'))
+
+
+class BrokerTestCase(base.TestCase):
+    """Calls from a client to a broker serving in a thread"""
+
+    def setUp(self):
+        super(BrokerTestCase, self).setUp()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        socket_path = os.path.join(tmp_dir, broker.SOCKET_NAME)
+
+        self.mock_call = mock.patch.object(broker.BrokerServer,
+                                           '_call').start()
+
+        ready = threading.Event()
+        server = broker.BrokerServer(socket_path, threads=2)
+        threading.Thread(target=server.serve, args=(ready,),
+                         daemon=True).start()
+        self.assertTrue(ready.wait(5))
+
+        self.client = broker.BrokerClient(socket_path)
+        self.addCleanup(self.client._close)
+        self.conn = broker.BrokerConnection(self.client, 'qemu:///system',
+                                            readonly=True)
+
+    def test_domain_call(self):
+        self.mock_call.return_value = '<domain/>'
+
+        domain = self.conn.lookupByName('SpongeBob')
+        ret = domain.XMLDesc(2)
+
+        self.assertEqual('<domain/>', ret)
+        request = self.mock_call.call_args[0][0]
+        self.assertEqual('XMLDesc', request['method'])
+        self.assertEqual('SpongeBob', request['domain'])
+        self.assertEqual([2], request['args'])
+        self.assertEqual('qemu:///system', request['uri'])
+        self.assertTrue(request['readonly'])
+
+    def test_domain_name(self):
+        self.mock_call.return_value = None
+        domain = self.conn.lookupByName('SpongeBob')
+
+        self.assertEqual('SpongeBob', domain.name())
+
+    def test_stale_response_dropped(self):
+        self.mock_call.return_value = 1
+        self.assertTrue(self.client.available())
+        # Left over from a call that got interrupted
+        self.client._local.buffer = broker._encode({'id': -1,
+                                                    'result': 0})
+
+        ret = self.conn.call('isActive', domain='SpongeBob')
+
+        self.assertEqual(1, ret)
+
+    def test_domain_method_not_allowed(self):
+        domain = broker.BrokerDomain(self.conn, 'SpongeBob')
+
+        self.assertRaises(AttributeError, getattr, domain, 'undefine')
+
+    def test_libvirt_error(self):
+        self.mock_call.side_effect = libvirt.libvirtError('boom')
+
+        self.assertRaises(libvirt.libvirtError, self.conn.call, 'isActive',
+                          domain='SpongeBob')
+
+    def test_other_error(self):
+        self.mock_call.side_effect = ValueError('boom')
+
+        self.assertRaises(exception.VirtualBMCError, self.conn.call,
+                          'isActive', domain='SpongeBob')
+
+
+class BrokerClientTestCase(base.TestCase):
+
+    @mock.patch('time.monotonic', autospec=True)
+    def test_unreachable(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        client = broker.BrokerClient('/nonexistent/broker.sock')
+
+        self.assertFalse(client.available())
+
+        with mock.patch('socket.socket', autospec=True) as mock_socket:
+            self.assertFalse(client.available())
+            # Not tried again before the reconnect interval
+            self.assertFalse(mock_socket.called)
+
+        self.assertRaises(libvirt.libvirtError, client.call,
+                          method='isActive')
+
+
+@mock.patch.object(utils, 'libvirt_connection')
+@mock.patch.object(broker, 'get_client')
+class LibvirtConnectionTestCase(base.TestCase):
+
+    def test_broker(self, mock_get_client, mock_libvirt_conn):
+        mock_get_client.return_value.available.return_value = True
+
+        with broker.libvirt_connection('qemu:///system',
+                                       readonly=True) as conn:
+            self.assertIsInstance(conn, broker.BrokerConnection)
+
+        self.assertFalse(mock_libvirt_conn.called)
+
+    def test_broker_unavailable(self, mock_get_client, mock_libvirt_conn):
+        mock_get_client.return_value.available.return_value = False
+
+        ret = broker.libvirt_connection('qemu:///system', readonly=True)
+
+        self.assertEqual(mock_libvirt_conn.return_value, ret)
+        mock_libvirt_conn.assert_called_once_with(uri='qemu:///system',
+                                                  readonly=True)
+
+    def test_broker_disabled(self, mock_get_client, mock_libvirt_conn):
+        mock_get_client.return_value = None
+
+        ret = broker.libvirt_connection('qemu:///system')
+
+        self.assertEqual(mock_libvirt_conn.return_value, ret)
+
+
+class BrokerProcessTestCase(base.TestCase):
+
+    def setUp(self):
+        super(BrokerProcessTestCase, self).setUp()
+        self.process = broker.BrokerProcess('/tmp/broker.sock', threads=4)
+        self.process._context = mock.Mock()
+
+    def test_ensure_running(self):
+        self.process.ensure_running()
+
+        ctx = self.process._context
+        ctx.Process.assert_called_once_with(
+            name='vbmcd-libvirt-broker', target=broker.broker_main,
+            args=('/tmp/broker.sock', 4, ctx.Event.return_value))
+        ctx.Process.return_value.start.assert_called_once_with()
+        ctx.Event.return_value.wait.assert_called_once_with(
+            broker.START_TIMEOUT)
+
+    def test_ensure_running_alive(self):
+        self.process.ensure_running()
+        self.process._context.Process.return_value.is_alive.return_value = (
+            True)
+
+        self.process.ensure_running()
+
+        self.assertEqual(1, self.process._context.Process.call_count)
+
+    def test_ensure_running_restart(self):
+        self.process.ensure_running()
+        self.process._context.Process.return_value.is_alive.return_value = (
+            False)
+
+        self.process.ensure_running()
+
+        self.assertEqual(2, self.process._context.Process.call_count)
+
+    def test_shutdown(self):
+        self.process.ensure_running()
+        process = self.process._context.Process.return_value
+        process.is_alive.return_value = True
+
+        self.process.shutdown()
+
+        process.terminate.assert_called_once_with()
+        self.assertIsNone(self.process._process)
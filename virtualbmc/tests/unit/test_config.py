@@ -14,6 +14,7 @@
 #    under the License.
 
 import configparser
+import copy
 import os
 from unittest import mock
 
@@ -35,9 +36,37 @@ class VirtualBMCConfigTestCase(base.TestCase):
                                         'pid_file': '/foo/bar/2',
                                         'server_port': '12345',
                                         'server_spawn_wait': 3000,
-                                        'server_response_timeout': 5000},
+                                        'server_response_timeout': 5000,
+                                        'server_threads': 4,
+                                        'bmc_engine': 'process',
+                                        'workers': 0,
+                                        'config_store': 'directory',
+                                        'spawn_concurrency': 8,
+                                        'bmc_start_method': 'fork',
+                                        'warm_pool_size': 0,
+                                        'backend': 'libvirt'},
                             'log': {'debug': 'true', 'logfile': '/foo/bar/4'},
-                            'ipmi': {'session_timeout': '30'}}
+                            'ipmi': {'session_timeout': '30',
+                                     'replay_cache_size': 256,
+                                     'replay_cache_ttl': 2,
+                                     'sel_capacity': 1024,
+                                     'sel_save_interval': 30,
+                                     'sol_buffer_size': 16384},
+                            'libvirt': {'connection_pool_size': 16,
+                                        'keepalive_interval': 5,
+                                        'keepalive_count': 3,
+                                        'max_concurrent_calls': 0,
+                                        'reserved_calls': 4,
+                                        'broker': 'false',
+                                        'broker_threads': 16,
+                                        'domain_events': 'false'},
+                            'fake_backend': {'latency': '5, power_on:2000',
+                                             'failure_rate': '0'},
+                            'qmp': {'timeout': '10'},
+                            'sensors': {'interval': '5',
+                                        'table_size': 4096,
+                                        'idle_watts': 40,
+                                        'vcpu_watts': 12}}
 
     @mock.patch.object(config.VirtualBMCConfig, '_validate')
     @mock.patch.object(config.VirtualBMCConfig, '_as_dict')
@@ -51,18 +80,28 @@ class VirtualBMCConfigTestCase(base.TestCase):
         mock__as_dict.assert_called_once_with(config)
         mock__validate.assert_called_once_with()
 
+    @mock.patch.object(config.VirtualBMCConfig, 'DEFAULTS',
+                       copy.deepcopy(config.VirtualBMCConfig.DEFAULTS))
     @mock.patch.object(os.path, 'exists')
     def test__as_dict(self, mock_exists):
         mock_exists.side_effect = (False, True)
         config = mock.Mock()
-        config.sections.side_effect = ['default', 'log', 'ipmi'],
+        config.sections.side_effect = ['default', 'log', 'ipmi',
+                                       'libvirt', 'fake_backend', 'qmp',
+                                       'sensors'],
         config.items.side_effect = [[('show_passwords', 'true'),
                                      ('config_dir', '/foo/bar/1'),
                                      ('pid_file', '/foo/bar/2'),
                                      ('server_port', '12345')],
                                     [('logfile', '/foo/bar/4'),
                                      ('debug', 'true')],
-                                    [('session_timeout', '30')]]
+                                    [('session_timeout', '30')],
+                                    [('broker', 'false'),
+                                     ('domain_events', 'false')],
+                                    [('latency', '5, power_on:2000'),
+                                     ('failure_rate', '0')],
+                                    [('timeout', '10')],
+                                    [('interval', '5')]]
         ret = self.vbmc_config._as_dict(config)
         self.assertEqual(self.config_dict, ret)
 
@@ -77,4 +116,11 @@ class VirtualBMCConfigTestCase(base.TestCase):
         expected['default']['server_port'] = 12345
         expected['log']['debug'] = True
         expected['ipmi']['session_timeout'] = 30
+        expected['libvirt']['broker'] = False
+        expected['libvirt']['domain_events'] = False
+        expected['fake_backend']['latency'] = {None: 0.005,
+                                               'power_on': 2.0}
+        expected['fake_backend']['failure_rate'] = {None: 0.0}
+        expected['qmp']['timeout'] = 10
+        expected['sensors']['interval'] = 5
         self.assertEqual(expected, self.vbmc_config._conf_dict)
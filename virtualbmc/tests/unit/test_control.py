@@ -13,59 +13,263 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import asyncio
 import json
 import os
+import signal
+import threading
 from unittest import mock
 
 import zmq
+import zmq.asyncio
 
 from virtualbmc import control
+from virtualbmc import exception
 from virtualbmc.tests.unit import base
 
 
+class QuitNow(Exception):
+    pass
+
+
+@mock.patch.object(zmq.asyncio, 'Context')
 class VBMCControlServerTestCase(base.TestCase):
 
-    @mock.patch.object(zmq, 'Context')
-    @mock.patch.object(zmq, 'Poller')
-    @mock.patch.object(os, 'path')
-    @mock.patch.object(os, 'remove')
-    def test_control_loop(self, mock_rm, mock_path, mock_zmq_poller,
-                          mock_zmq_context):
-        mock_path.exists.return_value = False
+    def setUp(self):
+        super(VBMCControlServerTestCase, self).setUp()
+        self.mock_vbmc_manager = mock.MagicMock()
+        self.mock_vbmc_manager.watched_fds.return_value = {}
+        self.mock_vbmc_manager.poll_timeout.return_value = 10000
+
+    def _mock_socket(self, mock_zmq_context, requests):
+        mock_zmq_socket = mock_zmq_context.return_value.socket.return_value
+        mock_zmq_socket.send_multipart = mock.AsyncMock()
+
+        async def recv_multipart():
+            if requests:
+                return requests.pop(0)
+
+            # Quit once all requests are answered
+            while (mock_zmq_socket.send_multipart.call_count
+                   < self.expected_responses):
+                await asyncio.sleep(0.01)
 
-        mock_vbmc_manager = mock.MagicMock()
+            raise QuitNow()
+
+        mock_zmq_socket.recv_multipart.side_effect = recv_multipart
+        return mock_zmq_socket
+
+    def test_control_loop(self, mock_zmq_context):
         mock_handle_command = mock.MagicMock()
 
         req = {
             'command': 'list',
         }
 
-        mock_zmq_context = mock_zmq_context.return_value
-        mock_zmq_socket = mock_zmq_context.socket.return_value
-        mock_zmq_socket.recv.return_value = json.dumps(req).encode()
-        mock_zmq_poller = mock_zmq_poller.return_value
-        mock_zmq_poller.poll.return_value = {
-            mock_zmq_socket: zmq.POLLIN
-        }
+        self.expected_responses = 1
+        mock_zmq_socket = self._mock_socket(
+            mock_zmq_context, [[b'client', b'', json.dumps(req).encode()]])
 
         rsp = {
             'rc': 0,
             'msg': ['OK']
         }
 
-        class QuitNow(Exception):
-            pass
-
         mock_handle_command.return_value = rsp
-        mock_zmq_socket.send.side_effect = QuitNow()
 
         self.assertRaises(QuitNow,
                           control.main_loop,
-                          mock_vbmc_manager, mock_handle_command)
+                          self.mock_vbmc_manager, mock_handle_command)
 
+        mock_zmq_context.return_value.socket.assert_called_once_with(
+            zmq.ROUTER)
         mock_zmq_socket.bind.assert_called_once()
-        mock_handle_command.assert_called_once()
+        mock_handle_command.assert_called_once_with(
+            self.mock_vbmc_manager, req)
+
+        identity, delimiter, response = (
+            mock_zmq_socket.send_multipart.call_args[0][0])
+
+        self.assertEqual(b'client', identity)
+        self.assertEqual(b'', delimiter)
+        self.assertEqual(rsp, json.loads(response.decode()))
+
+    def test_control_loop_shutdown(self, mock_zmq_context):
+        server = control.ControlServer(self.mock_vbmc_manager, None)
+        writing = []
+
+        def periodic(shutdown=False):
+            if shutdown:
+                writing.append(server._lock._writing)
+
+        self.mock_vbmc_manager.periodic.side_effect = periodic
+
+        self.expected_responses = 0
+        self._mock_socket(mock_zmq_context, [])
+
+        self.assertRaises(QuitNow, asyncio.run, server.serve())
+
+        self.mock_vbmc_manager.periodic.assert_called_with(shutdown=True)
+        self.assertEqual([True], writing)
+
+    def test_control_loop_sigterm(self, mock_zmq_context):
+        server = control.ControlServer(self.mock_vbmc_manager, None)
+        mock_zmq_socket = mock_zmq_context.return_value.socket.return_value
+
+        async def recv_multipart():
+            os.kill(os.getpid(), signal.SIGTERM)
+            await asyncio.Future()
+
+        mock_zmq_socket.recv_multipart.side_effect = recv_multipart
+
+        asyncio.run(server.serve())
+
+        self.mock_vbmc_manager.periodic.assert_called_with(shutdown=True)
+        mock_zmq_socket.close.assert_called_once_with()
+
+    def test_control_loop_malformed_message(self, mock_zmq_context):
+        mock_handle_command = mock.MagicMock()
+        mock_handle_command.return_value = {'rc': 0, 'msg': []}
+
+        self.expected_responses = 1
+        self._mock_socket(
+            mock_zmq_context,
+            [[b'garbage'],
+             [b'client', b'', json.dumps({'command': 'list'}).encode()]])
+
+        self.assertRaises(QuitNow,
+                          control.main_loop,
+                          self.mock_vbmc_manager, mock_handle_command)
+
+        mock_handle_command.assert_called_once_with(
+            self.mock_vbmc_manager, {'command': 'list'})
+
+    def test_control_loop_concurrent_clients(self, mock_zmq_context):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def handle_command(vbmc_manager, data_in):
+            # Both commands have to be running for either to complete
+            barrier.wait()
+            return {'rc': 0, 'msg': [data_in['command']]}
+
+        self.expected_responses = 2
+        mock_zmq_socket = self._mock_socket(
+            mock_zmq_context,
+            [[b'client1', b'', json.dumps({'command': 'list'}).encode()],
+             [b'client2', b'', json.dumps({'command': 'show'}).encode()]])
+
+        self.assertRaises(QuitNow,
+                          control.main_loop,
+                          self.mock_vbmc_manager, handle_command)
+
+        responses = {call[0][0][0]: json.loads(call[0][0][2].decode())
+                     for call in mock_zmq_socket.send_multipart.call_args_list}
+        self.assertEqual({b'client1': {'rc': 0, 'msg': ['list']},
+                          b'client2': {'rc': 0, 'msg': ['show']}},
+                         responses)
+
+    def test_control_loop_command_error(self, mock_zmq_context):
+        mock_handle_command = mock.MagicMock()
+        mock_handle_command.side_effect = exception.VirtualBMCError('boom')
+
+        self.expected_responses = 1
+        mock_zmq_socket = self._mock_socket(
+            mock_zmq_context,
+            [[b'client', b'', json.dumps({'command': 'stop'}).encode()]])
+
+        self.assertRaises(QuitNow,
+                          control.main_loop,
+                          self.mock_vbmc_manager, mock_handle_command)
+
+        response = mock_zmq_socket.send_multipart.call_args[0][0][2]
+        self.assertEqual({'rc': 1, 'msg': ['Command failed: boom']},
+                         json.loads(response.decode()))
+
+    def test_run_command_add_checks_domain_unlocked(self, mock_zmq_context):
+        server = control.ControlServer(self.mock_vbmc_manager, None)
+        writing = []
+
+        def record(*args, **kwargs):
+            writing.append(server._lock._writing)
+            return {'rc': 0, 'msg': []}
+
+        self.mock_vbmc_manager.check_domain.side_effect = record
+        server.handle_command = mock.Mock(side_effect=record)
+
+        req = {'command': 'add', 'domain_name': 'foo'}
+        server._run_command(req)
+
+        self.mock_vbmc_manager.check_domain.assert_called_once_with(**req)
+        server.handle_command.assert_called_once_with(
+            self.mock_vbmc_manager, dict(req, checked=True))
+        # Only the store gets updated under the write lock
+        self.assertEqual([False, True], writing)
+
+    def test_run_command_add_check_failed(self, mock_zmq_context):
+        server = control.ControlServer(self.mock_vbmc_manager, mock.Mock())
+        self.mock_vbmc_manager.check_domain.side_effect = (
+            exception.DomainNotFound(domain='foo'))
+
+        ret = server._run_command({'command': 'add', 'domain_name': 'foo'})
+
+        self.assertEqual(1, ret['rc'])
+        self.assertFalse(server.handle_command.called)
+
+    def test_control_loop_events(self, mock_zmq_context):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        os.write(write_fd, b'x')
+
+        self.mock_vbmc_manager.watched_fds.return_value = {read_fd: ['foo']}
+
+        def periodic(shutdown=False):
+            handle_events = self.mock_vbmc_manager.handle_events
+            if not shutdown and handle_events.call_count > 1:
+                raise QuitNow()
+
+        self.mock_vbmc_manager.periodic.side_effect = periodic
+
+        self.expected_responses = 1
+        self._mock_socket(mock_zmq_context, [])
+
+        self.assertRaises(QuitNow,
+                          control.main_loop,
+                          self.mock_vbmc_manager, mock.MagicMock())
+
+        self.assertEqual([mock.call([]), mock.call([read_fd])],
+                         self.mock_vbmc_manager.handle_events.call_args_list)
+
+
+class CommandDispatcherTestCase(base.TestCase):
+
+    def test_start(self):
+        mock_vbmc_manager = mock.Mock()
+        mock_vbmc_manager.start_many.return_value = {
+            'foo': (0, ''),
+            'bar': (1, 'No domain with matching name bar was found'),
+        }
+
+        ret = control.command_dispatcher(
+            mock_vbmc_manager,
+            {'command': 'start', 'domain_names': ['foo', 'bar', 'foo']})
+
+        mock_vbmc_manager.start_many.assert_called_once_with(['foo', 'bar'])
+        self.assertEqual(1, ret['rc'])
+        self.assertEqual(['No domain with matching name bar was found'],
+                         ret['msg'])
+        self.assertEqual(
+            [['foo', 'OK'],
+             ['bar', 'No domain with matching name bar was found']],
+            ret['rows'])
+
+    def test_stop(self):
+        mock_vbmc_manager = mock.Mock()
+        mock_vbmc_manager.stop_many.return_value = {'foo': (0, '')}
 
-        response = json.loads(mock_zmq_socket.send.call_args[0][0].decode())
+        ret = control.command_dispatcher(
+            mock_vbmc_manager, {'command': 'stop', 'domain_names': ['foo']})
 
-        self.assertEqual(rsp, response)
+        mock_vbmc_manager.stop_many.assert_called_once_with(['foo'])
+        self.assertEqual(0, ret['rc'])
+        self.assertEqual([], ret['msg'])
@@ -0,0 +1,256 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+import pyghmi.ipmi.private.session as ipmisession
+
+from virtualbmc import engine
+from virtualbmc.tests.unit import base
+from virtualbmc.tests.unit import utils as test_utils
+from virtualbmc import utils
+
+
+class FakeConnection(object):
+    """Worker side of the manager pipe replaying a list of commands"""
+
+    def __init__(self, commands):
+        self.commands = list(commands)
+        self.sent = []
+
+    def poll(self, timeout):
+        return True
+
+    def recv(self):
+        if not self.commands:
+            raise EOFError()
+        return self.commands.pop(0)
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+@mock.patch.object(utils, 'exit_on_sigterm', mock.Mock())
+@mock.patch.object(ipmisession.Session, 'wait_for_rsp')
+@mock.patch.object(ipmisession.Session, '_assignsocket')
+@mock.patch.object(engine, 'VirtualBMC')
+class WorkerMainTestCase(base.TestCase):
+
+    def setUp(self):
+        super(WorkerMainTestCase, self).setUp()
+        self.domain = test_utils.get_domain()
+
+    def test_start_stop(self, mock_vbmc, mock_assign, mock_wait):
+        conn = FakeConnection([(engine.START, self.domain),
+                               (engine.STOP, self.domain['domain_name'])])
+
+        engine.worker_main(conn)
+
+        mock_assign.assert_called_once_with()
+        mock_vbmc.assert_called_once_with(**self.domain)
+        mock_vbmc.return_value.close.assert_called_once_with()
+        self.assertEqual(
+            [(engine.RUNNING, self.domain['domain_name'], None)], conn.sent)
+
+    def test_start_error(self, mock_vbmc, mock_assign, mock_wait):
+        mock_vbmc.side_effect = Exception('boom')
+        conn = FakeConnection([(engine.START, self.domain)])
+
+        engine.worker_main(conn)
+
+        self.assertEqual(
+            [(engine.ERROR, self.domain['domain_name'], 'boom')], conn.sent)
+
+    def test_terminated(self, mock_vbmc, mock_assign, mock_wait):
+        # SIGTERM raises SystemExit
+        mock_wait.side_effect = SystemExit(0)
+        conn = FakeConnection([(engine.START, self.domain)])
+        conn.poll = mock.Mock(side_effect=[True, False])
+
+        self.assertRaises(SystemExit, engine.worker_main, conn)
+
+        # Closed, their SEL saved
+        mock_vbmc.return_value.close.assert_called_once_with()
+
+
+class SharedBMCInstanceTestCase(base.TestCase):
+
+    def setUp(self):
+        super(SharedBMCInstanceTestCase, self).setUp()
+        self.domain = test_utils.get_domain()
+        self.engine = mock.Mock(spec=engine.SharedEngine)
+        self.worker = mock.Mock(errors={})
+        self.worker.is_alive.return_value = True
+        self.instance = engine.SharedBMCInstance(self.engine, self.domain)
+        self.instance.worker = self.worker
+
+    def test_start(self):
+        self.instance.start()
+        self.engine.place.assert_called_once_with(self.instance)
+
+    def test_terminate(self):
+        self.instance.terminate()
+        self.engine.remove.assert_called_once_with(self.instance)
+
+    def test_is_alive(self):
+        self.assertTrue(self.instance.is_alive())
+        self.assertIsNone(self.instance.exitcode)
+        self.worker.poll.assert_called_with()
+
+    def test_is_alive_not_placed(self):
+        self.instance.worker = None
+        self.assertFalse(self.instance.is_alive())
+
+    def test_is_alive_error(self):
+        self.worker.errors[self.domain['domain_name']] = 'boom'
+        self.assertFalse(self.instance.is_alive())
+        self.assertEqual(1, self.instance.exitcode)
+
+    def test_is_alive_worker_dead(self):
+        self.worker.is_alive.return_value = False
+        self.assertFalse(self.instance.is_alive())
+
+    def test_sentinels(self):
+        self.worker.sentinel = 42
+        self.worker.fileno.return_value = 43
+        self.assertEqual([42, 43], self.instance.sentinels)
+
+    def test_sentinels_not_placed(self):
+        self.instance.worker = None
+        self.assertEqual([], self.instance.sentinels)
+
+
+class HashRingTestCase(base.TestCase):
+
+    def test_get_stable(self):
+        ring = engine.HashRing(range(4))
+        self.assertEqual(ring.get('SpongeBob'),
+                         engine.HashRing(range(4)).get('SpongeBob'))
+
+    def test_get_empty(self):
+        self.assertIsNone(engine.HashRing([]).get('SpongeBob'))
+
+    def test_get_spreads_keys(self):
+        ring = engine.HashRing(range(4))
+        shards = {ring.get('node-%d' % i) for i in range(100)}
+        self.assertEqual({0, 1, 2, 3}, shards)
+
+    def test_remove_node_remaps_only_its_keys(self):
+        names = ['node-%d' % i for i in range(200)]
+        before = engine.HashRing(range(4))
+        after = engine.HashRing([0, 1, 2])
+
+        for name in names:
+            if before.get(name) != 3:
+                self.assertEqual(before.get(name), after.get(name))
+
+
+_Worker = engine.Worker
+
+
+def _fake_worker(index):
+    worker = mock.Mock(spec=_Worker, index=index, errors={},
+                       started_at=0)
+    worker.is_alive.return_value = True
+    return worker
+
+
+@mock.patch.object(engine, 'Worker', side_effect=_fake_worker)
+class SharedEngineTestCase(base.TestCase):
+
+    def setUp(self):
+        super(SharedEngineTestCase, self).setUp()
+        self.domain = test_utils.get_domain()
+        self.engine = engine.SharedEngine(workers=4)
+
+    def _start(self, domain):
+        instance = self.engine.spawn(domain)
+        instance.start()
+        return instance
+
+    def test_default_workers(self, mock_worker):
+        with mock.patch.object(engine.os, 'cpu_count', return_value=7):
+            self.assertEqual(7, engine.SharedEngine().size)
+
+    def test_spawn(self, mock_worker):
+        instance = self.engine.spawn(self.domain)
+
+        self.assertIsNone(instance.worker)
+        self.assertFalse(mock_worker.called)
+
+    def test_place(self, mock_worker):
+        instance = self._start(self.domain)
+
+        index = engine.HashRing(range(4)).get(self.domain['domain_name'])
+        mock_worker.assert_called_once_with(index)
+        instance.worker.start.assert_called_once_with()
+        instance.worker.start_bmc.assert_called_once_with(self.domain)
+
+    def test_place_reuses_worker(self, mock_worker):
+        first = self._start(self.domain)
+        second = self._start(self.domain)
+
+        self.assertIs(first.worker, second.worker)
+        mock_worker.assert_called_once()
+
+    def test_remove(self, mock_worker):
+        instance = self._start(self.domain)
+        instance.terminate()
+
+        instance.worker.stop_bmc.assert_called_once_with(
+            self.domain['domain_name'])
+
+    def test_rebalance_restarts_dead_worker(self, mock_worker):
+        instance = self._start(self.domain)
+        old_worker = instance.worker
+        old_worker.is_alive.return_value = False
+
+        with mock.patch.object(engine.time, 'monotonic',
+                               return_value=1000):
+            self.engine.rebalance()
+
+        self.assertIsNot(old_worker, instance.worker)
+        self.assertEqual(old_worker.index, instance.worker.index)
+        instance.worker.start_bmc.assert_called_once_with(self.domain)
+
+    def test_rebalance_crashing_worker(self, mock_worker):
+        instance = self._start(self.domain)
+        old_worker = instance.worker
+        old_worker.is_alive.return_value = False
+
+        with mock.patch.object(engine.time, 'monotonic', return_value=1):
+            self.engine.rebalance()
+
+        # the instance moved over to another worker
+        self.assertNotEqual(old_worker.index, instance.worker.index)
+        self.assertFalse(old_worker.stop_bmc.called)
+        instance.worker.start_bmc.assert_called_once_with(self.domain)
+
+    def test_resize(self, mock_worker):
+        instances = [self._start(test_utils.get_domain(domain_name=name))
+                     for name in ('node-%d' % i for i in range(20))]
+        retired = [instance for instance in instances
+                   if instance.worker.index >= 2]
+        retired_workers = [instance.worker for instance in retired]
+
+        self.engine.resize(2)
+
+        for instance in instances:
+            self.assertLess(instance.worker.index, 2)
+        for worker in retired_workers:
+            worker.terminate.assert_called_with()
+
+    def test_shutdown(self, mock_worker):
+        instance = self._start(self.domain)
+        self.engine.shutdown()
+
+        instance.worker.terminate.assert_called_once_with()
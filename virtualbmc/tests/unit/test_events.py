@@ -0,0 +1,104 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+import libvirt
+
+from virtualbmc import events
+from virtualbmc import exception
+from virtualbmc.tests.unit import base
+from virtualbmc import utils
+
+
+@mock.patch.object(events, 'start_event_loop')
+@mock.patch.object(utils, 'open_connection')
+class DomainEventMonitorTestCase(base.TestCase):
+
+    def setUp(self):
+        super(DomainEventMonitorTestCase, self).setUp()
+        self.monitor = events.DomainEventMonitor('fake:///plankton')
+        self.callback = mock.Mock()
+
+    def test_subscribe(self, mock_open, mock_loop):
+        conn = mock_open.return_value
+        self.monitor.subscribe('SpongeBob', self.callback)
+
+        mock_loop.assert_called_once_with()
+        mock_open.assert_called_once_with(
+            'fake:///plankton', sasl_username=None, sasl_password=None,
+            readonly=True)
+        self.assertEqual(
+            [mock.call(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                       self.monitor._on_lifecycle, None),
+             mock.call(None, libvirt.VIR_DOMAIN_EVENT_ID_REBOOT,
+                       self.monitor._on_reboot, None),
+             mock.call(None, libvirt.VIR_DOMAIN_EVENT_ID_WATCHDOG,
+                       self.monitor._on_watchdog, None)],
+            conn.domainEventRegisterAny.call_args_list)
+        self.assertTrue(self.monitor.alive)
+
+    def test_connect_error(self, mock_open, mock_loop):
+        mock_open.side_effect = exception.LibvirtConnectionOpenError(
+            uri='fake:///plankton', error='boom')
+
+        self.assertFalse(self.monitor.connect())
+        # reconnection is rate limited
+        self.assertFalse(self.monitor.connect())
+        mock_open.assert_called_once()
+
+    def test_lifecycle_dispatch(self, mock_open, mock_loop):
+        other_callback = mock.Mock()
+        self.monitor.subscribe('SpongeBob', self.callback)
+        self.monitor.subscribe('Patrick', other_callback)
+
+        domain = mock.Mock()
+        domain.name.return_value = 'SpongeBob'
+        self.monitor._on_lifecycle(
+            None, domain, libvirt.VIR_DOMAIN_EVENT_STOPPED, 0, None)
+
+        self.callback.assert_called_once_with(
+            libvirt.VIR_DOMAIN_EVENT_STOPPED, 0)
+        self.assertFalse(other_callback.called)
+
+    def test_reboot_watchdog_dispatch(self, mock_open, mock_loop):
+        self.monitor.subscribe('SpongeBob', self.callback)
+
+        domain = mock.Mock()
+        domain.name.return_value = 'SpongeBob'
+        self.monitor._on_reboot(None, domain, None)
+        self.monitor._on_watchdog(
+            None, domain, libvirt.VIR_DOMAIN_EVENT_WATCHDOG_RESET, None)
+
+        self.assertEqual(
+            [mock.call(events.REBOOT_EVENT, 0),
+             mock.call(events.WATCHDOG_EVENT,
+                       libvirt.VIR_DOMAIN_EVENT_WATCHDOG_RESET)],
+            self.callback.call_args_list)
+
+    def test_unsubscribe(self, mock_open, mock_loop):
+        self.monitor.subscribe('SpongeBob', self.callback)
+        self.monitor.unsubscribe('SpongeBob', self.callback)
+
+        domain = mock.Mock()
+        domain.name.return_value = 'SpongeBob'
+        self.monitor._on_lifecycle(
+            None, domain, libvirt.VIR_DOMAIN_EVENT_STOPPED, 0, None)
+
+        self.assertFalse(self.callback.called)
+
+    def test_close_notifies_subscribers(self, mock_open, mock_loop):
+        self.monitor.subscribe('SpongeBob', self.callback)
+        self.monitor._on_close(None, 1, None)
+
+        self.assertFalse(self.monitor.alive)
+        self.callback.assert_called_once_with(None, 1)
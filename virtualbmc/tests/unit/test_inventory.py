@@ -0,0 +1,176 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from virtualbmc import inventory
+from virtualbmc import sensors
+from virtualbmc.tests.unit import base
+
+DOMAIN_XML = """\
+<domain type='kvm'>
+  <name>SpongeBob</name>
+  <uuid>c7a5fdbd-cdaf-9455-926a-d65c16db1809</uuid>
+  <memory unit='GiB'>8</memory>
+  <vcpu placement='static'>4</vcpu>
+  <sysinfo type='smbios'>
+    <system>
+      <entry name='manufacturer'>Krusty Krab</entry>
+      <entry name='serial'>KK-0001</entry>
+    </system>
+  </sysinfo>
+  <os>
+    <type arch='x86_64' machine='pc-q35-6.2'>hvm</type>
+  </os>
+  <devices>
+    <disk type='file' device='disk'>
+      <source file='/var/lib/libvirt/images/spongebob.qcow2'/>
+      <target dev='vda' bus='virtio'/>
+    </disk>
+    <disk type='file' device='cdrom'>
+      <target dev='sda' bus='sata'/>
+    </disk>
+    <interface type='network'>
+      <mac address='52:54:00:12:34:56'/>
+      <model type='virtio'/>
+    </interface>
+  </devices>
+</domain>
+"""
+
+
+def _fields(area, header_size):
+    """Decode the fields of a FRU area"""
+    fields = []
+    offset = header_size
+    while area[offset] != inventory.END_OF_FIELDS:
+        length = area[offset] & 0x3f
+        fields.append(area[offset + 1:offset + 1 + length].decode('latin-1'))
+        offset += 1 + length
+
+    return fields
+
+
+class ParseDomainTestCase(base.TestCase):
+
+    def test_parse_domain(self):
+        ret = inventory.parse_domain(DOMAIN_XML)
+
+        self.assertEqual({
+            'name': 'SpongeBob',
+            'uuid': 'c7a5fdbd-cdaf-9455-926a-d65c16db1809',
+            'vcpus': 4,
+            'memory': 8 * 2 ** 30,
+            'machine': 'pc-q35-6.2',
+            'manufacturer': 'Krusty Krab',
+            'product': None,
+            'version': '',
+            'serial': 'KK-0001',
+            'disks': [{'device': 'disk', 'target': 'vda', 'bus': 'virtio',
+                       'source': '/var/lib/libvirt/images/spongebob.qcow2'},
+                      {'device': 'cdrom', 'target': 'sda', 'bus': 'sata',
+                       'source': ''}],
+            'nics': [{'mac': '52:54:00:12:34:56', 'model': 'virtio'}],
+        }, ret)
+
+    def test_parse_domain_minimal(self):
+        ret = inventory.parse_domain(
+            "<domain><name>Patrick</name><memory>1024</memory></domain>")
+
+        self.assertEqual(1024 * 1024, ret['memory'])
+        self.assertEqual(1, ret['vcpus'])
+        self.assertEqual(inventory.DEFAULT_MANUFACTURER,
+                         ret['manufacturer'])
+        self.assertEqual([], ret['disks'])
+
+
+class EncodeFruTestCase(base.TestCase):
+
+    def setUp(self):
+        super(EncodeFruTestCase, self).setUp()
+        self.domain = inventory.parse_domain(DOMAIN_XML)
+
+    def _areas(self, fru):
+        header = fru[:8]
+        self.assertEqual(0, sum(header) & 0xff)
+        areas = []
+        for offset in header[2:5]:
+            start = offset * inventory.FRU_BLOCK_SIZE
+            area = fru[start:start + fru[start + 1]
+                       * inventory.FRU_BLOCK_SIZE]
+            self.assertEqual(0, sum(area) & 0xff)
+            areas.append(area)
+
+        return areas
+
+    def test_encode_fru(self):
+        fru = inventory.encode_fru(self.domain)
+
+        chassis, board, product = self._areas(fru)
+        self.assertEqual(len(fru), 8 + len(chassis) + len(board)
+                         + len(product))
+        self.assertEqual(['', 'KK-0001'], _fields(chassis, 3))
+        self.assertEqual(['Krusty Krab', 'pc-q35-6.2', 'KK-0001', '', ''],
+                         _fields(board, 6))
+        self.assertEqual(
+            ['Krusty Krab', 'pc-q35-6.2', '', '', 'KK-0001', 'SpongeBob', '',
+             'vCPUs: 4', 'Memory: 8192 MiB', 'NIC: 52:54:00:12:34:56 virtio',
+             'Disk: vda disk virtio /var/lib/libvirt/images/spongebob.qcow2',
+             'Disk: sda cdrom sata '],
+            _fields(product, 3))
+
+    def test_encode_fru_uuid_serial(self):
+        self.domain['serial'] = None
+
+        chassis, _, _ = self._areas(inventory.encode_fru(self.domain))
+
+        self.assertEqual(['', self.domain['uuid']], _fields(chassis, 3))
+
+    def test_encode_fru_too_many_devices(self):
+        self.domain['nics'] = [{'mac': '52:54:00:12:34:%02x' % i,
+                                'model': 'virtio'} for i in range(100)]
+
+        _, _, product = self._areas(inventory.encode_fru(self.domain))
+
+        self.assertLessEqual(len(product), inventory.MAX_FRU_AREA_SIZE)
+        self.assertIn('NIC: 52:54:00:12:34:00 virtio', _fields(product, 3))
+
+
+class InventoryTestCase(base.TestCase):
+
+    def test_inventory(self):
+        ret = inventory.Inventory(DOMAIN_XML)
+
+        self.assertEqual(len(sensors.SENSORS) + 2, len(ret.sdr))
+        _, record = ret.sdr.get(1, 0, 0xff)
+        self.assertEqual(inventory.MC_DEVICE_LOCATOR, record[3])
+        _, record = ret.sdr.get(2, 0, 0xff)
+        self.assertEqual(inventory.FRU_DEVICE_LOCATOR, record[3])
+        self.assertEqual(b'SpongeBob', record[16:])
+
+        # The memory sensor is normally at most 8 GiB
+        _, record = ret.sdr.get(4, 0, 0xff)
+        self.assertEqual(inventory.NORMAL_MAXIMUM_SPECIFIED, record[30])
+        self.assertEqual(40, record[32])
+
+    def test_inventory_no_domain(self):
+        ret = inventory.Inventory()
+
+        self.assertIsNone(ret.fru)
+        self.assertEqual(len(sensors.SENSORS) + 1, len(ret.sdr))
+        _, record = ret.sdr.get(3, 0, 0xff)
+        self.assertEqual(0, record[30])
+
+    def test_read_fru(self):
+        ret = inventory.Inventory(DOMAIN_XML)
+
+        self.assertEqual(ret.fru[:8], ret.read_fru(0, 8))
+        self.assertEqual(b'', ret.read_fru(len(ret.fru), 8))
+        self.assertRaises(IndexError, ret.read_fru, len(ret.fru) + 1, 8)
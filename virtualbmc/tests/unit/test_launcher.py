@@ -0,0 +1,205 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import gc
+import multiprocessing
+import threading
+from unittest import mock
+
+from virtualbmc import launcher
+from virtualbmc.tests.unit import base
+from virtualbmc.tests.unit import utils as test_utils
+from virtualbmc import utils
+
+
+@mock.patch.object(utils, 'exit_on_sigterm', mock.Mock())
+@mock.patch.object(gc, 'freeze')
+@mock.patch.object(launcher, 'VirtualBMC')
+class VbmcRunnerTestCase(base.TestCase):
+
+    def setUp(self):
+        super(VbmcRunnerTestCase, self).setUp()
+        self.domain = test_utils.get_domain()
+
+    @mock.patch.object(launcher.time, 'monotonic')
+    @mock.patch.object(launcher.LOG, 'info')
+    def test_vbmc_runner(self, mock_info, mock_monotonic, mock_vbmc,
+                         mock_freeze):
+        mock_monotonic.return_value = 10.5
+
+        launcher.vbmc_runner(self.domain, started_at=10)
+
+        mock_freeze.assert_called_once_with()
+        mock_vbmc.assert_called_once_with(**self.domain)
+        mock_vbmc.return_value.listen.assert_called_once_with(
+            timeout=mock.ANY)
+        self.assertEqual(500, mock_info.call_args[0][1]['time'])
+
+    def test_vbmc_runner_terminated(self, mock_vbmc, mock_freeze):
+        # SIGTERM raises SystemExit
+        mock_vbmc.return_value.listen.side_effect = SystemExit(0)
+
+        self.assertRaises(SystemExit, launcher.vbmc_runner, self.domain)
+
+        mock_vbmc.return_value.close.assert_called_once_with()
+
+    def test_vbmc_runner_error(self, mock_vbmc, mock_freeze):
+        mock_vbmc.side_effect = OSError('boom')
+
+        launcher.vbmc_runner(self.domain)
+
+        mock_vbmc.assert_called_once_with(**self.domain)
+
+    @mock.patch.object(multiprocessing, 'current_process')
+    @mock.patch.object(launcher, 'vbmc_runner')
+    def test_idle_worker_main(self, mock_runner, mock_process, mock_vbmc,
+                              mock_freeze):
+        conn = mock.Mock()
+        conn.recv.return_value = (self.domain, 10)
+
+        launcher.idle_worker_main(conn)
+
+        conn.close.assert_called_once_with()
+        mock_runner.assert_called_once_with(self.domain, started_at=10)
+        self.assertEqual('vbmcd-managing-domain-SpongeBob',
+                         mock_process.return_value.name)
+
+    @mock.patch.object(launcher, 'vbmc_runner')
+    def test_idle_worker_main_manager_gone(self, mock_runner, mock_vbmc,
+                                           mock_freeze):
+        conn = mock.Mock()
+        conn.recv.side_effect = EOFError()
+
+        launcher.idle_worker_main(conn)
+
+        self.assertFalse(mock_runner.called)
+
+
+class BMCProcessTestCase(base.TestCase):
+
+    def setUp(self):
+        super(BMCProcessTestCase, self).setUp()
+        self.launcher = mock.Mock(spec=launcher.Launcher)
+        self.instance = launcher.BMCProcess(self.launcher,
+                                            test_utils.get_domain())
+
+    def test_not_started(self):
+        self.assertFalse(self.instance.is_alive())
+        self.assertIsNone(self.instance.exitcode)
+        self.instance.terminate()
+
+    def test_start(self):
+        self.instance.start()
+
+        process = self.launcher.launch.return_value
+        self.launcher.launch.assert_called_once_with(
+            self.instance.bmc_config)
+        self.assertEqual(process.is_alive.return_value,
+                         self.instance.is_alive())
+        self.assertEqual(process.sentinel, self.instance.sentinel)
+
+        self.instance.terminate()
+        process.terminate.assert_called_once_with()
+
+
+@mock.patch.object(gc, 'unfreeze')
+@mock.patch.object(gc, 'freeze')
+class LauncherTestCase(base.TestCase):
+
+    def setUp(self):
+        super(LauncherTestCase, self).setUp()
+        self.domain = test_utils.get_domain()
+        self.launcher = launcher.Launcher(warm_pool=2)
+        self.context = mock.Mock()
+        self.launcher._context = self.context
+
+    def test_launch_forks(self, mock_freeze, mock_unfreeze):
+        process = self.launcher.launch(self.domain)
+
+        self.assertEqual(self.context.Process.return_value, process)
+        self.context.Process.assert_called_once_with(
+            name='vbmcd-managing-domain-SpongeBob',
+            target=launcher.vbmc_runner, args=(self.domain, mock.ANY))
+        process.start.assert_called_once_with()
+        mock_freeze.assert_called_once_with()
+        mock_unfreeze.assert_called_once_with()
+
+    def test_fork_concurrently(self, mock_freeze, mock_unfreeze):
+        started = threading.Event()
+        release = threading.Event()
+
+        def start():
+            started.set()
+            release.wait(5)
+
+        self.context.Process.side_effect = [
+            mock.Mock(start=start), mock.Mock()]
+        thread = threading.Thread(target=self.launcher.launch,
+                                  args=(self.domain,))
+        thread.start()
+        started.wait(5)
+
+        # Forking meanwhile leaves the objects frozen
+        self.launcher.launch(self.domain)
+        self.assertFalse(mock_unfreeze.called)
+
+        release.set()
+        thread.join(5)
+
+        mock_freeze.assert_called_once_with()
+        mock_unfreeze.assert_called_once_with()
+
+    def test_launch_forkserver(self, mock_freeze, mock_unfreeze):
+        self.launcher.start_method = 'forkserver'
+
+        process = self.launcher.launch(self.domain)
+
+        process.start.assert_called_once_with()
+        self.assertFalse(mock_freeze.called)
+        self.assertFalse(mock_unfreeze.called)
+
+    def test_refill(self, mock_freeze, mock_unfreeze):
+        self.context.Pipe.side_effect = [(mock.Mock(), mock.Mock()),
+                                         (mock.Mock(), mock.Mock())]
+
+        self.launcher.refill()
+
+        self.assertEqual(2, len(self.launcher._idle))
+        self.assertEqual(2, self.context.Process.call_count)
+        self.assertEqual(launcher.idle_worker_main,
+                         self.context.Process.call_args[1]['target'])
+
+    def test_launch_idle_worker(self, mock_freeze, mock_unfreeze):
+        dead, alive = mock.Mock(), mock.Mock()
+        dead.is_alive.return_value = False
+        dead_conn, alive_conn = mock.Mock(), mock.Mock()
+        self.launcher._idle.extend([(dead, dead_conn), (alive, alive_conn)])
+
+        process = self.launcher.launch(self.domain)
+
+        self.assertEqual(alive, process)
+        self.assertEqual('vbmcd-managing-domain-SpongeBob', alive.name)
+        self.assertFalse(dead_conn.send.called)
+        dead_conn.close.assert_called_once_with()
+        alive_conn.send.assert_called_once_with((self.domain, mock.ANY))
+        alive_conn.close.assert_called_once_with()
+        self.assertFalse(self.context.Process.called)
+
+    def test_shutdown(self, mock_freeze, mock_unfreeze):
+        process, conn = mock.Mock(), mock.Mock()
+        self.launcher._idle.append((process, conn))
+
+        self.launcher.shutdown()
+
+        process.terminate.assert_called_once_with()
+        conn.close.assert_called_once_with()
+        self.assertEqual(0, len(self.launcher._idle))
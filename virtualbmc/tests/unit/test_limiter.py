@@ -0,0 +1,182 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from virtualbmc import limiter
+from virtualbmc.tests.unit import base
+from virtualbmc import utils
+
+
+class ConcurrencyLimiterTestCase(base.TestCase):
+
+    def setUp(self):
+        super(ConcurrencyLimiterTestCase, self).setUp()
+        self.lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.lock_dir)
+        self.limiter = limiter.ConcurrencyLimiter(
+            self.lock_dir, 'qemu:///system', slots=2, reserved=1)
+        self.stack = contextlib.ExitStack()
+        self.addCleanup(self.stack.close)
+
+    def _acquire_in_thread(self, priority=False):
+        acquired = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def run():
+            with self.limiter.acquire(priority=priority):
+                acquired.set()
+                release.wait(5)
+
+        threading.Thread(target=run, daemon=True).start()
+        return acquired, release
+
+    def test_acquire(self):
+        self.stack.enter_context(self.limiter.acquire())
+
+        self.assertEqual(1, self.limiter.stats['calls'])
+        self.assertEqual(0, self.limiter.stats['waits'])
+
+    def test_fork_while_slot_held(self):
+        slot_limiter = limiter.ConcurrencyLimiter(
+            self.lock_dir, 'qemu:///session', slots=1)
+        ready_r, ready_w = os.pipe()
+        quit_r, quit_w = os.pipe()
+
+        with slot_limiter.acquire():
+            pid = os.fork()
+            if not pid:
+                # Outlive the parent's call
+                try:
+                    os.write(ready_w, b'x')
+                    os.read(quit_r, 1)
+                finally:
+                    os._exit(0)
+
+        try:
+            os.read(ready_r, 1)
+            # The child has not kept the slot, the parent has freed it
+            fd = slot_limiter._lock(0)
+            self.assertIsNotNone(fd)
+            limiter._close(fd)
+
+        finally:
+            os.write(quit_w, b'x')
+            os.waitpid(pid, 0)
+            for pipe_fd in (ready_r, ready_w, quit_r, quit_w):
+                os.close(pipe_fd)
+
+    def test_priority_uses_reserved_slot(self):
+        self.stack.enter_context(self.limiter.acquire())
+
+        # The only unreserved slot is taken, the reserved one is not
+        self.stack.enter_context(self.limiter.acquire(priority=True))
+
+        self.assertEqual(0, self.limiter.stats['waits'])
+
+    def test_wait(self):
+        self.stack.enter_context(self.limiter.acquire())
+
+        acquired, release = self._acquire_in_thread()
+        self.assertFalse(acquired.wait(0.1))
+        self.assertEqual(1, self.limiter.queue_depth())
+
+        self.stack.close()
+
+        self.assertTrue(acquired.wait(5))
+        self.assertEqual(1, self.limiter.stats['waits'])
+
+    def test_priority_wait(self):
+        self.stack.enter_context(self.limiter.acquire(priority=True))
+        self.stack.enter_context(self.limiter.acquire(priority=True))
+
+        acquired, release = self._acquire_in_thread(priority=True)
+        while not self.limiter.stats['waits']:
+            time.sleep(0.01)
+        self.assertFalse(acquired.is_set())
+
+        self.stack.close()
+
+        self.assertTrue(acquired.wait(5))
+
+    def test_shared_between_limiters(self):
+        # e.g. limiters of different processes
+        other = limiter.ConcurrencyLimiter(
+            self.lock_dir, 'qemu:///system', slots=2, reserved=1)
+        self.stack.enter_context(other.acquire())
+
+        acquired, release = self._acquire_in_thread()
+
+        self.assertFalse(acquired.wait(0.1))
+
+
+class GetLimiterTestCase(base.TestCase):
+
+    def setUp(self):
+        super(GetLimiterTestCase, self).setUp()
+        self.lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.lock_dir)
+        mock.patch.object(limiter, 'LIMITERS', {}).start()
+
+    def _get_limiter(self, max_concurrent_calls):
+        conf = {'default': {'pid_file': self.lock_dir + '/master.pid'},
+                'libvirt': {'max_concurrent_calls': max_concurrent_calls,
+                            'reserved_calls': 4}}
+        with mock.patch('virtualbmc.config.get_config', return_value=conf):
+            return limiter.get_limiter('qemu:///system')
+
+    def test_get_limiter(self):
+        ret = self._get_limiter(8)
+
+        self.assertEqual(8, ret.slots)
+        self.assertEqual(4, ret.reserved)
+        self.assertIs(ret, self._get_limiter(8))
+
+    def test_get_limiter_unlimited(self):
+        self.assertIsNone(self._get_limiter(0))
+
+
+@mock.patch.object(utils, 'get_connection_pool')
+@mock.patch.object(limiter, 'get_limiter')
+class LibvirtConnectionLimitTestCase(base.TestCase):
+
+    def test_read_only(self, mock_get_limiter, mock_get_pool):
+        uri_limiter = mock_get_limiter.return_value
+
+        with utils.libvirt_connection('qemu:///system', readonly=True):
+            uri_limiter.acquire.assert_called_once_with(priority=False)
+            self.assertFalse(
+                uri_limiter.acquire.return_value.__exit__.called)
+
+        self.assertTrue(uri_limiter.acquire.return_value.__exit__.called)
+
+    def test_read_write(self, mock_get_limiter, mock_get_pool):
+        uri_limiter = mock_get_limiter.return_value
+
+        with utils.libvirt_connection('qemu:///system'):
+            pass
+
+        uri_limiter.acquire.assert_called_once_with(priority=True)
+
+    def test_unlimited(self, mock_get_limiter, mock_get_pool):
+        mock_get_limiter.return_value = None
+
+        with utils.libvirt_connection('qemu:///system') as conn:
+            self.assertEqual(mock_get_pool.return_value.get.return_value,
+                             conn)
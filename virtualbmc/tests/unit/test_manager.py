@@ -17,14 +17,18 @@ import builtins
 import configparser
 import copy
 import errno
-import multiprocessing
 import os
 import shutil
+import time
 from unittest import mock
 
-
+from virtualbmc import broker
+from virtualbmc import engine
 from virtualbmc import exception
+from virtualbmc import launcher
 from virtualbmc import manager
+from virtualbmc import stats
+from virtualbmc import store
 from virtualbmc.tests.unit import base
 from virtualbmc.tests.unit import utils as test_utils
 from virtualbmc import utils
@@ -36,8 +40,10 @@ class VirtualBMCManagerTestCase(base.TestCase):
 
     def setUp(self):
         super(VirtualBMCManagerTestCase, self).setUp()
-        self.manager = manager.VirtualBMCManager()
-        self.manager.config_dir = _CONFIG_PATH
+        with mock.patch.dict(manager.CONF['default'],
+                             {'config_dir': _CONFIG_PATH}), \
+                mock.patch.dict(manager.CONF['sensors'], {'interval': 0}):
+            self.manager = manager.VirtualBMCManager()
         self.domain0 = test_utils.get_domain()
         self.domain1 = test_utils.get_domain(domain_name='Patrick', port=321)
         self.domain_name0 = self.domain0['domain_name']
@@ -55,10 +61,9 @@ class VirtualBMCManagerTestCase(base.TestCase):
     def _get_config(self, section, item):
         return self.domain0.get(item)
 
-    @mock.patch.object(os.path, 'exists')
+    @mock.patch.object(os, 'stat')
     @mock.patch.object(configparser, 'ConfigParser')
-    def test__parse_config(self, mock_configparser, mock_exists):
-        mock_exists.return_value = True
+    def test__parse_config(self, mock_configparser, mock_stat):
         config = mock_configparser.return_value
         config.get.side_effect = self._get_config
         config.getint.side_effect = self._get_config
@@ -73,15 +78,56 @@ class VirtualBMCManagerTestCase(base.TestCase):
                                         'port', 'domain_name', 'libvirt_uri',
                                         'libvirt_sasl_username',
                                         'libvirt_sasl_password',
-                                        'active')]
+                                        'qmp_socket', 'active')]
         self.assertEqual(expected_get_calls, config.get.call_args_list)
 
-    @mock.patch.object(os.path, 'exists')
-    def test__parse_config_domain_not_found(self, mock_exists):
-        mock_exists.return_value = False
+    @mock.patch.object(os, 'stat')
+    def test__parse_config_domain_not_found(self, mock_stat):
+        mock_stat.side_effect = FileNotFoundError()
         self.assertRaises(exception.DomainNotFound,
                           self.manager._parse_config, self.domain_name0)
-        mock_exists.assert_called_once_with(self.domain_path0 + '/config')
+        mock_stat.assert_called_once_with(self.domain_path0 + '/config')
+
+    @mock.patch.object(os, 'stat')
+    @mock.patch.object(configparser, 'ConfigParser')
+    def test__parse_config_cached(self, mock_configparser, mock_stat):
+        config = mock_configparser.return_value
+        config.get.side_effect = self._get_config
+        config.getint.side_effect = self._get_config
+        mock_stat.return_value = mock.Mock(st_ino=1, st_mtime_ns=2,
+                                           st_size=3)
+
+        first = self.manager._parse_config(self.domain_name0)
+        first['status'] = 'tampered'
+        second = self.manager._parse_config(self.domain_name0)
+
+        self.assertEqual(self.domain0, second)
+        mock_configparser.assert_called_once_with()
+
+        # the file has changed since
+        mock_stat.return_value = mock.Mock(st_ino=1, st_mtime_ns=4,
+                                           st_size=3)
+        self.manager._parse_config(self.domain_name0)
+        self.assertEqual(2, mock_configparser.call_count)
+
+    @mock.patch.object(os.path, 'isdir')
+    @mock.patch.object(os, 'listdir')
+    @mock.patch.object(os, 'stat')
+    def test__domain_names(self, mock_stat, mock_listdir, mock_isdir):
+        mock_stat.return_value = mock.Mock(st_ino=1, st_mtime_ns=2)
+        mock_listdir.return_value = [self.domain_name0, 'master.pid']
+        mock_isdir.side_effect = [True, False]
+
+        self.assertEqual([self.domain_name0], self.manager._domain_names())
+        self.assertEqual([self.domain_name0], self.manager._domain_names())
+        mock_listdir.assert_called_once_with(_CONFIG_PATH)
+
+        # a domain directory has been added
+        mock_stat.return_value = mock.Mock(st_ino=1, st_mtime_ns=3)
+        mock_listdir.return_value = [self.domain_name0, self.domain_name1]
+        mock_isdir.side_effect = [True, True]
+        self.assertEqual([self.domain_name0, self.domain_name1],
+                         self.manager._domain_names())
 
     @mock.patch.object(builtins, 'open')
     @mock.patch.object(manager.VirtualBMCManager, '_parse_config')
@@ -179,6 +225,30 @@ class VirtualBMCManagerTestCase(base.TestCase):
             sasl_username=self.add_params['libvirt_sasl_username'],
             sasl_password=self.add_params['libvirt_sasl_password'])
 
+    @mock.patch.object(builtins, 'open')
+    @mock.patch.object(configparser, 'ConfigParser')
+    @mock.patch.object(os, 'makedirs')
+    @mock.patch.object(utils, 'check_libvirt_connection_and_domain')
+    def test_add_fake_backend(self, mock_check_conn, mock_makedirs,
+                              mock_configparser, mock_open):
+        with mock.patch.dict(manager.CONF['default'], {'backend': 'fake'}):
+            ret, _ = self.manager.add(**self.add_params)
+
+        self.assertEqual(0, ret)
+        # Fake domains exist wherever they are asked for
+        self.assertFalse(mock_check_conn.called)
+
+    @mock.patch.object(builtins, 'open')
+    @mock.patch.object(configparser, 'ConfigParser')
+    @mock.patch.object(os, 'makedirs')
+    @mock.patch.object(utils, 'check_libvirt_connection_and_domain')
+    def test_add_checked(self, mock_check_conn, mock_makedirs,
+                         mock_configparser, mock_open):
+        ret, _ = self.manager.add(checked=True, **self.add_params)
+
+        self.assertEqual(0, ret)
+        self.assertFalse(mock_check_conn.called)
+
     @mock.patch.object(os, 'makedirs')
     @mock.patch.object(utils, 'check_libvirt_connection_and_domain')
     def test_add_oserror(self, mock_check_conn, mock_makedirs):
@@ -212,13 +282,13 @@ class VirtualBMCManagerTestCase(base.TestCase):
         mock_exists.assert_called_once_with(self.domain_path0)
 
     @mock.patch.object(builtins, 'open')
-    @mock.patch.object(manager.VirtualBMCManager, '_parse_config')
+    @mock.patch.object(store.DirectoryStore, 'get')
     @mock.patch.object(os.path, 'exists')
     @mock.patch.object(os.path, 'isdir')
     @mock.patch.object(os, 'listdir')
-    @mock.patch.object(multiprocessing, 'Process')
-    def test_start(self, mock_process, mock_listdir, mock_isdir, mock_exists,
-                   mock__parse, mock_open):
+    @mock.patch.object(launcher.Launcher, 'launch')
+    def test_start(self, mock_launch, mock_listdir, mock_isdir, mock_exists,
+                   mock_get, mock_open):
         conf = {'ipmi': {'session_timeout': 10},
                 'default': {'show_passwords': False}}
         with mock.patch('virtualbmc.manager.CONF', conf):
@@ -227,17 +297,35 @@ class VirtualBMCManagerTestCase(base.TestCase):
             mock_exists.return_value = True
             domain0_conf = self.domain0.copy()
             domain0_conf.update(active='False')
-            mock__parse.return_value = domain0_conf
+            mock_get.return_value = domain0_conf
             file_handler = mock_open.return_value.__enter__.return_value
             self.manager.start(self.domain_name0)
-            mock__parse.assert_called_with(self.domain_name0)
+            mock_get.assert_called_with(self.domain_name0)
             self.assertEqual(file_handler.write.call_count, 9)
 
+    @mock.patch.object(launcher.Launcher, 'launch')
+    def test__spawn(self, mock_launch):
+        instance = self.manager._spawn(self.domain0)
+
+        self.assertIsInstance(instance, launcher.BMCProcess)
+        self.assertEqual(self.domain0, instance.bmc_config)
+        self.assertFalse(mock_launch.called)
+
+    @mock.patch.object(launcher.Launcher, 'launch')
+    def test__spawn_shared_engine(self, mock_launch):
+        self.manager._engine = mock.Mock(spec=engine.SharedEngine)
+
+        instance = self.manager._spawn(self.domain0)
+
+        self.manager._engine.spawn.assert_called_once_with(self.domain0)
+        self.assertEqual(self.manager._engine.spawn.return_value, instance)
+        self.assertFalse(mock_launch.called)
+
     @mock.patch.object(builtins, 'open')
-    @mock.patch.object(manager.VirtualBMCManager, '_parse_config')
+    @mock.patch.object(store.DirectoryStore, 'get')
     @mock.patch.object(os.path, 'isdir')
     @mock.patch.object(os, 'listdir')
-    def test_stop(self, mock_listdir, mock_isdir, mock__parse, mock_open):
+    def test_stop(self, mock_listdir, mock_isdir, mock_get, mock_open):
         conf = {'ipmi': {'session_timeout': 10},
                 'default': {'show_passwords': False}}
         with mock.patch('virtualbmc.manager.CONF', conf):
@@ -245,42 +333,273 @@ class VirtualBMCManagerTestCase(base.TestCase):
             mock_isdir.return_value = True
             domain0_conf = self.domain0.copy()
             domain0_conf.update(active='True')
-            mock__parse.return_value = domain0_conf
+            mock_get.return_value = domain0_conf
             file_handler = mock_open.return_value.__enter__.return_value
             self.manager.stop(self.domain_name0)
-            mock_isdir.assert_called_once_with(self.domain_path0)
-            mock__parse.assert_called_with(self.domain_name0)
+            # Only the stopped domain gets reconciled
+            self.assertFalse(mock_listdir.called)
+            mock_get.assert_called_with(self.domain_name0)
             self.assertEqual(file_handler.write.call_count, 9)
 
+    @mock.patch.object(manager.VirtualBMCManager, '_sync_vbmc_states')
+    @mock.patch.object(store.DirectoryStore, 'set_active')
+    @mock.patch.object(manager.VirtualBMCManager, '_parse_config')
+    def test_start_many(self, mock__parse, mock_set_active, mock__sync):
+        domain1_conf = self.domain1.copy()
+        domain1_conf.update(active='True')
+        mock__parse.side_effect = [
+            self.domain0, exception.DomainNotFound(domain='Squidward'),
+            domain1_conf]
+        mock__sync.return_value = {self.domain_name1: 'boom'}
+
+        ret = self.manager.start_many(
+            [self.domain_name0, 'Squidward', self.domain_name1])
+
+        # A single store update, for the domain not enabled yet
+        mock_set_active.assert_called_once_with([self.domain_name0], True)
+        mock__sync.assert_called_once_with(
+            domain_names=[self.domain_name0, self.domain_name1])
+        self.assertEqual((0, ''), ret[self.domain_name0])
+        self.assertEqual(
+            (1, 'No domain with matching name Squidward was found'),
+            ret['Squidward'])
+        self.assertEqual(
+            (1, 'Failed to start domain Patrick. Error: boom'),
+            ret[self.domain_name1])
+
+    @mock.patch.object(manager.VirtualBMCManager, '_sync_vbmc_states')
+    @mock.patch.object(store.DirectoryStore, 'set_active')
+    @mock.patch.object(manager.VirtualBMCManager, '_parse_config')
+    def test_stop_many(self, mock__parse, mock_set_active, mock__sync):
+        mock__parse.side_effect = [
+            dict(self.domain0, active='True'),
+            dict(self.domain1, active='True')]
+
+        ret = self.manager.stop_many([self.domain_name0, self.domain_name1])
+
+        mock_set_active.assert_called_once_with(
+            [self.domain_name0, self.domain_name1], False)
+        mock__sync.assert_called_once_with(
+            domain_names=[self.domain_name0, self.domain_name1])
+        self.assertEqual({self.domain_name0: (0, ''),
+                          self.domain_name1: (0, '')}, ret)
+
+    @mock.patch.object(shutil, 'rmtree')
     @mock.patch.object(os.path, 'exists')
-    def test_stop_domain_not_found(self, mock_exists):
-        mock_exists.return_value = False
+    @mock.patch.object(manager.VirtualBMCManager, 'stop_many')
+    def test_delete_many(self, mock_stop_many, mock_exists, mock_rmtree):
+        mock_exists.side_effect = [True, False]
+
+        ret = self.manager.delete_many(
+            [self.domain_name0, self.domain_name1])
+
+        mock_stop_many.assert_called_once_with([self.domain_name0])
+        mock_rmtree.assert_called_once_with(self.domain_path0)
+        self.assertEqual((0, ''), ret[self.domain_name0])
+        self.assertEqual(
+            (1, 'No domain with matching name Patrick was found'),
+            ret[self.domain_name1])
+
+    @mock.patch.object(manager.VirtualBMCManager, '_vbmc_enabled')
+    @mock.patch.object(manager.VirtualBMCManager, '_parse_config')
+    @mock.patch.object(launcher.Launcher, 'refill')
+    @mock.patch.object(launcher.Launcher, 'spawn')
+    def test__sync_vbmc_states_spawns_concurrently(
+            self, mock_spawn, mock_refill, mock__parse, mock__enabled):
+        mock__parse.side_effect = [self.domain0, self.domain1]
+        mock__enabled.return_value = True
+        instance0, instance1 = mock.Mock(), mock.Mock()
+        instance1.start.side_effect = OSError('boom')
+        mock_spawn.side_effect = [instance0, instance1]
+
+        with mock.patch.object(manager.futures, 'ThreadPoolExecutor',
+                               wraps=manager.futures.ThreadPoolExecutor
+                               ) as mock_executor:
+            errors = self.manager._sync_vbmc_states(
+                domain_names=[self.domain_name0, self.domain_name1])
+
+        mock_executor.assert_called_once_with(2)
+        instance0.start.assert_called_once_with()
+        self.assertEqual({self.domain_name1: 'boom'}, errors)
+        self.assertEqual({self.domain_name0: instance0},
+                         self.manager._running_domains)
+        # Before the instances get started, then once they are
+        self.assertEqual([mock.call(), mock.call()],
+                         mock_refill.call_args_list)
+
+    @mock.patch.object(launcher.Launcher, 'refill')
+    def test__sync_vbmc_states_fills_warm_pool(self, mock_refill):
+        self.manager._sync_vbmc_states(domain_names=[])
+
+        mock_refill.assert_called_once_with()
+
+    def test__sync_vbmc_states_broker(self):
+        self.manager._broker = mock.Mock(spec=broker.BrokerProcess)
+
+        self.manager._sync_vbmc_states(domain_names=[])
+        self.manager._broker.ensure_running.assert_called_once_with()
+
+        self.manager._sync_vbmc_states(shutdown=True, domain_names=[])
+        self.manager._broker.shutdown.assert_called_once_with()
+        self.assertEqual(1, self.manager._broker.ensure_running.call_count)
+
+    @mock.patch.object(manager.VirtualBMCManager, '_vbmc_enabled')
+    @mock.patch.object(manager.VirtualBMCManager, '_parse_config')
+    @mock.patch.object(launcher.Launcher, 'refill')
+    @mock.patch.object(launcher.Launcher, 'spawn')
+    def test__sync_vbmc_states_collector(
+            self, mock_spawn, mock_refill, mock__parse, mock__enabled):
+        self.manager._collector = mock.Mock(spec=stats.StatsCollector)
+        mock__parse.side_effect = [self.domain0, self.domain1]
+        mock__enabled.side_effect = [True, False]
+
+        self.manager._sync_vbmc_states(
+            domain_names=[self.domain_name0, self.domain_name1])
+
+        collector = self.manager._collector
+        collector.ensure_running.assert_called_once_with()
+        collector.watch.assert_called_once_with(
+            self.domain_name0, self.domain0['libvirt_uri'],
+            sasl_username=self.domain0['libvirt_sasl_username'],
+            sasl_password=self.domain0['libvirt_sasl_password'])
+        collector.unwatch.assert_called_once_with(self.domain_name1)
+
+        self.manager._sync_vbmc_states(shutdown=True, domain_names=[])
+        collector.stop.assert_called_once_with()
+
+    @mock.patch.object(os, 'stat')
+    def test_stop_domain_not_found(self, mock_stat):
+        mock_stat.side_effect = FileNotFoundError()
         ret = self.manager.stop(self.domain_name0)
         expected_ret = 1, 'No domain with matching name SpongeBob was found'
         self.assertEqual(ret, expected_ret)
-        mock_exists.assert_called_once_with(
-            os.path.join(self.domain_path0, 'config')
-        )
+        # Logging the error stats source files too
+        self.assertEqual(
+            mock.call(os.path.join(self.domain_path0, 'config')),
+            mock_stat.call_args_list[0])
 
-    @mock.patch.object(os.path, 'isdir')
-    @mock.patch.object(os, 'listdir')
+    @mock.patch.object(store.DirectoryStore, 'get_all')
     @mock.patch.object(manager.VirtualBMCManager, '_show')
-    def test_list(self, mock__show, mock_listdir, mock_isdir):
-        mock_isdir.return_value = True
-        mock_listdir.return_value = (self.domain_name0, self.domain_name1)
+    def test_list(self, mock__show, mock_get_all):
+        mock_get_all.return_value = [self.domain0, self.domain1]
 
         ret, _ = self.manager.list()
         expected_ret = 0
         self.assertEqual(ret, expected_ret)
-        mock_listdir.assert_called_once_with(_CONFIG_PATH)
-        expected_calls = [mock.call(self.domain_path0),
-                          mock.call(self.domain_path1)]
-        self.assertEqual(expected_calls, mock_isdir.call_args_list)
-        expected_calls = [mock.call(self.domain_name0),
-                          mock.call(self.domain_name1)]
+        mock_get_all.assert_called_once_with()
+        expected_calls = [
+            mock.call(self.domain_name0, bmc_config=self.domain0),
+            mock.call(self.domain_name1, bmc_config=self.domain1)]
         self.assertEqual(expected_calls, mock__show.call_args_list)
 
     @mock.patch.object(manager.VirtualBMCManager, '_show')
     def test_show(self, mock__show):
         self.manager.show(self.domain0)
         mock__show.assert_called_once_with(self.domain0)
+
+
+@mock.patch.object(manager.VirtualBMCManager, '_sync_vbmc_states')
+class VirtualBMCManagerReconcileTestCase(base.TestCase):
+
+    def setUp(self):
+        super(VirtualBMCManagerReconcileTestCase, self).setUp()
+        with mock.patch.dict(manager.CONF['default'],
+                             {'config_dir': _CONFIG_PATH}), \
+                mock.patch.dict(manager.CONF['sensors'], {'interval': 0}):
+            self.manager = manager.VirtualBMCManager()
+        self.manager._store = mock.Mock(spec=store.DirectoryStore)
+        self.manager._store.changed.return_value = False
+        self.instance = mock.Mock(sentinel=42)
+        self.instance.is_alive.return_value = True
+        self.manager._running_domains = {'SpongeBob': self.instance}
+        self.now = time.monotonic()
+        patcher = mock.patch.object(time, 'monotonic',
+                                    side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_periodic_nothing_changed(self, mock__sync):
+        self.manager.periodic()
+
+        self.manager._store.changed.assert_called_once_with()
+        self.assertFalse(mock__sync.called)
+
+    def test_periodic_store_changed(self, mock__sync):
+        self.manager._store.changed.return_value = True
+        self.manager._store.domain_names.return_value = ['Patrick']
+
+        self.manager.periodic()
+
+        mock__sync.assert_called_once_with(domain_names=mock.ANY)
+        self.assertEqual({'Patrick', 'SpongeBob'},
+                         set(mock__sync.call_args[1]['domain_names']))
+        self.assertEqual({}, self.manager._dirty)
+
+    def test_periodic_checks_store_on_interval(self, mock__sync):
+        self.manager.periodic()
+        self.manager.periodic()
+        self.now += manager.CHANGES_CHECK_INTERVAL
+        self.manager.periodic()
+
+        self.assertEqual(2, self.manager._store.changed.call_count)
+
+    def test_periodic_only_due_domains(self, mock__sync):
+        self.manager._mark_dirty(['SpongeBob'])
+        self.manager._mark_dirty(['Patrick'], delay=10)
+
+        self.manager.periodic()
+
+        mock__sync.assert_called_once_with(domain_names=['SpongeBob'])
+        self.assertEqual(['Patrick'], list(self.manager._dirty))
+
+    def test_periodic_shutdown(self, mock__sync):
+        self.manager._mark_dirty(['SpongeBob'])
+
+        self.manager.periodic(shutdown=True)
+
+        mock__sync.assert_called_once_with(True)
+        self.assertEqual({}, self.manager._dirty)
+
+    def test_poll_timeout(self, mock__sync):
+        self.manager._next_changes_check = self.now + 3
+        self.assertEqual(3000, self.manager.poll_timeout())
+
+        self.manager._mark_dirty(['SpongeBob'], delay=1)
+        self.assertEqual(1000, self.manager.poll_timeout())
+
+        self.now += 2
+        self.assertEqual(0, self.manager.poll_timeout())
+
+    def test_watched_fds(self, mock__sync):
+        self.assertEqual({42: ['SpongeBob']}, self.manager.watched_fds())
+
+    def test_watched_fds_dead_instance(self, mock__sync):
+        self.instance.is_alive.return_value = False
+
+        self.assertEqual({}, self.manager.watched_fds())
+        self.assertEqual(
+            {'SpongeBob': self.now + manager.RESPAWN_DELAY},
+            self.manager._dirty)
+
+    def test_watched_fds_shared_engine(self, mock__sync):
+        self.manager._engine = mock.Mock(spec=engine.SharedEngine)
+        self.instance.sentinels = [42, 43]
+
+        self.assertEqual({42: ['SpongeBob'], 43: ['SpongeBob']},
+                         self.manager.watched_fds())
+
+    def test_handle_events(self, mock__sync):
+        self.manager.watched_fds()
+        self.instance.is_alive.return_value = False
+
+        self.manager.handle_events([42])
+
+        self.assertEqual(
+            {'SpongeBob': self.now + manager.RESPAWN_DELAY},
+            self.manager._dirty)
+        self.assertEqual({}, self.manager.watched_fds())
+
+    def test_handle_events_still_alive(self, mock__sync):
+        self.manager.handle_events([42])
+
+        self.assertEqual({}, self.manager._dirty)
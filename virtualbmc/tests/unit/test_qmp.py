@@ -0,0 +1,138 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import resource
+import shutil
+import socket
+import tempfile
+import threading
+from unittest import mock
+
+from virtualbmc import exception
+from virtualbmc import qmp
+from virtualbmc.tests.unit import base
+from virtualbmc.tests.unit import utils as test_utils
+
+
+class QMPClientTestCase(base.TestCase):
+
+    def setUp(self):
+        super(QMPClientTestCase, self).setUp()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, 'qmp.sock')
+        self.server = test_utils.FakeQMPServer(self.path)
+        self.addCleanup(self.server.stop)
+        self.client = qmp.QMPClient(self.path, timeout=5)
+        self.addCleanup(self.client.close)
+
+    def test_execute(self):
+        self.assertEqual({'status': 'prelaunch', 'running': False},
+                         self.client.execute('query-status'))
+        self.assertEqual({}, self.client.execute('cont'))
+        self.assertEqual('running',
+                         self.client.execute('query-status')['status'])
+
+        # Capabilities negotiated once, on a single connection
+        self.assertEqual(['qmp_capabilities', 'query-status', 'cont',
+                          'query-status'], self.server.commands)
+        self.assertEqual(1, self.server.connections)
+
+    def test_execute_events_skipped(self):
+        self.client.execute('cont')
+
+        # Events come ahead of the response
+        self.assertEqual({}, self.client.execute('system_powerdown'))
+        self.assertEqual('shutdown',
+                         self.client.execute('query-status')['status'])
+
+    def test_execute_error(self):
+        self.assertRaises(exception.QMPCommandError,
+                          self.client.execute, 'foo')
+
+        # The connection is kept
+        self.client.execute('query-status')
+        self.assertEqual(1, self.server.connections)
+
+    def test_execute_reconnect(self):
+        self.client.execute('query-status')
+        self.server.disconnect()
+
+        self.client.execute('query-status')
+
+        self.assertEqual(2, self.server.connections)
+        self.assertEqual(2, self.server.commands.count('query-status'))
+
+    def test_execute_not_running(self):
+        self.server.stop()
+
+        self.assertRaises(FileNotFoundError,
+                          self.client.execute, 'query-status')
+
+    def test_execute_quit(self):
+        self.assertEqual({}, self.client.execute('quit'))
+
+        self.assertRaises(OSError, self.client.execute, 'query-status')
+
+    def test_execute_high_fd(self):
+        # select() only copes with file descriptors below 1024
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard != resource.RLIM_INFINITY and hard <= 2048:
+            self.skipTest('Not enough file descriptors')
+        if soft != resource.RLIM_INFINITY and soft <= 2048:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (4096, hard))
+            self.addCleanup(resource.setrlimit, resource.RLIMIT_NOFILE,
+                            (soft, hard))
+
+        self.client.execute('query-status')
+        sock = self.client._sock
+        self.client._sock = socket.socket(fileno=os.dup2(sock.fileno(), 2048))
+        sock.close()
+
+        self.assertEqual('prelaunch',
+                         self.client.execute('query-status')['status'])
+        # Not taken for a lost connection
+        self.assertEqual(1, self.server.connections)
+
+    def test_close_waits_for_command(self):
+        self.client.execute('query-status')
+        started = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        command = self.client._command
+
+        def slow_command(*args):
+            started.set()
+            self.assertTrue(release.wait(5))
+            return command(*args)
+
+        results = []
+        with mock.patch.object(self.client, '_command',
+                               side_effect=slow_command):
+            executing = threading.Thread(
+                target=lambda: results.append(
+                    self.client.execute('query-status')))
+            executing.start()
+            self.assertTrue(started.wait(5))
+
+            closing = threading.Thread(target=self.client.close)
+            closing.start()
+            closing.join(0.1)
+            self.assertTrue(closing.is_alive())
+
+            release.set()
+            executing.join(5)
+            closing.join(5)
+
+        self.assertEqual('prelaunch', results[0]['status'])
+        self.assertIsNone(self.client._sock)
@@ -0,0 +1,172 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
+
+from virtualbmc import sel
+from virtualbmc.tests.unit import base
+
+
+class SystemEventLogTestCase(base.TestCase):
+
+    def setUp(self):
+        super(SystemEventLogTestCase, self).setUp()
+        self.log = sel.SystemEventLog(4)
+
+    def _offsets(self, log):
+        """Return the record IDs and event offsets, from the oldest"""
+        entries = []
+        record_id = 0
+        while record_id != sel.LAST_RECORD_ID:
+            next_id, entry = log.get(record_id, 0, sel.ENTRY_SIZE)
+            entries.append((entry[0] | entry[1] << 8, entry[13]))
+            record_id = next_id
+
+        return entries
+
+    def _event(self, offset):
+        return sel.Event(sel.SENSOR_TYPE_WATCHDOG, sel.WATCHDOG_SENSOR,
+                         offset, False)
+
+    def test_add(self):
+        self.assertEqual(1, self.log.add(sel.POWER_ON, timestamp=1000))
+
+        _, entry = self.log.get(1, 0, sel.ENTRY_SIZE)
+        self.assertEqual(
+            b'\x01\x00\x02\xe8\x03\x00\x00\x20\x00\x04\x09\x10\xef\x00\xff'
+            b'\xff', entry)
+        self.assertEqual(1000, self.log.last_addition)
+        self.assertEqual(3 * sel.ENTRY_SIZE, self.log.free_space)
+
+    def test_get_partial(self):
+        self.log.add(sel.POWER_OFF)
+
+        next_id, entry = self.log.get(sel.LAST_RECORD_ID, 10, 8)
+
+        self.assertEqual(sel.LAST_RECORD_ID, next_id)
+        self.assertEqual(bytes([sel.SENSOR_TYPE_POWER_UNIT,
+                                sel.POWER_UNIT_SENSOR, sel.SENSOR_SPECIFIC,
+                                0, 0xff, 0xff]), entry)
+        self.assertRaises(IndexError, self.log.get, 1, 17, 1)
+
+    def test_get_not_present(self):
+        self.assertRaises(KeyError, self.log.get, 0, 0, 16)
+
+        self.log.add(sel.POWER_OFF)
+
+        self.assertRaises(KeyError, self.log.get, 2, 0, 16)
+        self.assertRaises(KeyError, self.log.get, 0x10000, 0, 16)
+
+    def test_overwrite_oldest(self):
+        for offset in range(6):
+            self.log.add(self._event(offset))
+
+        self.assertEqual([(3, 2), (4, 3), (5, 4), (6, 5)],
+                         self._offsets(self.log))
+        self.assertRaises(KeyError, self.log.get, 2, 0, 16)
+        self.assertTrue(self.log.overflow)
+        self.assertEqual(0, self.log.free_space)
+
+    def test_record_id_wrap(self):
+        self.log._added = sel.MAX_RECORD_ID - 2
+        for offset in range(4):
+            self.log.add(self._event(offset))
+
+        self.assertEqual([(0xfffd, 0), (0xfffe, 1), (1, 2), (2, 3)],
+                         self._offsets(self.log))
+        _, entry = self.log.get(0xfffe, 0, 16)
+        self.assertEqual(1, entry[13])
+
+    def test_clear(self):
+        self.log.add(sel.POWER_ON)
+        self.log.add(sel.POWER_OFF)
+
+        self.log.clear()
+
+        self.assertEqual(0, len(self.log))
+        self.assertNotEqual(0, self.log.last_erase)
+        self.assertEqual(1, self.log.add(sel.POWER_ON))
+
+
+class SystemEventLogFileTestCase(base.TestCase):
+
+    def setUp(self):
+        super(SystemEventLogFileTestCase, self).setUp()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        os.mkdir(os.path.join(tmp_dir, 'SpongeBob'))
+        self.path = os.path.join(tmp_dir, 'SpongeBob', 'sel')
+        self.log = sel.SystemEventLog(4, path=self.path)
+        self.addCleanup(self.log.close)
+
+    def test_save_load(self):
+        for offset in range(6):
+            self.log.add(sel.Event(sel.SENSOR_TYPE_WATCHDOG,
+                                   sel.WATCHDOG_SENSOR, offset, False),
+                         timestamp=1000 + offset)
+
+        self.log.close()
+        ret = sel.SystemEventLog(4, path=self.path)
+
+        self.assertEqual(4, len(ret))
+        self.assertTrue(ret.overflow)
+        self.assertEqual(1005, ret.last_addition)
+        for record_id in range(3, 7):
+            self.assertEqual(self.log.get(record_id, 0, 16)[1],
+                             ret.get(record_id, 0, 16)[1])
+        self.assertEqual(7, ret.add(sel.POWER_ON))
+
+    def test_load_shrunk(self):
+        for _ in range(3):
+            self.log.add(sel.POWER_ON)
+        self.log.close()
+
+        ret = sel.SystemEventLog(2, path=self.path)
+
+        self.assertEqual(2, len(ret))
+        self.assertRaises(KeyError, ret.get, 1, 0, 16)
+        self.assertEqual(sel.LAST_RECORD_ID, ret.get(3, 0, 16)[0])
+
+    @mock.patch.object(sel.LOG, 'warning', autospec=True)
+    def test_load_invalid(self, mock_warning):
+        with open(self.path, 'wb') as f:
+            f.write(b'VSEL\x01')
+
+        ret = sel.SystemEventLog(4, path=self.path)
+
+        self.assertEqual(0, len(ret))
+        self.assertTrue(mock_warning.called)
+
+    def test_save_scheduled(self):
+        saved = threading.Event()
+        self.log.save_interval = 0
+        with mock.patch.object(self.log, 'save', side_effect=saved.set):
+            self.log.add(sel.POWER_ON)
+            self.assertTrue(saved.wait(5))
+
+    def test_save_directory_gone(self):
+        self.log.add(sel.POWER_ON)
+        # The vBMC got deleted
+        shutil.rmtree(os.path.dirname(self.path))
+
+        self.log.close()
+
+        self.assertFalse(os.path.exists(os.path.dirname(self.path)))
+
+    def test_save_unchanged(self):
+        self.log.close()
+
+        self.assertFalse(os.path.exists(self.path))
@@ -0,0 +1,68 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from virtualbmc import sensors
+from virtualbmc.tests.unit import base
+
+
+class SensorsTestCase(base.TestCase):
+
+    def test_encode_full_sensor_record(self):
+        sensor = sensors.SENSORS_BY_NUMBER[2]
+
+        record = sensors.encode_full_sensor_record(2, sensor)
+
+        self.assertEqual(48 + len('Memory'), len(record))
+        # Record ID, SDR version, record type and length
+        self.assertEqual(b'\x02\x00\x51\x01', record[:4])
+        self.assertEqual(len(record) - 5, record[4])
+        self.assertEqual(2, record[7])
+        self.assertEqual(sensors.SENSOR_TYPE_MEMORY, record[12])
+        self.assertEqual(sensors.UNIT_GIGABYTE, record[21])
+        # M is 2, result exponent is -1
+        self.assertEqual(2, record[24])
+        self.assertEqual(0xf0, record[29])
+        self.assertEqual(0xc0 | len('Memory'), record[47])
+        self.assertEqual(b'Memory', record[48:])
+
+    def test_raw_reading(self):
+        sensor = sensors.SENSORS_BY_NUMBER[3]
+
+        self.assertEqual(5, sensors.raw_reading(
+            sensor, {'disk_read': 10 * 2 ** 20}))
+        self.assertEqual(0xff, sensors.raw_reading(
+            sensor, {'disk_read': 2 ** 40}))
+
+
+class SdrRepositoryTestCase(base.TestCase):
+
+    def setUp(self):
+        super(SdrRepositoryTestCase, self).setUp()
+        self.records = [sensors.encode_record(1, 0xc0, b'first'),
+                        sensors.encode_record(5, 0xc0, b'second')]
+        self.sdr = sensors.SdrRepository(self.records)
+
+    def test_get(self):
+        self.assertEqual((5, self.records[0]), self.sdr.get(0, 0, 0xff))
+        self.assertEqual((5, self.records[0]), self.sdr.get(1, 0, 0xff))
+        self.assertEqual((sensors.LAST_RECORD_ID, self.records[1]),
+                         self.sdr.get(5, 0, 0xff))
+
+    def test_get_partial(self):
+        self.assertEqual((5, b'fir'), self.sdr.get(1, 5, 3))
+        self.assertEqual((5, b''), self.sdr.get(1, 10, 3))
+
+    def test_get_not_found(self):
+        self.assertRaises(KeyError, self.sdr.get, 2, 0, 0xff)
+
+    def test_get_out_of_range(self):
+        self.assertRaises(IndexError, self.sdr.get, 1, 11, 0xff)
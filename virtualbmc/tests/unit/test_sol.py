@@ -0,0 +1,207 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+import libvirt
+import pyghmi.ipmi.console as console
+
+from virtualbmc import events
+from virtualbmc import sol
+from virtualbmc.tests.unit import base
+from virtualbmc import utils
+
+READABLE = libvirt.VIR_STREAM_EVENT_READABLE
+WRITABLE = libvirt.VIR_STREAM_EVENT_WRITABLE
+HANGUP = libvirt.VIR_STREAM_EVENT_HANGUP
+
+
+class SolConsoleTestCase(base.TestCase):
+
+    def setUp(self):
+        super(SolConsoleTestCase, self).setUp()
+        mock.patch.object(events, 'start_event_loop').start()
+        mock.patch.object(console.session.Session, 'wait_for_rsp').start()
+        self.mock_open = mock.patch.object(utils, 'open_connection').start()
+        self.mock_domain = mock.patch.object(utils,
+                                             'get_libvirt_domain').start()
+        self.mock_add_timeout = mock.patch.object(
+            libvirt, 'virEventAddTimeout', create=True).start()
+        self.mock_update_timeout = mock.patch.object(
+            libvirt, 'virEventUpdateTimeout', create=True).start()
+        self.mock_remove_timeout = mock.patch.object(
+            libvirt, 'virEventRemoveTimeout', create=True).start()
+        self.conn = self.mock_open.return_value
+        self.stream = self.conn.newStream.return_value
+        self.stream.recv.return_value = sol.STREAM_AGAIN
+        self.session = mock.Mock()
+        self.on_close = mock.Mock()
+        self.console = sol.SolConsole(
+            self.session, 'SpongeBob', {'uri': 'fake:///plankton'},
+            buffer_size=8, on_close=self.on_close)
+        self.console.start()
+
+    def _payloads(self):
+        payloads = [c[0][0] for c in self.session.send_payload.call_args_list]
+        self.session.send_payload.reset_mock()
+        return payloads
+
+    def _read(self, *data):
+        self.stream.recv.side_effect = list(data) + [sol.STREAM_AGAIN]
+        self.console._on_stream_event(self.stream, READABLE, None)
+
+    def test_start(self):
+        self.mock_open.assert_called_once_with(uri='fake:///plankton')
+        self.assertEqual(self.console._got_sol_payload,
+                         self.session.sol_handler)
+        self.mock_domain.return_value.openConsole.assert_called_once_with(
+            None, self.stream, 0)
+        self.stream.eventAddCallback.assert_called_once_with(
+            READABLE | sol.STREAM_ERROR_EVENTS,
+            self.console._on_stream_event, None)
+        self.mock_add_timeout.assert_called_once_with(
+            -1, self.console._on_timeout, None)
+        self.assertFalse(self.mock_update_timeout.called)
+
+    def test_output(self):
+        self._read(b'hel', b'lo')
+
+        self.assertEqual([bytearray(b'\x01\x00\x00\x00hello')],
+                         self._payloads())
+        self.mock_update_timeout.assert_called_with(
+            self.mock_add_timeout.return_value, sol.RETRY_INTERVAL)
+
+        # Acknowledged
+        self.console._got_sol_payload(bytearray([0, 1, 5, 0]))
+
+        self.assertEqual(b'', self.console._output)
+        self.assertEqual([], self._payloads())
+        self.mock_update_timeout.assert_called_with(
+            self.mock_add_timeout.return_value, -1)
+
+    def test_output_backpressure(self):
+        self._read(b'12345678')
+
+        # Nothing more read until acknowledged
+        self.stream.recv.assert_called_once_with(8)
+        self.stream.eventUpdateCallback.assert_called_once_with(
+            sol.STREAM_ERROR_EVENTS)
+
+        self.console._got_sol_payload(bytearray([0, 1, 8, 0]))
+
+        self.stream.eventUpdateCallback.assert_called_with(
+            READABLE | sol.STREAM_ERROR_EVENTS)
+
+    def test_output_nack(self):
+        self._read(b'hello')
+        self._payloads()
+
+        self.console._got_sol_payload(bytearray([0, 1, 2, sol.SOL_NACK]))
+
+        # The rest goes once the client is ready again
+        self.assertEqual([], self._payloads())
+        self.console._on_timeout(None, None)
+        self.assertEqual([bytearray(b'\x02\x00\x00\x00llo')],
+                         self._payloads())
+
+    def test_output_retransmitted(self):
+        self._read(b'hello')
+        payload, = self._payloads()
+
+        for _ in range(sol.MAX_RETRIES):
+            self.console._on_timeout(None, None)
+        self.assertEqual([payload] * sol.MAX_RETRIES, self._payloads())
+
+        # The client is gone
+        self.console._on_timeout(None, None)
+        self.on_close.assert_called_once_with(self.console)
+
+    def test_input(self):
+        self.stream.send.return_value = 3
+
+        self.console._got_sol_payload(bytearray(b'\x01\x00\x00\x00ls\r'))
+
+        self.stream.send.assert_called_once_with(b'ls\r')
+        self.assertEqual([bytearray((0, 1, 3, 0))], self._payloads())
+
+    def test_input_retransmitted(self):
+        self.stream.send.return_value = 3
+
+        self.console._got_sol_payload(bytearray(b'\x01\x00\x00\x00ls\r'))
+        self.console._got_sol_payload(bytearray(b'\x01\x00\x00\x00ls\r'))
+
+        self.stream.send.assert_called_once_with(b'ls\r')
+        self.assertEqual([bytearray((0, 1, 3, 0))] * 2, self._payloads())
+
+    def test_input_backpressure(self):
+        self.stream.send.return_value = sol.STREAM_AGAIN
+
+        self.console._got_sol_payload(bytearray(b'\x01\x00\x00\x00hello'))
+        self.stream.eventUpdateCallback.assert_called_with(
+            READABLE | WRITABLE | sol.STREAM_ERROR_EVENTS)
+
+        # The input buffer is full, only part of it is accepted
+        self.console._got_sol_payload(bytearray(b'\x02\x00\x00\x00world'))
+        self.assertEqual([bytearray((0, 1, 5, 0)),
+                          bytearray((0, 2, 3, sol.SOL_NACK))],
+                         self._payloads())
+
+        self.stream.send.return_value = 8
+        self.console._on_stream_event(self.stream, WRITABLE, None)
+
+        self.stream.send.assert_called_with(b'hellowor')
+        self.stream.eventUpdateCallback.assert_called_with(
+            READABLE | sol.STREAM_ERROR_EVENTS)
+
+    def test_hangup(self):
+        self.console._on_stream_event(self.stream, HANGUP, None)
+
+        self.stream.abort.assert_called_once_with()
+        self.mock_update_timeout.assert_called_with(
+            self.mock_add_timeout.return_value, sol.RETRY_INTERVAL)
+
+        # Client input goes nowhere meanwhile
+        self.console._got_sol_payload(bytearray(b'\x01\x00\x00\x00ls\r'))
+        self.assertFalse(self.stream.send.called)
+        self.assertEqual(
+            [bytearray((0, 1, 3, sol.SOL_TRANSFER_UNAVAILABLE))],
+            self._payloads())
+
+        # Reattached once the domain is back
+        self.console._on_timeout(None, None)
+        self.assertEqual(2, self.stream.eventAddCallback.call_count)
+        self.mock_update_timeout.assert_called_with(
+            self.mock_add_timeout.return_value, -1)
+
+    def test_console_unavailable(self):
+        self.console._on_stream_event(self.stream, HANGUP, None)
+        self.mock_domain.return_value.openConsole.side_effect = (
+            libvirt.libvirtError('boom'))
+
+        self.console._on_timeout(None, None)
+
+        self.assertIsNone(self.console._stream)
+        self.mock_update_timeout.assert_called_with(
+            self.mock_add_timeout.return_value, sol.RETRY_INTERVAL)
+
+    def test_close(self):
+        self.console.close()
+        self.console.close()
+
+        self.stream.abort.assert_called_once_with()
+        self.mock_remove_timeout.assert_called_once_with(
+            self.mock_add_timeout.return_value)
+        self.conn.close.assert_called_once_with()
+        self.assertEqual([bytearray((0, 0, 0, sol.SOL_DEACTIVATING))],
+                         self._payloads())
+        self.assertIsNone(self.session.sol_handler)
+        self.on_close.assert_called_once_with(self.console)
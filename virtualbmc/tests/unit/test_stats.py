@@ -0,0 +1,262 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from virtualbmc import stats
+from virtualbmc.tests.unit import base
+from virtualbmc import utils
+
+VALUES = {'cpu_usage': 50.0, 'memory': 1024.0, 'disk_read': 1.0,
+          'disk_write': 2.0, 'net_rx': 3.0, 'net_tx': 4.0, 'power': 64.0,
+          'power_min': 40.0, 'power_max': 88.0, 'power_avg': 50.5}
+
+
+def get_stats(cpu_time=0, rd_bytes=0, wr_bytes=0, rx_bytes=0,
+              tx_bytes=0):
+    return {'state.state': 1, 'cpu.time': cpu_time, 'vcpu.current': 2,
+            'balloon.current': 1024, 'balloon.maximum': 2048,
+            'block.count': 2, 'block.0.rd.bytes': rd_bytes,
+            'block.0.wr.bytes': wr_bytes, 'block.1.rd.bytes': rd_bytes,
+            'block.1.wr.bytes': wr_bytes, 'net.count': 1,
+            'net.0.rx.bytes': rx_bytes, 'net.0.tx.bytes': tx_bytes}
+
+
+class StatsTableTestCase(base.TestCase):
+
+    def setUp(self):
+        super(StatsTableTestCase, self).setUp()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, '.stats-foo')
+        self.table = stats.StatsTable(self.path, capacity=2)
+        self.addCleanup(self.table.close)
+        self.reader = stats.StatsReader(self.path, 'SpongeBob', max_age=30)
+
+    def test_read(self):
+        self.table.update('Patrick', dict(VALUES, cpu_usage=10.0))
+        self.table.update('SpongeBob', VALUES)
+
+        ret = self.reader.read()
+
+        self.assertLess(time.time() - ret.pop('timestamp'), 30)
+        self.assertEqual(VALUES, ret)
+
+    def test_read_update(self):
+        self.table.update('SpongeBob', VALUES)
+        self.reader.read()
+
+        self.table.update('SpongeBob', dict(VALUES, cpu_usage=25.0))
+
+        self.assertEqual(25.0, self.reader.read()['cpu_usage'])
+
+    def test_read_no_table(self):
+        os.unlink(self.path)
+
+        self.assertIsNone(self.reader.read())
+
+    def test_read_not_found(self):
+        self.table.update('Patrick', VALUES)
+
+        self.assertIsNone(self.reader.read())
+
+    def test_read_no_readings(self):
+        self.table.update('SpongeBob')
+
+        self.assertIsNone(self.reader.read())
+
+    def test_read_removed(self):
+        self.table.update('SpongeBob', VALUES)
+        self.reader.read()
+
+        self.table.remove('SpongeBob')
+        self.table.update('Patrick', VALUES)
+
+        self.assertIsNone(self.reader.read())
+
+    @mock.patch.object(time, 'time', autospec=True)
+    def test_read_stale(self, mock_time):
+        mock_time.return_value = 1000
+        self.table.update('SpongeBob', VALUES)
+
+        mock_time.return_value = 1031
+
+        self.assertIsNone(self.reader.read())
+
+    def test_read_torn(self):
+        self.table.update('SpongeBob', VALUES)
+        self.reader.read()
+
+        # As seen while the collector is writing the record
+        stats._SEQUENCE.pack_into(self.table._map, stats.HEADER_SIZE
+                                  + stats._SEQUENCE_OFFSET, 3)
+
+        self.assertIsNone(self.reader.read())
+
+    @mock.patch.object(time, 'time', autospec=True)
+    def test_read_new_table(self, mock_time):
+        mock_time.return_value = 1000
+        self.table.update('SpongeBob', VALUES)
+        self.reader.read()
+
+        # The collector got restarted, the former table goes stale
+        mock_time.return_value = 1040
+        table = stats.StatsTable(self.path, capacity=4)
+        self.addCleanup(table.close)
+        table.update('SpongeBob', dict(VALUES, cpu_usage=25.0))
+
+        self.assertEqual(25.0, self.reader.read()['cpu_usage'])
+
+    def test_update_full(self):
+        self.table.update('Patrick', VALUES)
+        self.table.update('Squidward', VALUES)
+
+        self.table.update('SpongeBob', VALUES)
+
+        self.assertEqual({'Patrick', 'Squidward'}, self.table.names())
+        self.assertIsNone(self.reader.read())
+
+
+class DomainSamplerTestCase(base.TestCase):
+
+    def setUp(self):
+        super(DomainSamplerTestCase, self).setUp()
+        self.sampler = stats._DomainSampler(idle_watts=40, vcpu_watts=12)
+
+    def test_sample(self):
+        self.assertIsNone(self.sampler.sample(get_stats(), 100))
+
+        ret = self.sampler.sample(
+            get_stats(cpu_time=10 * 10 ** 9, rd_bytes=1000, wr_bytes=2000,
+                      rx_bytes=3000, tx_bytes=4000), 110)
+
+        self.assertEqual({'cpu_usage': 50.0, 'memory': 1024 * 1024,
+                          'disk_read': 200.0, 'disk_write': 400.0,
+                          'net_rx': 300.0, 'net_tx': 400.0, 'power': 52.0,
+                          'power_min': 52.0, 'power_max': 52.0,
+                          'power_avg': 52.0}, ret)
+
+    def test_sample_power_window(self):
+        self.sampler.sample(get_stats(), 100)
+        self.sampler.sample(get_stats(cpu_time=20 * 10 ** 9), 110)
+
+        ret = self.sampler.sample(get_stats(cpu_time=20 * 10 ** 9), 120)
+
+        self.assertEqual(40.0, ret['power'])
+        self.assertEqual(40.0, ret['power_min'])
+        self.assertEqual(64.0, ret['power_max'])
+        self.assertEqual(52.0, ret['power_avg'])
+
+    def test_sample_not_running(self):
+        self.sampler.sample(get_stats(), 100)
+
+        self.assertIsNone(self.sampler.sample({'state.state': 5}, 110))
+        self.assertIsNone(self.sampler.sample(get_stats(), 120))
+
+    def test_sample_restarted(self):
+        self.sampler.sample(get_stats(cpu_time=10 ** 12), 100)
+
+        self.assertIsNone(self.sampler.sample(get_stats(), 110))
+        self.assertIsNotNone(self.sampler.sample(get_stats(), 120))
+
+
+@mock.patch.object(utils, 'libvirt_connection')
+class StatsCollectorTestCase(base.TestCase):
+
+    def setUp(self):
+        super(StatsCollectorTestCase, self).setUp()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, '.stats-foo')
+        mock.patch.object(stats, 'get_table_path',
+                          return_value=self.path).start()
+        self.collector = stats.StatsCollector(
+            interval=10, table_size=4, idle_watts=40, vcpu_watts=12)
+        self.collector.watch('SpongeBob', 'qemu:///system')
+        self.collector.watch('Patrick', 'qemu:///system')
+
+    def _set_stats(self, mock_libvirt_conn, *results):
+        conn = mock_libvirt_conn.return_value.__enter__.return_value
+        conn.getAllDomainStats.side_effect = [
+            [(mock.Mock(**{'name.return_value': name}), record)
+             for name, record in result.items()]
+            for result in results]
+        return conn
+
+    def test_collect(self, mock_libvirt_conn):
+        conn = self._set_stats(
+            mock_libvirt_conn,
+            {'SpongeBob': get_stats(), 'Patrick': get_stats(),
+             'Squidward': get_stats()},
+            {'SpongeBob': get_stats(cpu_time=10 ** 9),
+             'Patrick': {'state.state': 5}, 'Squidward': get_stats()})
+
+        self.collector.collect()
+        self.collector.collect()
+
+        mock_libvirt_conn.assert_called_with(
+            'qemu:///system', sasl_username=None, sasl_password=None,
+            readonly=True)
+        conn.getAllDomainStats.assert_called_with(stats.STATS_TYPES)
+        self.assertEqual({'SpongeBob', 'Patrick'},
+                         self.collector._tables['qemu:///system'].names())
+        reader = stats.StatsReader(self.path, 'SpongeBob', max_age=30)
+        self.assertIsNotNone(reader.read())
+        reader = stats.StatsReader(self.path, 'Patrick', max_age=30)
+        self.assertIsNone(reader.read())
+
+    def test_collect_unwatched(self, mock_libvirt_conn):
+        self._set_stats(mock_libvirt_conn,
+                        {'SpongeBob': get_stats(), 'Patrick': get_stats()},
+                        {'SpongeBob': get_stats(), 'Patrick': get_stats()})
+        self.collector.collect()
+
+        self.collector.unwatch('Patrick')
+        self.collector.collect()
+
+        self.assertEqual({'SpongeBob'},
+                         self.collector._tables['qemu:///system'].names())
+
+    def test_collect_no_more_domains(self, mock_libvirt_conn):
+        self._set_stats(mock_libvirt_conn, {'SpongeBob': get_stats()})
+        self.collector.collect()
+        table = self.collector._tables['qemu:///system']
+
+        self.collector.unwatch('SpongeBob')
+        self.collector.unwatch('Patrick')
+        self.collector.collect()
+
+        self.assertEqual({}, self.collector._tables)
+        self.assertTrue(table._map.closed)
+
+    def test_collect_error(self, mock_libvirt_conn):
+        mock_libvirt_conn.side_effect = Exception('boom')
+        self.collector.watch('Squidward', 'qemu+ssh://remote/system')
+
+        self.collector.collect()
+
+        self.assertEqual(2, mock_libvirt_conn.call_count)
+
+    def test_ensure_running(self, mock_libvirt_conn):
+        with mock.patch('threading.Thread', autospec=True) as mock_thread:
+            mock_thread.return_value.is_alive.return_value = True
+            self.collector.ensure_running()
+            self.collector.ensure_running()
+
+        mock_thread.assert_called_once_with(
+            target=self.collector._run, name='vbmc-stats-collector',
+            daemon=True)
+        mock_thread.return_value.start.assert_called_once_with()
@@ -0,0 +1,222 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from unittest import mock
+
+from virtualbmc import exception
+from virtualbmc import store
+from virtualbmc.tests.unit import base
+from virtualbmc.tests.unit import utils as test_utils
+
+
+class SQLiteStoreTestCase(base.TestCase):
+
+    def setUp(self):
+        super(SQLiteStoreTestCase, self).setUp()
+        self.config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config_dir)
+        self.db_path = os.path.join(self.config_dir, store.SQLITE_DB_FILE)
+        self.store = store.SQLiteStore(self.db_path)
+        self.domain0 = test_utils.get_domain(active='False')
+        self.domain1 = test_utils.get_domain(domain_name='Patrick', port=321,
+                                             active='True')
+
+    def test_create_get(self):
+        self.store.create(**self.domain0)
+
+        self.assertEqual(self.domain0, self.store.get('SpongeBob'))
+        self.assertTrue(self.store.exists('SpongeBob'))
+
+    def test_create_already_exists(self):
+        self.store.create(**self.domain0)
+
+        self.assertRaises(exception.DomainAlreadyExists,
+                          self.store.create, **self.domain0)
+
+    def test_get_not_found(self):
+        self.assertRaises(exception.DomainNotFound,
+                          self.store.get, 'SpongeBob')
+        self.assertFalse(self.store.exists('SpongeBob'))
+
+    def test_get_all(self):
+        self.store.create(**self.domain1)
+        self.store.create(**self.domain0)
+
+        self.assertEqual([self.domain1, self.domain0], self.store.get_all())
+        self.assertEqual(['Patrick', 'SpongeBob'], self.store.domain_names())
+
+    def test_update(self):
+        self.store.create(**self.domain0)
+        self.domain0.update(port=623, active=True)
+
+        self.store.update(**self.domain0)
+
+        bmc = self.store.get('SpongeBob')
+        self.assertEqual(623, bmc['port'])
+        self.assertEqual('True', bmc['active'])
+
+    def test_update_not_found(self):
+        self.assertRaises(exception.DomainNotFound,
+                          self.store.update, **self.domain0)
+
+    def test_set_active(self):
+        self.store.create(**self.domain0)
+        self.store.create(**self.domain1)
+
+        self.store.set_active(['SpongeBob', 'Patrick'], False)
+
+        self.assertEqual(['False', 'False'],
+                         [bmc['active'] for bmc in self.store.get_all()])
+
+    def test_delete(self):
+        self.store.create(**self.domain0)
+
+        self.store.delete('SpongeBob')
+
+        self.assertEqual([], self.store.get_all())
+
+    def test_changed(self):
+        self.assertTrue(self.store.changed())
+        self.assertFalse(self.store.changed())
+
+        other = store.SQLiteStore(self.db_path)
+        other.create(**self.domain0)
+
+        self.assertTrue(self.store.changed())
+        self.assertFalse(self.store.changed())
+
+    def test_added_columns(self):
+        db_path = os.path.join(self.config_dir, 'old.db')
+        db = sqlite3.connect(db_path)
+        db.execute(store.SQLiteStore.SCHEMA[0].replace(
+            ' qmp_socket TEXT,', ''))
+        db.execute("INSERT INTO bmcs (domain_name, port) "
+                   "VALUES ('SpongeBob', 623)")
+        db.commit()
+        db.close()
+
+        ret = store.SQLiteStore(db_path)
+
+        self.assertIsNone(ret.get('SpongeBob')['qmp_socket'])
+        self.domain1.update(qmp_socket='/run/qemu/patrick.qmp')
+        ret.create(**self.domain1)
+        self.assertEqual(self.domain1, ret.get('Patrick'))
+
+    def test_import(self):
+        directory_store = store.DirectoryStore(self.config_dir)
+        os.makedirs(os.path.join(self.config_dir, 'SpongeBob'))
+        directory_store.update(**self.domain0)
+
+        sqlite_store = store.SQLiteStore(self.db_path,
+                                         import_dir=self.config_dir)
+        self.assertEqual([self.domain0], sqlite_store.get_all())
+
+        # Only imported once, deleted BMCs do not come back
+        sqlite_store.delete('SpongeBob')
+        sqlite_store = store.SQLiteStore(self.db_path,
+                                         import_dir=self.config_dir)
+        self.assertEqual([], sqlite_store.get_all())
+
+
+class DirectoryStoreTestCase(base.TestCase):
+
+    def setUp(self):
+        super(DirectoryStoreTestCase, self).setUp()
+        self.store = store.DirectoryStore('/foo')
+
+    @mock.patch.object(os, 'listdir', lambda path: [])
+    @mock.patch.object(os, 'stat')
+    def test_changed(self, mock_stat):
+        mock_stat.return_value = mock.Mock(st_ino=1, st_mtime_ns=2)
+        self.assertTrue(self.store.changed())
+        self.assertFalse(self.store.changed())
+
+        mock_stat.return_value = mock.Mock(st_ino=1, st_mtime_ns=3)
+        self.assertTrue(self.store.changed())
+
+    @mock.patch.object(os, 'stat')
+    def test_changed_missing_dir(self, mock_stat):
+        mock_stat.side_effect = FileNotFoundError()
+        self.assertTrue(self.store.changed())
+        self.assertTrue(self.store.changed())
+
+    def test_changed_config_rewritten(self):
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        directory_store = store.DirectoryStore(config_dir)
+        domain = test_utils.get_domain(active='False')
+        directory_store.create(**domain)
+
+        self.assertTrue(directory_store.changed())
+        self.assertFalse(directory_store.changed())
+
+        # Edited in place, the config directory is left untouched
+        config_path = os.path.join(config_dir, 'SpongeBob', 'config')
+        with open(config_path, 'a') as f:
+            f.write('# edited\n')
+
+        self.assertTrue(directory_store.changed())
+        self.assertFalse(directory_store.changed())
+
+    def test_concurrent_reads(self):
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        directory_store = store.DirectoryStore(config_dir)
+        for index in range(20):
+            directory_store.create(**test_utils.get_domain(
+                domain_name='domain-%d' % index, port=6230 + index))
+
+        # Configs get parsed as they are read
+        directory_store = store.DirectoryStore(config_dir)
+        errors = []
+
+        def read():
+            try:
+                for _ in range(20):
+                    self.assertEqual(20, len(directory_store.get_all()))
+
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=read) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+
+
+class GetStoreTestCase(base.TestCase):
+
+    def test_get_store_directory(self):
+        with mock.patch.dict(store.CONF['default'],
+                             {'config_store': 'directory'}):
+            ret = store.get_store('/foo')
+
+        self.assertIsInstance(ret, store.DirectoryStore)
+        self.assertEqual('/foo', ret.config_dir)
+
+    @mock.patch.object(store, 'SQLiteStore')
+    def test_get_store_sqlite(self, mock_sqlite_store):
+        with mock.patch.dict(store.CONF['default'],
+                             {'config_store': 'sqlite'}):
+            ret = store.get_store('/foo')
+
+        self.assertEqual(mock_sqlite_store.return_value, ret)
+        mock_sqlite_store.assert_called_once_with(
+            '/foo/virtualbmc.db', import_dir='/foo')
@@ -14,6 +14,9 @@
 #    under the License.
 
 import os
+import signal
+import threading
+import time
 from unittest import mock
 
 import libvirt
@@ -51,6 +54,14 @@ class MiscUtilsTestCase(base.TestCase):
         expected = {'foo': 'bar', 'password': '***'}
         self.assertEqual(expected, output_dict)
 
+    @mock.patch.object(signal, 'signal')
+    def test_exit_on_sigterm(self, mock_signal):
+        utils.exit_on_sigterm()
+
+        signum, handler = mock_signal.call_args[0]
+        self.assertEqual(signal.SIGTERM, signum)
+        self.assertRaises(SystemExit, handler, signum, None)
+
 
 class LibvirtUtilsTestCase(base.TestCase):
 
@@ -114,6 +125,264 @@ class LibvirtUtilsTestCase(base.TestCase):
         self._test_libvirt_open_sasl(readonly=True)
 
 
+@mock.patch.object(utils, 'open_connection')
+class LibvirtConnectionPoolTestCase(base.TestCase):
+
+    def setUp(self):
+        super(LibvirtConnectionPoolTestCase, self).setUp()
+        self.pool = utils.LibvirtConnectionPool(max_size=2)
+        self.uri = 'fake:///squidward'
+
+    def test_get_reuses_connection(self, mock_open):
+        conn = mock_open.return_value
+        conn.isAlive.return_value = True
+
+        self.assertEqual(conn, self.pool.get(self.uri, readonly=True))
+        self.assertEqual(conn, self.pool.get(self.uri, readonly=True))
+
+        mock_open.assert_called_once_with(self.uri, sasl_username=None,
+                                          sasl_password=None, readonly=True)
+        conn.setKeepAlive.assert_called_once_with(5, 3)
+        self.assertEqual(1, self.pool.stats['misses'])
+        self.assertEqual(1, self.pool.stats['hits'])
+
+    def test_get_keyed_by_readonly(self, mock_open):
+        mock_open.side_effect = [mock.Mock(), mock.Mock()]
+        ro_conn = self.pool.get(self.uri, readonly=True)
+        rw_conn = self.pool.get(self.uri)
+
+        self.assertNotEqual(ro_conn, rw_conn)
+        self.assertEqual(2, mock_open.call_count)
+        self.assertEqual(2, self.pool.stats['misses'])
+
+    def test_get_reconnects_dead_connection(self, mock_open):
+        dead_conn = mock.Mock()
+        dead_conn.isAlive.return_value = False
+        new_conn = mock.Mock()
+        mock_open.side_effect = [dead_conn, new_conn]
+
+        self.pool.get(self.uri)
+        self.assertEqual(new_conn, self.pool.get(self.uri))
+
+        self.pool.release(dead_conn)
+        dead_conn.close.assert_called_once_with()
+        self.assertFalse(new_conn.close.called)
+        self.assertEqual(1, self.pool.stats['reconnects'])
+
+    def test_get_evicts_least_recently_used(self, mock_open):
+        conns = [mock.Mock(), mock.Mock(), mock.Mock()]
+        mock_open.side_effect = conns
+
+        for uri in ('fake:///1', 'fake:///2', 'fake:///3'):
+            self.pool.release(self.pool.get(uri))
+
+        conns[0].close.assert_called_once_with()
+        self.assertFalse(conns[1].close.called)
+        self.assertEqual(1, self.pool.stats['evictions'])
+
+    def test_get_evicts_borrowed_connection_on_release(self, mock_open):
+        conns = [mock.Mock(), mock.Mock(), mock.Mock()]
+        mock_open.side_effect = conns
+
+        borrowed = self.pool.get('fake:///1')
+        self.pool.get('fake:///2')
+        self.pool.get('fake:///3')
+
+        # still in use, only dropped from the pool
+        self.assertFalse(borrowed.close.called)
+
+        self.pool.release(borrowed)
+        borrowed.close.assert_called_once_with()
+
+    def test_release_keeps_pooled_connection(self, mock_open):
+        conn = self.pool.get(self.uri)
+        self.pool.release(conn)
+
+        self.assertFalse(conn.close.called)
+        self.assertEqual(conn, self.pool.get(self.uri))
+        mock_open.assert_called_once_with(self.uri, sasl_username=None,
+                                          sasl_password=None, readonly=False)
+
+    def test_release_drops_dead_connection(self, mock_open):
+        conn = self.pool.get(self.uri)
+        conn.isAlive.return_value = False
+
+        self.pool.release(conn, error=libvirt.libvirtError('boom'))
+        self.pool.get(self.uri)
+
+        conn.close.assert_called_once_with()
+        self.assertEqual(2, mock_open.call_count)
+
+    def test_release_dead_connection_still_borrowed(self, mock_open):
+        conn = self.pool.get(self.uri)
+        self.pool.get(self.uri)
+        conn.isAlive.return_value = False
+
+        self.pool.release(conn, error=libvirt.libvirtError('boom'))
+        self.assertFalse(conn.close.called)
+
+        self.pool.release(conn)
+        conn.close.assert_called_once_with()
+
+    def test_get_connects_unlocked(self, mock_open):
+        connecting = threading.Event()
+        connected = threading.Event()
+        self.addCleanup(connected.set)
+        conn = mock.Mock()
+
+        def open_connection(uri, **kwargs):
+            if uri != self.uri:
+                return mock.Mock()
+            connecting.set()
+            self.assertTrue(connected.wait(5))
+            return conn
+
+        mock_open.side_effect = open_connection
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.pool.get(self.uri)))
+            for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(connecting.wait(5))
+
+        # Other keys are served meanwhile
+        self.pool.get('fake:///patrick')
+
+        connected.set()
+        for thread in threads:
+            thread.join(5)
+
+        # The connection got shared
+        self.assertEqual([conn, conn], results)
+        self.assertEqual(2, mock_open.call_count)
+
+    def test_get_connect_error(self, mock_open):
+        mock_open.side_effect = [exception.LibvirtConnectionOpenError(
+            uri=self.uri, error='boom'), mock.Mock()]
+
+        self.assertRaises(exception.LibvirtConnectionOpenError,
+                          self.pool.get, self.uri)
+        self.pool.get(self.uri)
+        self.assertEqual(2, mock_open.call_count)
+
+    def test_get_after_fork(self, mock_open):
+        conn = self.pool.get(self.uri)
+        # Held by another thread of the parent while forking
+        self.pool._lock.acquire()
+
+        utils._reset_pools()
+        self.pool.get(self.uri)
+
+        # the parent's connection must be left alone
+        self.assertFalse(conn.close.called)
+        self.assertEqual(2, mock_open.call_count)
+        self.assertEqual(1, self.pool.stats['misses'])
+
+
+class ReadWriteLockTestCase(base.TestCase):
+
+    def setUp(self):
+        super(ReadWriteLockTestCase, self).setUp()
+        self.lock = utils.ReadWriteLock()
+
+    def _try(self, lock):
+        acquired = threading.Event()
+
+        def run():
+            with lock:
+                acquired.set()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread, acquired
+
+    def test_readers_share(self):
+        with self.lock.read():
+            thread, acquired = self._try(self.lock.read())
+            self.assertTrue(acquired.wait(5))
+
+    def test_writer_excludes_readers(self):
+        with self.lock.write():
+            thread, acquired = self._try(self.lock.read())
+            self.assertFalse(acquired.wait(0.1))
+
+        self.assertTrue(acquired.wait(5))
+
+    def test_waiting_writer_blocks_new_readers(self):
+        with self.lock.read():
+            writer, writer_acquired = self._try(self.lock.write())
+            # Let the writer queue up
+            while not self.lock._writers_waiting:
+                time.sleep(0.01)
+
+            reader, reader_acquired = self._try(self.lock.read())
+            self.assertFalse(reader_acquired.wait(0.1))
+            self.assertFalse(writer_acquired.is_set())
+
+        self.assertTrue(writer_acquired.wait(5))
+        self.assertTrue(reader_acquired.wait(5))
+
+
+@mock.patch.object(time, 'monotonic')
+class ReplayCacheTestCase(base.TestCase):
+
+    def setUp(self):
+        super(ReplayCacheTestCase, self).setUp()
+        self.cache = utils.ReplayCache(max_size=2, ttl=5)
+
+    def test_get_put(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        self.assertIsNone(self.cache.get('foo'))
+
+        self.cache.put('foo', 'bar')
+
+        self.assertEqual('bar', self.cache.get('foo'))
+        self.assertEqual(1, self.cache.stats['hits'])
+        self.assertEqual(1, self.cache.stats['misses'])
+
+    def test_expired(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        self.cache.put('foo', 'bar')
+
+        mock_monotonic.return_value = 105
+        self.assertIsNone(self.cache.get('foo'))
+        self.assertEqual(1, self.cache.stats['expirations'])
+
+    def test_evicted(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        for key in ('foo', 'bar', 'baz'):
+            self.cache.put(key, key)
+
+        self.assertIsNone(self.cache.get('foo'))
+        self.assertEqual('baz', self.cache.get('baz'))
+        self.assertEqual(1, self.cache.stats['evictions'])
+
+    def test_slot_reused(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        self.cache.put('foo', 'bar', slot=1)
+        self.cache.put('baz', 'qux', slot=2)
+
+        self.assertIsNone(self.cache.get('quux', slot=1))
+        self.assertIsNone(self.cache.get('foo', slot=1))
+        self.assertEqual('qux', self.cache.get('baz', slot=2))
+        self.assertEqual(1, self.cache.stats['evictions'])
+
+    def test_slot_retransmitted(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        self.cache.put('foo', 'bar', slot=1)
+
+        self.assertEqual('bar', self.cache.get('foo', slot=1))
+        self.assertEqual('bar', self.cache.get('foo', slot=1))
+
+    def test_disabled(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        self.cache.max_size = 0
+        self.cache.put('foo', 'bar')
+
+        self.assertIsNone(self.cache.get('foo'))
+
+
 @mock.patch.object(utils, 'os')
 class DetachProcessUtilsTestCase(base.TestCase):
 
@@ -13,11 +13,24 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+import shutil
+import struct
+import tempfile
+import threading
 from unittest import mock
 
 import libvirt
+import pyghmi.ipmi.private.session as ipmisession
 
+from virtualbmc import backends
+from virtualbmc import events
 from virtualbmc import exception
+from virtualbmc import inventory
+from virtualbmc import sel
+from virtualbmc import sensors
+from virtualbmc import sol
+from virtualbmc import stats
 from virtualbmc.tests.unit import base
 from virtualbmc.tests.unit import utils as test_utils
 from virtualbmc import utils
@@ -42,8 +55,25 @@ DOMAIN_XML_TEMPLATE = """\
 </domain>
 """
 
+INVENTORY_DOMAIN_XML = """\
+<domain type='kvm'>
+  <name>SpongeBob</name>
+  <uuid>c7a5fdbd-cdaf-9455-926a-d65c16db1809</uuid>
+  <memory unit='KiB'>4194304</memory>
+  <vcpu placement='static'>2</vcpu>
+  <os>
+    <type arch='x86_64' machine='pc-q35-6.2'>hvm</type>
+  </os>
+  <devices>
+    <interface type='network'>
+      <mac address='52:54:00:12:34:56'/>
+    </interface>
+  </devices>
+</domain>
+"""
 
-@mock.patch.object(utils, 'libvirt_open')
+
+@mock.patch.object(utils, 'libvirt_connection')
 @mock.patch.object(utils, 'get_libvirt_domain')
 class VirtualBMCTestCase(base.TestCase):
 
@@ -56,207 +86,1153 @@ class VirtualBMCTestCase(base.TestCase):
                    lambda *args, **kwargs: None).start()
         self.vbmc = vbmc.VirtualBMC(**self.domain)
 
-    def _assert_libvirt_calls(self, mock_libvirt_domain, mock_libvirt_open,
+    def _assert_libvirt_calls(self, mock_libvirt_domain, mock_libvirt_conn,
                               readonly=False):
         """Helper method to assert that the LibVirt calls were invoked."""
         mock_libvirt_domain.assert_called_once_with(
             mock.ANY, self.domain['domain_name'])
         params = {'sasl_password': self.domain['libvirt_sasl_password'],
                   'sasl_username': self.domain['libvirt_sasl_username'],
-                  'uri': self.domain['libvirt_uri']}
-        if readonly:
-            params['readonly'] = True
-        mock_libvirt_open.assert_called_once_with(**params)
+                  'uri': self.domain['libvirt_uri'], 'readonly': readonly}
+        mock_libvirt_conn.assert_called_once_with(**params)
+
+    def test_close(self, mock_libvirt_domain, mock_libvirt_conn):
+        sock = mock.Mock()
+        self.vbmc.serversocket = sock
+        self.vbmc.port = self.domain['port']
+        session = mock.Mock(bmc=self.vbmc)
+        handlers = {sock: {0: self.vbmc},
+                    ('::1', 1234): {self.domain['port']: session}}
+        iosockets = [mock.Mock(), sock]
 
-    def test_get_boot_device(self, mock_libvirt_domain, mock_libvirt_open):
+        with mock.patch.object(ipmisession.Session, 'bmc_handlers',
+                               handlers), \
+                mock.patch.object(ipmisession, 'iosockets', iosockets):
+            self.vbmc.close()
+
+        self.assertEqual({('::1', 1234): {}}, handlers)
+        self.assertEqual(1, len(iosockets))
+        sock.close.assert_called_once_with()
+
+    def test_get_boot_device(self, mock_libvirt_domain, mock_libvirt_conn):
         for boot_device in vbmc.GET_BOOT_DEVICES_MAP:
             domain_xml = DOMAIN_XML_TEMPLATE % boot_device
             mock_libvirt_domain.return_value.XMLDesc.return_value = domain_xml
             ret = self.vbmc.get_boot_device()
 
             self.assertEqual(vbmc.GET_BOOT_DEVICES_MAP[boot_device], ret)
-            self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open,
+            self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn,
                                        readonly=True)
 
             # reset mocks for the next iteraction
             mock_libvirt_domain.reset_mock()
-            mock_libvirt_open.reset_mock()
+            mock_libvirt_conn.reset_mock()
+
+    def test_get_boot_device_no_boot_element(self, mock_libvirt_domain,
+                                             mock_libvirt_conn):
+        domain_xml = DOMAIN_XML_TEMPLATE.replace("<boot dev='%s'/>", '')
+        mock_libvirt_domain.return_value.XMLDesc.return_value = domain_xml
+
+        self.assertEqual(0, self.vbmc.get_boot_device())
+
+    def test_parse_boot_settings_stops_at_os(self, mock_libvirt_domain,
+                                             mock_libvirt_conn):
+        # Whatever follows <os> is not even looked at, so that broken
+        # XML there goes unnoticed
+        domain_xml = ((DOMAIN_XML_TEMPLATE % 'hd').split('<devices>')[0]
+                      + ' ' * 128 + '</broken>' * 2000)
 
-    def test_set_boot_device(self, mock_libvirt_domain, mock_libvirt_open):
+        with mock.patch.object(vbmc, 'XML_PARSE_CHUNK_SIZE', 64):
+            ret = vbmc.parse_boot_settings(domain_xml)
+
+        self.assertEqual({'boot_dev': 'hd'}, ret)
+
+    def test_set_boot_device(self, mock_libvirt_domain, mock_libvirt_conn):
         for boot_device in vbmc.SET_BOOT_DEVICES_MAP:
             domain_xml = DOMAIN_XML_TEMPLATE % 'foo'
             mock_libvirt_domain.return_value.XMLDesc.return_value = domain_xml
-            conn = mock_libvirt_open.return_value.__enter__.return_value
+            conn = mock_libvirt_conn.return_value.__enter__.return_value
             self.vbmc.set_boot_device(boot_device)
 
-            expected = ('<boot dev="%s" />' %
+            expected = ("<boot dev='%s'/>" %
                         vbmc.SET_BOOT_DEVICES_MAP[boot_device])
             self.assertIn(expected, str(conn.defineXML.call_args))
             self.assertEqual(1, str(conn.defineXML.call_args).count('<boot '))
-            self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+            self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
             # reset mocks for the next iteraction
             mock_libvirt_domain.reset_mock()
-            mock_libvirt_open.reset_mock()
+            mock_libvirt_conn.reset_mock()
+
+    def test_set_boot_device_unchanged(self, mock_libvirt_domain,
+                                       mock_libvirt_conn):
+        domain_xml = DOMAIN_XML_TEMPLATE.replace(
+            "<boot order='2'/>", '').replace("<boot order='1'/>", '')
+        mock_libvirt_domain.return_value.XMLDesc.return_value = (
+            domain_xml % 'hd')
+        conn = mock_libvirt_conn.return_value.__enter__.return_value
+
+        ret = self.vbmc.set_boot_device('hd')
+
+        self.assertIsNone(ret)
+        self.assertFalse(conn.defineXML.called)
 
     def test_set_boot_device_error(self, mock_libvirt_domain,
-                                   mock_libvirt_open):
+                                   mock_libvirt_conn):
         mock_libvirt_domain.side_effect = libvirt.libvirtError('boom')
         ret = self.vbmc.set_boot_device('network')
         self.assertEqual(0xc0, ret)
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
     def test_set_boot_device_unkown_device_error(self, mock_libvirt_domain,
-                                                 mock_libvirt_open):
+                                                 mock_libvirt_conn):
         ret = self.vbmc.set_boot_device('device-foo-bar')
         self.assertEqual(0xcc, ret)
-        self.assertFalse(mock_libvirt_open.called)
+        self.assertFalse(mock_libvirt_conn.called)
         self.assertFalse(mock_libvirt_domain.called)
 
-    def _test_get_power_state(self, mock_libvirt_domain, mock_libvirt_open,
+    def _test_get_power_state(self, mock_libvirt_domain, mock_libvirt_conn,
                               power_on=True):
         mock_libvirt_domain.return_value.isActive.return_value = power_on
         ret = self.vbmc.get_power_state()
 
         expected = vbmc.POWERON if power_on else vbmc.POWEROFF
         self.assertEqual(expected, ret)
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open,
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn,
                                    readonly=True)
 
-    def test_get_power_state_on(self, mock_libvirt_domain, mock_libvirt_open):
-        self._test_get_power_state(mock_libvirt_domain, mock_libvirt_open,
+    def test_get_power_state_on(self, mock_libvirt_domain, mock_libvirt_conn):
+        self._test_get_power_state(mock_libvirt_domain, mock_libvirt_conn,
                                    power_on=True)
 
-    def test_get_power_state_off(self, mock_libvirt_domain, mock_libvirt_open):
-        self._test_get_power_state(mock_libvirt_domain, mock_libvirt_open,
+    def test_get_power_state_off(self, mock_libvirt_domain, mock_libvirt_conn):
+        self._test_get_power_state(mock_libvirt_domain, mock_libvirt_conn,
                                    power_on=False)
 
     def test_get_power_state_error(self, mock_libvirt_domain,
-                                   mock_libvirt_open):
+                                   mock_libvirt_conn):
         mock_libvirt_domain.side_effect = libvirt.libvirtError('boom')
         self.assertRaises(exception.VirtualBMCError, self.vbmc.get_power_state)
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open,
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn,
                                    readonly=True)
 
-    def test_pulse_diag_is_on(self, mock_libvirt_domain, mock_libvirt_open):
+    def test_pulse_diag_is_on(self, mock_libvirt_domain, mock_libvirt_conn):
         domain = mock_libvirt_domain.return_value
         domain.isActive.return_value = True
         self.vbmc.pulse_diag()
 
         domain.injectNMI.assert_called_once_with()
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
-    def test_pulse_diag_is_off(self, mock_libvirt_domain, mock_libvirt_open):
+    def test_pulse_diag_is_off(self, mock_libvirt_domain, mock_libvirt_conn):
         domain = mock_libvirt_domain.return_value
         domain.isActive.return_value = False
         self.vbmc.pulse_diag()
 
         # power is already off, assert injectNMI() wasn't invoked
         domain.injectNMI.assert_not_called()
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
-    def test_pulse_diag_error(self, mock_libvirt_domain, mock_libvirt_open):
+    def test_pulse_diag_error(self, mock_libvirt_domain, mock_libvirt_conn):
         mock_libvirt_domain.side_effect = libvirt.libvirtError('boom')
         ret = self.vbmc.pulse_diag()
         self.assertEqual(0xC0, ret)
         mock_libvirt_domain.return_value.injectNMI.assert_not_called()
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
-    def test_power_off_is_on(self, mock_libvirt_domain, mock_libvirt_open):
+    def test_power_off_is_on(self, mock_libvirt_domain, mock_libvirt_conn):
         domain = mock_libvirt_domain.return_value
         domain.isActive.return_value = True
-        self.vbmc.power_off()
+        self.vbmc._power_off()
 
         domain.destroy.assert_called_once_with()
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
-    def test_power_off_is_off(self, mock_libvirt_domain, mock_libvirt_open):
+    def test_power_off_is_off(self, mock_libvirt_domain, mock_libvirt_conn):
         domain = mock_libvirt_domain.return_value
         domain.isActive.return_value = False
-        self.vbmc.power_off()
+        self.vbmc._power_off()
 
         # power is already off, assert destroy() wasn't invoked
         domain.destroy.assert_not_called()
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
-    def test_power_off_error(self, mock_libvirt_domain, mock_libvirt_open):
+    def test_power_off_error(self, mock_libvirt_domain, mock_libvirt_conn):
         mock_libvirt_domain.side_effect = libvirt.libvirtError('boom')
-        ret = self.vbmc.power_off()
-        self.assertEqual(0xC0, ret)
+        self.assertRaises(exception.BackendError, self.vbmc._power_off)
         mock_libvirt_domain.return_value.destroy.assert_not_called()
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
-    def test_power_reset_is_on(self, mock_libvirt_domain, mock_libvirt_open):
+    def test_power_reset_is_on(self, mock_libvirt_domain, mock_libvirt_conn):
         domain = mock_libvirt_domain.return_value
         domain.isActive.return_value = True
-        self.vbmc.power_reset()
+        self.vbmc._power_reset()
 
         domain.reset.assert_called_once_with()
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
-    def test_power_reset_is_off(self, mock_libvirt_domain, mock_libvirt_open):
+    def test_power_reset_is_off(self, mock_libvirt_domain, mock_libvirt_conn):
         domain = mock_libvirt_domain.return_value
         domain.isActive.return_value = False
-        self.vbmc.power_reset()
+        self.vbmc._power_reset()
 
         # power is already off, assert reset() wasn't invoked
         domain.reset.assert_not_called()
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
-    def test_power_reset_error(self, mock_libvirt_domain, mock_libvirt_open):
+    def test_power_reset_error(self, mock_libvirt_domain, mock_libvirt_conn):
         mock_libvirt_domain.side_effect = libvirt.libvirtError('boom')
-        ret = self.vbmc.power_reset()
-        self.assertEqual(0xC0, ret)
+        self.assertRaises(exception.BackendError, self.vbmc._power_reset)
         mock_libvirt_domain.return_value.reset.assert_not_called()
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
     def test_power_shutdown_is_on(self, mock_libvirt_domain,
-                                  mock_libvirt_open):
+                                  mock_libvirt_conn):
         domain = mock_libvirt_domain.return_value
         domain.isActive.return_value = True
-        self.vbmc.power_shutdown()
+        self.vbmc._power_shutdown()
 
         domain.shutdown.assert_called_once_with()
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
     def test_power_shutdown_is_off(self, mock_libvirt_domain,
-                                   mock_libvirt_open):
+                                   mock_libvirt_conn):
         domain = mock_libvirt_domain.return_value
         domain.isActive.return_value = False
-        self.vbmc.power_shutdown()
+        self.vbmc._power_shutdown()
 
         # power is already off, assert shutdown() wasn't invoked
         domain.shutdown.assert_not_called()
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
     def test_power_shutdown_error(self, mock_libvirt_domain,
-                                  mock_libvirt_open):
+                                  mock_libvirt_conn):
         mock_libvirt_domain.side_effect = libvirt.libvirtError('boom')
-        ret = self.vbmc.power_shutdown()
-        self.assertEqual(0xC0, ret)
+        self.assertRaises(exception.BackendError, self.vbmc._power_shutdown)
         mock_libvirt_domain.return_value.shutdown.assert_not_called()
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
-    def test_power_on_is_on(self, mock_libvirt_domain, mock_libvirt_open):
+    def test_power_on_is_on(self, mock_libvirt_domain, mock_libvirt_conn):
         domain = mock_libvirt_domain.return_value
         domain.isActive.return_value = True
-        self.vbmc.power_on()
+        self.vbmc._power_on()
 
         # power is already on, assert create() wasn't invoked
         domain.create.assert_not_called()
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
-    def test_power_on_is_off(self, mock_libvirt_domain, mock_libvirt_open):
+    def test_power_on_is_off(self, mock_libvirt_domain, mock_libvirt_conn):
         domain = mock_libvirt_domain.return_value
         domain.isActive.return_value = False
-        self.vbmc.power_on()
+        self.vbmc._power_on()
 
         domain.create.assert_called_once_with()
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
 
-    def test_power_on_error(self, mock_libvirt_domain, mock_libvirt_open):
+    def test_power_on_error(self, mock_libvirt_domain, mock_libvirt_conn):
         mock_libvirt_domain.side_effect = libvirt.libvirtError('boom')
-        ret = self.vbmc.power_on()
-        self.assertEqual(0xC0, ret)
+        self.assertRaises(exception.BackendError, self.vbmc._power_on)
         self.assertFalse(mock_libvirt_domain.return_value.create.called)
-        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_open)
+        self._assert_libvirt_calls(mock_libvirt_domain, mock_libvirt_conn)
+
+
+@mock.patch.object(utils, 'libvirt_connection')
+@mock.patch.object(utils, 'get_libvirt_domain')
+class VirtualBMCPowerStateCacheTestCase(base.TestCase):
+
+    def setUp(self):
+        super(VirtualBMCPowerStateCacheTestCase, self).setUp()
+        self.domain = test_utils.get_domain()
+        mock.patch('pyghmi.ipmi.bmc.Bmc.__init__',
+                   lambda *args, **kwargs: None).start()
+        conf = {'default': {'config_dir': '/foo'},
+                'ipmi': {'replay_cache_size': 256, 'replay_cache_ttl': 5,
+                         'sel_capacity': 16, 'sel_save_interval': 30},
+                'libvirt': {'domain_events': True},
+                'sensors': {'interval': 0}}
+        mock.patch('virtualbmc.vbmc.CONF', conf).start()
+        self.monitor = mock.Mock(spec=events.DomainEventMonitor)
+        self.monitor.connect.return_value = True
+        self.monitor.alive = True
+        mock.patch.object(events, 'get_event_monitor',
+                          return_value=self.monitor).start()
+        self.vbmc = vbmc.VirtualBMC(**self.domain)
+        self.vbmc._sel = sel.SystemEventLog(16)
+
+    def test_subscribed(self, mock_libvirt_domain, mock_libvirt_conn):
+        self.monitor.subscribe.assert_called_once_with(
+            self.domain['domain_name'], self.vbmc._handle_domain_event)
+
+    def test_get_power_state_cached(self, mock_libvirt_domain,
+                                    mock_libvirt_conn):
+        mock_libvirt_domain.return_value.isActive.return_value = True
+
+        self.assertEqual(vbmc.POWERON, self.vbmc.get_power_state())
+        self.assertEqual(vbmc.POWERON, self.vbmc.get_power_state())
+
+        mock_libvirt_domain.assert_called_once_with(
+            mock.ANY, self.domain['domain_name'])
+
+    def test_get_power_state_invalidated_by_event(self, mock_libvirt_domain,
+                                                  mock_libvirt_conn):
+        domain = mock_libvirt_domain.return_value
+        domain.isActive.return_value = False
+        self.assertEqual(vbmc.POWEROFF, self.vbmc.get_power_state())
+
+        domain.isActive.return_value = True
+        self.vbmc._handle_domain_event(libvirt.VIR_DOMAIN_EVENT_STARTED, 0)
+
+        self.assertEqual(vbmc.POWERON, self.vbmc.get_power_state())
+        self.assertEqual(2, mock_libvirt_domain.call_count)
+
+    def test_get_power_state_events_down(self, mock_libvirt_domain,
+                                         mock_libvirt_conn):
+        self.monitor.connect.return_value = False
+        mock_libvirt_domain.return_value.isActive.return_value = True
+
+        self.vbmc.get_power_state()
+        self.vbmc.get_power_state()
+
+        self.assertEqual(2, mock_libvirt_domain.call_count)
+
+    def test_get_boot_device_cached(self, mock_libvirt_domain,
+                                    mock_libvirt_conn):
+        domain = mock_libvirt_domain.return_value
+        domain.XMLDesc.return_value = DOMAIN_XML_TEMPLATE % 'network'
+
+        self.assertEqual(4, self.vbmc.get_boot_device())
+        self.assertEqual(4, self.vbmc.get_boot_device())
+
+        self.assertEqual(1, domain.XMLDesc.call_count)
+
+    def test_get_boot_device_invalidated_by_event(self, mock_libvirt_domain,
+                                                  mock_libvirt_conn):
+        domain = mock_libvirt_domain.return_value
+        domain.XMLDesc.return_value = DOMAIN_XML_TEMPLATE % 'network'
+        self.assertEqual(4, self.vbmc.get_boot_device())
+
+        domain.XMLDesc.return_value = DOMAIN_XML_TEMPLATE % 'hd'
+        self.vbmc._handle_domain_event(libvirt.VIR_DOMAIN_EVENT_DEFINED, 0)
+
+        self.assertEqual(8, self.vbmc.get_boot_device())
+        self.assertEqual(2, domain.XMLDesc.call_count)
+
+    def test_get_boot_device_events_down(self, mock_libvirt_domain,
+                                         mock_libvirt_conn):
+        self.monitor.connect.return_value = False
+        domain = mock_libvirt_domain.return_value
+        domain.XMLDesc.return_value = DOMAIN_XML_TEMPLATE % 'network'
+
+        self.vbmc.get_boot_device()
+        self.vbmc.get_boot_device()
+
+        self.assertEqual(2, domain.XMLDesc.call_count)
+
+    def test_set_boot_device_invalidates(self, mock_libvirt_domain,
+                                         mock_libvirt_conn):
+        domain = mock_libvirt_domain.return_value
+        domain.XMLDesc.return_value = DOMAIN_XML_TEMPLATE % 'network'
+        self.vbmc.get_boot_device()
+
+        self.vbmc.set_boot_device('hd')
+        domain.XMLDesc.return_value = DOMAIN_XML_TEMPLATE % 'hd'
+
+        self.assertEqual(8, self.vbmc.get_boot_device())
+
+    def test_power_on_invalidates(self, mock_libvirt_domain,
+                                  mock_libvirt_conn):
+        domain = mock_libvirt_domain.return_value
+        domain.isActive.return_value = False
+        self.vbmc.get_power_state()
+
+        self.vbmc._power_on()
+        domain.isActive.return_value = True
+
+        self.assertEqual(vbmc.POWERON, self.vbmc.get_power_state())
+
+
+@mock.patch.object(utils, 'libvirt_connection')
+@mock.patch.object(utils, 'get_libvirt_domain')
+class VirtualBMCBootOverrideTestCase(base.TestCase):
+
+    def setUp(self):
+        super(VirtualBMCBootOverrideTestCase, self).setUp()
+        self.domain = test_utils.get_domain()
+        mock.patch('pyghmi.ipmi.bmc.Bmc.__init__',
+                   lambda *args, **kwargs: None).start()
+        self.vbmc = vbmc.VirtualBMC(**self.domain)
+        self.session = mock.Mock()
+
+    def _set_boot_options(self, flags, bootdevice):
+        request = {'data': [vbmc.BOOT_FLAGS_PARAMETER, flags,
+                            bootdevice << 2, 0, 0]}
+        self.vbmc.set_system_boot_options(request, self.session)
+
+    def _get_boot_options(self):
+        request = {'data': [vbmc.BOOT_FLAGS_PARAMETER, 0, 0]}
+        self.vbmc.get_system_boot_options(request, self.session)
+        return self.session.send_ipmi_response.call_args[1]['data']
+
+    def test_set_one_time(self, mock_libvirt_domain, mock_libvirt_conn):
+        # PXE, next boot only
+        self._set_boot_options(vbmc.BOOT_FLAGS_VALID, 1)
+
+        self.assertEqual('network', self.vbmc._boot_override)
+        self.assertFalse(mock_libvirt_conn.called)
+        self.session.send_ipmi_response.assert_called_once_with()
+        self.assertEqual([1, 5, vbmc.BOOT_FLAGS_VALID, 4, 0, 0, 0],
+                         self._get_boot_options())
+
+    def test_set_one_time_invalid_device(self, mock_libvirt_domain,
+                                         mock_libvirt_conn):
+        # Floppy
+        self._set_boot_options(vbmc.BOOT_FLAGS_VALID, 0xf)
+
+        self.assertIsNone(self.vbmc._boot_override)
+        self.session.send_ipmi_response.assert_called_once_with(
+            code=vbmc.IPMI_INVALID_DATA)
+
+    def test_set_persistent(self, mock_libvirt_domain, mock_libvirt_conn):
+        domain = mock_libvirt_domain.return_value
+        domain.XMLDesc.return_value = DOMAIN_XML_TEMPLATE % 'hd'
+        self.vbmc._boot_override = 'network'
+
+        self._set_boot_options(
+            vbmc.BOOT_FLAGS_VALID | vbmc.BOOT_FLAGS_PERSISTENT, 5)
+
+        conn = mock_libvirt_conn.return_value.__enter__.return_value
+        self.assertIn("<boot dev='cdrom'/>", conn.defineXML.call_args[0][0])
+        domain.XMLDesc.assert_called_once_with(
+            flags=libvirt.VIR_DOMAIN_XML_SECURE
+            | libvirt.VIR_DOMAIN_XML_INACTIVE)
+        self.assertIsNone(self.vbmc._boot_override)
+
+        domain.XMLDesc.return_value = DOMAIN_XML_TEMPLATE % 'cdrom'
+        self.assertEqual(
+            [1, 5, vbmc.BOOT_FLAGS_VALID | vbmc.BOOT_FLAGS_PERSISTENT,
+             0x14, 0, 0, 0], self._get_boot_options())
+
+    def test_clear(self, mock_libvirt_domain, mock_libvirt_conn):
+        self.vbmc._boot_override = 'network'
+
+        self._set_boot_options(0, 0)
+
+        self.assertIsNone(self.vbmc._boot_override)
+
+    def test_power_on_one_time(self, mock_libvirt_domain, mock_libvirt_conn):
+        domain = mock_libvirt_domain.return_value
+        domain.isActive.return_value = False
+        domain.XMLDesc.return_value = DOMAIN_XML_TEMPLATE % 'hd'
+        self.vbmc._boot_override = 'network'
+
+        self.assertIsNone(self.vbmc._power_on())
+
+        conn = mock_libvirt_conn.return_value.__enter__.return_value
+        self.assertIn("<boot dev='network'/>",
+                      conn.createXML.call_args[0][0])
+        self.assertFalse(conn.defineXML.called)
+        self.assertFalse(domain.create.called)
+        self.assertIsNone(self.vbmc._boot_override)
+
+    def test_power_on_one_time_error(self, mock_libvirt_domain,
+                                     mock_libvirt_conn):
+        domain = mock_libvirt_domain.return_value
+        domain.isActive.return_value = False
+        domain.XMLDesc.return_value = DOMAIN_XML_TEMPLATE % 'hd'
+        conn = mock_libvirt_conn.return_value.__enter__.return_value
+        conn.createXML.side_effect = libvirt.libvirtError('boom')
+        self.vbmc._boot_override = 'network'
+
+        self.assertRaises(exception.BackendError, self.vbmc._power_on)
+
+        # Kept for the next attempt
+        self.assertEqual('network', self.vbmc._boot_override)
+
+    def test_power_reset_one_time(self, mock_libvirt_domain,
+                                  mock_libvirt_conn):
+        domain = mock_libvirt_domain.return_value
+        domain.isActive.return_value = True
+        domain.XMLDesc.return_value = DOMAIN_XML_TEMPLATE % 'hd'
+        conn = mock_libvirt_conn.return_value.__enter__.return_value
+        self.vbmc._boot_override = 'network'
+
+        self.vbmc._power_reset()
+
+        domain.destroy.assert_called_once_with()
+        self.assertEqual(1, conn.createXML.call_count)
+        self.assertFalse(domain.reset.called)
+
+        # Back to the persistent definition
+        self.vbmc._power_reset()
+
+        self.assertEqual(2, domain.destroy.call_count)
+        domain.create.assert_called_once_with()
+        self.assertFalse(domain.reset.called)
+
+        self.vbmc._power_reset()
+
+        domain.reset.assert_called_once_with()
+        self.assertEqual(1, conn.createXML.call_count)
+
+
+class VirtualBMCPowerWorkerTestCase(base.TestCase):
+
+    def setUp(self):
+        super(VirtualBMCPowerWorkerTestCase, self).setUp()
+        self.domain = test_utils.get_domain()
+        mock.patch('pyghmi.ipmi.bmc.Bmc.__init__',
+                   lambda *args, **kwargs: None).start()
+        self.vbmc = vbmc.VirtualBMC(**self.domain)
+        self.vbmc._sel = sel.SystemEventLog(16)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.started = threading.Event()
+
+    def _blocking_action(self, *args):
+        self.started.set()
+        self.assertTrue(self.release.wait(5))
+
+    def _wait_idle(self):
+        self.vbmc._power_worker.shutdown(wait=True)
+        self.vbmc._power_worker = None
+
+    @mock.patch.object(vbmc.VirtualBMC, '_power_on')
+    def test_power_on(self, mock_power_on):
+        self.assertIsNone(self.vbmc.power_on())
+        self._wait_idle()
+
+        mock_power_on.assert_called_once_with()
+        self.assertIsNone(self.vbmc._power_action)
+        _, entry = self.vbmc._sel.get(0, 0, sel.ENTRY_SIZE)
+        self.assertEqual(bytes([sel.SENSOR_TYPE_POWER_UNIT,
+                                sel.POWER_UNIT_SENSOR,
+                                sel.DEASSERTION | sel.SENSOR_SPECIFIC, 0]),
+                         entry[10:14])
+
+    @mock.patch.object(vbmc.VirtualBMC, '_power_on')
+    def test_power_on_events_alive(self, mock_power_on):
+        # Domain events log the power on
+        self.vbmc._events = mock.Mock(spec=events.DomainEventMonitor,
+                                      alive=True)
+
+        self.vbmc.power_on()
+        self._wait_idle()
+
+        self.assertEqual(0, len(self.vbmc._sel))
+
+    @mock.patch.object(vbmc.VirtualBMC, '_power_on')
+    def test_power_on_coalesced(self, mock_power_on):
+        mock_power_on.side_effect = self._blocking_action
+
+        self.assertIsNone(self.vbmc.power_on())
+        self.assertTrue(self.started.wait(5))
+        self.assertIsNone(self.vbmc.power_on())
+
+        self.release.set()
+        self._wait_idle()
+        mock_power_on.assert_called_once_with()
+
+    @mock.patch.object(vbmc.VirtualBMC, '_power_off')
+    @mock.patch.object(vbmc.VirtualBMC, '_power_on')
+    def test_conflicting_action_busy(self, mock_power_on, mock_power_off):
+        mock_power_on.side_effect = self._blocking_action
+
+        self.vbmc.power_on()
+        self.assertTrue(self.started.wait(5))
+        self.assertEqual(vbmc.IPMI_COMMAND_NODE_BUSY, self.vbmc.power_off())
+
+        self.release.set()
+        self._wait_idle()
+        self.assertFalse(mock_power_off.called)
+
+        # Accepted again once the power on is over
+        self.assertIsNone(self.vbmc.power_off())
+        self._wait_idle()
+        mock_power_off.assert_called_once_with()
+
+    @mock.patch.object(vbmc.LOG, 'error')
+    @mock.patch.object(vbmc.VirtualBMC, '_power_reset')
+    def test_action_error(self, mock_power_reset, mock_error):
+        mock_power_reset.side_effect = exception.DomainNotFound(
+            domain=self.domain['domain_name'])
+
+        self.assertIsNone(self.vbmc.power_reset())
+        self._wait_idle()
+
+        self.assertTrue(mock_error.called)
+        self.assertIsNone(self.vbmc._power_action)
+        self.assertEqual(0, len(self.vbmc._sel))
+
+
+class VirtualBMCReplayTestCase(base.TestCase):
+
+    def setUp(self):
+        super(VirtualBMCReplayTestCase, self).setUp()
+        self.domain = test_utils.get_domain()
+        mock.patch('pyghmi.ipmi.bmc.Bmc.__init__',
+                   lambda *args, **kwargs: None).start()
+        self.vbmc = vbmc.VirtualBMC(**self.domain)
+        self.session = mock.Mock(sessionid=1234, seqlun=7)
+        self.request = {'netfn': 0, 'command': 2, 'data': [0]}
+
+    @mock.patch.object(vbmc.VirtualBMC, 'power_off')
+    def test_replay(self, mock_power_off):
+        mock_power_off.return_value = None
+        self.vbmc.handle_raw_request(self.request, self.session)
+        self.vbmc.handle_raw_request(self.request, self.session)
+
+        mock_power_off.assert_called_once_with()
+        self.assertEqual([mock.call(data=(), code=0),
+                          mock.call(data=b'', code=0)],
+                         self.session.send_ipmi_response.call_args_list)
+        self.assertEqual(1, self.vbmc._replay_cache.stats['hits'])
+
+    @mock.patch.object(vbmc.VirtualBMC, 'power_off')
+    def test_replay_new_sequence_number(self, mock_power_off):
+        mock_power_off.return_value = None
+        self.vbmc.handle_raw_request(self.request, self.session)
+        self.session.seqlun = 8
+        self.vbmc.handle_raw_request(self.request, self.session)
+
+        self.assertEqual(2, mock_power_off.call_count)
+
+    @mock.patch.object(vbmc.VirtualBMC, 'power_off')
+    @mock.patch.object(vbmc.VirtualBMC, 'get_power_state')
+    def test_replay_sequence_number_wrapped(self, mock_get_power_state,
+                                            mock_power_off):
+        mock_power_off.return_value = None
+        mock_get_power_state.return_value = 0
+        self.vbmc.handle_raw_request(self.request, self.session)
+        # Requests in between, the sequence number wraps
+        self.session.seqlun = 8
+        self.vbmc.handle_raw_request(
+            {'netfn': 0, 'command': 1, 'data': []}, self.session)
+        self.session.seqlun = 7
+        self.vbmc.handle_raw_request(self.request, self.session)
+
+        self.assertEqual(2, mock_power_off.call_count)
+        self.assertEqual(0, self.vbmc._replay_cache.stats['hits'])
+
+    @mock.patch.object(vbmc.VirtualBMC, 'power_off')
+    def test_replay_busy_not_cached(self, mock_power_off):
+        mock_power_off.return_value = vbmc.IPMI_COMMAND_NODE_BUSY
+
+        self.vbmc.handle_raw_request(self.request, self.session)
+        self.vbmc.handle_raw_request(self.request, self.session)
+
+        self.assertEqual(2, mock_power_off.call_count)
+
+    @mock.patch.object(vbmc.VirtualBMC, 'activate_payload')
+    def test_replay_excluded(self, mock_activate_payload):
+        request = {'netfn': 6, 'command': 0x48, 'data': [1, 1, 0, 0]}
+
+        self.vbmc.handle_raw_request(request, self.session)
+        self.vbmc.handle_raw_request(request, self.session)
+
+        self.assertEqual(2, mock_activate_payload.call_count)
+
+
+class VirtualBMCSensorTestCase(base.TestCase):
+
+    def setUp(self):
+        super(VirtualBMCSensorTestCase, self).setUp()
+        self.domain = test_utils.get_domain()
+        mock.patch('pyghmi.ipmi.bmc.Bmc.__init__',
+                   lambda *args, **kwargs: None).start()
+        self.mock_libvirt_conn = mock.patch.object(
+            utils, 'libvirt_connection').start()
+        self.mock_libvirt_domain = mock.patch.object(
+            utils, 'get_libvirt_domain').start()
+        self.xml_desc = self.mock_libvirt_domain.return_value.XMLDesc
+        self.xml_desc.return_value = INVENTORY_DOMAIN_XML
+        self.vbmc = vbmc.VirtualBMC(**self.domain)
+        self.vbmc._stats = mock.Mock(spec=stats.StatsReader)
+        self.vbmc._stats.read.return_value = {
+            'cpu_usage': 50.0, 'memory': 4 * 2 ** 30,
+            'disk_read': 20 * 2 ** 20, 'disk_write': 0.0,
+            'net_rx': 125e6, 'net_tx': 0.0, 'power': 64.4,
+            'power_min': 40.0, 'power_max': 88.0, 'power_avg': 50.6,
+            'timestamp': 1700000000.5}
+        self.session = mock.Mock(sessionid=1234, seqlun=7)
+
+    def _request(self, netfn, command, data):
+        self.session.seqlun += 1
+        self.vbmc.handle_raw_request(
+            {'netfn': netfn, 'command': command, 'data': data},
+            self.session)
+        return self.session.send_ipmi_response.call_args[1]
+
+    def test_get_sensor_reading(self):
+        response = self._request(vbmc.NETFN_SENSOR, 0x2d, [1])
+        self.assertEqual([50, vbmc.SENSOR_READING_AVAILABLE, 0],
+                         response['data'])
+
+        # 4 GiB in steps of 0.2 GiB
+        response = self._request(vbmc.NETFN_SENSOR, 0x2d, [2])
+        self.assertEqual(20, response['data'][0])
+
+        # 1000 Mbit/s in steps of 4 Mbit/s
+        response = self._request(vbmc.NETFN_SENSOR, 0x2d, [5])
+        self.assertEqual(250, response['data'][0])
+
+    def test_get_sensor_reading_unavailable(self):
+        self.vbmc._stats.read.return_value = None
+
+        response = self._request(vbmc.NETFN_SENSOR, 0x2d, [1])
+
+        self.assertEqual([0, vbmc.SENSOR_READING_UNAVAILABLE, 0],
+                         response['data'])
+
+    def test_get_sensor_reading_sensors_disabled(self):
+        self.vbmc._stats = None
+
+        response = self._request(vbmc.NETFN_SENSOR, 0x2d, [1])
+
+        self.assertEqual([0, vbmc.SENSOR_READING_UNAVAILABLE, 0],
+                         response['data'])
+
+    def test_get_sensor_reading_not_present(self):
+        response = self._request(vbmc.NETFN_SENSOR, 0x2d, [0x42])
+
+        self.assertEqual(vbmc.IPMI_NOT_PRESENT, response['code'])
+
+    def test_get_sensor_reading_no_data(self):
+        response = self._request(vbmc.NETFN_SENSOR, 0x2d, [])
+
+        self.assertEqual(vbmc.IPMI_REQUEST_DATA_LENGTH_INVALID,
+                         response['code'])
+
+    def test_get_sdr(self):
+        record = inventory.encode_mc_device_locator(1)
+
+        # First record header, as read by ipmitool
+        response = self._request(vbmc.NETFN_STORAGE, 0x23,
+                                 [1, 0, 0, 0, 0, 5])
+        self.assertEqual(b'\x02\x00' + record[:5], response['data'])
+
+        response = self._request(vbmc.NETFN_STORAGE, 0x23,
+                                 [1, 0, 1, 0, 5, 0xff])
+        self.assertEqual(b'\x02\x00' + record[5:], response['data'])
+
+        # FRU device locator, then sensors
+        response = self._request(vbmc.NETFN_STORAGE, 0x23,
+                                 [1, 0, 2, 0, 0, 5])
+        self.assertEqual(b'\x03\x00\x02\x00\x51'
+                         + bytes([inventory.FRU_DEVICE_LOCATOR]),
+                         response['data'][:6])
+
+        self.assertEqual(1, self.xml_desc.call_count)
+
+    def test_get_sdr_last(self):
+        last = 2 + len(sensors.SENSORS)
+        response = self._request(vbmc.NETFN_SENSOR, 0x21,
+                                 [1, 0, last, 0, 0, 5])
+
+        self.assertEqual(b'\xff\xff', response['data'][:2])
+
+    def test_get_sdr_domain_not_found(self):
+        self.mock_libvirt_domain.side_effect = exception.DomainNotFound(
+            domain='SpongeBob')
+
+        response = self._request(vbmc.NETFN_STORAGE, 0x23,
+                                 [1, 0, 2, 0, 0, 5])
+
+        # Sensors only
+        self.assertEqual(b'\x03\x00\x02\x00\x51'
+                         + bytes([sensors.FULL_SENSOR_RECORD]),
+                         response['data'][:6])
+
+    def test_get_sdr_not_present(self):
+        response = self._request(vbmc.NETFN_STORAGE, 0x23,
+                                 [1, 0, 0x42, 0, 0, 5])
+
+        self.assertEqual(vbmc.IPMI_NOT_PRESENT, response['code'])
+
+    def test_reserve_sdr_repository(self):
+        first = self._request(vbmc.NETFN_STORAGE, 0x22, [])['data']
+        second = self._request(vbmc.NETFN_STORAGE, 0x22, [])['data']
+
+        self.assertEqual([1, 0], first)
+        self.assertEqual([2, 0], second)
+
+    def test_get_sdr_repository_info(self):
+        response = self._request(vbmc.NETFN_STORAGE, 0x20, [])
+
+        self.assertEqual([sensors.SDR_VERSION, len(sensors.SENSORS) + 2, 0],
+                         response['data'][:3])
+
+    def test_get_fru_inventory_area_info(self):
+        fru = inventory.Inventory(INVENTORY_DOMAIN_XML).fru
+
+        response = self._request(vbmc.NETFN_STORAGE, 0x10, [0])
+
+        self.assertEqual([len(fru) & 0xff, len(fru) >> 8, 0],
+                         response['data'])
+
+    def test_get_fru_inventory_area_info_not_present(self):
+        response = self._request(vbmc.NETFN_STORAGE, 0x10, [1])
+
+        self.assertEqual(vbmc.IPMI_NOT_PRESENT, response['code'])
+
+    def test_read_fru_data(self):
+        fru = inventory.Inventory(INVENTORY_DOMAIN_XML).fru
+
+        response = self._request(vbmc.NETFN_STORAGE, 0x11, [0, 8, 0, 16])
+        self.assertEqual(b'\x10' + fru[8:24], response['data'])
+
+        response = self._request(vbmc.NETFN_STORAGE, 0x11,
+                                 [0, len(fru) - 2, 0, 16])
+        self.assertEqual(b'\x02' + fru[-2:], response['data'])
+
+    def test_read_fru_data_out_of_range(self):
+        response = self._request(vbmc.NETFN_STORAGE, 0x11,
+                                 [0, 0xff, 0xff, 16])
+
+        self.assertEqual(vbmc.IPMI_PARAMETER_OUT_OF_RANGE, response['code'])
+
+    def test_read_fru_data_domain_not_found(self):
+        self.mock_libvirt_domain.side_effect = exception.DomainNotFound(
+            domain='SpongeBob')
+
+        response = self._request(vbmc.NETFN_STORAGE, 0x11, [0, 0, 0, 16])
+
+        self.assertEqual(vbmc.IPMI_NOT_PRESENT, response['code'])
+
+    def test_inventory_refresh(self):
+        # Without domain events, the info commands rebuild the inventory
+        self._request(vbmc.NETFN_STORAGE, 0x10, [0])
+        self._request(vbmc.NETFN_STORAGE, 0x11, [0, 0, 0, 16])
+        self._request(vbmc.NETFN_STORAGE, 0x11, [0, 16, 0, 16])
+        self._request(vbmc.NETFN_STORAGE, 0x10, [0])
+
+        self.assertEqual(2, self.xml_desc.call_count)
+        self.xml_desc.assert_called_with(
+            flags=libvirt.VIR_DOMAIN_XML_INACTIVE)
+
+    def test_inventory_events(self):
+        self.vbmc._events = mock.Mock(spec=events.DomainEventMonitor)
+        self.vbmc._events.connect.return_value = True
+
+        self._request(vbmc.NETFN_STORAGE, 0x10, [0])
+        self._request(vbmc.NETFN_STORAGE, 0x10, [0])
+        self.assertEqual(1, self.xml_desc.call_count)
+
+        self.vbmc._handle_domain_event(libvirt.VIR_DOMAIN_EVENT_DEFINED, 0)
+        self._request(vbmc.NETFN_STORAGE, 0x10, [0])
+        self.assertEqual(2, self.xml_desc.call_count)
+
+    def test_get_dcmi_power_reading(self):
+        response = self._request(vbmc.NETFN_DCMI, 0x02, [0xdc, 1, 0, 0])
+
+        self.assertEqual(
+            b'\xdc' + struct.pack('<4HIIB', 64, 40, 88, 51, 1700000000,
+                                  vbmc.CONF['sensors']['interval']
+                                  * stats.POWER_SAMPLES * 1000,
+                                  vbmc.DCMI_POWER_MEASUREMENT_ACTIVE),
+            response['data'])
+
+    def test_get_dcmi_power_reading_invalid(self):
+        response = self._request(vbmc.NETFN_DCMI, 0x02, [0x42, 1, 0, 0])
+
+        self.assertEqual(vbmc.IPMI_INVALID_DATA, response['code'])
+
+
+class VirtualBMCSelTestCase(base.TestCase):
+
+    def setUp(self):
+        super(VirtualBMCSelTestCase, self).setUp()
+        self.domain = test_utils.get_domain()
+        mock.patch('pyghmi.ipmi.bmc.Bmc.__init__',
+                   lambda *args, **kwargs: None).start()
+        self.config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config_dir)
+        mock.patch.dict(vbmc.CONF['default'],
+                        {'config_dir': self.config_dir}).start()
+        os.mkdir(os.path.join(self.config_dir, self.domain['domain_name']))
+        self.vbmc = vbmc.VirtualBMC(**self.domain)
+        self.addCleanup(self.vbmc._sel.close)
+        self.session = mock.Mock(sessionid=1234, seqlun=7)
+
+    def _request(self, command, data):
+        self.session.seqlun += 1
+        self.vbmc.handle_raw_request(
+            {'netfn': vbmc.NETFN_STORAGE, 'command': command, 'data': data},
+            self.session)
+        return self.session.send_ipmi_response.call_args[1]
+
+    def _reserve(self):
+        return list(self._request(0x42, [])['data'])
+
+    def test_domain_events(self):
+        for event, sel_event in vbmc.DOMAIN_EVENT_SEL_EVENTS.items():
+            self.vbmc._handle_domain_event(event, 0)
+        # Unknown watchdog action
+        self.vbmc._handle_domain_event(events.WATCHDOG_EVENT, 42)
+
+        expected = list(vbmc.DOMAIN_EVENT_SEL_EVENTS.values())
+        expected.append(sel.WATCHDOG_EXPIRED)
+        self.assertEqual(len(expected), len(self.vbmc._sel))
+        for record_id, event in enumerate(expected, 1):
+            _, entry = self.vbmc._sel.get(record_id, 0, sel.ENTRY_SIZE)
+            self.assertEqual(
+                (event.sensor_type, event.sensor_number, event.offset),
+                (entry[10], entry[11], entry[13]))
+
+    @mock.patch.object(vbmc.time, 'time', return_value=1700000000)
+    def test_get_sel_info(self, mock_time):
+        response = self._request(0x40, [])
+        self.assertEqual(
+            struct.pack('<BHHIIB', sel.SEL_VERSION, 0,
+                        vbmc.CONF['ipmi']['sel_capacity'] * sel.ENTRY_SIZE,
+                        vbmc.SEL_UNSPECIFIED_TIMESTAMP,
+                        vbmc.SEL_UNSPECIFIED_TIMESTAMP, vbmc.SEL_OPERATIONS),
+            response['data'])
+
+        self.vbmc._handle_domain_event(events.REBOOT_EVENT, 0)
+
+        response = self._request(0x40, [])
+        count, free, last_addition = struct.unpack_from('<xHHI',
+                                                        response['data'])
+        self.assertEqual(1, count)
+        self.assertEqual(1700000000, last_addition)
+
+    def test_get_sel_entry(self):
+        self.vbmc._handle_domain_event(events.REBOOT_EVENT, 0)
+        self.vbmc._handle_domain_event(events.WATCHDOG_EVENT, 42)
+
+        response = self._request(0x43, [0, 0, 0, 0, 0, 0xff])
+        self.assertEqual(b'\x02\x00\x01\x00\x02', response['data'][:5])
+        self.assertEqual(bytes([sel.SENSOR_TYPE_SYSTEM_RESTART,
+                                sel.SYSTEM_RESTART_SENSOR,
+                                sel.SENSOR_SPECIFIC, 0x07, 0xff, 0xff]),
+                         response['data'][12:])
+
+        response = self._request(0x43, [0, 0, 2, 0, 10, 2])
+        self.assertEqual(
+            b'\xff\xff' + bytes([sel.SENSOR_TYPE_WATCHDOG,
+                                 sel.WATCHDOG_SENSOR]),
+            response['data'])
+
+    def test_get_sel_entry_not_present(self):
+        response = self._request(0x43, [0, 0, 0, 0, 0, 0xff])
+        self.assertEqual(vbmc.IPMI_NOT_PRESENT, response['code'])
+
+        self.vbmc._handle_domain_event(events.REBOOT_EVENT, 0)
+        response = self._request(0x43, [0, 0, 1, 0, 17, 1])
+        self.assertEqual(vbmc.IPMI_PARAMETER_OUT_OF_RANGE, response['code'])
+
+    def test_clear_sel(self):
+        self.vbmc._handle_domain_event(events.REBOOT_EVENT, 0)
+        reservation = self._reserve()
+
+        response = self._request(0x47, reservation + list(b'CLR')
+                                 + [vbmc.SEL_INITIATE_ERASE])
+
+        self.assertEqual([vbmc.SEL_ERASE_COMPLETED], response['data'])
+        self.assertEqual(0, len(self.vbmc._sel))
+        self.assertNotEqual(0, self.vbmc._sel.last_erase)
+
+    def test_clear_sel_invalid(self):
+        self.vbmc._handle_domain_event(events.REBOOT_EVENT, 0)
+        reservation = self._reserve()
+
+        response = self._request(0x47, [0, 0] + list(b'CLR')
+                                 + [vbmc.SEL_INITIATE_ERASE])
+        self.assertEqual(vbmc.IPMI_INVALID_RESERVATION, response['code'])
+
+        response = self._request(0x47, reservation + list(b'CLX')
+                                 + [vbmc.SEL_INITIATE_ERASE])
+        self.assertEqual(vbmc.IPMI_INVALID_DATA, response['code'])
+
+        response = self._request(0x47, reservation + list(b'CLR'))
+        self.assertEqual(vbmc.IPMI_REQUEST_DATA_LENGTH_INVALID,
+                         response['code'])
+        self.assertEqual(1, len(self.vbmc._sel))
+
+    @mock.patch.object(vbmc.time, 'time', return_value=1700000000.5)
+    def test_get_sel_time(self, mock_time):
+        response = self._request(0x48, [])
+        self.assertEqual(struct.pack('<I', 1700000000), response['data'])
+
+    def test_saved_on_close(self):
+        self.vbmc._handle_domain_event(events.REBOOT_EVENT, 0)
+        self.vbmc._sel.close()
+
+        ret = sel.SystemEventLog(16, path=os.path.join(
+            self.config_dir, self.domain['domain_name'], 'sel'))
+
+        self.assertEqual(1, len(ret))
+
+
+@mock.patch.object(sol, 'SolConsole', autospec=True)
+class VirtualBMCSolTestCase(base.TestCase):
+
+    def setUp(self):
+        super(VirtualBMCSolTestCase, self).setUp()
+        self.domain = test_utils.get_domain()
+        mock.patch('pyghmi.ipmi.bmc.Bmc.__init__',
+                   lambda *args, **kwargs: None).start()
+        self.vbmc = vbmc.VirtualBMC(**self.domain)
+        self.vbmc.port = 6230
+        self.session = mock.Mock()
+        self.request = {'netfn': 6, 'command': 0x48, 'data': [1, 1, 0, 0]}
+
+    def test_activate(self, mock_console):
+        self.vbmc.activate_payload(self.request, self.session)
+
+        mock_console.assert_called_once_with(
+            self.session, self.domain['domain_name'], self.vbmc._conn_args,
+            vbmc.CONF['ipmi']['sol_buffer_size'],
+            on_close=self.vbmc._sol_closed)
+        self.session.send_ipmi_response.assert_called_once_with(
+            data=b'\x00\x00\x00\x00\x00\x01\x00\x01\x56\x18\xff\xff')
+        mock_console.return_value.start.assert_called_once_with()
+        self.assertIs(mock_console.return_value, self.vbmc.sol)
+        self.assertTrue(self.vbmc.activated)
+
+    def test_activate_already_active(self, mock_console):
+        self.vbmc.activate_payload(self.request, self.session)
+
+        self.vbmc.activate_payload(self.request, self.session)
+
+        mock_console.assert_called_once()
+        self.session.send_ipmi_response.assert_called_with(
+            code=vbmc.IPMI_PAYLOAD_ALREADY_ACTIVE)
+
+    def test_activate_error(self, mock_console):
+        mock_console.side_effect = exception.LibvirtConnectionOpenError(
+            uri='foo://bar', error='boom')
+
+        self.vbmc.activate_payload(self.request, self.session)
+
+        self.session.send_ipmi_response.assert_called_once_with(
+            code=vbmc.IPMI_PAYLOAD_UNAVAILABLE)
+        self.assertIsNone(self.vbmc.sol)
+
+    def test_deactivate(self, mock_console):
+        self.vbmc.activate_payload(self.request, self.session)
+        sol_console = self.vbmc.sol
+        sol_console.close.side_effect = (
+            lambda: self.vbmc._sol_closed(sol_console))
+
+        self.vbmc.deactivate_payload(self.request, self.session)
+
+        self.session.send_ipmi_response.assert_called_with()
+        sol_console.close.assert_called_once_with()
+        self.assertIsNone(self.vbmc.sol)
+        self.assertFalse(self.vbmc.activated)
+
+    def test_deactivate_not_active(self, mock_console):
+        self.vbmc.deactivate_payload(self.request, self.session)
+
+        self.session.send_ipmi_response.assert_called_once_with(
+            code=vbmc.IPMI_PAYLOAD_ALREADY_DEACTIVATED)
+
+
+@mock.patch.object(utils, 'libvirt_connection')
+class VirtualBMCFakeBackendTestCase(base.TestCase):
+
+    def setUp(self):
+        super(VirtualBMCFakeBackendTestCase, self).setUp()
+        self.domain = test_utils.get_domain()
+        mock.patch('pyghmi.ipmi.bmc.Bmc.__init__',
+                   lambda *args, **kwargs: None).start()
+        mock.patch.dict(backends.CONF['default'],
+                        {'backend': 'fake'}).start()
+        mock.patch.dict(vbmc.CONF['libvirt'],
+                        {'domain_events': True}).start()
+        self.mock_monitor = mock.patch.object(events,
+                                              'get_event_monitor').start()
+        self.vbmc = vbmc.VirtualBMC(**self.domain)
+        self.backend = self.vbmc._backend
+        self.session = mock.Mock()
+
+    def test_no_libvirt(self, mock_libvirt_conn):
+        self.assertIsInstance(self.backend, backends.FakeBackend)
+        self.assertIsNone(self.vbmc._events)
+        self.assertIsNone(self.vbmc._stats)
+        self.assertFalse(self.mock_monitor.called)
+
+        self.vbmc.activate_payload({'data': [1, 1, 0, 0]}, self.session)
+
+        self.session.send_ipmi_response.assert_called_once_with(
+            code=vbmc.IPMI_PAYLOAD_UNAVAILABLE)
+        self.assertFalse(mock_libvirt_conn.called)
+
+    def test_power(self, mock_libvirt_conn):
+        self.vbmc._boot_override = 'network'
+
+        self.assertIsNone(self.vbmc._power_on())
+
+        self.assertEqual(vbmc.POWERON, self.vbmc.get_power_state())
+        self.assertIsNone(self.vbmc._boot_override)
+        self.assertIsNone(self.vbmc._power_off())
+        self.assertEqual(vbmc.POWEROFF, self.vbmc.get_power_state())
+        self.assertFalse(mock_libvirt_conn.called)
+
+    def test_power_on_error(self, mock_libvirt_conn):
+        self.backend.failure_rate = {'power_on': 1.0}
+        self.vbmc._boot_override = 'network'
+
+        self.assertRaises(exception.BackendError, self.vbmc._power_on)
+
+        # Kept for the next attempt
+        self.assertEqual('network', self.vbmc._boot_override)
+        self.assertEqual(vbmc.POWEROFF, self.vbmc.get_power_state())
+
+    @mock.patch.object(vbmc.LOG, 'error')
+    def test_power_action_failed(self, mock_error, mock_libvirt_conn):
+        self.backend.failure_rate = {None: 1.0}
+        self.vbmc._sel = sel.SystemEventLog(16)
+
+        for power_action in (self.vbmc.power_on, self.vbmc.power_off,
+                             self.vbmc.power_shutdown, self.vbmc.power_reset):
+            self.assertIsNone(power_action())
+            self.vbmc._power_worker.shutdown(wait=True)
+            self.vbmc._power_worker = None
+
+        # Failed actions get logged, not added to the SEL
+        self.assertEqual(4, mock_error.call_count)
+        self.assertEqual(0, len(self.vbmc._sel))
+
+    def test_boot_device(self, mock_libvirt_conn):
+        self.assertIsNone(self.vbmc.set_boot_device('optical'))
+
+        self.assertEqual(vbmc.GET_BOOT_DEVICES_MAP['cdrom'],
+                         self.vbmc.get_boot_device())
+
+    def test_inventory(self, mock_libvirt_conn):
+        ret = self.vbmc._get_inventory()
+
+        self.assertIsNotNone(ret.fru)
+        self.assertIn(b'SpongeBob', ret.fru)
+
+
+class VirtualBMCQMPBackendTestCase(base.TestCase):
+
+    def setUp(self):
+        super(VirtualBMCQMPBackendTestCase, self).setUp()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, 'qmp.sock')
+        self.server = test_utils.FakeQMPServer(self.path)
+        self.addCleanup(self.server.stop)
+        self.domain = test_utils.get_domain(qmp_socket=self.path)
+        mock.patch('pyghmi.ipmi.bmc.Bmc.__init__',
+                   lambda *args, **kwargs: None).start()
+        self.vbmc = vbmc.VirtualBMC(**self.domain)
+        self.addCleanup(self.vbmc._backend.close)
+
+    def test_power(self):
+        self.assertIsInstance(self.vbmc._backend, backends.QMPBackend)
+        self.assertIsNone(self.vbmc._stats)
+        self.assertEqual(vbmc.POWEROFF, self.vbmc.get_power_state())
+
+        self.assertIsNone(self.vbmc._power_on())
+
+        self.assertEqual(vbmc.POWERON, self.vbmc.get_power_state())
+
+    def test_set_boot_device_not_supported(self):
+        self.assertEqual(vbmc.IPMI_NOT_SUPPORTED_IN_PRESENT_STATE,
+                         self.vbmc.set_boot_device('network'))
+        self.assertEqual(0, self.vbmc.get_boot_device())
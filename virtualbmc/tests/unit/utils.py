@@ -13,6 +13,11 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import json
+import os
+import socket
+import threading
+
 
 def get_domain(**kwargs):
     domain = {'domain_name': kwargs.get('domain_name', 'SpongeBob'),
@@ -23,6 +28,7 @@ def get_domain(**kwargs):
               'libvirt_uri': kwargs.get('libvirt_uri', 'foo://bar'),
               'libvirt_sasl_username': kwargs.get('libvirt_sasl_username'),
               'libvirt_sasl_password': kwargs.get('libvirt_sasl_password'),
+              'qmp_socket': kwargs.get('qmp_socket'),
               'active': kwargs.get('active', False)}
 
     status = kwargs.get('status')
@@ -30,3 +36,111 @@ def get_domain(**kwargs):
         domain['status'] = status
 
     return domain
+
+
+class FakeQMPServer(object):
+    """A stand-in for the QMP monitor of a QEMU process
+
+    Serves one connection at a time on a UNIX socket, keeping track of
+    the run state of the machine and of the commands received.
+    """
+
+    def __init__(self, path, status='prelaunch'):
+        self.path = path
+        self.status = status
+        self.uuid = 'c7a5fdbd-cdaf-9455-926a-d65c16db1809'
+        self.commands = []
+        self.connections = 0
+        self._conn = None
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(path)
+        self._listener.listen(1)
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except OSError:
+                return
+
+            self.connections += 1
+            self._conn = conn
+            try:
+                self._handle(conn)
+            except OSError:
+                pass
+            finally:
+                conn.close()
+
+    def _send(self, conn, message):
+        conn.sendall(json.dumps(message).encode('utf-8') + b'\r\n')
+
+    def _event(self, conn, event):
+        self._send(conn, {'event': event, 'data': {},
+                          'timestamp': {'seconds': 0, 'microseconds': 0}})
+
+    def _handle(self, conn):
+        self._send(conn, {'QMP': {'version': {}, 'capabilities': []}})
+        negotiated = False
+        for line in conn.makefile('rb'):
+            request = json.loads(line)
+            command = request['execute']
+            response = {'return': {}}
+            if not negotiated and command != 'qmp_capabilities':
+                response = {'error': {'class': 'CommandNotFound',
+                                      'desc': 'Expecting capabilities '
+                                              'negotiation'}}
+            else:
+                negotiated = True
+                self.commands.append(command)
+                response = self._execute(conn, command, response)
+
+            if command == 'quit':
+                # Like QEMU, gone right after answering
+                self.stop()
+
+            if 'id' in request:
+                response['id'] = request['id']
+            self._send(conn, response)
+
+            if command == 'quit':
+                return
+
+    def _execute(self, conn, command, response):
+        if command == 'query-status':
+            response['return'] = {'status': self.status,
+                                  'running': self.status == 'running'}
+        elif command == 'query-uuid':
+            response['return'] = {'UUID': self.uuid}
+        elif command == 'cont':
+            if self.status == 'shutdown':
+                return {'error': {'class': 'GenericError',
+                                  'desc': 'Resetting the Virtual Machine '
+                                          'is required'}}
+            self.status = 'running'
+        elif command == 'system_reset':
+            self._event(conn, 'RESET')
+            if self.status != 'running':
+                self.status = 'prelaunch'
+        elif command == 'system_powerdown':
+            self._event(conn, 'POWERDOWN')
+            self.status = 'shutdown'
+            self._event(conn, 'SHUTDOWN')
+        elif command not in ('qmp_capabilities', 'quit', 'inject-nmi'):
+            return {'error': {'class': 'CommandNotFound',
+                              'desc': 'The command %s has not been '
+                                      'found' % command}}
+
+        return response
+
+    def disconnect(self):
+        """Drop the current connection, as a restarted QEMU would"""
+        if self._conn is not None:
+            self._conn.shutdown(socket.SHUT_RDWR)
+
+    def stop(self):
+        self._listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
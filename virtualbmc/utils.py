@@ -10,12 +10,52 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import contextlib
 import os
+import signal
 import sys
+import threading
+import time
+import weakref
 
 import libvirt
 
+from virtualbmc import config as vbmc_config
 from virtualbmc import exception
+from virtualbmc import limiter
+from virtualbmc import log
+
+CONNECTION_POOL = None
+
+# All connection pools of the process, reset in children after fork
+_POOLS = weakref.WeakSet()
+
+
+def open_connection(uri, sasl_username=None, sasl_password=None,
+                    readonly=False):
+    try:
+        if sasl_username and sasl_password:
+
+            def request_cred(credentials, user_data):
+                for credential in credentials:
+                    if credential[0] == libvirt.VIR_CRED_AUTHNAME:
+                        credential[4] = sasl_username
+                    elif credential[0] == libvirt.VIR_CRED_PASSPHRASE:
+                        credential[4] = sasl_password
+                return 0
+
+            auth = [[libvirt.VIR_CRED_AUTHNAME,
+                     libvirt.VIR_CRED_PASSPHRASE], request_cred, None]
+            flags = libvirt.VIR_CONNECT_RO if readonly else 0
+            return libvirt.openAuth(uri, auth, flags)
+        elif readonly:
+            return libvirt.openReadOnly(uri)
+        else:
+            return libvirt.open(uri)
+
+    except libvirt.libvirtError as e:
+        raise exception.LibvirtConnectionOpenError(uri=uri, error=e)
 
 
 class libvirt_open(object):
@@ -28,35 +68,367 @@ class libvirt_open(object):
         self.readonly = readonly
 
     def __enter__(self):
-        try:
-            if self.sasl_username and self.sasl_password:
-
-                def request_cred(credentials, user_data):
-                    for credential in credentials:
-                        if credential[0] == libvirt.VIR_CRED_AUTHNAME:
-                            credential[4] = self.sasl_username
-                        elif credential[0] == libvirt.VIR_CRED_PASSPHRASE:
-                            credential[4] = self.sasl_password
-                    return 0
-
-                auth = [[libvirt.VIR_CRED_AUTHNAME,
-                         libvirt.VIR_CRED_PASSPHRASE], request_cred, None]
-                flags = libvirt.VIR_CONNECT_RO if self.readonly else 0
-                self.conn = libvirt.openAuth(self.uri, auth, flags)
-            elif self.readonly:
-                self.conn = libvirt.openReadOnly(self.uri)
-            else:
-                self.conn = libvirt.open(self.uri)
-
-            return self.conn
-
-        except libvirt.libvirtError as e:
-            raise exception.LibvirtConnectionOpenError(uri=self.uri, error=e)
+        self.conn = open_connection(self.uri,
+                                    sasl_username=self.sasl_username,
+                                    sasl_password=self.sasl_password,
+                                    readonly=self.readonly)
+        return self.conn
 
     def __exit__(self, type, value, traceback):
         self.conn.close()
 
 
+class LibvirtConnectionPool(object):
+    """Pool of persistent libvirt connections.
+
+    Connections are keyed by libvirt URI, SASL user name and the
+    read-only flag, so that every IPMI request served by a BMC reuses
+    the same connection instead of opening (and authenticating) a new
+    one. Connections are health-checked before being handed out and
+    transparently reopened if libvirt reports them dead. Once the pool
+    holds `max_size` connections, the least recently used one is dropped.
+
+    Connections are opened outside of the pool lock, one at a time per
+    key: threads asking for a key being connected wait for it.
+
+    Every connection handed out by `get` must be given back with
+    `release`. Connections dropped from the pool while borrowed are
+    only closed once the last borrower gives them back.
+
+    The pool is per-process: a pool inherited over `fork()` drops the
+    parent's connections rather than sharing their sockets.
+    """
+
+    def __init__(self, max_size=16, keepalive_interval=5,
+                 keepalive_count=3):
+        self.max_size = max_size
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self._conns = collections.OrderedDict()
+        self._borrowed = collections.Counter()
+        self._connecting = {}
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()
+        _POOLS.add(self)
+
+    def _reset(self):
+        # Connections opened by the parent process must not be closed
+        # or used from here, just forget about them. The lock may have
+        # been held by another thread of the parent while forking.
+        self._lock = threading.Lock()
+        self._conns.clear()
+        self._borrowed.clear()
+        self._connecting.clear()
+        self.stats.clear()
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            return bool(conn.isAlive())
+        except libvirt.libvirtError:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    def _discard(self, conn):
+        # Connections still borrowed get closed on their last release
+        if not self._borrowed[conn]:
+            self._close(conn)
+
+    def _set_keepalive(self, conn):
+        if not self.keepalive_interval:
+            return
+        try:
+            conn.setKeepAlive(self.keepalive_interval, self.keepalive_count)
+        except libvirt.libvirtError:
+            # Keepalive requires a libvirt event loop and remote driver,
+            # not having it just means relying on the health check
+            pass
+
+    def get(self, uri, sasl_username=None, sasl_password=None,
+            readonly=False):
+        """Borrow an open connection, reusing a pooled one if healthy."""
+        key = (uri, sasl_username, readonly)
+
+        while True:
+            with self._lock:
+                conn = self._conns.get(key)
+                if conn is not None:
+                    if self._is_alive(conn):
+                        self._conns.move_to_end(key)
+                        self._borrowed[conn] += 1
+                        self.stats['hits'] += 1
+                        return conn
+
+                    del self._conns[key]
+                    self._discard(conn)
+                    self.stats['reconnects'] += 1
+                    log.get_logger().debug(
+                        'Reconnecting to libvirt at %(uri)s, connection '
+                        'pool stats: %(stats)s',
+                        {'uri': uri, 'stats': dict(self.stats)})
+
+                connecting = self._connecting.get(key)
+                if connecting is None:
+                    connecting = self._connecting[key] = threading.Event()
+                    self.stats['misses'] += 1
+                    break
+
+            # Another thread is connecting, share its connection
+            connecting.wait()
+
+        try:
+            conn = open_connection(uri, sasl_username=sasl_username,
+                                   sasl_password=sasl_password,
+                                   readonly=readonly)
+            self._set_keepalive(conn)
+
+        except BaseException:
+            with self._lock:
+                self._connecting.pop(key, None)
+            connecting.set()
+            raise
+
+        with self._lock:
+            self._connecting.pop(key, None)
+            self._conns[key] = conn
+            self._borrowed[conn] += 1
+
+            while len(self._conns) > self.max_size:
+                _, evicted = self._conns.popitem(last=False)
+                self._discard(evicted)
+                self.stats['evictions'] += 1
+                log.get_logger().debug(
+                    'Evicted a libvirt connection from the pool, '
+                    'connection pool stats: %(stats)s',
+                    {'stats': dict(self.stats)})
+
+        connecting.set()
+        return conn
+
+    def release(self, conn, error=None):
+        """Give a borrowed connection back, dropping it if it went bad."""
+        alive = error is None or self._is_alive(conn)
+
+        with self._lock:
+            if not self._borrowed[conn]:
+                # Borrowed before a fork or not from this pool at all
+                return
+
+            self._borrowed[conn] -= 1
+            if not self._borrowed[conn]:
+                del self._borrowed[conn]
+
+            pooled = False
+            for key, candidate in list(self._conns.items()):
+                if candidate is conn:
+                    if alive:
+                        pooled = True
+                    else:
+                        del self._conns[key]
+
+            if not pooled:
+                self._discard(conn)
+
+    def close_all(self):
+        with self._lock:
+            while self._conns:
+                _, conn = self._conns.popitem()
+                self._close(conn)
+            self._borrowed.clear()
+
+
+def _reset_pools():
+    for pool in list(_POOLS):
+        pool._reset()
+
+
+os.register_at_fork(after_in_child=_reset_pools)
+
+
+def get_connection_pool():
+    global CONNECTION_POOL
+    if CONNECTION_POOL is None:
+        libvirt_conf = vbmc_config.get_config()['libvirt']
+        CONNECTION_POOL = LibvirtConnectionPool(
+            max_size=libvirt_conf['connection_pool_size'],
+            keepalive_interval=libvirt_conf['keepalive_interval'],
+            keepalive_count=libvirt_conf['keepalive_count'])
+
+    return CONNECTION_POOL
+
+
+class libvirt_connection(object):
+    """Borrow a connection from the libvirt connection pool.
+
+    Same interface as `libvirt_open`, except that the connection is
+    kept open for reuse on exit. The calls made meanwhile count against
+    the host-wide limit of concurrent calls to the libvirt URI, calls
+    on read-write connections having priority over read-only ones.
+    """
+
+    def __init__(self, uri, sasl_username=None, sasl_password=None,
+                 readonly=False):
+        self.uri = uri
+        self.sasl_username = sasl_username
+        self.sasl_password = sasl_password
+        self.readonly = readonly
+
+    def __enter__(self):
+        self._slot = contextlib.ExitStack()
+        uri_limiter = limiter.get_limiter(self.uri)
+        if uri_limiter is not None:
+            self._slot.enter_context(
+                uri_limiter.acquire(priority=not self.readonly))
+
+        try:
+            self.conn = get_connection_pool().get(
+                self.uri, sasl_username=self.sasl_username,
+                sasl_password=self.sasl_password, readonly=self.readonly)
+
+        except BaseException:
+            self._slot.close()
+            raise
+
+        return self.conn
+
+    def __exit__(self, type, value, traceback):
+        try:
+            error = value if isinstance(value, libvirt.libvirtError) else None
+            get_connection_pool().release(self.conn, error=error)
+
+        finally:
+            self._slot.close()
+
+
+class ReadWriteLock(object):
+    """Lock shared by readers and exclusive to writers
+
+    Waiting writers block new readers, so that a steady stream of
+    readers can not starve writers.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writers_waiting = 0
+        self._writing = False
+
+    @contextlib.contextmanager
+    def read(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+        try:
+            yield
+
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                while self._writing or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writing = True
+
+        try:
+            yield
+
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+class ReplayCache(object):
+    """Recently sent IPMI responses, for replaying to retransmissions.
+
+    Entries expire `ttl` seconds after being stored. Entries may be
+    stored in a slot, which holds a single entry: a request coming in
+    with another key in the same slot drops the previous one. Once the
+    cache holds `max_size` entries, the oldest one is dropped; a
+    `max_size` of 0 disables the cache.
+    """
+
+    def __init__(self, max_size=256, ttl=2):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._slots = {}
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def _drop(self, key):
+        _, slot, _ = self._entries.pop(key)
+        if slot is not None and self._slots.get(slot) == key:
+            del self._slots[slot]
+
+    def _expire(self, now):
+        # Entries all live as long, the oldest ones expire first
+        while self._entries:
+            key, (expires_at, _, _) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+
+            self._drop(key)
+            self.stats['expirations'] += 1
+
+    def _claim(self, key, slot):
+        # Whatever else the slot held is not going to be asked again
+        stale = self._slots.get(slot)
+        if stale is not None and stale != key:
+            self._drop(stale)
+            self.stats['evictions'] += 1
+
+    def get(self, key, slot=None):
+        """Return the value stored under `key` or None"""
+        with self._lock:
+            self._expire(time.monotonic())
+            if slot is not None:
+                self._claim(key, slot)
+
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+
+            self.stats['hits'] += 1
+            return entry[2]
+
+    def put(self, key, value, slot=None):
+        if not self.max_size:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if slot is not None:
+                self._claim(key, slot)
+                self._slots[slot] = key
+
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, slot, value)
+
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+
+
 def get_libvirt_domain(conn, domain):
     try:
         return conn.lookupByName(domain)
@@ -66,8 +438,8 @@ def get_libvirt_domain(conn, domain):
 
 def check_libvirt_connection_and_domain(uri, domain, sasl_username=None,
                                         sasl_password=None):
-    with libvirt_open(uri, readonly=True, sasl_username=sasl_username,
-                      sasl_password=sasl_password) as conn:
+    with libvirt_connection(uri, readonly=True, sasl_username=sasl_username,
+                            sasl_password=sasl_password) as conn:
         get_libvirt_domain(conn, domain)
 
 
@@ -87,6 +459,21 @@ def str2bool(string):
     return lower == 'true'
 
 
+def _exit_on_signal(signum, frame):
+    sys.exit(0)
+
+
+def exit_on_sigterm():
+    """Have SIGTERM exit the process cleanly
+
+    The manager process installs a signal handler for SIGTERM to
+    propagate it to children. Rather than dying right away on it,
+    children unwind through SystemExit, so that the vBMCs they run get
+    closed and save their state.
+    """
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+
+
 def mask_dict_password(dictionary, secret='***'):
     """Replace passwords with a secret in a dictionary."""
     d = dictionary.copy()
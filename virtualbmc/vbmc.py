@@ -10,17 +10,34 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from concurrent import futures
+import os
+import struct
+import threading
+import time
 import xml.etree.ElementTree as ET
 
 import libvirt
 import pyghmi.ipmi.bmc as bmc
+import pyghmi.ipmi.command as ipmicommand
+import pyghmi.ipmi.private.session as ipmisession
 
+from virtualbmc import backends
+from virtualbmc import config as vbmc_config
+from virtualbmc import events
 from virtualbmc import exception
+from virtualbmc import inventory
 from virtualbmc import log
+from virtualbmc import sel
+from virtualbmc import sensors
+from virtualbmc import sol
+from virtualbmc import stats
 from virtualbmc import utils
 
 LOG = log.get_logger()
 
+CONF = vbmc_config.get_config()
+
 # Power states
 POWEROFF = 0
 POWERON = 1
@@ -33,6 +50,83 @@ POWERON = 1
 IPMI_COMMAND_NODE_BUSY = 0xC0
 # Invalid data field in request
 IPMI_INVALID_DATA = 0xcc
+# Request data length invalid
+IPMI_REQUEST_DATA_LENGTH_INVALID = 0xc7
+# Parameter out of range
+IPMI_PARAMETER_OUT_OF_RANGE = 0xc9
+# Requested sensor, data, or record not present
+IPMI_NOT_PRESENT = 0xcb
+# Reservation canceled or invalid reservation ID
+IPMI_INVALID_RESERVATION = 0xc5
+# Command or request parameters not supported in present state
+IPMI_NOT_SUPPORTED_IN_PRESENT_STATE = 0xd5
+# Activate/Deactivate Payload: payload already active or deactivated,
+# payload unavailable
+IPMI_PAYLOAD_ALREADY_ACTIVE = 0x80
+IPMI_PAYLOAD_ALREADY_DEACTIVATED = 0x80
+IPMI_PAYLOAD_UNAVAILABLE = 0x81
+
+# Network functions
+NETFN_SENSOR = 0x04
+NETFN_STORAGE = 0x0a
+NETFN_DCMI = 0x2c
+
+# Additional device support of the Get Device ID command: FRU
+# inventory device, SEL device, SDR repository device, sensor device
+ADDITIONAL_DEVICES = 0b00001111
+
+# Get Sensor Reading flags: events and scanning enabled, or reading
+# unavailable
+SENSOR_READING_AVAILABLE = 0b11000000
+SENSOR_READING_UNAVAILABLE = 0b00100000
+
+# Group extension identifying DCMI commands
+DCMI_GROUP_EXTENSION = 0xdc
+# Get Power Reading mode and reading state
+DCMI_SYSTEM_POWER_STATISTICS = 0x01
+DCMI_POWER_MEASUREMENT_ACTIVE = 0b01000000
+
+# Get SDR Repository Info: SDR version, reserve supported
+SDR_REPOSITORY_OPERATIONS = 0b00000010
+
+# Get SEL Info: reserve supported, overflow flag
+SEL_OPERATIONS = 0b00000010
+SEL_OVERFLOW = 0b10000000
+# Time of an addition or erase that never happened
+SEL_UNSPECIFIED_TIMESTAMP = 0xffffffff
+# Clear SEL: confirmation, erase actions and erasure status
+SEL_CLEAR_CONFIRMATION = b'CLR'
+SEL_INITIATE_ERASE = 0xaa
+SEL_GET_ERASE_STATUS = 0x00
+SEL_ERASE_COMPLETED = 0x01
+
+# Handlers of the commands not handled by pyghmi
+COMMAND_HANDLERS = {
+    (NETFN_STORAGE, 0x10): 'get_fru_inventory_area_info',
+    (NETFN_STORAGE, 0x11): 'read_fru_data',
+    (NETFN_SENSOR, 0x20): 'get_device_sdr_info',
+    (NETFN_SENSOR, 0x21): 'get_sdr',
+    (NETFN_SENSOR, 0x22): 'reserve_sdr_repository',
+    (NETFN_SENSOR, 0x2d): 'get_sensor_reading',
+    (NETFN_STORAGE, 0x20): 'get_sdr_repository_info',
+    (NETFN_STORAGE, 0x22): 'reserve_sdr_repository',
+    (NETFN_STORAGE, 0x23): 'get_sdr',
+    (NETFN_STORAGE, 0x40): 'get_sel_info',
+    (NETFN_STORAGE, 0x42): 'reserve_sel',
+    (NETFN_STORAGE, 0x43): 'get_sel_entry',
+    (NETFN_STORAGE, 0x47): 'clear_sel',
+    (NETFN_STORAGE, 0x48): 'get_sel_time',
+    (NETFN_DCMI, 0x02): 'get_dcmi_power_reading',
+}
+
+# Boot flags parameter of the Get/Set System Boot Options commands
+BOOT_FLAGS_PARAMETER = 5
+BOOT_FLAGS_VALID = 0b10000000
+BOOT_FLAGS_PERSISTENT = 0b01000000
+
+# Commands never replayed to retransmissions (activate and deactivate
+# payload), they set up state tied to the session
+REPLAY_EXCLUDED_COMMANDS = frozenset([(6, 0x48), (6, 0x49)])
 
 # Boot device maps
 GET_BOOT_DEVICES_MAP = {
@@ -47,12 +141,104 @@ SET_BOOT_DEVICES_MAP = {
     'optical': 'cdrom',
 }
 
+# Domain lifecycle events after which the cached power state is stale
+POWER_STATE_EVENTS = (
+    libvirt.VIR_DOMAIN_EVENT_UNDEFINED,
+    libvirt.VIR_DOMAIN_EVENT_STARTED,
+    libvirt.VIR_DOMAIN_EVENT_STOPPED,
+    libvirt.VIR_DOMAIN_EVENT_SHUTDOWN,
+    libvirt.VIR_DOMAIN_EVENT_CRASHED,
+)
+
+# Domain lifecycle events after which the cached boot settings are stale
+BOOT_SETTINGS_EVENTS = (
+    libvirt.VIR_DOMAIN_EVENT_DEFINED,
+    libvirt.VIR_DOMAIN_EVENT_UNDEFINED,
+)
+
+# SEL entries logged on domain events
+DOMAIN_EVENT_SEL_EVENTS = {
+    libvirt.VIR_DOMAIN_EVENT_STARTED: sel.POWER_ON,
+    libvirt.VIR_DOMAIN_EVENT_STOPPED: sel.POWER_OFF,
+    libvirt.VIR_DOMAIN_EVENT_CRASHED: sel.CRITICAL_STOP,
+    events.REBOOT_EVENT: sel.SYSTEM_RESTART,
+}
+
+# SEL entries logged on watchdog events, by watchdog action
+WATCHDOG_SEL_EVENTS = {
+    libvirt.VIR_DOMAIN_EVENT_WATCHDOG_RESET: sel.WATCHDOG_RESET,
+    libvirt.VIR_DOMAIN_EVENT_WATCHDOG_POWEROFF: sel.WATCHDOG_POWER_DOWN,
+    libvirt.VIR_DOMAIN_EVENT_WATCHDOG_SHUTDOWN: sel.WATCHDOG_POWER_DOWN,
+}
+
+# SEL entries logged on completion of power actions, when domain
+# events do not tell
+POWER_ACTION_SEL_EVENTS = {
+    'on': sel.POWER_ON,
+    'off': sel.POWER_OFF,
+    'reset': sel.HARD_RESET,
+}
+
+# Domain lifecycle events after which the cached inventory is stale
+INVENTORY_EVENTS = BOOT_SETTINGS_EVENTS
+
+# Size of the domain XML chunks fed to the parser
+XML_PARSE_CHUNK_SIZE = 4096
+
+
+def parse_boot_settings(domain_xml):
+    """Extract the boot settings from a domain XML description.
+
+    The XML is parsed incrementally and parsing stops at the end of
+    the `<os>` element, so that the (possibly large) device list that
+    follows it is never looked at.
+
+    :param domain_xml: The domain XML description
+    :returns: A dictionary with the boot settings
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    depth = 0
+
+    for offset in range(0, len(domain_xml), XML_PARSE_CHUNK_SIZE):
+        parser.feed(domain_xml[offset:offset + XML_PARSE_CHUNK_SIZE])
+
+        for event, element in parser.read_events():
+            if event == 'start':
+                depth += 1
+                continue
+
+            depth -= 1
+            # Only the <os> element right under <domain> is of interest
+            if element.tag == 'os' and depth == 1:
+                boot_element = element.find('boot')
+                boot_dev = None
+                if boot_element is not None:
+                    boot_dev = boot_element.attrib.get('dev')
+                return {'boot_dev': boot_dev}
+
+    return {'boot_dev': None}
+
+
+class _ResponseRecorder(object):
+    """Proxy to an IPMI session recording the responses sent"""
+
+    def __init__(self, session):
+        self._session = session
+        self.responses = []
+
+    def send_ipmi_response(self, data=(), code=0):
+        self.responses.append({'data': bytes(data), 'code': code})
+        self._session.send_ipmi_response(data=data, code=code)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
 
 class VirtualBMC(bmc.Bmc):
 
     def __init__(self, username, password, port, address,
                  domain_name, libvirt_uri, libvirt_sasl_username=None,
-                 libvirt_sasl_password=None, **kwargs):
+                 libvirt_sasl_password=None, qmp_socket=None, **kwargs):
         super(VirtualBMC, self).__init__({username: password},
                                          port=port, address=address)
         self.domain_name = domain_name
@@ -60,31 +246,449 @@ class VirtualBMC(bmc.Bmc):
                            'sasl_username': libvirt_sasl_username,
                            'sasl_password': libvirt_sasl_password}
 
-    # Copied from nova/virt/libvirt/guest.py
-    def get_xml_desc(self, domain, dump_sensitive=False):
-        """Returns xml description of guest.
+        self._power_state = None
+        self._power_state_generation = 0
+        self._boot_settings = None
+        self._boot_settings_generation = 0
+        # One-time boot device, applied on the next power on or reset
+        self._boot_override = None
+        # Power action in progress and the thread running it
+        self._power_action = None
+        self._power_lock = threading.Lock()
+        self._power_worker = None
+        self._replay_cache = utils.ReplayCache(
+            max_size=CONF['ipmi']['replay_cache_size'],
+            ttl=CONF['ipmi']['replay_cache_ttl'])
+        self.additionaldevices = ADDITIONAL_DEVICES
+        # FRU data and SDRs, built off the domain definition
+        self._inventory = None
+        self._inventory_generation = 0
+        self._sdr_reservation = 0
+        self._sel = sel.SystemEventLog(
+            CONF['ipmi']['sel_capacity'],
+            path=os.path.join(CONF['default']['config_dir'], domain_name,
+                              'sel'),
+            save_interval=CONF['ipmi']['sel_save_interval'])
+        self._sel_reservation = 0
+        self._backend = backends.get_backend(domain_name, self._conn_args,
+                                             qmp_socket=qmp_socket)
+        self._stats = None
+        if CONF['sensors']['interval'] and self._backend.libvirt_domain:
+            # Readings older than a few collections are stale
+            self._stats = stats.StatsReader(
+                stats.get_table_path(libvirt_uri), domain_name,
+                max_age=3 * CONF['sensors']['interval'])
+        # Serial-over-LAN session, if activated
+        self.sol = None
+        self._events = None
+        if CONF['libvirt']['domain_events'] and self._backend.libvirt_domain:
+            self._events = events.get_event_monitor(**self._conn_args)
+            self._events.subscribe(domain_name, self._handle_domain_event)
+
+    def close(self):
+        """Stop serving IPMI requests and release the BMC resources.
 
-        :param domain: The libvirt domain to call
-        :param dump_sensitive: Dump security sensitive information
-        :returns string: XML description of the guest
+        Saves the SEL, so it is also called when the process running
+        the BMC exits.
         """
-        flags = dump_sensitive and libvirt.VIR_DOMAIN_XML_SECURE or 0
-        return domain.XMLDesc(flags=flags)
+        if self._events is not None:
+            self._events.unsubscribe(self.domain_name,
+                                     self._handle_domain_event)
+
+        if self._power_worker is not None:
+            self._power_worker.shutdown(wait=False)
+
+        self._sel.close()
+        self._backend.close()
+
+        if self.sol is not None:
+            self.sol.close()
+
+        sock = self.serversocket
+        ipmisession.Session.bmc_handlers.pop(sock, None)
+        for handlers in ipmisession.Session.bmc_handlers.values():
+            if getattr(handlers.get(self.port), 'bmc', None) is self:
+                del handlers[self.port]
+
+        if sock in ipmisession.iosockets:
+            ipmisession.iosockets.remove(sock)
+
+        sock.close()
+
+    def handle_raw_request(self, request, session):
+        command = (request['netfn'], request['command'])
+        if command in REPLAY_EXCLUDED_COMMANDS:
+            return super(VirtualBMC, self).handle_raw_request(request,
+                                                              session)
+
+        # A client retransmits a request with the same sequence number.
+        # Sequence numbers wrap every 64 requests, and clients wait for
+        # the response before sending their next request, so only the
+        # last request of a session may come in again.
+        sessionid = getattr(session, 'sessionid', None)
+        key = (sessionid, getattr(session, 'seqlun', None),
+               request['netfn'], request['command'], bytes(request['data']))
+
+        response = self._replay_cache.get(key, slot=sessionid)
+        if response is not None:
+            LOG.debug('Replaying the response to netfn %(netfn)#x command '
+                      '%(command)#x for domain %(domain)s, %(hits)d '
+                      'request(s) replayed so far',
+                      {'netfn': request['netfn'],
+                       'command': request['command'],
+                       'domain': self.domain_name,
+                       'hits': self._replay_cache.stats['hits']})
+            session.send_ipmi_response(**response)
+            return
+
+        recorder = _ResponseRecorder(session)
+        self._handle_request(request, recorder)
+
+        # Busy nodes are asked again, so are failed requests
+        if (len(recorder.responses) == 1
+                and recorder.responses[0]['code'] != IPMI_COMMAND_NODE_BUSY):
+            self._replay_cache.put(key, recorder.responses[0],
+                                   slot=sessionid)
+
+    def _handle_request(self, request, session):
+        handler = COMMAND_HANDLERS.get((request['netfn'],
+                                        request['command']))
+        if handler is None:
+            return super(VirtualBMC, self).handle_raw_request(request,
+                                                              session)
+
+        try:
+            getattr(self, handler)(request['data'], session)
+
+        except IndexError:
+            session.send_ipmi_response(code=IPMI_REQUEST_DATA_LENGTH_INVALID)
+
+        except Exception as ex:
+            LOG.exception('Failed to handle netfn %(netfn)#x command '
+                          '%(command)#x for domain %(domain)s: %(error)s',
+                          {'netfn': request['netfn'],
+                           'command': request['command'],
+                           'domain': self.domain_name, 'error': ex})
+            session.send_ipmi_response(code=0xff)
+
+    def activate_payload(self, request, session):
+        if self.sol is not None:
+            return session.send_ipmi_response(
+                code=IPMI_PAYLOAD_ALREADY_ACTIVE)
+
+        if not self._backend.libvirt_domain:
+            return session.send_ipmi_response(code=IPMI_PAYLOAD_UNAVAILABLE)
+
+        try:
+            sol_console = sol.SolConsole(
+                session, self.domain_name, self._conn_args,
+                CONF['ipmi']['sol_buffer_size'], on_close=self._sol_closed)
+
+        except exception.LibvirtConnectionOpenError as ex:
+            LOG.error('Failed to activate SOL for domain %(domain)s. '
+                      'Error: %(error)s',
+                      {'domain': self.domain_name, 'error': ex})
+            return session.send_ipmi_response(code=IPMI_PAYLOAD_UNAVAILABLE)
+
+        self.sol = sol_console
+        self.activated = True
+        LOG.info('SOL activated for domain %(domain)s',
+                 {'domain': self.domain_name})
+
+        # Payload sizes, port and no VLAN
+        session.send_ipmi_response(data=struct.pack(
+            '<4xHHHH', sol.SOL_PAYLOAD_SIZE, sol.SOL_PAYLOAD_SIZE,
+            self.port, 0xffff))
+
+        # Console output only follows the activation response
+        sol_console.start()
+
+    def deactivate_payload(self, request, session):
+        sol_console = self.sol
+        if sol_console is None:
+            return session.send_ipmi_response(
+                code=IPMI_PAYLOAD_ALREADY_DEACTIVATED)
+
+        session.send_ipmi_response()
+        sol_console.close()
+
+    def _sol_closed(self, sol_console):
+        if self.sol is sol_console:
+            self.sol = None
+            self.activated = False
+            LOG.info('SOL deactivated for domain %(domain)s',
+                     {'domain': self.domain_name})
+
+    def _get_stats(self):
+        if self._stats is None:
+            return None
+
+        return self._stats.read()
+
+    def get_sensor_reading(self, data, session):
+        sensor = sensors.SENSORS_BY_NUMBER.get(data[0])
+        if sensor is None:
+            return session.send_ipmi_response(code=IPMI_NOT_PRESENT)
+
+        domain_stats = self._get_stats()
+        if domain_stats is None:
+            return session.send_ipmi_response(
+                data=[0, SENSOR_READING_UNAVAILABLE, 0])
+
+        session.send_ipmi_response(
+            data=[sensors.raw_reading(sensor, domain_stats),
+                  SENSOR_READING_AVAILABLE, 0])
+
+    def _get_inventory(self, refresh=False):
+        """Return the FRU data and SDRs of the domain
+
+        They are built once and kept until the domain gets redefined. As
+        redefinitions go unnoticed without domain events, they are then
+        rebuilt on `refresh`, which is asked for by the commands clients
+        start reading the FRU data or SDRs with.
+        """
+        events_alive = self._events is not None and self._events.connect()
+        if self._inventory is not None and (events_alive or not refresh):
+            return self._inventory
+
+        generation = self._inventory_generation
+
+        try:
+            domain_xml = self._backend.get_definition()
+
+        except exception.VirtualBMCError as ex:
+            LOG.warning('Error getting the definition of domain %(domain)s, '
+                        'serving sensor SDRs only. Error: %(error)s',
+                        {'domain': self.domain_name, 'error': ex})
+            # Not kept, the next request tries again
+            return inventory.Inventory()
+
+        domain_inventory = inventory.Inventory(domain_xml)
+
+        # Only keep the inventory if no event raced with the query
+        if generation == self._inventory_generation:
+            self._inventory = domain_inventory
+
+        return domain_inventory
+
+    def get_device_sdr_info(self, data, session):
+        # Static sensor population, sensors on LUN 0
+        session.send_ipmi_response(data=[len(sensors.SENSORS), 0x01])
+
+    def get_sdr_repository_info(self, data, session):
+        sdr = self._get_inventory(refresh=True).sdr
+        session.send_ipmi_response(
+            data=[sensors.SDR_VERSION, len(sdr) & 0xff, len(sdr) >> 8,
+                  0, 0, 0, 0, 0, 0, 0, 0, 0, 0, SDR_REPOSITORY_OPERATIONS])
+
+    def reserve_sdr_repository(self, data, session):
+        # Records never change, reservations are only handed out for
+        # the sake of the clients asking for them
+        self._sdr_reservation = self._sdr_reservation % 0xffff + 1
+        session.send_ipmi_response(
+            data=[self._sdr_reservation & 0xff, self._sdr_reservation >> 8])
+
+    def get_sdr(self, data, session):
+        record_id = data[2] | data[3] << 8
+        try:
+            next_id, record = self._get_inventory().sdr.get(
+                record_id, data[4], data[5])
+
+        except KeyError:
+            return session.send_ipmi_response(code=IPMI_NOT_PRESENT)
+
+        except IndexError:
+            return session.send_ipmi_response(
+                code=IPMI_PARAMETER_OUT_OF_RANGE)
+
+        session.send_ipmi_response(
+            data=bytes([next_id & 0xff, next_id >> 8]) + record)
+
+    def get_fru_inventory_area_info(self, data, session):
+        fru = self._get_inventory(refresh=True).fru
+        if data[0] != inventory.FRU_DEVICE_ID or fru is None:
+            return session.send_ipmi_response(code=IPMI_NOT_PRESENT)
+
+        # Accessed by bytes
+        session.send_ipmi_response(data=[len(fru) & 0xff, len(fru) >> 8, 0])
+
+    def read_fru_data(self, data, session):
+        domain_inventory = self._get_inventory()
+        if data[0] != inventory.FRU_DEVICE_ID or domain_inventory.fru is None:
+            return session.send_ipmi_response(code=IPMI_NOT_PRESENT)
+
+        offset = data[1] | data[2] << 8
+        try:
+            fru_data = domain_inventory.read_fru(offset, data[3])
+
+        except IndexError:
+            return session.send_ipmi_response(
+                code=IPMI_PARAMETER_OUT_OF_RANGE)
+
+        session.send_ipmi_response(data=bytes([len(fru_data)]) + fru_data)
+
+    def get_dcmi_power_reading(self, data, session):
+        if (data[0] != DCMI_GROUP_EXTENSION
+                or data[1] != DCMI_SYSTEM_POWER_STATISTICS):
+            return session.send_ipmi_response(code=IPMI_INVALID_DATA)
+
+        domain_stats = self._get_stats()
+        if domain_stats is None:
+            readings = [0, 0, 0, 0]
+            timestamp = int(time.time())
+            state = 0
+        else:
+            readings = [int(round(domain_stats[field])) for field in
+                        ('power', 'power_min', 'power_max', 'power_avg')]
+            timestamp = int(domain_stats['timestamp'])
+            state = DCMI_POWER_MEASUREMENT_ACTIVE
+
+        period = CONF['sensors']['interval'] * stats.POWER_SAMPLES * 1000
+        session.send_ipmi_response(
+            data=bytes([DCMI_GROUP_EXTENSION])
+            + struct.pack('<4HIIB', *(readings + [timestamp, period, state])))
+
+    def get_sel_info(self, data, session):
+        session.send_ipmi_response(data=struct.pack(
+            '<BHHIIB', sel.SEL_VERSION, len(self._sel),
+            min(self._sel.free_space, 0xffff),
+            self._sel.last_addition or SEL_UNSPECIFIED_TIMESTAMP,
+            self._sel.last_erase or SEL_UNSPECIFIED_TIMESTAMP,
+            SEL_OPERATIONS | (SEL_OVERFLOW if self._sel.overflow else 0)))
+
+    def reserve_sel(self, data, session):
+        self._sel_reservation = self._sel_reservation % 0xffff + 1
+        session.send_ipmi_response(
+            data=[self._sel_reservation & 0xff, self._sel_reservation >> 8])
+
+    def get_sel_entry(self, data, session):
+        record_id = data[2] | data[3] << 8
+        offset, count = data[4], data[5]
+        with self._sel.lock:
+            try:
+                next_id, entry = self._sel.get(record_id, offset, count)
+
+            except KeyError:
+                return session.send_ipmi_response(code=IPMI_NOT_PRESENT)
+
+            except IndexError:
+                return session.send_ipmi_response(
+                    code=IPMI_PARAMETER_OUT_OF_RANGE)
+
+            response = bytes([next_id & 0xff, next_id >> 8]) + entry
+
+        session.send_ipmi_response(data=response)
+
+    def clear_sel(self, data, session):
+        action = data[5]
+        if data[0] | data[1] << 8 != self._sel_reservation:
+            return session.send_ipmi_response(code=IPMI_INVALID_RESERVATION)
+
+        if (bytes(data[2:5]) != SEL_CLEAR_CONFIRMATION
+                or action not in (SEL_INITIATE_ERASE, SEL_GET_ERASE_STATUS)):
+            return session.send_ipmi_response(code=IPMI_INVALID_DATA)
+
+        if action == SEL_INITIATE_ERASE:
+            LOG.info('Clearing the SEL of domain %(domain)s',
+                     {'domain': self.domain_name})
+            self._sel.clear()
+
+        # Erasure is immediate
+        session.send_ipmi_response(data=[SEL_ERASE_COMPLETED])
+
+    def get_sel_time(self, data, session):
+        session.send_ipmi_response(data=struct.pack('<I', int(time.time())))
+
+    def _handle_domain_event(self, event, detail):
+        # NOTE: called from the libvirt event loop thread, event is None
+        # when the event channel is lost
+        if event == events.WATCHDOG_EVENT:
+            self._sel.add(WATCHDOG_SEL_EVENTS.get(detail,
+                                                  sel.WATCHDOG_EXPIRED))
+        elif event in DOMAIN_EVENT_SEL_EVENTS:
+            self._sel.add(DOMAIN_EVENT_SEL_EVENTS[event])
+
+        if event is None or event in POWER_STATE_EVENTS:
+            self._invalidate_power_state()
+        if event is None or event in BOOT_SETTINGS_EVENTS:
+            self._invalidate_boot_settings()
+        if event is None or event in INVENTORY_EVENTS:
+            self._invalidate_inventory()
+
+    def _invalidate_power_state(self):
+        self._power_state = None
+        self._power_state_generation += 1
+
+    def _invalidate_boot_settings(self):
+        self._boot_settings = None
+        self._boot_settings_generation += 1
+
+    def _invalidate_inventory(self):
+        self._inventory = None
+        self._inventory_generation += 1
+
+    def _get_boot_settings(self):
+        events_alive = self._events is not None and self._events.connect()
+        if events_alive and self._boot_settings is not None:
+            return self._boot_settings
+
+        generation = self._boot_settings_generation
+
+        boot_settings = parse_boot_settings(self._backend.get_definition())
+
+        # Only cache the result if no event raced with the query
+        if (events_alive and self._events.alive
+                and generation == self._boot_settings_generation):
+            self._boot_settings = boot_settings
+
+        return boot_settings
 
     def get_boot_device(self):
         LOG.debug('Get boot device called for %(domain)s',
                   {'domain': self.domain_name})
-        with utils.libvirt_open(readonly=True, **self._conn_args) as conn:
-            domain = utils.get_libvirt_domain(conn, self.domain_name)
-            boot_element = ET.fromstring(domain.XMLDesc()).find('.//os/boot')
-            boot_dev = None
-            if boot_element is not None:
-                boot_dev = boot_element.attrib.get('dev')
-            return GET_BOOT_DEVICES_MAP.get(boot_dev, 0)
-
-    def _remove_boot_elements(self, parent_element):
-        for boot_element in parent_element.findall('boot'):
-            parent_element.remove(boot_element)
+        boot_dev = self._get_boot_settings()['boot_dev']
+        return GET_BOOT_DEVICES_MAP.get(boot_dev, 0)
+
+    def get_system_boot_options(self, request, session):
+        if request['data'][0] != BOOT_FLAGS_PARAMETER:
+            return super(VirtualBMC, self).get_system_boot_options(
+                request, session)
+
+        boot_override = self._boot_override
+        if boot_override is not None:
+            flags = BOOT_FLAGS_VALID
+            bootdevice = GET_BOOT_DEVICES_MAP.get(boot_override, 0)
+        else:
+            flags = BOOT_FLAGS_VALID | BOOT_FLAGS_PERSISTENT
+            bootdevice = self.get_boot_device()
+
+        session.send_ipmi_response(data=[1, BOOT_FLAGS_PARAMETER, flags,
+                                         bootdevice, 0, 0, 0])
+
+    def set_system_boot_options(self, request, session):
+        if (request['data'][0] != BOOT_FLAGS_PARAMETER
+                or request['data'][1] & BOOT_FLAGS_PERSISTENT):
+            return super(VirtualBMC, self).set_system_boot_options(
+                request, session)
+
+        if not request['data'][1] & BOOT_FLAGS_VALID:
+            # The boot flags are being cleared
+            self._boot_override = None
+            session.send_ipmi_response()
+            return
+
+        bootdevice = ipmicommand.boot_devices.get(
+            (request['data'][2] >> 2) & 0b1111)
+        device = SET_BOOT_DEVICES_MAP.get(bootdevice)
+        if device is None:
+            session.send_ipmi_response(code=IPMI_INVALID_DATA)
+            return
+
+        LOG.debug('One-time boot device "%(bootdev)s" set for domain '
+                  '%(domain)s', {'domain': self.domain_name,
+                                 'bootdev': bootdevice})
+        self._boot_override = device
+        session.send_ipmi_response()
 
     def set_boot_device(self, bootdevice):
         LOG.debug('Set boot device called for %(domain)s with boot '
@@ -95,27 +699,21 @@ class VirtualBMC(bmc.Bmc):
             # Invalid data field in request
             return IPMI_INVALID_DATA
 
+        # A persistent boot device replaces any pending one-time one
+        self._boot_override = None
+        self._invalidate_boot_settings()
         try:
-            with utils.libvirt_open(**self._conn_args) as conn:
-                domain = utils.get_libvirt_domain(conn, self.domain_name)
-                tree = ET.fromstring(
-                    self.get_xml_desc(domain, dump_sensitive=True))
-
-                # Remove all "boot" element under "devices"
-                # They are mutually exclusive with "os/boot"
-                for device_element in tree.findall('devices/*'):
-                    self._remove_boot_elements(device_element)
-
-                for os_element in tree.findall('os'):
-                    # Remove all "boot" elements under "os"
-                    self._remove_boot_elements(os_element)
-
-                    # Add a new boot element with the request boot device
-                    boot_element = ET.SubElement(os_element, 'boot')
-                    boot_element.set('dev', device)
-
-                conn.defineXML(ET.tostring(tree, encoding="unicode"))
-        except libvirt.libvirtError:
+            if not self._backend.set_boot_device(device):
+                LOG.debug('Domain %(domain)s already boots from '
+                          '%(bootdev)s, not redefining it',
+                          {'domain': self.domain_name, 'bootdev': device})
+                return
+
+        except exception.OperationNotSupported as ex:
+            LOG.error(str(ex))
+            return IPMI_NOT_SUPPORTED_IN_PRESENT_STATE
+
+        except exception.BackendError:
             LOG.error('Failed setting the boot device  %(bootdev)s for '
                       'domain %(domain)s', {'bootdev': device,
                                             'domain': self.domain_name})
@@ -125,91 +723,138 @@ class VirtualBMC(bmc.Bmc):
     def get_power_state(self):
         LOG.debug('Get power state called for domain %(domain)s',
                   {'domain': self.domain_name})
+
+        events_alive = self._events is not None and self._events.connect()
+        if events_alive and self._power_state is not None:
+            return self._power_state
+
+        generation = self._power_state_generation
+        power_state = POWEROFF
+
         try:
-            with utils.libvirt_open(readonly=True, **self._conn_args) as conn:
-                domain = utils.get_libvirt_domain(conn, self.domain_name)
-                if domain.isActive():
-                    return POWERON
-        except libvirt.libvirtError as e:
+            if self._backend.is_active():
+                power_state = POWERON
+        except exception.BackendError as e:
             msg = ('Error getting the power state of domain %(domain)s. '
                    'Error: %(error)s' % {'domain': self.domain_name,
                                          'error': e})
             LOG.error(msg)
             raise exception.VirtualBMCError(message=msg)
 
-        return POWEROFF
+        # Only cache the result if no event raced with the query
+        if (events_alive and self._events.alive
+                and generation == self._power_state_generation):
+            self._power_state = power_state
+
+        return power_state
 
     def pulse_diag(self):
         LOG.debug('Power diag called for domain %(domain)s',
                   {'domain': self.domain_name})
         try:
-            with utils.libvirt_open(**self._conn_args) as conn:
-                domain = utils.get_libvirt_domain(conn, self.domain_name)
-                if domain.isActive():
-                    domain.injectNMI()
-        except libvirt.libvirtError as e:
+            self._backend.inject_nmi()
+        except exception.BackendError as e:
             LOG.error('Error powering diag the domain %(domain)s. '
                       'Error: %(error)s', {'domain': self.domain_name,
                                            'error': e})
             # Command failed, but let client to retry
             return IPMI_COMMAND_NODE_BUSY
 
+    def _boot_override_done(self, boot_override):
+        # Unless another one got set meanwhile
+        if boot_override is not None and self._boot_override == boot_override:
+            self._boot_override = None
+
+    def _dispatch_power_action(self, action, func):
+        """Run a power action in the background.
+
+        The IPMI response does not wait for libvirt: the action runs in
+        the power worker of this BMC. A request for the action already
+        in progress is folded into it, any other power action is refused
+        until it is over.
+        """
+        with self._power_lock:
+            in_progress = self._power_action
+            if in_progress is not None:
+                if in_progress == action:
+                    LOG.debug('Power %(action)s already in progress for '
+                              'domain %(domain)s',
+                              {'action': action, 'domain': self.domain_name})
+                    return
+
+                LOG.debug('Refusing power %(action)s for domain %(domain)s, '
+                          'power %(in_progress)s in progress',
+                          {'action': action, 'domain': self.domain_name,
+                           'in_progress': in_progress})
+                return IPMI_COMMAND_NODE_BUSY
+
+            if self._power_worker is None:
+                self._power_worker = futures.ThreadPoolExecutor(
+                    max_workers=1,
+                    thread_name_prefix='vbmc-power-%s' % self.domain_name)
+
+            self._power_action = action
+            future = self._power_worker.submit(func)
+
+        future.add_done_callback(
+            lambda future: self._power_action_done(action, future))
+
+    def _power_action_done(self, action, future):
+        with self._power_lock:
+            self._power_action = None
+
+        try:
+            future.result()
+        except Exception as e:
+            LOG.error('Power %(action)s of domain %(domain)s failed. '
+                      'Error: %(error)s', {'action': action,
+                                           'domain': self.domain_name,
+                                           'error': e})
+            return
+
+        # Domain events log the power actions of any origin
+        if ((self._events is None or not self._events.alive)
+                and action in POWER_ACTION_SEL_EVENTS):
+            self._sel.add(POWER_ACTION_SEL_EVENTS[action])
+
     def power_off(self):
         LOG.debug('Power off called for domain %(domain)s',
                   {'domain': self.domain_name})
-        try:
-            with utils.libvirt_open(**self._conn_args) as conn:
-                domain = utils.get_libvirt_domain(conn, self.domain_name)
-                if domain.isActive():
-                    domain.destroy()
-        except libvirt.libvirtError as e:
-            LOG.error('Error powering off the domain %(domain)s. '
-                      'Error: %(error)s', {'domain': self.domain_name,
-                                           'error': e})
-            # Command failed, but let client to retry
-            return IPMI_COMMAND_NODE_BUSY
+        return self._dispatch_power_action('off', self._power_off)
 
     def power_on(self):
         LOG.debug('Power on called for domain %(domain)s',
                   {'domain': self.domain_name})
-        try:
-            with utils.libvirt_open(**self._conn_args) as conn:
-                domain = utils.get_libvirt_domain(conn, self.domain_name)
-                if not domain.isActive():
-                    domain.create()
-        except libvirt.libvirtError as e:
-            LOG.error('Error powering on the domain %(domain)s. '
-                      'Error: %(error)s', {'domain': self.domain_name,
-                                           'error': e})
-            # Command failed, but let client to retry
-            return IPMI_COMMAND_NODE_BUSY
+        return self._dispatch_power_action('on', self._power_on)
 
     def power_shutdown(self):
         LOG.debug('Soft power off called for domain %(domain)s',
                   {'domain': self.domain_name})
-        try:
-            with utils.libvirt_open(**self._conn_args) as conn:
-                domain = utils.get_libvirt_domain(conn, self.domain_name)
-                if domain.isActive():
-                    domain.shutdown()
-        except libvirt.libvirtError as e:
-            LOG.error('Error soft powering off the domain %(domain)s. '
-                      'Error: %(error)s', {'domain': self.domain_name,
-                                           'error': e})
-            # Command failed, but let client to retry
-            return IPMI_COMMAND_NODE_BUSY
+        return self._dispatch_power_action('shutdown', self._power_shutdown)
 
     def power_reset(self):
         LOG.debug('Power reset called for domain %(domain)s',
                   {'domain': self.domain_name})
-        try:
-            with utils.libvirt_open(**self._conn_args) as conn:
-                domain = utils.get_libvirt_domain(conn, self.domain_name)
-                if domain.isActive():
-                    domain.reset()
-        except libvirt.libvirtError as e:
-            LOG.error('Error reseting the domain %(domain)s. '
-                      'Error: %(error)s', {'domain': self.domain_name,
-                                           'error': e})
-            # Command not supported in present state
-            return IPMI_COMMAND_NODE_BUSY
+        return self._dispatch_power_action('reset', self._power_reset)
+
+    # The power actions run in the power worker, which logs their
+    # errors and only logs their events once they succeeded
+
+    def _power_off(self):
+        self._invalidate_power_state()
+        self._backend.power_off()
+
+    def _power_on(self):
+        self._invalidate_power_state()
+        boot_override = self._boot_override
+        if self._backend.power_on(boot_device=boot_override):
+            self._boot_override_done(boot_override)
+
+    def _power_shutdown(self):
+        self._invalidate_power_state()
+        self._backend.shutdown()
+
+    def _power_reset(self):
+        boot_override = self._boot_override
+        if self._backend.reset(boot_device=boot_override):
+            self._boot_override_done(boot_override)